@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Admin bulk export of whole CKAN organizations or search queries to Zenodo.
+
+Pages through CKAN package_search lazily (one page of --rows packages in
+memory at a time, oldest first), plans a deposition for every package — a new
+one per package from its title and description, or the existing --deposition-id
+for all of them — and queues each resource as an ordinary transfer through
+export_to_zenodo, so the worker, scheduler, off-peak windows and duplicate
+checks apply exactly as for exports from the web UI. Resources are queued in
+batches of --batch-size with at most --concurrency exports in flight.
+
+Progress is appended to a JSON-lines manifest: the run's query, every created
+deposition (written before any of its files are queued), each resource's
+outcome and each finished page. Re-running with the same --manifest continues
+where a crashed or interrupted run stopped: it resumes at the first unfinished
+page, reuses the depositions it created and does not queue finished resources
+again. Resources that failed with an unexpected error (e.g. CKAN or the
+database was unreachable) are not recorded, so they are retried on resume.
+
+With --plan nothing is queued or created: every package is planned with the
+dry-run planner and a summary of bytes, problem files and projected upload time
+is printed. No manifest or Zenodo token is needed.
+
+The Zenodo token is read from the ZENODO_API_KEY environment variable.
+
+Usage:
+    python3 -m ckan_zenodo bulk-export --organization hiperact --plan
+    python3 -m ckan_zenodo bulk-export --organization hiperact --user alice --manifest hiperact.jsonl
+    python3 -m ckan_zenodo bulk-export --query 'tags:climate' --user alice --manifest climate.jsonl \\
+        --deposition-id 1234567 --concurrency 8
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+import threading
+import concurrent.futures
+import ckan_zenodo
+import planner
+import preflight
+
+
+def iter_pages(q, fq, rows=100, start=0):
+    """Yield (start, packages) for each page of the search, fetching a page only when it is needed."""
+    while True:
+        result = ckan_zenodo.search_ckan_packages(q=q, fq=fq, rows=rows, start=start)
+        packages = result.get('results', [])
+        if not packages:
+            return
+        yield start, packages
+        start += len(packages)
+        if start >= result.get('count', 0):
+            return
+
+
+class Manifest:
+    """Append-only JSON-lines record of a bulk export, replayed on load."""
+
+    def __init__(self, path):
+        self.path = path
+        self.run = None
+        self.next_start = 0
+        self.depositions = {}
+        self.resources = {}
+        self.done_packages = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._replay()
+        self._fh = open(path, 'a')
+
+    def _replay(self):
+        with open(self.path) as fh:
+            for line in fh:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # A run killed mid-write leaves a truncated last line
+                    logging.warning(f"Ignoring an incomplete line in {self.path}")
+                    continue
+                self._apply(event)
+
+    def _apply(self, event):
+        kind = event['event']
+        if kind == 'run':
+            self.run = event['query']
+        elif kind == 'deposition':
+            self.depositions[event['package_id']] = (event['deposition_id'], event['deposition_name'])
+        elif kind == 'resource':
+            self.resources[event['resource_id']] = event['outcome']
+        elif kind == 'package_done':
+            self.done_packages.add(event['package_id'])
+        elif kind == 'page':
+            self.next_start = event['next_start']
+
+    def record(self, event, sync=False):
+        """Append an event (and apply it); sync forces it to disk before returning."""
+        with self._lock:
+            self._apply(event)
+            self._fh.write(json.dumps(event) + '\n')
+            self._fh.flush()
+            if sync:
+                os.fsync(self._fh.fileno())
+
+    def sync(self):
+        with self._lock:
+            os.fsync(self._fh.fileno())
+
+    def close(self):
+        self._fh.close()
+
+
+class BulkExport:
+    """Plans depositions and queues the resources of every package a search returns."""
+
+    def __init__(self, zenodo_apikey, user, manifest, creator, deposition_id=None, upload_type=None,
+                 access_right=None, batch_size=50, concurrency=4):
+        self.zenodo_apikey = zenodo_apikey
+        self.user = user
+        self.manifest = manifest
+        self.creator = creator
+        self.deposition_id = deposition_id
+        self.upload_type = upload_type
+        self.access_right = access_right
+        self.batch_size = max(batch_size, 1)
+        self.concurrency = max(concurrency, 1)
+        self.counts = {'queued': 0, 'skipped': 0, 'failed': 0, 'errors': 0, 'resumed': 0}
+        self._shared_deposition_name = None
+
+    def run(self, query, q, fq, rows=100):
+        """Export every package of the search; returns the counts of this run."""
+        if self.manifest.run is None:
+            self.manifest.record({'event': 'run', 'query': query}, sync=True)
+        elif self.manifest.run != query:
+            raise ValueError(f"{self.manifest.path} belongs to another run ({self.manifest.run}); "
+                             f"use a new manifest for this query")
+        if self.manifest.next_start:
+            logging.info(f"Resuming at package {self.manifest.next_start}")
+
+        advance = True
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for start, packages in iter_pages(q, fq, rows=rows, start=self.manifest.next_start):
+                if not self.export_page(pool, packages) and advance:
+                    # Keep the cursor before this page so a resumed run retries its errors;
+                    # finished packages of later pages are skipped on resume all the same
+                    logging.warning(f"Page at {start} had errors; the manifest stays at this page")
+                    advance = False
+                if advance:
+                    self.manifest.record({'event': 'page', 'next_start': start + len(packages)}, sync=True)
+        return self.counts
+
+    def export_page(self, pool, packages):
+        """Plan the page's depositions, then queue its resources in batches. True if nothing needs a retry."""
+        work, complete = [], True
+        for package in packages:
+            resources = package.get('resources', [])
+            todo = [] if package['id'] in self.manifest.done_packages else \
+                [res for res in resources if res['id'] not in self.manifest.resources]
+            self.counts['resumed'] += len(resources) - len(todo)
+            if not todo:
+                continue
+            try:
+                deposition = self.plan_deposition(package)
+            except Exception as e:
+                logging.error(f"Could not create a deposition for package {package['name']}: {e}")
+                self.counts['errors'] += len(todo)
+                complete = False
+                continue
+            work.extend((package, deposition, res) for res in todo)
+
+        # Stat the page's files in parallel; export_to_zenodo() then hits the preflight cache
+        preflight.stat_many([ckan_zenodo.get_file_path(res['id'], res['url']) for _, _, res in work])
+
+        for i in range(0, len(work), self.batch_size):
+            batch = work[i:i + self.batch_size]
+            results = list(pool.map(lambda item: self.export_resource(*item), batch))
+            complete = all(results) and complete
+            self.manifest.sync()
+
+        for package in packages:
+            if package['id'] not in self.manifest.done_packages and \
+                    all(res['id'] in self.manifest.resources for res in package.get('resources', [])):
+                self.manifest.record({'event': 'package_done', 'package_id': package['id']})
+        return complete
+
+    def plan_deposition(self, package):
+        """(deposition_id, name) for the package: the shared one, the one created earlier, or a new one."""
+        if self.deposition_id:
+            if self._shared_deposition_name is None:
+                self._shared_deposition_name = ckan_zenodo.get_deposition_name(self.zenodo_apikey,
+                                                                               self.deposition_id)
+            return self.deposition_id, self._shared_deposition_name
+        if package['id'] in self.manifest.depositions:
+            return self.manifest.depositions[package['id']]
+        title = package.get('title') or package['name']
+        deposition = ckan_zenodo.create_deposition(self.zenodo_apikey, title, package.get('notes') or title,
+                                                   self.creator, upload_type=self.upload_type,
+                                                   access_right=self.access_right)
+        # On disk before any file is queued, so a resumed run never creates it twice
+        self.manifest.record({'event': 'deposition', 'package_id': package['id'],
+                              'deposition_id': deposition['id'], 'deposition_name': title}, sync=True)
+        return deposition['id'], title
+
+    def export_resource(self, package, deposition, res):
+        """Queue one resource and record its outcome; False if it must be retried."""
+        deposition_id, deposition_name = deposition
+        event = {'event': 'resource', 'package_id': package['id'], 'resource_id': res['id']}
+        try:
+            transfer_id = ckan_zenodo.export_to_zenodo(self.zenodo_apikey, res['id'], res['name'], res['url'],
+                                                       deposition_id, package_id=package['id'], user=self.user,
+                                                       deposition_name=deposition_name,
+                                                       **ckan_zenodo.source_version(res))
+            event.update(outcome='queued', transfer_id=transfer_id)
+        except ckan_zenodo.DuplicateTransfer:
+            event.update(outcome='skipped')
+        except (ckan_zenodo.ResourceFileNotFound, ckan_zenodo.FileTooLarge) as e:
+            event.update(outcome='failed', error=str(e))
+        except Exception as e:
+            logging.error(f"Error exporting resource {res['id']} of package {package['name']}: {e}")
+            self.counts['errors'] += 1
+            return False
+        self.manifest.record(event)
+        self.counts[event['outcome']] += 1
+        return True
+
+
+def plan(q, fq, rows=100, deposition_id=None):
+    """Dry-run plan of every package of the search, merged into one."""
+    throughput = planner.historical_throughput()
+    plans = []
+    for _, packages in iter_pages(q, fq, rows=rows):
+        for package in packages:
+            plans.append(planner.plan_resources(package.get('resources', []), deposition_id, throughput=throughput))
+    total = planner.merge_plans(plans, throughput=throughput)
+    total['packages'] = len(plans)
+    return total
+
+
+def print_plan(total):
+    print(f"{total['packages']} package(s), {total['resources']} resource(s): {total['files']} file(s) "
+          f"to upload, {planner.format_bytes(total['bytes'])}")
+    if total['projected_seconds'] is not None:
+        print(f"Projected upload time: {planner.format_duration(total['projected_seconds'])} "
+              f"({total['parallel_uploads']} at once at {planner.format_bytes(total['bytes_per_sec'])}/s, "
+              f"median of {total['history_samples']} completed transfer(s); queue waits not included)")
+    for title, key in (('Largest files', 'largest'), ('Missing files', 'missing'),
+                       ('Over the file size limit', 'too_large'), ('Already exported', 'duplicates'),
+                       ('Exported to other depositions (uploaded again)', 'exported_elsewhere')):
+        if total[key]:
+            print(f"\n{title} ({len(total[key])}):")
+            for entry in total[key]:
+                print(f"  {planner.format_bytes(entry['size']):>10}  {entry['id']}  {entry['path']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python3 -m ckan_zenodo',
+                                     description='Bulk-export CKAN packages to Zenodo')
+    commands = parser.add_subparsers(dest='command', required=True)
+    bulk = commands.add_parser('bulk-export', help='Queue every package of an organization or search query')
+    source = bulk.add_mutually_exclusive_group(required=True)
+    source.add_argument('--organization', help='Export every package of this CKAN organization')
+    source.add_argument('--query', help='Export every package this CKAN search (Solr q) returns')
+    bulk.add_argument('--plan', action='store_true', help='Only report what the export would do')
+    bulk.add_argument('--user', help='Username the transfers are recorded under')
+    bulk.add_argument('--email', default='', help='Address for the transfer notifications')
+    bulk.add_argument('--creator', help="Deposition creator as 'Family, Given' (default: the username)")
+    bulk.add_argument('--manifest', help='Progress file; re-run with the same one to resume')
+    bulk.add_argument('--deposition-id', help='Export everything into this deposition instead of one per package')
+    bulk.add_argument('--upload-type', help='Upload type of created depositions (default from [zenodo])')
+    bulk.add_argument('--access-right', help='Access right of created depositions (default from [zenodo])')
+    bulk.add_argument('--rows', type=int, default=100, help='Packages fetched per search page')
+    bulk.add_argument('--batch-size', type=int, default=50, help='Resources queued between manifest syncs')
+    bulk.add_argument('--concurrency', type=int, default=4, help='Resources exported at once')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.organization:
+        q, fq, query = '*:*', f'organization:{args.organization}', f'organization:{args.organization}'
+    else:
+        q, fq, query = args.query, '', args.query
+
+    if args.plan:
+        print_plan(plan(q, fq, rows=args.rows, deposition_id=args.deposition_id))
+        return
+
+    if not args.user or not args.manifest:
+        parser.error('--user and --manifest are required unless --plan is given')
+    zenodo_apikey = os.environ.get('ZENODO_API_KEY')
+    if not zenodo_apikey:
+        parser.error('set ZENODO_API_KEY to the Zenodo token the depositions belong to')
+
+    manifest = Manifest(args.manifest)
+    export = BulkExport(zenodo_apikey, {'username': args.user, 'email': args.email}, manifest,
+                        args.creator or args.user, deposition_id=args.deposition_id,
+                        upload_type=args.upload_type, access_right=args.access_right,
+                        batch_size=args.batch_size, concurrency=args.concurrency)
+    try:
+        counts = export.run(query, q, fq, rows=args.rows)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        manifest.close()
+
+    print(f"{counts['queued']} queued, {counts['skipped']} skipped, {counts['failed']} failed, "
+          f"{counts['resumed']} already done in an earlier run")
+    if counts['errors']:
+        print(f"{counts['errors']} resource(s) hit errors; run again with the same --manifest to retry them.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""
+Circuit breaker around the Zenodo API, shared by all worker threads and processes.
+
+Each worker process keeps a sliding window of its own recent Zenodo calls
+(outcome and duration). When the share of failed calls in the window reaches
+[circuit_breaker] failure_rate, the breaker trips: the shared state row in the
+circuit_breakers table is set to 'open', and every worker stops taking uploads
+for open_seconds. After that one worker wins the right to send a single probe
+upload ('half_open'); success closes the circuit for everyone, failure opens it
+again.
+
+Only failures that are Zenodo's fault count (see is_zenodo_fault): a rejected
+API key or a missing file says nothing about Zenodo's health. Time-outs —
+including stalled uploads — count as failures, which is how a slow Zenodo
+trips the breaker.
+
+The shared state is read through a short cache (state_cache_seconds) so idle
+checks do not hit the database for every message. If the database cannot be
+reached the breaker fails open and lets uploads through.
+"""
+import os
+import time
+import socket
+import logging
+import threading
+import collections
+import pymysql
+import requests
+import configs
+import db
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+def is_zenodo_fault(exc):
+    """True for errors that indicate Zenodo itself is unhealthy (5xx, 429, network, time-outs)."""
+    if isinstance(exc, requests.exceptions.HTTPError):
+        response = exc.response
+        return response is not None and (response.status_code >= 500 or response.status_code == 429)
+    return isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+# --- Shared state (circuit_breakers table) ---
+def read_state(name):
+    """Return the shared breaker row for name, or None if it does not exist."""
+    connection = db.get_connection()
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            sql = """SELECT state, reason, trips, calls, error_rate, latency_ms, opened_at,
+                            TIMESTAMPDIFF(SECOND, opened_at, NOW()) AS open_for
+                     FROM circuit_breakers WHERE name = %s"""
+            cursor.execute(sql, (name,))
+            return cursor.fetchone()
+    finally:
+        connection.close()
+
+
+def _write(sql, params):
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            rows = cursor.execute(sql, params)
+        connection.commit()
+        return rows
+    finally:
+        connection.close()
+
+
+def _trip(name, reason):
+    # trips is assigned first so it still sees the previous state
+    _write("""UPDATE circuit_breakers
+              SET trips = trips + (state = 'closed'), state = 'open', opened_at = NOW(),
+                  probe_owner = NULL, probe_started_at = NULL, reason = %s
+              WHERE name = %s""", (reason, name))
+
+
+def _close(name):
+    _write("""UPDATE circuit_breakers
+              SET state = 'closed', opened_at = NULL, probe_owner = NULL,
+                  probe_started_at = NULL, reason = NULL
+              WHERE name = %s""", (name,))
+
+
+def _claim_probe(name, owner, open_seconds):
+    """Atomically become the half-open prober; also takes over a probe that never reported back."""
+    rows = _write("""UPDATE circuit_breakers
+                     SET state = 'half_open', probe_owner = %s, probe_started_at = NOW()
+                     WHERE name = %s
+                       AND ((state = 'open' AND opened_at <= NOW() - INTERVAL %s SECOND)
+                         OR (state = 'half_open' AND probe_started_at <= NOW() - INTERVAL %s SECOND))""",
+                  (owner, name, open_seconds, open_seconds))
+    return rows == 1
+
+
+def _release_probe(name, owner):
+    # opened_at is left as it was, so the next allow() anywhere can claim the probe at once
+    _write("""UPDATE circuit_breakers
+              SET state = 'open', probe_owner = NULL, probe_started_at = NULL
+              WHERE name = %s AND state = 'half_open' AND probe_owner = %s""", (name, owner))
+
+
+def _publish_stats(name, calls, error_rate, latency_ms):
+    _write("UPDATE circuit_breakers SET calls = %s, error_rate = %s, latency_ms = %s WHERE name = %s",
+           (calls, error_rate, latency_ms, name))
+
+
+class CircuitBreaker:
+    """Sliding-window breaker for one external service, with its state shared through the DB."""
+
+    def __init__(self, name='zenodo', window_seconds=300, min_calls=5, failure_rate=0.5,
+                 open_seconds=120, state_cache_seconds=5, clock=time.monotonic):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.state_cache_seconds = state_cache_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._calls = collections.deque()
+        self._shared = None
+        self._shared_read_at = None
+        self._stats_written_at = None
+        self._probing = False
+
+    # --- local window ---
+    def _prune(self, now):
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+
+    # --- shared state ---
+    def _state_row(self):
+        now = self._clock()
+        if self._shared_read_at is None or now - self._shared_read_at >= self.state_cache_seconds:
+            try:
+                self._shared = read_state(self.name) or {'state': CLOSED}
+            except Exception as e:
+                logging.warning(f"Circuit breaker '{self.name}': cannot read shared state ({e}); failing open")
+                self._shared = {'state': CLOSED}
+            self._shared_read_at = now
+        return self._shared
+
+    def _set_local(self, state, open_for=0):
+        self._shared = {**(self._shared or {}), 'state': state, 'open_for': open_for}
+        self._shared_read_at = self._clock()
+
+    def state(self):
+        """Current shared state ('closed', 'open' or 'half_open'), read through the cache."""
+        with self._lock:
+            return self._state_row()['state']
+
+    def allow(self):
+        """
+        Return True if a Zenodo call may be made now. While open, returns False until
+        open_seconds have passed; then exactly one caller across all workers is let
+        through as the half-open probe.
+        """
+        with self._lock:
+            row = self._state_row()
+            if row['state'] == CLOSED:
+                return True
+            if self._probing:
+                return False
+            if row['state'] == OPEN and (row.get('open_for') or 0) < self.open_seconds:
+                return False
+            try:
+                claimed = _claim_probe(self.name, self.owner, self.open_seconds)
+            except Exception as e:
+                logging.warning(f"Circuit breaker '{self.name}': cannot claim probe ({e})")
+                return False
+            if claimed:
+                self._probing = True
+                self._set_local(HALF_OPEN)
+                logging.info(f"Circuit breaker '{self.name}' half-open: sending a probe upload")
+            return claimed
+
+    def retry_after(self):
+        """Seconds until the open period ends (at least 1) — how long to pause consuming."""
+        with self._lock:
+            row = self._state_row()
+        open_for = row.get('open_for') or 0
+        return max(self.open_seconds - open_for, 1)
+
+    def abandon_probe(self):
+        """
+        Give up the half-open probe without a verdict — the task failed for a reason
+        that says nothing about Zenodo (missing file, rejected token, ...).
+        """
+        with self._lock:
+            if not self._probing:
+                return
+            self._probing = False
+            self._set_local(OPEN, open_for=self.open_seconds)
+            try:
+                _release_probe(self.name, self.owner)
+            except Exception as e:
+                logging.error(f"Circuit breaker '{self.name}': cannot release probe: {e}")
+
+    def record(self, ok, seconds):
+        """Record the outcome of one Zenodo call and trip, close or re-open the circuit as needed."""
+        with self._lock:
+            now = self._clock()
+            self._calls.append((now, ok, seconds))
+            self._prune(now)
+
+            try:
+                if self._probing:
+                    self._probing = False
+                    if ok:
+                        _close(self.name)
+                        self._calls.clear()
+                        self._set_local(CLOSED)
+                        logging.info(f"Circuit breaker '{self.name}' closed: probe succeeded")
+                    else:
+                        _trip(self.name, 'Half-open probe failed')
+                        self._set_local(OPEN)
+                        logging.warning(f"Circuit breaker '{self.name}' re-opened: probe failed")
+                    return
+
+                calls = len(self._calls)
+                failures = sum(1 for _, call_ok, _ in self._calls if not call_ok)
+                if (not ok and calls >= self.min_calls and failures / calls >= self.failure_rate
+                        and self._state_row()['state'] == CLOSED):
+                    reason = (f"{failures}/{calls} Zenodo calls failed in the last "
+                              f"{self.window_seconds}s")
+                    _trip(self.name, reason)
+                    self._calls.clear()
+                    self._set_local(OPEN)
+                    logging.warning(f"Circuit breaker '{self.name}' opened: {reason}")
+                elif self._stats_written_at is None or now - self._stats_written_at >= self.state_cache_seconds:
+                    latency = sum(s for _, _, s in self._calls) / calls * 1000
+                    _publish_stats(self.name, calls, round(failures / calls, 3), round(latency, 1))
+                    self._stats_written_at = now
+            except Exception as e:
+                logging.error(f"Circuit breaker '{self.name}': cannot update shared state: {e}")
+
+
+_breaker = None
+_breaker_pid = None
+_breaker_lock = threading.Lock()
+
+
+def get_breaker():
+    """Return this process's Zenodo breaker, or None when [circuit_breaker] enabled = false."""
+    global _breaker, _breaker_pid
+    cc = configs.get_circuit_breaker_config()
+    if not cc['enabled']:
+        return None
+    with _breaker_lock:
+        if _breaker is None or _breaker_pid != os.getpid():
+            _breaker = CircuitBreaker(
+                name='zenodo',
+                window_seconds=cc['window_seconds'],
+                min_calls=cc['min_calls'],
+                failure_rate=cc['failure_rate'],
+                open_seconds=cc['open_seconds'],
+                state_cache_seconds=cc['state_cache_seconds'],
+            )
+            _breaker_pid = os.getpid()
+        return _breaker
@@ -1,13 +1,22 @@
 import os
+import re
 import logging
+import hashlib
+import threading
 import pika
 import json
 import requests
 import pymysql
 from ckanapi import RemoteCKAN
-from flask import session
+from flask import session, has_request_context
 import configs
 import db
+import rate_limiter
+import scheduler
+import offpeak
+import queue_backend
+import preflight
+import upload_stream
 
 
 class ResourceFileNotFound(Exception):
@@ -32,6 +41,30 @@ class DuplicateTransfer(Exception):
     pass
 
 
+class TransferCancelled(Exception):
+    """Raised inside the worker to abort an upload whose transfer the user cancelled."""
+    pass
+
+
+# Statuses a user can still cancel
+CANCELLABLE_STATUSES = ('scheduled', 'pending', 'in_progress')
+
+
+def zenodo_timeout():
+    """(connect, read) timeout tuple applied to every Zenodo API request."""
+    zc = configs.get_zenodo_config()
+    return (zc['connect_timeout'], zc['read_timeout'])
+
+
+def _acquire(zenodo_apikey):
+    """
+    Rate-limit one Zenodo call. Inside a web request the wait is capped at
+    [rate_limit] web_max_wait (rate_limiter.RateLimited past it); in a worker it is not.
+    """
+    max_wait = configs.get_rate_limit_config()['web_max_wait'] if has_request_context() else None
+    rate_limiter.get_limiter().acquire(zenodo_apikey, max_wait=max_wait)
+
+
 # --- Returns the local file path for a CKAN resource based on its URL ---
 def get_file_path(resourse_id, url):
     """
@@ -59,21 +92,26 @@ def get_file_path(resourse_id, url):
 
 
 def _check_file_size(file_path):
-    """Raise FileTooLarge if the file exceeds the configured max_file_size_mb limit (0 = unlimited)."""
+    """
+    Return the file size in bytes (from the preflight stat cache).
+    Raise FileTooLarge if the file exceeds the configured max_file_size_mb limit (0 = unlimited).
+    """
     app_config = configs.get_app_config()
     max_mb = int(app_config.get('max_file_size_mb', 0))
+    size = preflight.stat(file_path).size
     if max_mb > 0:
-        size_mb = os.path.getsize(file_path) / (1024 * 1024)
+        size_mb = size / (1024 * 1024)
         if size_mb > max_mb:
             raise FileTooLarge(
                 f"File size {size_mb:.1f} MB exceeds the {max_mb} MB limit."
             )
+    return size
 
 
 def check_duplicate_transfer(resource_id, deposition_id):
     """
     Raise DuplicateTransfer if this resource + deposition was already exported
-    and that transfer is still pending, in-progress, or completed.
+    and that transfer is still scheduled, pending, in-progress, or completed.
     Only considers records that have resource_id populated (post-migration records).
     """
     connection = db.get_connection()
@@ -81,7 +119,7 @@ def check_duplicate_transfer(resource_id, deposition_id):
         with connection.cursor(pymysql.cursors.DictCursor) as cursor:
             sql = """SELECT id FROM zenodo_transfers
                      WHERE resource_id = %s AND deposition_id = %s
-                       AND status NOT IN ('failed')
+                       AND status NOT IN ('failed', 'cancelled')
                        AND resource_id IS NOT NULL"""
             cursor.execute(sql, (resource_id, deposition_id))
             if cursor.fetchone():
@@ -92,6 +130,141 @@ def check_duplicate_transfer(resource_id, deposition_id):
         connection.close()
 
 
+# --- Incremental sync: what changed since the last export ---
+def source_version(res):
+    """The CKAN version of a resource recorded with its transfer: export_to_zenodo() keyword arguments."""
+    return {'source_modified': res.get('last_modified') or None, 'source_hash': res.get('hash') or None}
+
+
+def get_sync_baseline(deposition_id, resource_ids):
+    """
+    Map each resource already exported to deposition_id to its latest transfer
+    that did not fail or get cancelled (the version the deposition holds or is
+    about to hold).
+    """
+    if not resource_ids:
+        return {}
+    connection = db.get_connection()
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            sql = f"""SELECT id, resource_id, status, file_size, source_modified, source_hash, updated_at
+                      FROM zenodo_transfers
+                      WHERE deposition_id = %s
+                        AND resource_id IN ({', '.join(['%s'] * len(resource_ids))})
+                        AND status NOT IN ('failed', 'cancelled')
+                      ORDER BY id"""
+            cursor.execute(sql, (deposition_id, *resource_ids))
+            # Ordered by id, so the latest transfer of each resource wins
+            return {row['resource_id']: row for row in cursor.fetchall()}
+    finally:
+        connection.close()
+
+
+def resource_changed(res, baseline, file_stat):
+    """
+    Why a resource differs from its baseline transfer (get_sync_baseline()),
+    or None if it is unchanged. The file size is always compared; then the CKAN
+    hash, or failing that last_modified, when both sides have it. Transfers recorded before
+    sync existed have neither, so the file's mtime is compared with the time
+    the transfer finished instead.
+    """
+    if not file_stat.exists:
+        return 'file missing'
+    if baseline['file_size'] is not None and file_stat.size != baseline['file_size']:
+        return 'size changed'
+    version = source_version(res)
+    if version['source_hash'] and baseline['source_hash']:
+        return 'hash changed' if version['source_hash'] != baseline['source_hash'] else None
+    if version['source_modified'] and baseline['source_modified']:
+        return 'modified in CKAN' if version['source_modified'] != baseline['source_modified'] else None
+    if baseline['source_hash'] or baseline['source_modified']:
+        return None
+    updated_at = baseline['updated_at']
+    if updated_at is not None and file_stat.mtime > updated_at.timestamp():
+        return 'file newer than last export'
+    return None
+
+
+# --- New versions of published records ---
+_MD5 = re.compile(r'^[0-9a-f]{32}$')
+
+
+def file_md5(file_path, chunk_size=1024 * 1024):
+    """MD5 hex digest of a local file, read in chunks."""
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def local_md5(res, file_path):
+    """
+    MD5 of a resource's file: CKAN's hash when it is an MD5 ('md5:<hex>' or
+    plain hex, as Zenodo reports checksums), otherwise computed from the file.
+    """
+    ckan_hash = (res.get('hash') or '').lower()
+    if ckan_hash.startswith('md5:'):
+        ckan_hash = ckan_hash[4:]
+    return ckan_hash if _MD5.match(ckan_hash) else file_md5(file_path)
+
+
+def same_content(remote_file, res, file_path, file_stat):
+    """
+    True if a file already in a deposition (an entry of its 'files') holds the
+    resource's current content. Sizes are compared first so only files of the
+    same size are checksummed.
+    """
+    if not file_stat.exists or file_stat.size != remote_file.get('filesize'):
+        return False
+    remote_md5 = (remote_file.get('checksum') or '').lower()
+    if remote_md5.startswith('md5:'):
+        remote_md5 = remote_md5[4:]
+    return local_md5(res, file_path) == remote_md5
+
+
+def create_new_version(zenodo_apikey, deposition_id):
+    """
+    Create (or, if one is already open, fetch) the draft of a new version of a
+    published Zenodo record and return it (Zenodo's JSON). The draft already
+    holds the files of the published version, copied server-side.
+    Raises ZenodoAPIError if Zenodo refuses.
+    """
+    zc = configs.get_zenodo_config()
+    params = {'access_token': zenodo_apikey}
+    rate_limiter.get_limiter().acquire(zenodo_apikey)
+    response = requests.post(f"{zc['api_url']}/{deposition_id}/actions/newversion", params=params,
+                             timeout=zenodo_timeout())
+    if response.status_code != 201:
+        logging.error(f"Failed to create a new version of deposition {deposition_id}: HTTP {response.status_code}")
+        raise ZenodoAPIError(
+            f"Zenodo returned HTTP {response.status_code} when creating a new version.",
+            status_code=response.status_code
+        )
+
+    rate_limiter.get_limiter().acquire(zenodo_apikey)
+    r = requests.get(response.json()['links']['latest_draft'], params=params, timeout=zenodo_timeout())
+    r.raise_for_status()
+    draft = r.json()
+    logging.info(f"New version draft {draft['id']} of deposition {deposition_id} "
+                 f"with {len(draft.get('files', []))} inherited file(s)")
+    return draft
+
+
+def delete_deposition_file(zenodo_apikey, deposition_id, file_id):
+    """Delete one file from an unpublished deposition. Raises ZenodoAPIError if Zenodo refuses."""
+    zc = configs.get_zenodo_config()
+    params = {'access_token': zenodo_apikey}
+    rate_limiter.get_limiter().acquire(zenodo_apikey)
+    response = requests.delete(f"{zc['api_url']}/{deposition_id}/files/{file_id}", params=params,
+                               timeout=zenodo_timeout())
+    if response.status_code != 204:
+        raise ZenodoAPIError(
+            f"Zenodo returned HTTP {response.status_code} when deleting file {file_id}.",
+            status_code=response.status_code
+        )
+
+
 # --- Fetches the name/title of a Zenodo deposition ---
 def get_deposition_name(zenodo_apikey, deposition_id):
     """
@@ -100,47 +273,164 @@ def get_deposition_name(zenodo_apikey, deposition_id):
     zc = configs.get_zenodo_config()
     headers = {"Content-Type": "application/json"}
     params = {'access_token': zenodo_apikey}
-    r = requests.get(f"{zc['api_url']}/{deposition_id}", params=params, headers=headers)
+    _acquire(zenodo_apikey)
+    r = requests.get(f"{zc['api_url']}/{deposition_id}", params=params, headers=headers,
+                     timeout=zenodo_timeout())
     r.raise_for_status()
     return r.json()['metadata']['title']
 
 
 # --- Inserts a transfer record into the MySQL database ---
 def insert_transfer_record(username, file_path, filename, deposition_id, deposition_name,
-                           resource_id='', user_email=''):
+                           resource_id='', user_email='', file_size=None, package_id=None,
+                           source_modified=None, source_hash=None):
     """
     Create a new transfer record in the zenodo_transfers table with 'pending' status.
+    source_modified and source_hash record the CKAN resource version for sync.
     Returns the newly created transfer ID.
     """
     connection = db.get_connection()
     try:
         with connection.cursor() as cursor:
-            sql = """INSERT INTO zenodo_transfers
-                         (username, user_email, file_path, filename, deposition_id,
-                          deposition_name, resource_id, status)
-                     VALUES (%s, %s, %s, %s, %s, %s, %s, 'pending')"""
-            cursor.execute(sql, (username, user_email, file_path, filename,
-                                 deposition_id, deposition_name, resource_id))
-            transfer_id = cursor.lastrowid
+            transfer_id = _insert_transfer(cursor, username, file_path, filename, deposition_id,
+                                           deposition_name, resource_id, user_email, file_size, package_id,
+                                           source_modified, source_hash)
         connection.commit()
         return transfer_id
     finally:
         connection.close()
 
 
-# --- Sends an upload task to RabbitMQ for asynchronous processing ---
-def send_upload_task(username, file_path, zenodo_token, deposition_id, deposition_name,
-                     filename, transfer_id, user_email=''):
+def _insert_transfer(cursor, username, file_path, filename, deposition_id, deposition_name,
+                     resource_id, user_email, file_size, package_id, source_modified=None, source_hash=None):
+    sql = """INSERT INTO zenodo_transfers
+                 (username, user_email, file_path, filename, file_size, deposition_id,
+                  deposition_name, resource_id, package_id, source_modified, source_hash, status)
+             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'pending')"""
+    cursor.execute(sql, (username, user_email, file_path, filename, file_size,
+                         deposition_id, deposition_name, resource_id, package_id,
+                         source_modified, source_hash))
+    return cursor.lastrowid
+
+
+# Publisher connections are opened lazily, one per thread, and never shared
+# across processes — the owning pid is checked so a forked child reconnects.
+_publisher = threading.local()
+
+
+def _publisher_channel():
+    """Return this thread's cached RabbitMQ channel, opening a connection on first use."""
+    if getattr(_publisher, 'pid', None) != os.getpid() or not _publisher.channel.is_open:
+        rc = configs.get_rabbitmq_config()
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=rc['host']))
+        channel = connection.channel()
+        for queue in scheduler.all_queues():
+            channel.queue_declare(queue=queue, durable=True)
+        _publisher.pid = os.getpid()
+        _publisher.connection = connection
+        _publisher.channel = channel
+    return _publisher.channel
+
+
+def reset_publisher():
+    """Close this thread's cached publisher connection (if any) so the next publish reconnects."""
+    if getattr(_publisher, 'pid', None) == os.getpid():
+        try:
+            _publisher.connection.close()
+        except Exception:
+            pass
+    _publisher.__dict__.clear()
+
+
+def _db_queue():
+    """True if upload tasks go to the upload_jobs table ([queue] backend = mysql) instead of RabbitMQ."""
+    return configs.get_queue_config()['backend'] == 'mysql'
+
+
+def _publish(routing_key, body):
     """
-    Publish an upload task message to the RabbitMQ queue.
-    This task will be processed by a background worker to upload the file to Zenodo.
+    Publish a persistent message on the cached channel.
+    An idle connection may have been dropped by the broker, so one reconnect is attempted.
+    With the database queue backend the task is inserted into upload_jobs instead.
+    """
+    if _db_queue():
+        queue_backend.publish(routing_key, body)
+        return
+    for attempt in (1, 2):
+        try:
+            _publisher_channel().basic_publish(exchange='', routing_key=routing_key, body=body,
+                                               properties=pika.BasicProperties(delivery_mode=2))
+            return
+        except pika.exceptions.AMQPError:
+            reset_publisher()
+            if attempt == 2:
+                raise
+
+
+def publish_task(task):
+    """Publish an already-built upload task dict to its user's scheduler lane (or the small-file lane)."""
+    _publish(scheduler.lane_queue(task['username'], task.get('file_size')), json.dumps(task))
+
+
+def schedule_task(task, cursor=None):
+    """
+    Park an upload task until the next off-peak window: the transfer becomes
+    'scheduled' and keeps the task for `worker.py release` to publish. The other
+    targets of a multi-target task are scheduled with it as their lead.
+    Completed and cancelled transfers are left alone. Pass cursor to write in the caller's
+    transaction. Returns the not_before time.
     """
-    rc = configs.get_rabbitmq_config()
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=rc['host']))
-    channel = connection.channel()
-    channel.queue_declare(queue=rc['queue'], durable=True)
+    if cursor is not None:
+        return _schedule(cursor, task)
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            not_before = _schedule(cursor, task)
+        connection.commit()
+    finally:
+        connection.close()
+    return not_before
 
-    message = json.dumps({
+
+def _schedule(cursor, task):
+    not_before = offpeak.not_before()
+    sql = ("UPDATE zenodo_transfers SET status = 'scheduled', not_before = %s, task_payload = %s, "
+           "tee_lead_id = NULL WHERE id = %s AND status NOT IN ('completed', 'cancelled')")
+    cursor.execute(sql, (not_before, json.dumps(task), task['transfer_id']))
+    followers = [target['transfer_id'] for target in task.get('targets', [])
+                 if target['transfer_id'] != task['transfer_id']]
+    if followers:
+        cursor.execute(f"""UPDATE zenodo_transfers SET status = 'scheduled', not_before = %s, tee_lead_id = %s
+                           WHERE id IN ({', '.join(['%s'] * len(followers))})
+                             AND status NOT IN ('completed', 'cancelled')""",
+                       (not_before, task['transfer_id'], *followers))
+    return not_before
+
+
+def _add_to_outbox(cursor, task):
+    if _db_queue():
+        # The job table is the queue itself, so the task is enqueued in the caller's transaction
+        queue_backend.insert_job(cursor, scheduler.lane_queue(task['username'], task.get('file_size')),
+                                 json.dumps(task))
+        return
+    cursor.execute("INSERT INTO transfer_outbox (transfer_id, payload) VALUES (%s, %s)",
+                   (task.get('transfer_id'), json.dumps(task)))
+
+
+def outbox_task(task):
+    """Write an upload task to transfer_outbox for `worker.py relay` to publish."""
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            _add_to_outbox(cursor, task)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def _build_task(username, file_path, zenodo_token, deposition_id, deposition_name,
+                filename, transfer_id, user_email, file_size):
+    return {
         'username': username,
         'file_path': file_path,
         'filename': filename,
@@ -149,13 +439,200 @@ def send_upload_task(username, file_path, zenodo_token, deposition_id, depositio
         'deposition_name': deposition_name,
         'transfer_id': transfer_id,
         'user_email': user_email,
-    })
+        'file_size': file_size,
+    }
 
-    channel.basic_publish(exchange='', routing_key=rc['queue'], body=message,
-                          properties=pika.BasicProperties(delivery_mode=2))
+
+# --- Sends an upload task to RabbitMQ for asynchronous processing ---
+def send_upload_task(username, file_path, zenodo_token, deposition_id, deposition_name,
+                     filename, transfer_id, user_email='', file_size=None, bundle=False):
+    """
+    Publish an upload task message to the RabbitMQ queue.
+    This task will be processed by a background worker to upload the file to Zenodo.
+    file_size (bytes) routes small files to the small-file lane; None means unknown.
+    bundle marks the task of a bundle transfer (create_bundle_transfer()).
+    Files above [offpeak] min_file_mb are scheduled for the next off-peak window instead.
+    With [outbox] enabled the task is written to transfer_outbox rather than published.
+    """
+    task = _build_task(username, file_path, zenodo_token, deposition_id, deposition_name,
+                       filename, transfer_id, user_email, file_size)
+    if bundle:
+        task['bundle'] = True
+    if offpeak.is_large(file_size):
+        not_before = schedule_task(task)
+        logging.info(f"Upload task scheduled for {not_before}: {filename} to deposition "
+                     f"'{deposition_name}' (transfer_id={transfer_id}, user={username})")
+        return
+    if configs.get_outbox_config()['enabled'] and not _db_queue():
+        outbox_task(task)
+    else:
+        publish_task(task)
     logging.info(f"Upload task queued: {filename} to deposition '{deposition_name}' "
                  f"(transfer_id={transfer_id}, user={username})")
-    connection.close()
+
+
+# --- Records a transfer and its upload task ---
+def create_transfer(username, file_path, zenodo_token, deposition_id, deposition_name, filename,
+                    resource_id='', user_email='', file_size=None, package_id=None,
+                    source_modified=None, source_hash=None):
+    """
+    Insert the transfer record and enqueue its upload task. Returns the transfer ID.
+    With [outbox] enabled both happen in one database transaction — the task goes
+    to transfer_outbox (or, for an off-peak file, onto the scheduled row) — so the
+    request never waits for RabbitMQ and a transfer is never left without its task.
+    With the database queue backend the task is inserted into upload_jobs in that
+    same transaction, outbox or not. Otherwise the record is committed first and
+    the task published straight away.
+    """
+    if not configs.get_outbox_config()['enabled'] and not _db_queue():
+        transfer_id = insert_transfer_record(username, file_path, filename, deposition_id,
+                                             deposition_name, resource_id, user_email,
+                                             file_size=file_size, package_id=package_id,
+                                             source_modified=source_modified, source_hash=source_hash)
+        send_upload_task(username, file_path, zenodo_token, deposition_id, deposition_name,
+                         filename, transfer_id, user_email, file_size=file_size)
+        return transfer_id
+
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            transfer_id = _insert_transfer(cursor, username, file_path, filename, deposition_id,
+                                           deposition_name, resource_id, user_email, file_size, package_id,
+                                           source_modified, source_hash)
+            task = _build_task(username, file_path, zenodo_token, deposition_id, deposition_name,
+                               filename, transfer_id, user_email, file_size)
+            if offpeak.is_large(file_size):
+                _schedule(cursor, task)
+            else:
+                _add_to_outbox(cursor, task)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    logging.info(f"Upload task recorded: {filename} to deposition '{deposition_name}' "
+                 f"(transfer_id={transfer_id}, user={username})")
+    return transfer_id
+
+
+def create_tee_transfer(username, file_path, zenodo_token, targets, filename, resource_id='',
+                        user_email='', file_size=None, source_modified=None, source_hash=None):
+    """
+    Insert one transfer record per target — a (deposition_id, deposition_name)
+    pair — and enqueue a single upload task for all of them, which the worker
+    uploads reading the file once (worker.tee_upload). The first record leads:
+    the task is its task (for scheduling, heartbeats and the reaper) and the
+    others point to it with tee_lead_id. A large file's followers are scheduled
+    with their lead, which `worker.py release` queues them with. The records are
+    written in one transaction. Returns the transfer IDs in the order of targets.
+    Raises ValueError for fewer than two targets; use create_transfer() for one.
+    """
+    if len(targets) < 2:
+        raise ValueError(f"A multi-target transfer needs at least two targets, got {len(targets)}")
+    transactional = configs.get_outbox_config()['enabled'] or _db_queue()
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            transfer_ids = [_insert_transfer(cursor, username, file_path, filename, deposition_id,
+                                             deposition_name, resource_id, user_email, file_size, None,
+                                             source_modified, source_hash)
+                            for deposition_id, deposition_name in targets]
+            cursor.execute(f"""UPDATE zenodo_transfers SET tee_lead_id = %s
+                               WHERE id IN ({', '.join(['%s'] * (len(transfer_ids) - 1))})""",
+                           (transfer_ids[0], *transfer_ids[1:]))
+            lead_deposition_id, lead_deposition_name = targets[0]
+            task = _build_task(username, file_path, zenodo_token, lead_deposition_id, lead_deposition_name,
+                               filename, transfer_ids[0], user_email, file_size)
+            task['targets'] = [{'transfer_id': transfer_id, 'deposition_id': deposition_id,
+                                'deposition_name': deposition_name}
+                               for transfer_id, (deposition_id, deposition_name) in zip(transfer_ids, targets)]
+            scheduled = offpeak.is_large(file_size)
+            if scheduled:
+                _schedule(cursor, task)
+            elif transactional:
+                _add_to_outbox(cursor, task)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    if not scheduled and not transactional:
+        publish_task(task)
+    logging.info(f"Upload task recorded: {filename} to {len(targets)} depositions "
+                 f"(transfer_ids={transfer_ids}, user={username})")
+    return transfer_ids
+
+
+def bundle_member_names(names):
+    """
+    Names in a bundle archive for the given resource names: path separators
+    become underscores and repeated names are numbered ('data.csv', 'data (2).csv').
+    """
+    taken, result = set(), []
+    for name in names:
+        name = re.sub(r'[/\\]', '_', name).strip() or 'resource'
+        root, ext = os.path.splitext(name)
+        candidate, n = name, 1
+        while candidate in taken:
+            n += 1
+            candidate = f"{root} ({n}){ext}"
+        taken.add(candidate)
+        result.append(candidate)
+    return result
+
+
+# --- Records a bundle transfer: many files uploaded as one ZIP archive ---
+def create_bundle_transfer(username, zenodo_token, deposition_id, deposition_name, filename, members,
+                           user_email='', package_id=None):
+    """
+    Insert one transfer record for a ZIP archive named filename and enqueue its
+    upload task; the worker builds the archive while uploading it
+    (worker.upload_bundle_to_zenodo). members are dicts with the resource_id,
+    name in the archive, path and size of each file, kept in the record's
+    bundle_manifest. The record and the task are written as create_tee_transfer()
+    writes them. Raises DuplicateTransfer if the deposition already has a live
+    transfer of an archive by that name, and FileTooLarge if the archive would
+    exceed max_file_size_mb. Returns the transfer ID.
+    """
+    file_size = upload_stream.zip_size((member['name'], member['size']) for member in members)
+    max_mb = int(configs.get_app_config().get('max_file_size_mb', 0))
+    if max_mb > 0 and file_size > max_mb * 1024 * 1024:
+        raise FileTooLarge(f"Archive size {file_size / (1024 * 1024):.1f} MB exceeds the {max_mb} MB limit.")
+
+    transactional = configs.get_outbox_config()['enabled'] or _db_queue()
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""SELECT id FROM zenodo_transfers
+                              WHERE deposition_id = %s AND filename = %s AND bundle_manifest IS NOT NULL
+                                AND status NOT IN ('failed', 'cancelled')""", (deposition_id, filename))
+            if cursor.fetchone():
+                raise DuplicateTransfer(f"Archive {filename} is already associated with deposition {deposition_id}.")
+            transfer_id = _insert_transfer(cursor, username, '', filename, deposition_id, deposition_name,
+                                           None, user_email, file_size, package_id)
+            cursor.execute("UPDATE zenodo_transfers SET bundle_manifest = %s WHERE id = %s",
+                           (json.dumps(members), transfer_id))
+            task = _build_task(username, '', zenodo_token, deposition_id, deposition_name,
+                               filename, transfer_id, user_email, file_size)
+            task['bundle'] = True
+            scheduled = offpeak.is_large(file_size)
+            if scheduled:
+                _schedule(cursor, task)
+            elif transactional:
+                _add_to_outbox(cursor, task)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    if not scheduled and not transactional:
+        publish_task(task)
+    logging.info(f"Upload task recorded: {filename} ({len(members)} files) to deposition '{deposition_name}' "
+                 f"(transfer_id={transfer_id}, user={username})")
+    return transfer_id
 
 
 # --- Retrieves CKAN resource metadata ---
@@ -166,7 +643,8 @@ def get_ckan_resource(resource_id):
     """
     config = configs.get_ckan_config()
     mysite = RemoteCKAN(config['server'], apikey=config['apikey'], user_agent='ckan-zenodo-1')
-    res = mysite.action.resource_show(id=resource_id)
+    res = mysite.call_action('resource_show', {'id': resource_id},
+                             requests_kwargs={'timeout': config['timeout']})
     logging.info(f"Fetched CKAN resource: {res['name']}")
     return res
 
@@ -179,11 +657,27 @@ def get_ckan_package(package_id):
     """
     config = configs.get_ckan_config()
     mysite = RemoteCKAN(config['server'], apikey=config['apikey'], user_agent='ckan-zenodo-1')
-    pac = mysite.action.package_show(id=package_id)
+    pac = mysite.call_action('package_show', {'id': package_id},
+                             requests_kwargs={'timeout': config['timeout']})
     logging.info(f"Fetched CKAN package: {pac['title']}")
     return pac
 
 
+# --- Searches CKAN packages ---
+def search_ckan_packages(q='*:*', fq='', rows=100, start=0):
+    """
+    Run one page of CKAN package_search (private packages included, oldest first
+    so pages stay stable while new datasets are added). Returns CKAN's result:
+    {'count': ..., 'results': [package, ...]}.
+    """
+    config = configs.get_ckan_config()
+    mysite = RemoteCKAN(config['server'], apikey=config['apikey'], user_agent='ckan-zenodo-1')
+    return mysite.call_action('package_search',
+                              {'q': q, 'fq': fq, 'rows': rows, 'start': start,
+                               'sort': 'metadata_created asc, id asc', 'include_private': True},
+                              requests_kwargs={'timeout': config['timeout']})
+
+
 # --- Retrieves all Zenodo depositions for the given API key ---
 def get_depositions(zenodo_apikey):
     """
@@ -191,7 +685,8 @@ def get_depositions(zenodo_apikey):
     """
     zc = configs.get_zenodo_config()
     params = {'access_token': zenodo_apikey}
-    r = requests.get(zc['api_url'], params=params)
+    _acquire(zenodo_apikey)
+    r = requests.get(zc['api_url'], params=params, timeout=zenodo_timeout())
     r.raise_for_status()
     logging.info("Fetched Zenodo depositions")
     return r.json()
@@ -206,13 +701,39 @@ def get_transfer_by_id(transfer_id, username):
     connection = db.get_connection()
     try:
         with connection.cursor(pymysql.cursors.DictCursor) as cursor:
-            sql = "SELECT * FROM zenodo_transfers WHERE id = %s AND username = %s"
+            sql = ("SELECT *, TIMESTAMPDIFF(SECOND, progress_at, NOW()) AS progress_age "
+                   "FROM zenodo_transfers WHERE id = %s AND username = %s")
             cursor.execute(sql, (transfer_id, username))
             return cursor.fetchone()
     finally:
         connection.close()
 
 
+def transfer_progress(transfer):
+    """
+    Upload progress of a transfer row from its last progress write: percent done,
+    throughput (bytes/s) and estimated seconds left. Unknown values are None;
+    throughput and ETA are only given while the upload is in progress.
+    """
+    sent, total = transfer.get('bytes_sent'), transfer.get('file_size')
+    rate = transfer.get('bytes_per_sec') if transfer['status'] == 'in_progress' else None
+    if transfer['status'] == 'completed':
+        percent = 100.0
+    elif sent is not None and total:
+        percent = round(sent * 100 / total, 1)
+    else:
+        percent = None
+    eta = round((total - sent) / rate) if rate and total and sent is not None else None
+    return {
+        'bytes_sent': sent,
+        'file_size': total,
+        'percent': percent,
+        'bytes_per_sec': rate,
+        'eta_seconds': eta,
+        'seconds_since_progress': transfer.get('progress_age'),
+    }
+
+
 # --- Resets a failed transfer so it can be re-queued ---
 def reset_transfer_for_retry(transfer_id):
     """
@@ -222,7 +743,8 @@ def reset_transfer_for_retry(transfer_id):
     try:
         with connection.cursor() as cursor:
             sql = ("UPDATE zenodo_transfers "
-                   "SET status = 'pending', retry_count = 0, zenodo_response = '' "
+                   "SET status = 'pending', retry_count = 0, zenodo_response = '', error_class = NULL, "
+                   "bytes_sent = NULL, bytes_per_sec = NULL, avg_bytes_per_sec = NULL, progress_at = NULL "
                    "WHERE id = %s")
             cursor.execute(sql, (transfer_id,))
         connection.commit()
@@ -231,66 +753,107 @@ def reset_transfer_for_retry(transfer_id):
 
 
 # --- Exports a CKAN resource into an existing Zenodo deposition ---
-def export_to_zenodo(zenodo_apikey, resource_id, filename, res_url, deposition_id):
+def export_to_zenodo(zenodo_apikey, resource_id, filename, res_url, deposition_id, package_id=None,
+                     user=None, deposition_name=None, source_modified=None, source_hash=None,
+                     replace=False):
     """
     Export a CKAN resource file to an existing Zenodo deposition.
     Creates a transfer record and enqueues an upload task in RabbitMQ.
-    Raises DuplicateTransfer if this resource + deposition combo already has a live transfer.
+    package_id records the CKAN package for package-wide cancellation.
+    user (username and email) defaults to the session's user; a known
+    deposition_name saves looking it up on Zenodo. source_modified and
+    source_hash (see source_version()) are recorded for incremental sync;
+    replace=True re-uploads a resource already exported to the deposition,
+    overwriting its file in the bucket.
+    Raises DuplicateTransfer if this resource + deposition combo already has a live transfer
+    (unless replace is set).
     Raises ResourceFileNotFound if the local file does not exist.
     Raises FileTooLarge if the file exceeds the configured size limit.
+    Returns the transfer ID.
     """
-    check_duplicate_transfer(resource_id, deposition_id)
+    if not replace:
+        check_duplicate_transfer(resource_id, deposition_id)
 
-    deposition_name = get_deposition_name(zenodo_apikey, deposition_id)
+    deposition_name = deposition_name or get_deposition_name(zenodo_apikey, deposition_id)
     file_path = get_file_path(resource_id, res_url)
 
-    if not os.path.exists(file_path):
+    if not preflight.stat(file_path).exists:
         logging.error(f"Resource file not found: {file_path}")
         raise ResourceFileNotFound(f"File not found: {file_path}")
 
-    _check_file_size(file_path)
+    file_size = _check_file_size(file_path)
+
+    user = user or session['user']
+    username = user['username']
+    user_email = user.get('email', '')
+    return create_transfer(username, file_path, zenodo_apikey, deposition_id, deposition_name, filename,
+                           resource_id, user_email, file_size=file_size, package_id=package_id,
+                           source_modified=source_modified, source_hash=source_hash)
+
+
+# --- Exports a CKAN resource into several Zenodo depositions at once ---
+def export_to_depositions(zenodo_apikey, resource_id, filename, res_url, deposition_ids,
+                          source_modified=None, source_hash=None):
+    """
+    Export a CKAN resource file to several existing depositions with one upload
+    task, so the worker reads the file only once (create_tee_transfer()).
+    Depositions the resource already has a live transfer to are left out.
+    Raises DuplicateTransfer if that leaves none, and ResourceFileNotFound or
+    FileTooLarge as export_to_zenodo() does.
+    Returns the transfer IDs, one per deposition exported to.
+    """
+    targets = []
+    for deposition_id in dict.fromkeys(deposition_ids):
+        try:
+            check_duplicate_transfer(resource_id, deposition_id)
+        except DuplicateTransfer:
+            logging.info(f"Resource {resource_id} already exported to deposition {deposition_id}; leaving it out")
+            continue
+        targets.append(deposition_id)
+    if not targets:
+        raise DuplicateTransfer(f"Resource {resource_id} is already associated with all selected depositions.")
+
+    file_path = get_file_path(resource_id, res_url)
+    if not preflight.stat(file_path).exists:
+        logging.error(f"Resource file not found: {file_path}")
+        raise ResourceFileNotFound(f"File not found: {file_path}")
+    file_size = _check_file_size(file_path)
 
     username = session['user']['username']
     user_email = session['user'].get('email', '')
-    transfer_id = insert_transfer_record(username, file_path, filename, deposition_id,
-                                         deposition_name, resource_id, user_email)
-    send_upload_task(username, file_path, zenodo_apikey, deposition_id, deposition_name,
-                     filename, transfer_id, user_email)
+    targets = [(deposition_id, get_deposition_name(zenodo_apikey, deposition_id)) for deposition_id in targets]
+    if len(targets) == 1:
+        return [create_transfer(username, file_path, zenodo_apikey, targets[0][0], targets[0][1], filename,
+                                resource_id, user_email, file_size=file_size,
+                                source_modified=source_modified, source_hash=source_hash)]
+    return create_tee_transfer(username, file_path, zenodo_apikey, targets, filename, resource_id,
+                               user_email, file_size=file_size,
+                               source_modified=source_modified, source_hash=source_hash)
 
 
-# --- Creates a new Zenodo deposition and exports a CKAN resource into it ---
-def create_deposit_and_export(zenodo_apikey, resource_id, filename, res_url,
-                               deposition_name, deposition_desc,
-                               upload_type=None, access_right=None):
+# --- Creates an empty Zenodo deposition ---
+def create_deposition(zenodo_apikey, title, description, creator, upload_type=None, access_right=None):
     """
-    Create a new Zenodo deposition with metadata and export a CKAN resource file into it.
-    upload_type and access_right override the config values when provided.
-    Raises ZenodoAPIError if deposition creation fails.
-    Raises ResourceFileNotFound if the local file does not exist; the orphaned deposition is deleted.
-    Raises FileTooLarge if the file exceeds the configured size limit.
+    Create a new Zenodo deposition with the given metadata and return it (Zenodo's JSON).
+    creator is a 'Family, Given' name; upload_type and access_right default to the config values.
+    Raises ZenodoAPIError if Zenodo does not create it.
     """
     zc = configs.get_zenodo_config()
     headers = {"Content-Type": "application/json"}
     params = {'access_token': zenodo_apikey}
-
-    effective_upload_type = upload_type or zc['upload_type']
-    effective_access_right = access_right or zc['access_right']
-
-    # Step 1: Create new deposition with configurable metadata
     metadata_payload = {
         "metadata": {
-            "upload_type": effective_upload_type,
-            "title": deposition_name,
-            "description": deposition_desc,
-            "access_right": effective_access_right,
-            'creators': [
-                {'name': session['user']['family_name'] + ', ' + session['user']['given_name'],
-                 'affiliation': 'MyAffiliation'}
-            ]
+            "upload_type": upload_type or zc['upload_type'],
+            "title": title,
+            "description": description,
+            "access_right": access_right or zc['access_right'],
+            'creators': [{'name': creator, 'affiliation': 'MyAffiliation'}]
         }
     }
 
-    response = requests.post(zc['api_url'], params=params, json=metadata_payload, headers=headers)
+    _acquire(zenodo_apikey)
+    response = requests.post(zc['api_url'], params=params, json=metadata_payload, headers=headers,
+                             timeout=zenodo_timeout())
 
     if response.status_code != 201:
         logging.error(f"Failed to create Zenodo deposition: HTTP {response.status_code}")
@@ -300,29 +863,188 @@ def create_deposit_and_export(zenodo_apikey, resource_id, filename, res_url,
         )
 
     deposition = response.json()
+    logging.info(f"Created Zenodo deposition: '{title}' (id={deposition['id']})")
+    return deposition
+
+
+# --- Creates a new Zenodo deposition and exports a CKAN resource into it ---
+def create_deposit_and_export(zenodo_apikey, resource_id, filename, res_url,
+                               deposition_name, deposition_desc,
+                               upload_type=None, access_right=None,
+                               source_modified=None, source_hash=None):
+    """
+    Create a new Zenodo deposition with metadata and export a CKAN resource file into it.
+    upload_type and access_right override the config values when provided.
+    source_modified and source_hash are recorded as in export_to_zenodo().
+    Raises ZenodoAPIError if deposition creation fails.
+    Raises ResourceFileNotFound if the local file does not exist; the orphaned deposition is deleted.
+    Raises FileTooLarge if the file exceeds the configured size limit.
+    """
+    zc = configs.get_zenodo_config()
+    params = {'access_token': zenodo_apikey}
+
+    # Step 1: Create new deposition with configurable metadata
+    creator = session['user']['family_name'] + ', ' + session['user']['given_name']
+    deposition = create_deposition(zenodo_apikey, deposition_name, deposition_desc, creator,
+                                   upload_type=upload_type, access_right=access_right)
     deposition_id = deposition['id']
-    logging.info(f"Created Zenodo deposition: '{deposition_name}' (id={deposition_id})")
 
     # Step 2: Check if CKAN file exists — clean up the deposition if not
     file_path = get_file_path(resource_id, res_url)
-    if not os.path.exists(file_path):
+    if not preflight.stat(file_path).exists:
         logging.error(f"Resource file not found: {file_path} — deleting orphaned deposition {deposition_id}")
         try:
-            requests.delete(f"{zc['api_url']}/{deposition_id}", params=params)
+            _acquire(zenodo_apikey)
+            requests.delete(f"{zc['api_url']}/{deposition_id}", params=params, timeout=zenodo_timeout())
             logging.info(f"Deleted orphaned deposition {deposition_id}")
         except Exception as del_err:
             logging.error(f"Failed to delete orphaned deposition {deposition_id}: {del_err}")
         raise ResourceFileNotFound(f"File not found: {file_path}")
 
-    _check_file_size(file_path)
+    file_size = _check_file_size(file_path)
 
     # Step 3: Create transfer record and enqueue upload
     username = session['user']['username']
     user_email = session['user'].get('email', '')
-    transfer_id = insert_transfer_record(username, file_path, filename, deposition_id,
-                                         deposition_name, resource_id, user_email)
-    send_upload_task(username, file_path, zenodo_apikey, deposition_id, deposition_name,
-                     filename, transfer_id, user_email)
+    create_transfer(username, file_path, zenodo_apikey, deposition_id, deposition_name, filename,
+                    resource_id, user_email, file_size=file_size,
+                    source_modified=source_modified, source_hash=source_hash)
+
+
+# --- Queues a package export for the worker to expand ---
+def create_package_job(zenodo_apikey, package_id, deposition_id, mode='export'):
+    """
+    Record a package export and queue one message for it; the worker fetches the
+    package from CKAN and creates a transfer per resource (worker.run_package_job).
+    mode 'sync' only exports the resources that are new or changed since their
+    last transfer to the deposition; mode 'newversion' exports them to a new
+    version of the (published) deposition, uploading only what changed; mode
+    'bundle' uploads its small files as one ZIP archive.
+    The row and the message are written in one transaction when the outbox or
+    the database queue is in use. Returns the job ID.
+    """
+    username = session['user']['username']
+    task = {
+        'type': 'package',
+        'username': username,
+        'user_email': session['user'].get('email', ''),
+        'zenodo_token': zenodo_apikey,
+        'package_id': package_id,
+        'deposition_id': deposition_id,
+        'mode': mode,
+    }
+    transactional = configs.get_outbox_config()['enabled'] or _db_queue()
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""INSERT INTO package_jobs (username, package_id, deposition_id, mode)
+                              VALUES (%s, %s, %s, %s)""", (username, package_id, deposition_id, mode))
+            task['job_id'] = cursor.lastrowid
+            if transactional:
+                _add_to_outbox(cursor, task)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    if not transactional:
+        publish_task(task)
+    logging.info(f"Package {mode} queued: {package_id} to deposition {deposition_id} "
+                 f"(job_id={task['job_id']}, user={username})")
+    return task['job_id']
+
+
+def get_package_jobs_for_user(username):
+    """Package export jobs of the given user, newest first."""
+    connection = db.get_connection()
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("SELECT * FROM package_jobs WHERE username = %s ORDER BY created_at DESC", (username,))
+            return cursor.fetchall()
+    finally:
+        connection.close()
+
+
+# --- Cancels transfers on the user's request ---
+def cancel_transfer(transfer_id, username):
+    """
+    Mark one of the user's scheduled, pending or in-progress transfers 'cancelled'.
+    Workers skip the queued message and abort an upload that is running.
+    Returns True if the transfer was cancelled.
+    """
+    return _cancel("id = %s", transfer_id, username) == 1
+
+
+def cancel_package_transfers(package_id, username):
+    """
+    Cancel every unfinished transfer the user exported from this CKAN package,
+    and stop package jobs still creating them. Returns the number of transfers.
+    """
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""UPDATE package_jobs SET status = 'cancelled'
+                              WHERE package_id = %s AND username = %s
+                                AND status IN ('pending', 'expanding')""", (package_id, username))
+        connection.commit()
+    finally:
+        connection.close()
+    return _cancel("package_id = %s", package_id, username)
+
+
+def _cancel(condition, value, username):
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            # A scheduled multi-target task lives only in its lead's task_payload
+            cursor.execute(f"""SELECT id, not_before, task_payload FROM zenodo_transfers
+                               WHERE {condition} AND username = %s AND status = 'scheduled'
+                                 AND task_payload IS NOT NULL
+                               FOR UPDATE""", (value, username))
+            leads = [row for row in cursor.fetchall() if 'targets' in json.loads(row[2])]
+            sql = f"""UPDATE zenodo_transfers
+                      SET status = 'cancelled', zenodo_response = 'Cancelled by user',
+                          not_before = NULL, task_payload = NULL
+                      WHERE {condition} AND username = %s
+                        AND status IN ({', '.join(['%s'] * len(CANCELLABLE_STATUSES))})"""
+            rows = cursor.execute(sql, (value, username, *CANCELLABLE_STATUSES))
+            for lead_id, not_before, task_payload in leads:
+                _hand_over_schedule(cursor, lead_id, not_before, json.loads(task_payload))
+        connection.commit()
+        return rows
+    finally:
+        connection.close()
+
+
+def _hand_over_schedule(cursor, lead_id, not_before, task):
+    """Make the first still-scheduled follower of a cancelled lead carry the task for the rest."""
+    cursor.execute("SELECT id FROM zenodo_transfers WHERE tee_lead_id = %s AND status = 'scheduled' "
+                   "ORDER BY id", (lead_id,))
+    open_ids = {row[0] for row in cursor.fetchall()}
+    targets = [target for target in task['targets'] if target['transfer_id'] in open_ids]
+    if not targets:
+        return
+    lead = targets[0]
+    task.update(targets=targets, transfer_id=lead['transfer_id'], deposition_id=lead['deposition_id'],
+                deposition_name=lead['deposition_name'])
+    cursor.execute("UPDATE zenodo_transfers SET tee_lead_id = NULL, not_before = %s, task_payload = %s "
+                   "WHERE id = %s", (not_before, json.dumps(task), lead['transfer_id']))
+    cursor.execute("UPDATE zenodo_transfers SET tee_lead_id = %s WHERE tee_lead_id = %s",
+                   (lead['transfer_id'], lead_id))
+    logging.info(f"Scheduled task of cancelled transfer {lead_id} handed over to transfer {lead['transfer_id']}")
+
+
+def is_cancelled(transfer_id):
+    """True if the transfer has been cancelled."""
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT status FROM zenodo_transfers WHERE id = %s", (transfer_id,))
+            row = cursor.fetchone()
+        return row is not None and row[0] == 'cancelled'
+    finally:
+        connection.close()
 
 
 # --- Retrieves transfer records for a given user ---
@@ -340,3 +1062,8 @@ def get_transfers_for_user(username):
         return results
     finally:
         connection.close()
+
+
+if __name__ == '__main__':
+    import bulk_export
+    bulk_export.main()
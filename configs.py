@@ -19,7 +19,8 @@ def get_ckan_config():
         'apikey': _config['ckan']['apikey'],
         'resources_path': _config['ckan']['resources_path'],
         'resources_usr_path': _config['ckan']['resources_usr_path'],
-        'resources_usr_url': _config['ckan']['resources_usr_url']
+        'resources_usr_url': _config['ckan']['resources_usr_url'],
+        'timeout': _config.getint('ckan', 'timeout', fallback=30),
     }
 
 
@@ -41,6 +42,117 @@ def get_rabbitmq_config():
     }
 
 
+def get_queue_config():
+    return {
+        'backend': _config.get('queue', 'backend', fallback='rabbitmq'),
+        'poll_interval': _config.getfloat('queue', 'poll_interval', fallback=1.0),
+        'visibility_timeout': _config.getint('queue', 'visibility_timeout', fallback=600),
+    }
+
+
+def get_worker_config():
+    return {
+        'heartbeat_interval': _config.getint('worker', 'heartbeat_interval', fallback=30),
+        'heartbeat_timeout': _config.getint('worker', 'heartbeat_timeout', fallback=180),
+        'reap_interval': _config.getint('worker', 'reap_interval', fallback=60),
+        'reap_batch_size': _config.getint('worker', 'reap_batch_size', fallback=100),
+        'progress_interval': _config.getint('worker', 'progress_interval', fallback=10),
+        'progress_percent': _config.getint('worker', 'progress_percent', fallback=5),
+        'cancel_check_interval': _config.getint('worker', 'cancel_check_interval', fallback=5),
+    }
+
+
+def get_scheduler_config():
+    return {
+        'lanes': _config.getint('scheduler', 'lanes', fallback=16),
+        'upload_slots': _config.getint('scheduler', 'upload_slots', fallback=4),
+        'max_uploads_per_user': _config.getint('scheduler', 'max_uploads_per_user', fallback=2),
+        'prefetch_per_lane': _config.getint('scheduler', 'prefetch_per_lane', fallback=10),
+        'user_weights': _config.get('scheduler', 'user_weights', fallback=''),
+        'small_file_mb': _config.getint('scheduler', 'small_file_mb', fallback=50),
+        'reserved_small_slots': _config.getint('scheduler', 'reserved_small_slots', fallback=1),
+    }
+
+
+def get_staging_config():
+    return {
+        'scratch_dir': _config.get('staging', 'scratch_dir', fallback=''),
+        'budget_mb': _config.getint('staging', 'budget_mb', fallback=20480),
+        'prefetch_files': _config.getint('staging', 'prefetch_files', fallback=2),
+        'copy_threads': _config.getint('staging', 'copy_threads', fallback=1),
+    }
+
+
+def get_offpeak_config():
+    return {
+        'min_file_mb': _config.getint('offpeak', 'min_file_mb', fallback=0),
+        'windows': _config.get('offpeak', 'windows', fallback='20:00-06:00'),
+        'max_concurrent_large': _config.getint('offpeak', 'max_concurrent_large', fallback=2),
+        'release_interval': _config.getint('offpeak', 'release_interval', fallback=60),
+    }
+
+
+def get_outbox_config():
+    return {
+        'enabled': _config.getboolean('outbox', 'enabled', fallback=False),
+        'batch_size': _config.getint('outbox', 'batch_size', fallback=100),
+        'relay_interval': _config.getfloat('outbox', 'relay_interval', fallback=1.0),
+    }
+
+
+def get_preflight_config():
+    return {
+        'threads': _config.getint('preflight', 'threads', fallback=16),
+        'cache_ttl': _config.getint('preflight', 'cache_ttl', fallback=60),
+        'max_entries': _config.getint('preflight', 'max_entries', fallback=10000),
+    }
+
+
+def get_planner_config():
+    return {
+        'history_transfers': _config.getint('planner', 'history_transfers', fallback=200),
+        'largest_files': _config.getint('planner', 'largest_files', fallback=10),
+    }
+
+
+def get_bundle_config():
+    return {
+        'max_member_mb': _config.getint('bundle', 'max_member_mb', fallback=10),
+    }
+
+
+def get_rate_limit_config():
+    return {
+        'backend': _config.get('rate_limit', 'backend', fallback='mysql'),
+        'requests_per_minute': _config.getint('rate_limit', 'requests_per_minute', fallback=90),
+        'burst': _config.getint('rate_limit', 'burst', fallback=5),
+        'max_concurrent_uploads': _config.getint('rate_limit', 'max_concurrent_uploads', fallback=2),
+        'lease_seconds': _config.getint('rate_limit', 'lease_seconds', fallback=600),
+        'web_max_wait': _config.getfloat('rate_limit', 'web_max_wait', fallback=5.0),
+    }
+
+
+def get_retry_config():
+    return {
+        'policy': _config.get('retry', 'policy', fallback='retry_policy.RetryPolicy'),
+        'base_delay': _config.getint('retry', 'base_delay', fallback=10),
+        'max_delay': _config.getint('retry', 'max_delay', fallback=300),
+        'jitter': _config.getfloat('retry', 'jitter', fallback=0.5),
+        'max_retry_after': _config.getint('retry', 'max_retry_after', fallback=300),
+    }
+
+
+def get_circuit_breaker_config():
+    return {
+        'enabled': _config.getboolean('circuit_breaker', 'enabled', fallback=True),
+        'window_seconds': _config.getint('circuit_breaker', 'window_seconds', fallback=300),
+        'min_calls': _config.getint('circuit_breaker', 'min_calls', fallback=5),
+        'failure_rate': _config.getfloat('circuit_breaker', 'failure_rate', fallback=0.5),
+        'open_seconds': _config.getint('circuit_breaker', 'open_seconds', fallback=120),
+        'state_cache_seconds': _config.getint('circuit_breaker', 'state_cache_seconds', fallback=5),
+    }
+
+
 def get_zenodo_config():
     use_sandbox = _config.getboolean('zenodo', 'use_sandbox', fallback=False)
     api_url = _config['zenodo']['api_url']
@@ -51,6 +163,13 @@ def get_zenodo_config():
         'use_sandbox': use_sandbox,
         'upload_type': _config.get('zenodo', 'upload_type', fallback='dataset'),
         'access_right': _config.get('zenodo', 'access_right', fallback='restricted'),
+        'connect_timeout': _config.getint('zenodo', 'connect_timeout', fallback=10),
+        'read_timeout': _config.getint('zenodo', 'read_timeout', fallback=300),
+        'min_upload_kbps': _config.getint('zenodo', 'min_upload_kbps', fallback=0),
+        'stall_seconds': _config.getint('zenodo', 'stall_seconds', fallback=120),
+        'upload_block_kb': _config.getint('zenodo', 'upload_block_kb', fallback=8192),
+        'tee_buffer_blocks': _config.getint('zenodo', 'tee_buffer_blocks', fallback=4),
+        'upload_drop_cache': _config.getboolean('zenodo', 'upload_drop_cache', fallback=True),
     }
 
 
@@ -63,6 +182,25 @@ def get_app_config():
     }
 
 
+def get_server_config():
+    return {
+        'host': _config.get('server', 'host', fallback='0.0.0.0'),
+        'port': _config.getint('server', 'port', fallback=8090),
+        'threads': _config.getint('server', 'threads', fallback=4),
+        'connection_limit': _config.getint('server', 'connection_limit', fallback=100),
+        'backlog': _config.getint('server', 'backlog', fallback=1024),
+        'channel_timeout': _config.getint('server', 'channel_timeout', fallback=120),
+        'processes': _config.getint('server', 'processes', fallback=1),
+    }
+
+
+def get_health_config():
+    return {
+        'probe_interval': _config.getint('health', 'probe_interval', fallback=30),
+        'probe_timeout': _config.getint('health', 'probe_timeout', fallback=5),
+    }
+
+
 def get_smtp_config():
     return {
         'enabled': _config.getboolean('smtp', 'enabled', fallback=False),
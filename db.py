@@ -20,6 +20,12 @@ def _get_pool():
     return _pool
 
 
+def reset_pool():
+    """Forget the current pool so the next get_connection() builds a fresh one (e.g. after fork)."""
+    global _pool
+    _pool = None
+
+
 def get_connection():
     """Return a pooled DB connection. Call .close() to return it to the pool."""
     return _get_pool().connection()
@@ -0,0 +1,235 @@
+"""
+Background health prober for the web tier.
+
+A daemon thread checks the database, RabbitMQ, the CKAN API and the Zenodo API
+every [health] probe_interval seconds and keeps the latest result in memory,
+together with the shared state of the workers' Zenodo circuit breaker. /health
+and /metrics only read that snapshot, so monitor and orchestrator probes never
+open connections themselves. One prober runs per server process; run_server()
+starts it (in each child when pre-forking), otherwise it is started on first use,
+and a forked child gets its own. Until its first run completes the snapshot
+reports 'stale'.
+"""
+import os
+import time
+import logging
+import datetime
+import threading
+import pika
+import pymysql
+import requests
+import configs
+import circuit_breaker
+
+# Components whose failure makes the service unable to accept exports (HTTP 503)
+CRITICAL = ('db', 'rabbitmq')
+
+
+def _check_db(timeout):
+    # A connection of its own rather than a pooled one, so the timeouts apply
+    conn = pymysql.connect(**configs.get_db_config(), connect_timeout=timeout,
+                           read_timeout=timeout, write_timeout=timeout)
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+    finally:
+        conn.close()
+
+
+def _check_rabbitmq(timeout):
+    if configs.get_queue_config()['backend'] == 'mysql':
+        return  # the upload queue lives in the database, checked above
+    rc = configs.get_rabbitmq_config()
+    conn = pika.BlockingConnection(
+        pika.ConnectionParameters(host=rc['host'], socket_timeout=timeout, connection_attempts=1)
+    )
+    conn.close()
+
+
+def _check_ckan(timeout):
+    cc = configs.get_ckan_config()
+    r = requests.get(f"{cc['server'].rstrip('/')}/api/3/action/status_show", timeout=timeout)
+    r.raise_for_status()
+
+
+def _check_zenodo(timeout):
+    # Unauthenticated: any non-5xx answer (typically 401) proves the API is reachable
+    zc = configs.get_zenodo_config()
+    r = requests.get(zc['api_url'], timeout=timeout)
+    if r.status_code >= 500:
+        raise requests.exceptions.HTTPError(f"HTTP {r.status_code}", response=r)
+
+
+def _read_circuit():
+    row = circuit_breaker.read_state('zenodo') or {'state': circuit_breaker.CLOSED}
+    return {
+        'state': row['state'],
+        'reason': row.get('reason'),
+        'opened_at': row['opened_at'].isoformat(timespec='seconds') if row.get('opened_at') else None,
+        'trips': row.get('trips', 0),
+        'calls': row.get('calls'),
+        'error_rate': row.get('error_rate'),
+        'latency_ms': row.get('latency_ms'),
+    }
+
+
+class HealthProber:
+    """Runs every check on an interval and serves the last results from memory."""
+
+    checks = {
+        'db': _check_db,
+        'rabbitmq': _check_rabbitmq,
+        'ckan': _check_ckan,
+        'zenodo': _check_zenodo,
+    }
+
+    def __init__(self, interval=30, timeout=5):
+        self.interval = interval
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._results = {}
+        self._circuit = None
+        self._last_run = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def run_once(self):
+        """Run all checks now and replace the cached results."""
+        results = {}
+        for name, check in self.checks.items():
+            started = time.perf_counter()
+            try:
+                check(self.timeout)
+                status = 'ok'
+            except Exception as e:
+                status = f'error: {e}'
+            results[name] = {
+                'status': status,
+                'latency_ms': round((time.perf_counter() - started) * 1000, 1),
+                'checked_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            }
+        try:
+            circuit = _read_circuit()
+        except Exception as e:
+            circuit = {'state': f'unknown: {e}'}
+        with self._lock:
+            self._results = results
+            self._circuit = circuit
+            self._last_run = time.monotonic()
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error(f"Health probe run failed: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        """Start probing in a daemon thread; the first probe runs there at once, not in the caller."""
+        self._thread = threading.Thread(target=self._loop, name='health-prober', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def snapshot(self):
+        """
+        Return the cached health document. The service counts as healthy only when
+        every critical component is ok and the results are no older than three
+        probe intervals (otherwise the prober itself is presumed stuck). An open
+        Zenodo circuit makes it degraded, not unready.
+        """
+        with self._lock:
+            results = {name: dict(r) for name, r in self._results.items()}
+            circuit = dict(self._circuit) if self._circuit else None
+            last_run = self._last_run
+        age = time.monotonic() - last_run if last_run is not None else None
+        stale = age is None or age > 3 * self.interval
+
+        doc = {name: r['status'] for name, r in results.items()}
+        doc['checks'] = results
+        doc['zenodo_circuit'] = circuit
+        doc['snapshot_age_s'] = round(age, 1) if age is not None else None
+        critical_ok = not stale and all(results.get(c, {}).get('status') == 'ok' for c in CRITICAL)
+        circuit_open = circuit is not None and circuit['state'] in (circuit_breaker.OPEN, circuit_breaker.HALF_OPEN)
+        all_ok = critical_ok and not circuit_open and all(r['status'] == 'ok' for r in results.values())
+        doc['status'] = 'healthy' if all_ok else ('stale' if stale else 'degraded')
+        doc['ready'] = critical_ok
+        return doc
+
+
+_prober = None
+_prober_pid = None
+_prober_lock = threading.Lock()
+
+
+def get_prober():
+    """Return this process's prober, starting it on first use (and again after a fork)."""
+    global _prober, _prober_pid
+    with _prober_lock:
+        if _prober is None or _prober_pid != os.getpid():
+            hc = configs.get_health_config()
+            _prober = HealthProber(interval=hc['probe_interval'], timeout=hc['probe_timeout'])
+            _prober_pid = os.getpid()
+            _prober.start()
+        return _prober
+
+
+def get_snapshot():
+    return get_prober().snapshot()
+
+
+def reset():
+    """Stop and forget the current prober; the next get_prober() starts a new one."""
+    global _prober, _prober_pid
+    with _prober_lock:
+        if _prober is not None and _prober_pid == os.getpid():
+            _prober.stop()
+        _prober = None
+        _prober_pid = None
+
+
+def render_metrics(doc):
+    """Render a health snapshot in the Prometheus text exposition format."""
+    lines = [
+        '# HELP ckan_zenodo_component_up Whether the component passed its last health check.',
+        '# TYPE ckan_zenodo_component_up gauge',
+    ]
+    for name, check in doc['checks'].items():
+        lines.append(f'ckan_zenodo_component_up{{component="{name}"}} {int(check["status"] == "ok")}')
+    lines += [
+        '# HELP ckan_zenodo_component_latency_ms Duration of the last health check.',
+        '# TYPE ckan_zenodo_component_latency_ms gauge',
+    ]
+    for name, check in doc['checks'].items():
+        lines.append(f'ckan_zenodo_component_latency_ms{{component="{name}"}} {check["latency_ms"]}')
+    lines += [
+        '# HELP ckan_zenodo_ready Whether the service can accept exports.',
+        '# TYPE ckan_zenodo_ready gauge',
+        f'ckan_zenodo_ready {int(doc["ready"])}',
+    ]
+
+    circuit = doc.get('zenodo_circuit')
+    if circuit and circuit['state'] in (circuit_breaker.CLOSED, circuit_breaker.OPEN, circuit_breaker.HALF_OPEN):
+        lines += [
+            '# HELP ckan_zenodo_circuit_state Current state of the Zenodo circuit breaker.',
+            '# TYPE ckan_zenodo_circuit_state gauge',
+        ]
+        for state in (circuit_breaker.CLOSED, circuit_breaker.OPEN, circuit_breaker.HALF_OPEN):
+            lines.append(f'ckan_zenodo_circuit_state{{state="{state}"}} {int(circuit["state"] == state)}')
+        lines += [
+            '# HELP ckan_zenodo_circuit_trips_total Times the Zenodo circuit breaker has opened.',
+            '# TYPE ckan_zenodo_circuit_trips_total counter',
+            f'ckan_zenodo_circuit_trips_total {circuit["trips"]}',
+        ]
+        for key, help_text in (('error_rate', 'Share of failed Zenodo calls in the last reported worker window.'),
+                               ('latency_ms', 'Mean Zenodo call duration in the last reported worker window.')):
+            if circuit.get(key) is not None:
+                lines += [
+                    f'# HELP ckan_zenodo_circuit_{key} {help_text}',
+                    f'# TYPE ckan_zenodo_circuit_{key} gauge',
+                    f'ckan_zenodo_circuit_{key} {circuit[key]}',
+                ]
+    return '\n'.join(lines) + '\n'
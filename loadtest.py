@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Load generator for the Flask web tier.
+
+Starts server.app under Waitress in a child process with every backend call
+(CKAN, Zenodo, MariaDB, RabbitMQ) replaced by a local stub that only sleeps
+for a configurable latency, then drives it with N simulated logged-in users.
+Users carry a forged, correctly signed session cookie, so no Keycloak round
+trip is needed.
+
+Each user loops over a weighted mix of /export, /ajax list_depositions,
+/ajax export_to_zenodo, /transfers and /api/transfer/<id> until the run
+duration expires. The run is repeated for every Waitress thread count given
+and a per-route throughput / tail-latency table is printed for each.
+
+Usage:
+    python3 loadtest.py                                  # 20 users, 4 threads, 20s
+    python3 loadtest.py --users 50 --threads 4,8,16 --duration 30
+    python3 loadtest.py --backend-latency-ms 150 --json results.json
+"""
+import sys
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import threading
+import multiprocessing
+import requests
+
+RESOURCE_ID = '12345678-1234-1234-1234-123456789abc'
+ROUTES = ('export', 'list_depositions', 'export_to_zenodo', 'transfers', 'transfer_status')
+DEFAULT_MIX = 'export=2,list_depositions=1,export_to_zenodo=1,transfers=2,transfer_status=6'
+# Both processes sign/verify the forged session cookies with this key
+SECRET_KEY = 'load-test-secret-key'
+
+
+def _percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    rank = max(math.ceil(pct / 100.0 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def _parse_mix(spec):
+    """Parse 'route=weight,route=weight' into a dict, rejecting unknown routes."""
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ROUTES:
+            raise ValueError(f"Unknown route in mix: {name!r}")
+        mix[name] = int(weight or 1)
+    return mix
+
+
+# --- Server side (runs in the child process) ---------------------------------
+
+def _install_stubs(latency, transfer_rows):
+    """Replace every backend call made by the measured routes with a sleeping stub."""
+    import ckan_zenodo
+
+    def _backend(result):
+        def stub(*args, **kwargs):
+            if latency:
+                time.sleep(latency)
+            return result
+        return stub
+
+    resource = {'id': RESOURCE_ID, 'name': 'dataset.csv', 'url': 'http://ckan.local/dataset.csv',
+                'package_id': 'load-test-package'}
+    package = {'id': 'load-test-package', 'title': 'Load test package', 'notes': '',
+               'resources': [resource]}
+    transfer = {'id': 1, 'status': 'in_progress', 'retry_count': 0,
+                'updated_at': '2026-01-01 12:00:00'}
+    rows = [{'id': i, 'filename': f'file-{i}.csv', 'deposition_name': 'Load test',
+             'status': 'completed', 'retry_count': 0,
+             'created_at': '2026-01-01 12:00:00', 'updated_at': '2026-01-01 12:00:00'}
+            for i in range(transfer_rows)]
+
+    ckan_zenodo.get_ckan_resource = _backend(resource)
+    ckan_zenodo.get_ckan_package = _backend(package)
+    ckan_zenodo.get_depositions = _backend([{'id': 99, 'title': 'Load test deposition'}])
+    ckan_zenodo.export_to_zenodo = _backend(None)
+    ckan_zenodo.create_package_job = _backend(1)
+    ckan_zenodo.get_transfers_for_user = _backend(rows)
+    ckan_zenodo.get_package_jobs_for_user = _backend([])
+    ckan_zenodo.get_transfer_by_id = _backend(transfer)
+
+
+def _serve(threads, latency, transfer_rows, port_queue):
+    from waitress import create_server
+    import server
+
+    # Queue-depth warnings are expected under load and would drown the report
+    logging.getLogger('waitress.queue').setLevel(logging.ERROR)
+    _install_stubs(latency, transfer_rows)
+    server.app.secret_key = SECRET_KEY
+    server.app.config['WTF_CSRF_ENABLED'] = False
+    httpd = create_server(server.app, host='127.0.0.1', port=0, threads=threads,
+                          connection_limit=10000, backlog=2048)
+    port_queue.put(httpd.effective_port)
+    httpd.run()
+
+
+def _session_cookie(username):
+    """Return (cookie_name, value) for a session that looks logged in to server.app."""
+    import server
+
+    app = server.app
+    app.secret_key = SECRET_KEY
+    serializer = app.session_interface.get_signing_serializer(app)
+    value = serializer.dumps({
+        'user': {'username': username, 'email': f'{username}@loadtest.local',
+                 'given_name': 'Load', 'family_name': 'Test'},
+        'zenodo_apikey': 'load-test-key',
+    })
+    return app.config['SESSION_COOKIE_NAME'], value
+
+
+# --- Client side -------------------------------------------------------------
+
+def _request(http, base, route):
+    if route == 'export':
+        return http.get(f'{base}/export', params={'resource': RESOURCE_ID})
+    if route == 'list_depositions':
+        return http.post(f'{base}/ajax', data={'action': 'list_depositions',
+                                               'zenodo_apikey': 'load-test-key'})
+    if route == 'export_to_zenodo':
+        return http.post(f'{base}/ajax', data={'action': 'export_to_zenodo',
+                                               'ckan_resource_id': RESOURCE_ID,
+                                               'deposition_id': '99'})
+    if route == 'transfers':
+        return http.get(f'{base}/transfers')
+    return http.get(f'{base}/api/transfer/1')
+
+
+def _user_loop(user_no, base, mix, deadline, samples, lock):
+    name, value = _session_cookie(f'loaduser{user_no}')
+    http = requests.Session()
+    http.cookies.set(name, value, domain='127.0.0.1', path='/')
+    routes, weights = zip(*mix.items())
+    rng = random.Random(user_no)
+    local = []
+    while time.monotonic() < deadline:
+        route = rng.choices(routes, weights)[0]
+        started = time.perf_counter()
+        try:
+            ok = _request(http, base, route).status_code < 400
+        except requests.exceptions.RequestException:
+            ok = False
+        local.append((route, time.perf_counter() - started, ok))
+    with lock:
+        samples.extend(local)
+
+
+def run_scenario(threads, users, duration, mix, latency, transfer_rows):
+    """Run one load scenario against a fresh server process and return the per-route summary."""
+    port_queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_serve, args=(threads, latency, transfer_rows, port_queue),
+                                   daemon=True)
+    proc.start()
+    try:
+        base = f'http://127.0.0.1:{port_queue.get(timeout=30)}'
+        samples, lock = [], threading.Lock()
+        started = time.monotonic()
+        deadline = started + duration
+        clients = [threading.Thread(target=_user_loop, args=(n, base, mix, deadline, samples, lock))
+                   for n in range(users)]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        elapsed = time.monotonic() - started
+    finally:
+        proc.terminate()
+        proc.join()
+    return summarise(samples, elapsed, threads=threads, users=users)
+
+
+def summarise(samples, elapsed, threads, users):
+    """Aggregate (route, seconds, ok) samples into throughput and latency percentiles per route."""
+    by_route = {}
+    for route, seconds, ok in samples:
+        by_route.setdefault(route, []).append((seconds, ok))
+
+    routes = {}
+    for route, items in sorted(by_route.items()):
+        latencies = sorted(s for s, _ in items)
+        routes[route] = {
+            'requests': len(items),
+            'errors': sum(1 for _, ok in items if not ok),
+            'rps': len(items) / elapsed if elapsed else 0.0,
+            'p50_ms': _percentile(latencies, 50) * 1000,
+            'p95_ms': _percentile(latencies, 95) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000,
+        }
+    all_latencies = sorted(s for _, s, _ in samples)
+    return {
+        'threads': threads,
+        'users': users,
+        'elapsed_s': elapsed,
+        'requests': len(samples),
+        'errors': sum(1 for *_, ok in samples if not ok),
+        'rps': len(samples) / elapsed if elapsed else 0.0,
+        'p99_ms': _percentile(all_latencies, 99) * 1000,
+        'routes': routes,
+    }
+
+
+def print_report(result):
+    print(f"\nwaitress threads={result['threads']}  users={result['users']}  "
+          f"{result['requests']} requests in {result['elapsed_s']:.1f}s  "
+          f"= {result['rps']:.1f} req/s  (errors: {result['errors']}, p99 {result['p99_ms']:.1f} ms)")
+    print(f"  {'route':<20} {'reqs':>7} {'err':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8}")
+    print('  ' + '-' * 78)
+    for route, r in result['routes'].items():
+        print(f"  {route:<20} {r['requests']:>7} {r['errors']:>5} {r['rps']:>8.1f} {r['p50_ms']:>8.1f} "
+              f"{r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['max_ms']:>8.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-test the web tier with stubbed backends')
+    parser.add_argument('--users', type=int, default=20, help='Number of simulated logged-in users')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds per scenario')
+    parser.add_argument('--threads', default='4', help='Comma-separated Waitress thread counts to compare')
+    parser.add_argument('--backend-latency-ms', type=float, default=50,
+                        help='Simulated latency of every CKAN/Zenodo/DB call')
+    parser.add_argument('--transfer-rows', type=int, default=50,
+                        help='Rows rendered by the stubbed /transfers page')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Weighted route mix, e.g. "export=1,transfers=3"')
+    parser.add_argument('--json', metavar='FILE', help='Also write the raw results as JSON')
+    args = parser.parse_args()
+
+    try:
+        mix = _parse_mix(args.mix)
+    except ValueError as exc:
+        sys.exit(str(exc))
+
+    results = []
+    for threads in (int(t) for t in args.threads.split(',')):
+        result = run_scenario(threads, args.users, args.duration, mix,
+                              args.backend_latency_ms / 1000.0, args.transfer_rows)
+        print_report(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=2)
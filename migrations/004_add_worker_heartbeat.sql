@@ -0,0 +1,10 @@
+-- Record which worker owns an in-flight transfer and when it last reported in.
+-- task_payload holds the queued message while the transfer is in flight so that
+-- `worker.py reap` can re-enqueue transfers orphaned by a dead worker.
+ALTER TABLE zenodo_transfers
+    ADD COLUMN IF NOT EXISTS worker_id VARCHAR(255) NULL,
+    ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP NULL DEFAULT NULL,
+    ADD COLUMN IF NOT EXISTS task_payload TEXT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_transfers_status_heartbeat
+    ON zenodo_transfers (status, heartbeat_at);
@@ -0,0 +1,19 @@
+-- Shared state of the Zenodo circuit breaker used by every worker process.
+-- Workers trip it to 'open' when too many Zenodo calls fail; one worker at a
+-- time may claim the 'half_open' probe. calls/error_rate/latency_ms are the
+-- last window statistics reported by a worker, for /health and /metrics.
+CREATE TABLE IF NOT EXISTS circuit_breakers (
+    name VARCHAR(64) NOT NULL PRIMARY KEY,
+    state ENUM('closed', 'open', 'half_open') NOT NULL DEFAULT 'closed',
+    reason TEXT NULL,
+    opened_at TIMESTAMP NULL DEFAULT NULL,
+    probe_owner VARCHAR(255) NULL,
+    probe_started_at TIMESTAMP NULL DEFAULT NULL,
+    trips INT NOT NULL DEFAULT 0,
+    calls INT NULL,
+    error_rate FLOAT NULL,
+    latency_ms FLOAT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+INSERT IGNORE INTO circuit_breakers (name) VALUES ('zenodo');
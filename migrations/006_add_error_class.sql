@@ -0,0 +1,4 @@
+-- Classification of the most recent failed upload attempt, as decided by the
+-- worker's retry policy: permanent, throttled, transient or unknown.
+ALTER TABLE zenodo_transfers
+    ADD COLUMN IF NOT EXISTS error_class VARCHAR(32) NULL AFTER retry_count;
@@ -0,0 +1,15 @@
+-- Per-token rate limiting shared by all workers (see rate_limiter.py).
+-- Rows are keyed by a hash of the Zenodo API token, never the token itself.
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+    fingerprint CHAR(32) NOT NULL PRIMARY KEY,
+    tokens DOUBLE NOT NULL DEFAULT 0,
+    refilled_at DATETIME(6) NOT NULL DEFAULT '2000-01-01 00:00:00'
+);
+
+CREATE TABLE IF NOT EXISTS upload_leases (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    fingerprint CHAR(32) NOT NULL,
+    owner VARCHAR(255) NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    INDEX idx_upload_leases_fingerprint (fingerprint, expires_at)
+);
@@ -0,0 +1,10 @@
+-- Off-peak scheduling of large transfers: a 'scheduled' transfer waits, with its
+-- task in task_payload, until `worker.py release` queues it inside a bandwidth
+-- window no earlier than not_before. file_size is recorded for every transfer.
+ALTER TABLE zenodo_transfers
+    MODIFY COLUMN status ENUM('scheduled', 'pending', 'in_progress', 'completed', 'failed') DEFAULT 'pending',
+    ADD COLUMN IF NOT EXISTS file_size BIGINT NULL AFTER filename,
+    ADD COLUMN IF NOT EXISTS not_before DATETIME NULL AFTER status;
+
+CREATE INDEX IF NOT EXISTS idx_transfers_status_not_before
+    ON zenodo_transfers (status, not_before);
@@ -0,0 +1,7 @@
+-- Live upload progress, written by the worker at most every [worker]
+-- progress_interval seconds or progress_percent percent of the file.
+-- file_size is refreshed with the size actually being uploaded.
+ALTER TABLE zenodo_transfers
+    ADD COLUMN IF NOT EXISTS bytes_sent BIGINT NULL AFTER file_size,
+    ADD COLUMN IF NOT EXISTS bytes_per_sec DOUBLE NULL AFTER bytes_sent,
+    ADD COLUMN IF NOT EXISTS progress_at TIMESTAMP NULL DEFAULT NULL AFTER bytes_per_sec;
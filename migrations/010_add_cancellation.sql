@@ -0,0 +1,9 @@
+-- User-initiated cancellation: the 'cancelled' status, and the CKAN package a
+-- transfer was exported from so all transfers of a package can be cancelled at once.
+ALTER TABLE zenodo_transfers
+    MODIFY COLUMN status ENUM('scheduled', 'pending', 'in_progress', 'completed', 'failed', 'cancelled')
+        DEFAULT 'pending',
+    ADD COLUMN IF NOT EXISTS package_id VARCHAR(100) NULL AFTER resource_id;
+
+CREATE INDEX IF NOT EXISTS idx_transfers_user_package
+    ON zenodo_transfers (username, package_id);
@@ -0,0 +1,9 @@
+-- Transactional outbox: with [outbox] enabled, an export writes its upload task
+-- here in the same transaction as the transfer row, and `worker.py relay`
+-- publishes the rows to RabbitMQ with publisher confirms, then deletes them.
+CREATE TABLE IF NOT EXISTS transfer_outbox (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    transfer_id INT NOT NULL,
+    payload TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,14 @@
+-- Database-backed upload queue ([queue] backend = mysql): one row per queued
+-- task, claimed by workers with SELECT ... FOR UPDATE SKIP LOCKED and hidden
+-- from other workers until visible_at while it is being processed.
+CREATE TABLE IF NOT EXISTS upload_jobs (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    queue VARCHAR(255) NOT NULL,
+    body TEXT NOT NULL,
+    visible_at DATETIME NOT NULL,
+    claimed_by VARCHAR(255) NULL,
+    deliveries INT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_upload_jobs_queue_visible (queue, visible_at, id),
+    INDEX idx_upload_jobs_claimed_by (claimed_by)
+);
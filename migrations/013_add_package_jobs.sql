@@ -0,0 +1,21 @@
+-- Package exports run as one job in the worker: the web request only records a
+-- package_jobs row and queues a small message; the worker fetches the package
+-- from CKAN, creates the per-file transfers and keeps the job's counts current.
+CREATE TABLE IF NOT EXISTS package_jobs (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    username VARCHAR(255) NOT NULL,
+    package_id VARCHAR(100) NOT NULL,
+    deposition_id VARCHAR(50) NOT NULL,
+    status ENUM('pending', 'expanding', 'completed', 'failed', 'cancelled') DEFAULT 'pending',
+    total INT NULL,
+    queued INT NOT NULL DEFAULT 0,
+    skipped INT NOT NULL DEFAULT 0,
+    failed INT NOT NULL DEFAULT 0,
+    message TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_package_jobs_user_package (username, package_id)
+);
+
+-- Package job messages go through the outbox too and have no transfer
+ALTER TABLE transfer_outbox MODIFY COLUMN transfer_id INT NULL;
@@ -0,0 +1,12 @@
+-- Incremental sync: the CKAN version (last_modified and hash) of the resource a
+-- transfer uploaded, so a sync job can tell which resources changed since, and
+-- the mode of a package job.
+ALTER TABLE zenodo_transfers
+    ADD COLUMN IF NOT EXISTS source_modified VARCHAR(32) NULL AFTER package_id,
+    ADD COLUMN IF NOT EXISTS source_hash VARCHAR(255) NULL AFTER source_modified;
+
+CREATE INDEX IF NOT EXISTS idx_transfers_deposition_resource
+    ON zenodo_transfers (deposition_id, resource_id);
+
+ALTER TABLE package_jobs
+    ADD COLUMN IF NOT EXISTS mode ENUM('export', 'sync') NOT NULL DEFAULT 'export' AFTER deposition_id;
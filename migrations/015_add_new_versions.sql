@@ -0,0 +1,6 @@
+-- New-version exports: a package job can open a new version of a published
+-- Zenodo record and upload only the files that changed; the draft it opened is
+-- recorded on the job.
+ALTER TABLE package_jobs
+    MODIFY COLUMN mode ENUM('export', 'sync', 'newversion') NOT NULL DEFAULT 'export',
+    ADD COLUMN IF NOT EXISTS version_deposition_id VARCHAR(50) NULL AFTER mode;
@@ -0,0 +1,4 @@
+-- Multi-target exports: one upload task serves several transfers (one per
+-- deposition). The other transfers point to the one that carries the task.
+ALTER TABLE zenodo_transfers
+    ADD COLUMN IF NOT EXISTS tee_lead_id INT NULL AFTER source_hash;
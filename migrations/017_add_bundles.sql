@@ -0,0 +1,8 @@
+-- Bundle exports: a package job can upload the package's small files as one
+-- ZIP archive, streamed on the fly. The archive's transfer keeps a manifest of
+-- its members (resource, name, size and, once uploaded, CRC-32 and offset).
+ALTER TABLE package_jobs
+    MODIFY COLUMN mode ENUM('export', 'sync', 'newversion', 'bundle') NOT NULL DEFAULT 'export';
+
+ALTER TABLE zenodo_transfers
+    ADD COLUMN IF NOT EXISTS bundle_manifest MEDIUMTEXT NULL AFTER tee_lead_id;
@@ -0,0 +1,4 @@
+-- The followers of a multi-target export are looked up by their lead when the
+-- releaser queues a scheduled task and when a scheduled lead is cancelled.
+CREATE INDEX IF NOT EXISTS idx_transfers_tee_lead
+    ON zenodo_transfers (tee_lead_id);
@@ -0,0 +1,5 @@
+-- Average throughput of a whole upload (file size over upload time), written
+-- with the last block. The planner projects export times from it; bytes_per_sec
+-- only holds the rate since the previous progress write.
+ALTER TABLE zenodo_transfers
+    ADD COLUMN IF NOT EXISTS avg_bytes_per_sec DOUBLE NULL AFTER bytes_per_sec;
@@ -0,0 +1,70 @@
+"""
+Off-peak windows for large transfers.
+
+Files above [offpeak] min_file_mb are not queued straight away. Their transfer
+is recorded as 'scheduled' with a not_before time — the start of the next
+bandwidth window — and `worker.py release` moves them into the upload queue
+only while a window is open, never letting more than max_concurrent_large
+large uploads be queued or running at once.
+
+Windows are given as local HH:MM-HH:MM ranges, e.g. "20:00-06:00, 12:00-13:00";
+a range whose end is not after its start runs past midnight.
+"""
+import datetime
+import configs
+
+
+def parse_windows(spec):
+    """Parse '20:00-06:00, 12:00-13:00' into [(1200, 360), (720, 780)] (minutes after midnight)."""
+    windows = []
+    for part in (spec or '').split(','):
+        if not part.strip():
+            continue
+        start, _, end = part.partition('-')
+        windows.append((_minutes(start), _minutes(end)))
+    return windows
+
+
+def _minutes(hhmm):
+    hours, _, minutes = hhmm.strip().partition(':')
+    return int(hours) * 60 + int(minutes or 0)
+
+
+def in_window(now, windows):
+    """True if the local datetime now falls inside one of the windows (always True without windows)."""
+    if not windows:
+        return True
+    minute = now.hour * 60 + now.minute
+    for start, end in windows:
+        if start < end and start <= minute < end:
+            return True
+        if start >= end and (minute >= start or minute < end):
+            return True
+    return False
+
+
+def next_window_start(now, windows):
+    """The earliest moment at or after now that lies inside a window."""
+    if in_window(now, windows):
+        return now.replace(microsecond=0)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    starts = [midnight + datetime.timedelta(days=day, minutes=start)
+              for day in (0, 1) for start, _ in windows]
+    return min(start for start in starts if start > now)
+
+
+def min_file_bytes():
+    """Size above which transfers wait for a window, or 0 when off-peak scheduling is disabled."""
+    return configs.get_offpeak_config()['min_file_mb'] * 1024 * 1024
+
+
+def is_large(file_size):
+    """True if a file of this many bytes must wait for an off-peak window."""
+    threshold = min_file_bytes()
+    return threshold > 0 and file_size is not None and file_size > threshold
+
+
+def not_before(now=None):
+    """When a transfer scheduled now may be released."""
+    windows = parse_windows(configs.get_offpeak_config()['windows'])
+    return next_window_start(now or datetime.datetime.now(), windows)
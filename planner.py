@@ -0,0 +1,179 @@
+"""
+Dry-run planning of package and bulk exports.
+
+Before a package or bulk export is launched, plan_resources() resolves every
+resource to its local path with get_file_path(), stats the files in parallel
+through the preflight cache (so launching the export right after the plan does
+not stat them again) and reports what the export would do: how many files and bytes it would queue,
+the largest files, files over max_file_size_mb, files that do not exist and
+resources already exported to the deposition. Nothing is written. For a
+deposition that does not exist yet nothing can be a duplicate, so resources
+exported to other depositions are only listed, and still counted as uploads.
+
+The projected upload time divides the bytes to upload by the throughput seen
+in history: the median avg_bytes_per_sec (file size over upload time, recorded
+when the last block is sent) of the last [planner] history_transfers
+completed transfers of at least 1 MiB (smaller ones are dominated by request
+latency), times the number of uploads a user may run at once. Queue waits and
+off-peak windows are not included, so it is a lower bound.
+"""
+import logging
+import statistics
+import pymysql
+import configs
+import db
+import ckan_zenodo
+import preflight
+
+MIN_HISTORY_FILE_SIZE = 1024 * 1024
+
+
+def stat_paths(paths):
+    """Map each path to its size in bytes, or None if it does not exist, statting in parallel."""
+    return {path: result.size for path, result in preflight.stat_many(paths).items()}
+
+
+def find_duplicates(resource_ids, deposition_id=None):
+    """
+    Resources already exported (not failed or cancelled) to deposition_id, or to
+    any deposition when deposition_id is None (a deposition yet to be created).
+    """
+    if not resource_ids:
+        return set()
+    connection = db.get_connection()
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            sql = f"""SELECT DISTINCT resource_id FROM zenodo_transfers
+                      WHERE resource_id IN ({', '.join(['%s'] * len(resource_ids))})
+                        AND status NOT IN ('failed', 'cancelled')"""
+            params = list(resource_ids)
+            if deposition_id is not None:
+                sql += " AND deposition_id = %s"
+                params.append(deposition_id)
+            cursor.execute(sql, params)
+            return {row['resource_id'] for row in cursor.fetchall()}
+    finally:
+        connection.close()
+
+
+def historical_throughput():
+    """Median bytes/s of recent completed uploads and how many it is based on; (None, 0) without history."""
+    connection = db.get_connection()
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""SELECT avg_bytes_per_sec FROM zenodo_transfers
+                              WHERE status = 'completed' AND avg_bytes_per_sec > 0 AND file_size >= %s
+                              ORDER BY updated_at DESC LIMIT %s""",
+                           (MIN_HISTORY_FILE_SIZE, configs.get_planner_config()['history_transfers']))
+            rates = [row['avg_bytes_per_sec'] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+    if not rates:
+        return None, 0
+    return statistics.median(rates), len(rates)
+
+
+def parallel_uploads(file_count):
+    """How many of one user's uploads the workers run at once."""
+    sc = configs.get_scheduler_config()
+    slots = sc['upload_slots']
+    if sc['max_uploads_per_user'] > 0:
+        slots = min(slots, sc['max_uploads_per_user'])
+    return max(min(slots, file_count), 1)
+
+
+def project(plan, throughput=None):
+    """Add the projected upload time to a plan; throughput is historical_throughput(), looked up if not given."""
+    rate, samples = throughput or historical_throughput()
+    parallel = parallel_uploads(plan['files'])
+    plan.update(bytes_per_sec=rate, history_samples=samples, parallel_uploads=parallel,
+                projected_seconds=round(plan['bytes'] / (rate * parallel)) if rate and plan['files'] else None)
+    return plan
+
+
+def plan_resources(resources, deposition_id=None, throughput=None):
+    """
+    Plan the export of CKAN resources (dicts with id, name, url) to deposition_id
+    (None for depositions that will be created). Returns a dict with the file and
+    byte counts to upload, the largest files and the files that would be skipped.
+    Without a deposition_id, resources already exported elsewhere are listed under
+    exported_elsewhere but still uploaded, as the export would do.
+    """
+    max_mb = int(configs.get_app_config().get('max_file_size_mb', 0))
+    paths = {res['id']: ckan_zenodo.get_file_path(res['id'], res['url']) for res in resources}
+    sizes = stat_paths(paths.values())
+    duplicates = find_duplicates([res['id'] for res in resources], deposition_id)
+
+    plan = {'resources': len(resources), 'files': 0, 'bytes': 0, 'largest': [],
+            'too_large': [], 'missing': [], 'duplicates': [], 'exported_elsewhere': []}
+    to_upload = []
+    for res in resources:
+        entry = {'id': res['id'], 'name': res['name'], 'path': paths[res['id']], 'size': sizes[paths[res['id']]]}
+        if res['id'] in duplicates and deposition_id is not None:
+            plan['duplicates'].append(entry)
+            continue
+        if res['id'] in duplicates:
+            plan['exported_elsewhere'].append(entry)
+        if entry['size'] is None:
+            plan['missing'].append(entry)
+        elif max_mb > 0 and entry['size'] > max_mb * 1024 * 1024:
+            plan['too_large'].append(entry)
+        else:
+            to_upload.append(entry)
+
+    plan['files'] = len(to_upload)
+    plan['bytes'] = sum(entry['size'] for entry in to_upload)
+    largest_files = configs.get_planner_config()['largest_files']
+    plan['largest'] = sorted(to_upload, key=lambda e: e['size'], reverse=True)[:largest_files]
+    project(plan, throughput)
+    logging.info(f"Planned {len(resources)} resource(s): {plan['files']} file(s), {plan['bytes']} bytes to upload, "
+                 f"{len(plan['missing'])} missing, {len(plan['too_large'])} too large, "
+                 f"{len(plan['duplicates'])} already exported, {len(plan['exported_elsewhere'])} exported elsewhere")
+    return plan
+
+
+def plan_package(package_id, deposition_id=None):
+    """Fetch a CKAN package and plan the export of its resources; the plan also carries the package."""
+    package = ckan_zenodo.get_ckan_package(package_id)
+    plan = plan_resources(package.get('resources', []), deposition_id)
+    plan['package'] = {'id': package.get('id', package_id), 'name': package.get('name', package_id),
+                       'title': package.get('title', '')}
+    return plan
+
+
+def merge_plans(plans, throughput=None):
+    """Combine per-package plans into one (bulk exports)."""
+    largest_files = configs.get_planner_config()['largest_files']
+    total = {'resources': 0, 'files': 0, 'bytes': 0, 'largest': [], 'too_large': [], 'missing': [],
+             'duplicates': [], 'exported_elsewhere': []}
+    for plan in plans:
+        for key in ('resources', 'files', 'bytes'):
+            total[key] += plan[key]
+        for key in ('too_large', 'missing', 'duplicates', 'exported_elsewhere'):
+            total[key].extend(plan[key])
+        total['largest'] = sorted(total['largest'] + plan['largest'], key=lambda e: e['size'],
+                                  reverse=True)[:largest_files]
+    return project(total, throughput)
+
+
+def format_bytes(size):
+    """1536 -> '1.5 KB'."""
+    if size is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024 or unit == 'TB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_duration(seconds):
+    """5430 -> '1h 30m'."""
+    if seconds is None:
+        return 'unknown'
+    hours, rest = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    if minutes:
+        return f"{minutes}m {seconds:02d}s"
+    return f"{seconds}s"
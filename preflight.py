@@ -0,0 +1,126 @@
+"""
+Parallel filesystem preflight with a short-lived stat cache.
+
+Export checks stat every resource file (does it exist, how large is it). On an
+NFS mount each stat is a network round trip, so statting a package's hundreds
+of files one after the other takes seconds. stat_many() stats all paths it is
+given in a pool of [preflight] threads threads, and every result is cached for
+cache_ttl seconds, so the checks that follow (export_to_zenodo() per resource,
+the planner) are answered from memory.
+
+Only files that exist are cached: a file that appears is seen at once, while
+one that is deleted or rewritten within cache_ttl may be reported with its old
+size. The upload itself always reads the file again, so a stale entry can only
+let a check pass that the upload then fails on. At most max_entries paths are
+kept, least recently statted dropped first.
+"""
+import os
+import time
+import threading
+import collections
+import concurrent.futures
+import configs
+
+FileStat = collections.namedtuple('FileStat', ['exists', 'size', 'mtime'])
+MISSING = FileStat(False, None, None)
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return MISSING
+    return FileStat(True, st.st_size, st.st_mtime)
+
+
+class Preflight:
+    """Thread-safe TTL cache of file stats, filled in parallel."""
+
+    def __init__(self, threads=16, cache_ttl=60, max_entries=10000, clock=time.monotonic):
+        self.threads = max(threads, 1)
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._pool = None
+
+    def _cached(self, path):
+        # Caller holds the lock
+        entry = self._cache.get(path)
+        if entry is None:
+            return None
+        statted_at, result = entry
+        if self._clock() - statted_at >= self.cache_ttl:
+            del self._cache[path]
+            return None
+        return result
+
+    def _store(self, path, result):
+        if not result.exists or self.cache_ttl <= 0:
+            return
+        with self._lock:
+            self._cache[path] = (self._clock(), result)
+            self._cache.move_to_end(path)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def stat(self, path):
+        """FileStat of one path, from the cache if it is fresh."""
+        with self._lock:
+            result = self._cached(path)
+        if result is None:
+            result = _stat(path)
+            self._store(path, result)
+        return result
+
+    def stat_many(self, paths):
+        """Map each path to its FileStat, statting the ones not cached in parallel."""
+        results, todo = {}, []
+        with self._lock:
+            for path in dict.fromkeys(paths):
+                results[path] = self._cached(path)
+                if results[path] is None:
+                    todo.append(path)
+        if len(todo) == 1:
+            results[todo[0]] = self.stat(todo[0])
+        elif todo:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads,
+                                                                       thread_name_prefix='preflight')
+            for path, result in zip(todo, self._pool.map(_stat, todo)):
+                self._store(path, result)
+                results[path] = result
+        return results
+
+    def invalidate(self, path):
+        with self._lock:
+            self._cache.pop(path, None)
+
+
+_preflight = None
+_preflight_pid = None
+_preflight_lock = threading.Lock()
+
+
+def get_preflight():
+    """Return this process's Preflight, built from [preflight] on first use (and again after a fork)."""
+    global _preflight, _preflight_pid
+    with _preflight_lock:
+        if _preflight is None or _preflight_pid != os.getpid():
+            pc = configs.get_preflight_config()
+            _preflight = Preflight(threads=pc['threads'], cache_ttl=pc['cache_ttl'],
+                                   max_entries=pc['max_entries'])
+            _preflight_pid = os.getpid()
+        return _preflight
+
+
+def stat(path):
+    """FileStat of path through the shared cache."""
+    return get_preflight().stat(path)
+
+
+def stat_many(paths):
+    """FileStats of paths, statted in parallel through the shared cache."""
+    return get_preflight().stat_many(paths)
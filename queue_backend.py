@@ -0,0 +1,225 @@
+"""
+Database-backed upload queue, an alternative to RabbitMQ.
+
+With [queue] backend = mysql, upload tasks are rows of the upload_jobs table
+instead of RabbitMQ messages, so a small deployment (or CI, or a benchmark)
+needs no broker. Everything above the transport is unchanged: tasks are still
+routed to the scheduler lanes, and the worker's callback, fair-share scheduler,
+retry policy, circuit-breaker pauses and reaper work exactly as with RabbitMQ.
+
+Publishing inserts a row. The worker uses DBChannel, a stand-in for the pika
+channel. Each poll it claims, per consumed queue, up to the prefetch of visible
+rows in a single transaction (SELECT ... FOR UPDATE SKIP LOCKED), so any number
+of workers can share the table. A claimed row stays invisible to other workers
+for visibility_timeout seconds; the channel keeps extending that while the task
+is unacknowledged. Acknowledging deletes the row, and a nack with requeue makes
+it visible again at once. If a worker dies, its rows become visible again when
+the timeout runs out and are delivered to another worker, as RabbitMQ does with
+unacknowledged messages.
+"""
+import time
+import heapq
+import queue
+import logging
+import itertools
+import collections
+import pymysql
+import db
+
+# What the worker's callback reads from a pika delivery
+Delivery = collections.namedtuple('Delivery', ['delivery_tag', 'consumer_tag', 'routing_key', 'redelivered'])
+
+
+def insert_job(cursor, queue_name, body):
+    """Add a task to queue_name using the caller's cursor (and transaction)."""
+    cursor.execute("INSERT INTO upload_jobs (queue, body, visible_at) VALUES (%s, %s, NOW())",
+                   (queue_name, body))
+
+
+def publish(queue_name, body):
+    """Add a task to queue_name in its own transaction."""
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            insert_job(cursor, queue_name, body)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+class _DBConnection:
+    """The parts of a pika BlockingConnection the worker uses, run on the channel's loop."""
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def add_callback_threadsafe(self, fn):
+        self._channel._callbacks.put(fn)
+
+    def call_later(self, delay, fn):
+        self._channel._call_later(delay, fn)
+
+    def close(self):
+        self._channel.close()
+
+
+class DBChannel:
+    """
+    Pika channel stand-in over the upload_jobs table. Deliveries, acks and timers
+    all run on the thread inside start_consuming(); other threads hand their calls
+    over with connection.add_callback_threadsafe(), as with pika.
+    """
+
+    def __init__(self, owner, prefetch=10, poll_interval=1.0, visibility_timeout=600, clock=time.monotonic):
+        self.owner = owner
+        self.prefetch = prefetch
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout
+        self.connection = _DBConnection(self)
+        self.is_open = True
+        self._clock = clock
+        self._consumers = {}
+        self._unacked = {}
+        self._callbacks = queue.Queue()
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self._renewed_at = clock()
+
+    def queue_declare(self, queue, durable=True):
+        pass
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch = prefetch_count
+
+    def confirm_delivery(self):
+        # basic_publish returns only once the row is committed
+        pass
+
+    def basic_consume(self, queue, on_message_callback, consumer_tag=None):
+        consumer_tag = consumer_tag or f"{self.owner}:{queue}"
+        self._consumers[consumer_tag] = (queue, on_message_callback)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag):
+        self._consumers.pop(consumer_tag, None)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        publish(routing_key, body)
+
+    def basic_ack(self, delivery_tag):
+        self._unacked.pop(delivery_tag, None)
+        self._execute("DELETE FROM upload_jobs WHERE id = %s AND claimed_by = %s", (delivery_tag, self.owner))
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        self._unacked.pop(delivery_tag, None)
+        if not requeue:
+            self._execute("DELETE FROM upload_jobs WHERE id = %s AND claimed_by = %s", (delivery_tag, self.owner))
+            return
+        self._execute("UPDATE upload_jobs SET visible_at = NOW(), claimed_by = NULL "
+                      "WHERE id = %s AND claimed_by = %s", (delivery_tag, self.owner))
+
+    def _execute(self, sql, params):
+        connection = db.get_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _call_later(self, delay, fn):
+        heapq.heappush(self._timers, (self._clock() + delay, next(self._timer_ids), fn))
+
+    def claim(self):
+        """
+        Claim visible jobs for every consumer with prefetch to spare, in one
+        transaction, and deliver them. Returns the number delivered.
+        """
+        wanted = collections.Counter(self._unacked.values())
+        claimed = []
+        connection = db.get_connection()
+        try:
+            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                for consumer_tag, (queue_name, _) in list(self._consumers.items()):
+                    free = self.prefetch - wanted[consumer_tag]
+                    if free <= 0:
+                        continue
+                    cursor.execute("""SELECT id, body, deliveries FROM upload_jobs
+                                      WHERE queue = %s AND visible_at <= NOW()
+                                      ORDER BY id LIMIT %s
+                                      FOR UPDATE SKIP LOCKED""", (queue_name, free))
+                    claimed.extend((consumer_tag, row) for row in cursor.fetchall())
+                if claimed:
+                    ids = tuple(row['id'] for _, row in claimed)
+                    cursor.execute(f"""UPDATE upload_jobs
+                                       SET visible_at = NOW() + INTERVAL %s SECOND, claimed_by = %s,
+                                           deliveries = deliveries + 1
+                                       WHERE id IN ({', '.join(['%s'] * len(ids))})""",
+                                   (self.visibility_timeout, self.owner, *ids))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+        for consumer_tag, row in claimed:
+            queue_name, on_message = self._consumers[consumer_tag]
+            self._unacked[row['id']] = consumer_tag
+            method = Delivery(row['id'], consumer_tag, queue_name, row['deliveries'] > 0)
+            on_message(self, method, None, row['body'])
+        return len(claimed)
+
+    def _renew(self):
+        """
+        Push back the visibility timeout of this channel's unacknowledged jobs. Only
+        the ids in _unacked are renewed: the owner (host:pid) is not unique across
+        restarts, and a restarted container must not keep alive its predecessor's jobs.
+        """
+        if not self._unacked or self._clock() - self._renewed_at < self.visibility_timeout / 3:
+            return
+        self._renewed_at = self._clock()
+        ids = tuple(self._unacked)
+        try:
+            self._execute(f"UPDATE upload_jobs SET visible_at = NOW() + INTERVAL %s SECOND "
+                          f"WHERE claimed_by = %s AND id IN ({', '.join(['%s'] * len(ids))})",
+                          (self.visibility_timeout, self.owner, *ids))
+        except Exception as e:
+            logging.warning(f"Could not extend the visibility of claimed jobs: {e}")
+
+    def process_events(self, timeout=0):
+        """
+        Run handed-over calls and due timers, waiting up to timeout seconds for the
+        first call. A failed call (e.g. an ack while the database is down) is only
+        logged: the job becomes visible again after visibility_timeout.
+        """
+        due = []
+        try:
+            due.append(self._callbacks.get(timeout=timeout) if timeout > 0 else self._callbacks.get_nowait())
+            while True:
+                due.append(self._callbacks.get_nowait())
+        except queue.Empty:
+            pass
+        while self._timers and self._timers[0][0] <= self._clock():
+            due.append(heapq.heappop(self._timers)[2])
+        for fn in due:
+            try:
+                fn()
+            except Exception as e:
+                logging.error(f"Queue operation failed: {e}")
+
+    def start_consuming(self):
+        """Claim and deliver jobs until close(); idle polls wait poll_interval seconds."""
+        while self.is_open:
+            self.process_events()
+            self._renew()
+            try:
+                claimed = self.claim()
+            except Exception as e:
+                logging.error(f"Could not claim upload jobs: {e}")
+                claimed = 0
+            if not claimed:
+                self.process_events(timeout=self.poll_interval)
+
+    def close(self):
+        self.is_open = False
@@ -0,0 +1,267 @@
+"""
+Per-token rate limiting for Zenodo API calls, shared by every worker and web process.
+
+Zenodo limits requests per access token. With several workers uploading for the
+same user, uncoordinated calls overshoot the limit, collect 429s and back off,
+so throughput swings between bursts and idle time. This module paces calls
+instead, with two limits per token:
+
+    requests_per_minute   — a token bucket holding at most `burst` tokens. A
+                            caller always takes a token and, if that drives the
+                            bucket below zero, sleeps until its token would have
+                            been refilled. Calls are therefore spaced evenly at
+                            the ceiling rather than rejected and retried.
+    max_concurrent_uploads — leases on upload slots; a PUT waits for a free slot.
+
+Workers wait as long as the bucket says. A web request cannot: acquire() takes
+a max_wait, and when the wait would exceed it the token is left in the bucket
+and RateLimited is raised instead of sleeping.
+
+Tokens are identified by token_fingerprint() — a hash, so the raw API key is
+never stored. The state lives either in MySQL (`backend = mysql`, shared across
+processes and hosts; tables rate_limit_buckets and upload_leases) or in process
+memory (`backend = local`, for a single worker or development). A limit of 0
+disables it.
+"""
+import os
+import time
+import socket
+import hashlib
+import logging
+import threading
+import contextlib
+import configs
+import db
+
+
+class RateLimited(Exception):
+    """Raised by acquire() when a request would have to wait longer than max_wait."""
+
+    def __init__(self, message, wait):
+        super().__init__(message)
+        self.wait = wait
+
+
+def token_fingerprint(token):
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+
+class LocalBackend:
+    """In-process state: correct for the threads of one process only."""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._slots = {}
+
+    def reserve(self, fingerprint, rate_per_sec, burst, max_wait=None):
+        with self._lock:
+            now = self._clock()
+            tokens, last = self._buckets.get(fingerprint, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate_per_sec) - 1
+            wait = max(-tokens, 0) / rate_per_sec
+            if max_wait is None or wait <= max_wait:
+                self._buckets[fingerprint] = (tokens, now)
+        return wait
+
+    def try_lease(self, fingerprint, limit, lease_seconds, owner):
+        with self._lock:
+            active = self._slots.setdefault(fingerprint, set())
+            if len(active) >= limit:
+                return None
+            lease = object()
+            active.add(lease)
+            return lease
+
+    def renew_lease(self, lease, lease_seconds):
+        pass
+
+    def release_lease(self, fingerprint, lease):
+        with self._lock:
+            self._slots.get(fingerprint, set()).discard(lease)
+
+
+class MySQLBackend:
+    """Shared state in the application database; the bucket row doubles as the per-token lock."""
+
+    def _locked_bucket(self, cursor, fingerprint):
+        # A new row's refilled_at defaults to the distant past, so its bucket starts full
+        cursor.execute("INSERT IGNORE INTO rate_limit_buckets (fingerprint) VALUES (%s)", (fingerprint,))
+        cursor.execute("SELECT tokens, TIMESTAMPDIFF(MICROSECOND, refilled_at, NOW(6)) "
+                       "FROM rate_limit_buckets WHERE fingerprint = %s FOR UPDATE", (fingerprint,))
+        return cursor.fetchone()
+
+    def reserve(self, fingerprint, rate_per_sec, burst, max_wait=None):
+        connection = db.get_connection()
+        try:
+            with connection.cursor() as cursor:
+                tokens, elapsed_us = self._locked_bucket(cursor, fingerprint)
+                tokens = min(burst, tokens + elapsed_us / 1e6 * rate_per_sec) - 1
+                wait = max(-tokens, 0) / rate_per_sec
+                if max_wait is None or wait <= max_wait:
+                    cursor.execute("UPDATE rate_limit_buckets SET tokens = %s, refilled_at = NOW(6) "
+                                   "WHERE fingerprint = %s", (tokens, fingerprint))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        return wait
+
+    def try_lease(self, fingerprint, limit, lease_seconds, owner):
+        connection = db.get_connection()
+        try:
+            with connection.cursor() as cursor:
+                self._locked_bucket(cursor, fingerprint)
+                cursor.execute("DELETE FROM upload_leases WHERE fingerprint = %s AND expires_at < NOW()",
+                               (fingerprint,))
+                cursor.execute("SELECT COUNT(*) FROM upload_leases WHERE fingerprint = %s", (fingerprint,))
+                if cursor.fetchone()[0] >= limit:
+                    lease = None
+                else:
+                    cursor.execute("INSERT INTO upload_leases (fingerprint, owner, expires_at) "
+                                   "VALUES (%s, %s, NOW() + INTERVAL %s SECOND)",
+                                   (fingerprint, owner, lease_seconds))
+                    lease = cursor.lastrowid
+            connection.commit()
+            return lease
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    def renew_lease(self, lease, lease_seconds):
+        connection = db.get_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("UPDATE upload_leases SET expires_at = NOW() + INTERVAL %s SECOND WHERE id = %s",
+                               (lease_seconds, lease))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def release_lease(self, fingerprint, lease):
+        connection = db.get_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM upload_leases WHERE id = %s", (lease,))
+            connection.commit()
+        finally:
+            connection.close()
+
+
+class RateLimiter:
+    """Paces Zenodo requests and caps concurrent uploads per API token."""
+
+    def __init__(self, backend, requests_per_minute=90, burst=5, max_concurrent_uploads=2,
+                 lease_seconds=600, poll_seconds=2.0, sleep=time.sleep):
+        self.backend = backend
+        self.requests_per_minute = requests_per_minute
+        self.burst = max(burst, 1)
+        self.max_concurrent_uploads = max_concurrent_uploads
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._sleep = sleep
+
+    def acquire(self, token, max_wait=None):
+        """
+        Block until one request for this token fits under requests_per_minute. Returns the wait.
+        With max_wait set, a request that would wait longer takes no token and raises RateLimited.
+        """
+        if self.requests_per_minute <= 0:
+            return 0.0
+        try:
+            wait = self.backend.reserve(token_fingerprint(token), self.requests_per_minute / 60.0, self.burst,
+                                        max_wait=max_wait)
+        except Exception as e:
+            logging.warning(f"Rate limiter unavailable, not pacing this request: {e}")
+            return 0.0
+        if max_wait is not None and wait > max_wait:
+            raise RateLimited(f"Zenodo rate limit for this token: next request in {wait:.0f}s", wait)
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+    @contextlib.contextmanager
+    def upload_slot(self, token):
+        """Hold one of the token's max_concurrent_uploads slots for the duration of the block."""
+        if self.max_concurrent_uploads <= 0:
+            yield
+            return
+        fingerprint = token_fingerprint(token)
+        lease = self._wait_for_lease(fingerprint)
+        if lease is None:
+            yield
+            return
+
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.lease_seconds / 3):
+                try:
+                    self.backend.renew_lease(lease, self.lease_seconds)
+                except Exception as e:
+                    logging.warning(f"Could not renew upload lease: {e}")
+
+        renewer = threading.Thread(target=renew, name='upload-lease', daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            renewer.join()
+            try:
+                self.backend.release_lease(fingerprint, lease)
+            except Exception as e:
+                logging.error(f"Could not release upload lease (it expires in {self.lease_seconds}s): {e}")
+
+    def _wait_for_lease(self, fingerprint):
+        waited = 0.0
+        while True:
+            try:
+                lease = self.backend.try_lease(fingerprint, self.max_concurrent_uploads,
+                                               self.lease_seconds, self.owner)
+            except Exception as e:
+                logging.warning(f"Rate limiter unavailable, not limiting this upload: {e}")
+                return None
+            if lease is not None:
+                if waited:
+                    logging.info(f"Waited {waited:.0f}s for a free upload slot")
+                return lease
+            self._sleep(self.poll_seconds)
+            waited += self.poll_seconds
+
+
+_limiter = None
+_limiter_pid = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    """Return this process's limiter, built from [rate_limit] on first use (and again after a fork)."""
+    global _limiter, _limiter_pid
+    with _limiter_lock:
+        if _limiter is None or _limiter_pid != os.getpid():
+            rc = configs.get_rate_limit_config()
+            backend = MySQLBackend() if rc['backend'] == 'mysql' else LocalBackend()
+            _limiter = RateLimiter(
+                backend,
+                requests_per_minute=rc['requests_per_minute'],
+                burst=rc['burst'],
+                max_concurrent_uploads=rc['max_concurrent_uploads'],
+                lease_seconds=rc['lease_seconds'],
+            )
+            _limiter_pid = os.getpid()
+        return _limiter
+
+
+def reset():
+    """Forget the current limiter; the next get_limiter() builds a new one from the config."""
+    global _limiter, _limiter_pid
+    with _limiter_lock:
+        _limiter = None
+        _limiter_pid = None
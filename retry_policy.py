@@ -0,0 +1,116 @@
+"""
+Retry policy for failed uploads.
+
+worker.callback asks the policy what to do with each failed attempt. The
+policy classifies the exception and returns a RetryDecision:
+
+    permanent  — 4xx answers other than 408/429 (bad token, deleted deposition,
+                 quota exceeded, ...) and local file errors. Retrying cannot
+                 help, so the transfer fails at once.
+    throttled  — 429. Waits for the server's Retry-After (seconds or HTTP date,
+                 capped at max_retry_after), falling back to backoff without it.
+    transient  — 5xx, 408, connection errors and time-outs (including stalled
+                 uploads). Exponential backoff with jitter so a batch of
+                 failures does not retry in lock-step.
+    unknown    — anything else. Plain exponential backoff, as before.
+
+The class used is [retry] policy (a dotted path), so a deployment can plug in
+its own subclass; load_policy() builds it from the [retry] settings.
+"""
+import random
+import logging
+import datetime
+import importlib
+import collections
+import email.utils
+import requests
+import configs
+
+PERMANENT, THROTTLED, TRANSIENT, UNKNOWN = 'permanent', 'throttled', 'transient', 'unknown'
+
+RetryDecision = collections.namedtuple('RetryDecision', ['error_class', 'retry', 'delay'])
+
+# Local failures that will not go away by trying the same task again
+_PERMANENT_ERRORS = (FileNotFoundError, IsADirectoryError, PermissionError)
+
+
+def parse_retry_after(value, now=None):
+    """Return the delay in seconds described by a Retry-After header, or None if unparseable."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return max(int((when - now).total_seconds()), 0)
+
+
+class RetryPolicy:
+    """Default policy: classify by HTTP status / exception type, then pick a delay per class."""
+
+    def __init__(self, base_delay=10, max_delay=300, jitter=0.5, max_retry_after=300, rng=random.random):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_retry_after = max_retry_after
+        self._rng = rng
+
+    def classify(self, exc):
+        if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+            status = exc.response.status_code
+            if status == 429:
+                return THROTTLED
+            if status == 408 or status >= 500:
+                return TRANSIENT
+            if 400 <= status < 500:
+                return PERMANENT
+        if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return TRANSIENT
+        if isinstance(exc, _PERMANENT_ERRORS):
+            return PERMANENT
+        return UNKNOWN
+
+    def backoff(self, retry_count):
+        """10s, 20s, 40s, … capped at max_delay."""
+        return min(2 ** retry_count * self.base_delay, self.max_delay)
+
+    def delay(self, error_class, exc, retry_count):
+        delay = self.backoff(retry_count)
+        if error_class == THROTTLED:
+            retry_after = parse_retry_after(exc.response.headers.get('Retry-After'))
+            if retry_after is not None:
+                return min(retry_after, self.max_retry_after)
+        if error_class in (TRANSIENT, THROTTLED):
+            # Keep (1 - jitter) of the backoff, randomise the rest
+            return delay * (1 - self.jitter) + delay * self.jitter * self._rng()
+        return delay
+
+    def decide(self, exc, retry_count, max_retries):
+        """Return the RetryDecision for a failed attempt number retry_count + 1."""
+        error_class = self.classify(exc)
+        if error_class == PERMANENT or retry_count >= max_retries:
+            return RetryDecision(error_class, False, 0)
+        return RetryDecision(error_class, True, self.delay(error_class, exc, retry_count))
+
+
+def load_policy():
+    """Build the policy named by [retry] policy with the configured delays."""
+    rc = configs.get_retry_config()
+    module_name, _, class_name = rc['policy'].rpartition('.')
+    try:
+        policy_class = getattr(importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError) as e:
+        logging.error(f"Cannot load retry policy {rc['policy']!r} ({e}); using the default")
+        policy_class = RetryPolicy
+    return policy_class(
+        base_delay=rc['base_delay'],
+        max_delay=rc['max_delay'],
+        jitter=rc['jitter'],
+        max_retry_after=rc['max_retry_after'],
+    )
@@ -0,0 +1,185 @@
+"""
+Fair-share scheduling of upload tasks between users.
+
+Two parts work together:
+
+Lanes — instead of one FIFO queue, tasks are published to one of [scheduler]
+lanes queues, chosen by a stable hash of the username (lane_queue). A worker
+consumes every lane with a per-lane prefetch, so one user's 2,000-file export
+fills only its own lane and tasks of users on other lanes stay visible to the
+worker. With lanes = 0 everything goes to the single [rabbitmq] queue.
+
+Lanes are shared, not per user: several users hash to the same lane, and the
+worker only sees the prefetch_per_lane oldest deliveries of each. A user whose
+lane also holds another user's bulk export waits behind that export's backlog
+in the broker (with 16 lanes, about 1 user in 16 for each bulk exporter). So
+fairness holds between lanes; more lanes make such sharing rarer.
+
+FairScheduler — the worker buffers the prefetched deliveries per user and hands
+them to its upload slots by smooth weighted round-robin: every user with work
+among the buffered deliveries is served in turn, in proportion to its weight
+([scheduler] user_weights, default 1), and never with more than
+max_uploads_per_user uploads running at once.
+
+Small files — a task whose file_size is at most [scheduler] small_file_mb goes
+to the user's small-file lane (<queue>.smallNN, hashed like the lanes) instead
+of the user's lane. The worker reserves reserved_small_slots of its upload
+slots for small tasks, so a single-resource export finishes in seconds even
+while every other slot is busy with a bulk run. Small tasks also run in the
+general slots. The reserved slots are shared by weighted round-robin too, and
+hold at most max_uploads_per_user of one user's tasks; that count is separate
+from the general slots, so a user's own bulk run does not hold up their
+interactive export, but a package of thousands of small files does not take
+every reserved slot either.
+"""
+import zlib
+import threading
+import collections
+import configs
+
+
+def is_small(file_size):
+    """True if a file of this many bytes belongs in the small-file lane (unknown sizes do not)."""
+    small_file_mb = configs.get_scheduler_config()['small_file_mb']
+    return small_file_mb > 0 and file_size is not None and file_size <= small_file_mb * 1024 * 1024
+
+
+def lane_queue(username, file_size=None):
+    """Return the queue a task for this user (and, if known, this file size) is published to."""
+    rc = configs.get_rabbitmq_config()
+    lanes = configs.get_scheduler_config()['lanes']
+    lane = f"{zlib.crc32(username.encode()) % lanes:02d}" if lanes > 0 else ''
+    if is_small(file_size):
+        return f"{rc['queue']}.small{lane}"
+    return f"{rc['queue']}.lane{lane}" if lane else rc['queue']
+
+
+def all_queues():
+    """
+    Every queue a worker consumes: the plain queue (tasks queued before lanes
+    existed), the shared small-file queue (small_file_mb set; used with lanes = 0
+    and by older versions), the lanes and their small-file lanes.
+    """
+    rc = configs.get_rabbitmq_config()
+    sc = configs.get_scheduler_config()
+    lanes = range(max(sc['lanes'], 0))
+    queues = [rc['queue']]
+    if sc['small_file_mb'] > 0:
+        queues.append(f"{rc['queue']}.small")
+    queues += [f"{rc['queue']}.lane{n:02d}" for n in lanes]
+    if sc['small_file_mb'] > 0:
+        queues += [f"{rc['queue']}.small{n:02d}" for n in lanes]
+    return queues
+
+
+def parse_weights(spec):
+    """Parse 'alice=3, bob=2' into {'alice': 3, 'bob': 2}."""
+    weights = {}
+    for part in (spec or '').split(','):
+        name, _, weight = part.partition('=')
+        if name.strip():
+            weights[name.strip()] = max(int(weight or 1), 1)
+    return weights
+
+
+class FairScheduler:
+    """Thread-safe per-user buffers served by smooth weighted round-robin."""
+
+    def __init__(self, max_uploads_per_user=1, weights=None):
+        self.max_uploads_per_user = max_uploads_per_user
+        self.weights = weights or {}
+        self._cond = threading.Condition()
+        self._queues = collections.OrderedDict()
+        self._running = collections.Counter()
+        self._reserved = collections.Counter()
+        self._credit = collections.Counter()
+        self._closed = False
+
+    def submit(self, user, item, small=False):
+        with self._cond:
+            self._queues.setdefault(user, collections.deque()).append((small, item))
+            self._cond.notify_all()
+
+    def _eligible(self, small_only):
+        running = self._reserved if small_only else self._running
+        return [user for user, items in self._queues.items()
+                if items and (not small_only or any(small for small, _ in items))
+                and (self.max_uploads_per_user <= 0 or running[user] < self.max_uploads_per_user)]
+
+    def _take(self, user, small_only):
+        items = self._queues[user]
+        if not small_only:
+            return items.popleft()[1]
+        for entry in items:
+            if entry[0]:
+                items.remove(entry)
+                return entry[1]
+
+    def _pick(self, eligible):
+        # Smooth weighted round-robin (as in nginx): spreads a user's turns evenly
+        total = 0
+        for user in eligible:
+            weight = self.weights.get(user, 1)
+            self._credit[user] += weight
+            total += weight
+        chosen = max(eligible, key=lambda u: self._credit[u])
+        self._credit[chosen] -= total
+        return chosen
+
+    def next(self, timeout=None, small_only=False):
+        """
+        Block until a task may run and return (user, item), or None when closed or
+        timed out. The caller must call done(user) when the task has finished.
+        A small_only slot takes only tasks submitted with small=True, each user's
+        in order; max_uploads_per_user applies to the small_only slots separately,
+        so uploads in the general slots do not hold it back. Pass the same
+        small_only to done().
+        """
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                eligible = self._eligible(small_only)
+                if eligible:
+                    user = self._pick(eligible)
+                    item = self._take(user, small_only)
+                    self._running[user] += 1
+                    if small_only:
+                        self._reserved[user] += 1
+                    return user, item
+                if not self._cond.wait(timeout):
+                    return None
+
+    def done(self, user, small_only=False):
+        with self._cond:
+            if small_only:
+                self._reserved[user] -= 1
+                if self._reserved[user] <= 0:
+                    del self._reserved[user]
+            self._running[user] -= 1
+            if self._running[user] <= 0:
+                del self._running[user]
+                if not self._queues.get(user):
+                    # Idle users drop out so their credit does not carry over
+                    self._queues.pop(user, None)
+                    self._credit.pop(user, None)
+            self._cond.notify_all()
+
+    def peek(self, count):
+        """Up to count buffered items, taking each user's oldest in turn (roughly the order they will run)."""
+        with self._cond:
+            queues = [list(items) for items in self._queues.values() if items]
+        items = []
+        for depth in range(count):
+            items.extend(q[depth][1] for q in queues if depth < len(q))
+        return items[:count]
+
+    def pending(self):
+        """Buffered task count per user."""
+        with self._cond:
+            return {user: len(items) for user, items in self._queues.items() if items}
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
@@ -1,6 +1,9 @@
 # Piotr Dzierżak 2024
 
+import os
 import re
+import signal
+import socket
 import uuid as uuid_mod
 from waitress import serve
 from flask import Flask, render_template, request, redirect, url_for, session, render_template_string, jsonify
@@ -8,8 +11,10 @@ from flask_wtf.csrf import CSRFProtect, CSRFError
 import datetime
 import logging
 import requests
-import pika
 import ckan_zenodo
+import planner
+import rate_limiter
+import health as health_probe
 import configs
 import db
 
@@ -20,6 +25,8 @@ logging.basicConfig(filename=app_conf.get('log_file'), format='%(asctime)s - %(l
                     level=logging.INFO)
 
 app.secret_key = app_conf.get('secret_key')
+app.jinja_env.filters['filesize'] = planner.format_bytes
+app.jinja_env.filters['duration'] = planner.format_duration
 csrf = CSRFProtect(app)
 
 sso_conf = configs.get_sso_config()
@@ -34,6 +41,10 @@ _VALID_UPLOAD_TYPES = {
     'video', 'software', 'lesson', 'physicalobject', 'other',
 }
 _VALID_ACCESS_RIGHTS = {'open', 'embargoed', 'restricted', 'closed'}
+# Depositions one multi-target export may upload to
+_MAX_EXPORT_TARGETS = 10
+_RATE_LIMITED_MESSAGE = ("Zenodo is busy with other requests for your API key (for example running uploads). "
+                         "Please try again in a minute.")
 
 
 def _valid_api_key(value):
@@ -190,8 +201,15 @@ def ajax():
       - list_depositions: List the user's Zenodo depositions (stores API key in session).
       - export_to_zenodo: Export a CKAN resource to an existing Zenodo deposition.
       - create_deposit_and_export: Create a new Zenodo deposition and export the resource into it.
+      - export_to_depositions: Export a CKAN resource to several depositions, reading the file once.
       - export_package_to_zenodo: Export all resources of a CKAN package to an existing deposition.
+      - sync_package_to_zenodo: Re-export only the package's new and changed resources to a deposition.
+      - new_version_to_zenodo: Export a package as a new version of a published record, uploading only changes.
+      - bundle_package_to_zenodo: Export a package with its small files uploaded as one streamed ZIP archive.
+      - plan_package_export: Dry run of a package export: sizes, problem files and projected time.
       - retry_transfer: Re-queue a previously failed transfer.
+      - cancel_transfer: Cancel a scheduled, queued or running transfer.
+      - cancel_package_transfers: Cancel every unfinished transfer of a CKAN package.
     """
     action = request.form.get('action', '')
 
@@ -211,6 +229,9 @@ def ajax():
             return render_template('zenodo_deposit.html', dep=dep, message="",
                                    default_upload_type=zc['upload_type'],
                                    default_access_right=zc['access_right'])
+        except rate_limiter.RateLimited as e:
+            logging.warning(f"{action} refused by the rate limiter: {e}")
+            return render_template('result.html', message=_RATE_LIMITED_MESSAGE, back_button=True)
         except requests.exceptions.HTTPError as e:
             logging.error(f"Zenodo API error fetching depositions: {e}")
             return render_template('result.html',
@@ -240,7 +261,8 @@ def ajax():
 
         try:
             res = ckan_zenodo.get_ckan_resource(ckan_resource_id)
-            ckan_zenodo.export_to_zenodo(zenodo_apikey, ckan_resource_id, res['name'], res['url'], deposition_id)
+            ckan_zenodo.export_to_zenodo(zenodo_apikey, ckan_resource_id, res['name'], res['url'], deposition_id,
+                                         **ckan_zenodo.source_version(res))
             return render_template('result.html',
                                    message="Export queued successfully. Track progress on the Transfers page.",
                                    back_button=True)
@@ -260,6 +282,9 @@ def ajax():
             return render_template('result.html',
                                    message="A Zenodo API error occurred. Check your API key and try again.",
                                    back_button=True)
+        except rate_limiter.RateLimited as e:
+            logging.warning(f"{action} refused by the rate limiter: {e}")
+            return render_template('result.html', message=_RATE_LIMITED_MESSAGE, back_button=True)
         except requests.exceptions.RequestException as e:
             logging.error(f"Network error during export: {e}")
             return render_template('result.html',
@@ -271,6 +296,60 @@ def ajax():
                                    message="An unexpected error occurred. Please try again.",
                                    back_button=True)
 
+    # ── export_to_depositions ─────────────────────────────────────────────────
+    elif action == "export_to_depositions":
+        zenodo_apikey = session.get('zenodo_apikey')
+        if not zenodo_apikey:
+            return render_template('result.html',
+                                   message="Session expired. Please re-enter your Zenodo API key and select a deposition again.",
+                                   back_button=True)
+
+        ckan_resource_id = request.form.get('ckan_resource_id', '').strip()
+        deposition_ids = [d.strip() for d in request.form.get('deposition_ids', '').split(',') if d.strip()]
+
+        if not _valid_uuid(ckan_resource_id):
+            return render_template('result.html', message="Invalid resource ID.", back_button=False)
+        if not deposition_ids or not all(_valid_deposition_id(d) for d in deposition_ids):
+            return render_template('result.html', message="Invalid deposition ID.", back_button=False)
+        if len(deposition_ids) > _MAX_EXPORT_TARGETS:
+            return render_template('result.html',
+                                   message=f"Select at most {_MAX_EXPORT_TARGETS} depositions.",
+                                   back_button=True)
+
+        try:
+            res = ckan_zenodo.get_ckan_resource(ckan_resource_id)
+            transfer_ids = ckan_zenodo.export_to_depositions(zenodo_apikey, ckan_resource_id, res['name'],
+                                                             res['url'], deposition_ids,
+                                                             **ckan_zenodo.source_version(res))
+            return render_template('result.html',
+                                   message=f"Export to {len(transfer_ids)} deposition(s) queued successfully. "
+                                           f"Track progress on the Transfers page.",
+                                   back_button=True)
+        except ckan_zenodo.DuplicateTransfer:
+            return render_template('result.html',
+                                   message="This resource has already been exported to all selected depositions. Check the Transfers page for its current status.",
+                                   back_button=True)
+        except ckan_zenodo.ResourceFileNotFound:
+            logging.warning(f"File not found for resource {ckan_resource_id}")
+            return render_template('result.html',
+                                   message="The resource file was not found on the server. Contact the administrator.",
+                                   back_button=True)
+        except ckan_zenodo.FileTooLarge as e:
+            return render_template('result.html', message=str(e), back_button=True)
+        except rate_limiter.RateLimited as e:
+            logging.warning(f"{action} refused by the rate limiter: {e}")
+            return render_template('result.html', message=_RATE_LIMITED_MESSAGE, back_button=True)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Network error during export_to_depositions: {e}")
+            return render_template('result.html',
+                                   message="Network error communicating with Zenodo. Please try again.",
+                                   back_button=True)
+        except Exception as e:
+            logging.error(f"Unexpected error during export_to_depositions: {e}")
+            return render_template('result.html',
+                                   message="An unexpected error occurred. Please try again.",
+                                   back_button=True)
+
     # ── create_deposit_and_export ─────────────────────────────────────────────
     elif action == "create_deposit_and_export":
         zenodo_apikey = session.get('zenodo_apikey')
@@ -307,6 +386,7 @@ def ajax():
                 deposit_name, deposit_desc,
                 upload_type=upload_type or None,
                 access_right=access_right or None,
+                **ckan_zenodo.source_version(res),
             )
             return render_template('result.html',
                                    message="Export queued successfully. Track progress on the Transfers page.",
@@ -323,6 +403,9 @@ def ajax():
             return render_template('result.html',
                                    message="Failed to create Zenodo deposition. Check your API key and try again.",
                                    back_button=True)
+        except rate_limiter.RateLimited as e:
+            logging.warning(f"{action} refused by the rate limiter: {e}")
+            return render_template('result.html', message=_RATE_LIMITED_MESSAGE, back_button=True)
         except requests.exceptions.RequestException as e:
             logging.error(f"Network error during create_deposit_and_export: {e}")
             return render_template('result.html',
@@ -334,8 +417,9 @@ def ajax():
                                    message="An unexpected error occurred. Please try again.",
                                    back_button=True)
 
-    # ── export_package_to_zenodo ──────────────────────────────────────────────
-    elif action == "export_package_to_zenodo":
+    # ── export_package_to_zenodo / sync_package_to_zenodo / new_version_to_zenodo / bundle_package_to_zenodo
+    elif action in ("export_package_to_zenodo", "sync_package_to_zenodo", "new_version_to_zenodo",
+                    "bundle_package_to_zenodo"):
         zenodo_apikey = session.get('zenodo_apikey')
         if not zenodo_apikey:
             return render_template('result.html',
@@ -351,43 +435,51 @@ def ajax():
             return render_template('result.html', message="Invalid deposition ID.", back_button=False)
 
         try:
-            package = ckan_zenodo.get_ckan_package(package_id)
-            resources = package.get('resources', [])
-            if not resources:
-                return render_template('result.html',
-                                       message="No resources found in this package.",
-                                       back_button=True)
-
-            queued, skipped, errors = 0, 0, []
-            for res in resources:
-                try:
-                    ckan_zenodo.export_to_zenodo(
-                        zenodo_apikey, res['id'], res['name'], res['url'], deposition_id
-                    )
-                    queued += 1
-                except ckan_zenodo.DuplicateTransfer:
-                    skipped += 1
-                except ckan_zenodo.ResourceFileNotFound:
-                    errors.append(f"File not found: {res['name']}")
-                except ckan_zenodo.FileTooLarge:
-                    errors.append(f"File too large: {res['name']}")
-                except Exception as e:
-                    logging.error(f"Error exporting resource {res.get('id')}: {e}")
-                    errors.append(f"Error: {res['name']}")
-
-            parts = [f"{queued} file(s) queued for export."]
-            if skipped:
-                parts.append(f"{skipped} already exported (skipped).")
-            if errors:
-                parts.append("Issues: " + "; ".join(errors))
-            return render_template('result.html', message=" ".join(parts), back_button=True)
+            if action == "sync_package_to_zenodo":
+                ckan_zenodo.create_package_job(zenodo_apikey, package_id, deposition_id, mode='sync')
+                message = ("Package sync queued. New and changed files will appear on the Transfers page "
+                           "as they are added.")
+            elif action == "new_version_to_zenodo":
+                ckan_zenodo.create_package_job(zenodo_apikey, package_id, deposition_id, mode='newversion')
+                message = ("New version queued. Changed files will appear on the Transfers page as they are "
+                           "added; review and publish the new version on Zenodo.")
+            elif action == "bundle_package_to_zenodo":
+                ckan_zenodo.create_package_job(zenodo_apikey, package_id, deposition_id, mode='bundle')
+                message = ("Package export queued. Its small files will be uploaded as one ZIP archive; it and "
+                           "the larger files will appear on the Transfers page as they are added.")
+            else:
+                ckan_zenodo.create_package_job(zenodo_apikey, package_id, deposition_id)
+                message = "Package export queued. Its files will appear on the Transfers page as they are added."
+            return render_template('result.html', message=message, back_button=True)
 
         except Exception as e:
-            logging.error(f"Unexpected error in export_package_to_zenodo: {e}")
+            logging.error(f"Unexpected error in {action}: {e}")
             return render_template('result.html',
                                    message="An unexpected error occurred. Please try again.",
                                    back_button=True)
 
+    # ── plan_package_export ───────────────────────────────────────────────────
+    elif action == "plan_package_export":
+        if 'user' not in session:
+            return render_template('result.html', message="Not authenticated.", back_button=False)
+
+        package_id = request.form.get('package_id', '').strip()
+        deposition_id = request.form.get('deposition_id', '').strip()
+
+        if not _valid_package_id(package_id):
+            return render_template('result.html', message="Invalid package ID.", back_button=False)
+        if deposition_id and not _valid_deposition_id(deposition_id):
+            return render_template('result.html', message="Invalid deposition ID.", back_button=False)
+
+        try:
+            plan = planner.plan_package(package_id, deposition_id or None)
+            return render_template('plan.html', plan=plan)
+        except Exception as e:
+            logging.error(f"Unexpected error in plan_package_export: {e}")
+            return render_template('result.html',
+                                   message="Could not plan the export. Please try again.",
+                                   back_button=True)
+
     # ── retry_transfer ────────────────────────────────────────────────────────
     elif action == "retry_transfer":
         if 'user' not in session:
@@ -420,11 +512,43 @@ def ajax():
             username, transfer['file_path'], zenodo_apikey,
             transfer['deposition_id'], transfer['deposition_name'],
             transfer['filename'], transfer_id, user_email,
+            file_size=transfer.get('file_size'), bundle=bool(transfer.get('bundle_manifest')),
         )
         return render_template('result.html',
                                message="Transfer has been re-queued. Check the Transfers page for its status.",
                                back_button=True)
 
+    # ── cancel_transfer ───────────────────────────────────────────────────────
+    elif action == "cancel_transfer":
+        if 'user' not in session:
+            return render_template('result.html', message="Not authenticated.", back_button=False)
+
+        transfer_id_str = request.form.get('transfer_id', '').strip()
+        if not transfer_id_str.isdigit():
+            return render_template('result.html', message="Invalid transfer ID.", back_button=False)
+
+        if not ckan_zenodo.cancel_transfer(int(transfer_id_str), session['user']['username']):
+            return render_template('result.html',
+                                   message="Transfer not found or already finished.",
+                                   back_button=True)
+        return render_template('result.html',
+                               message="Transfer cancelled. A running upload stops within a few seconds.",
+                               back_button=True)
+
+    # ── cancel_package_transfers ──────────────────────────────────────────────
+    elif action == "cancel_package_transfers":
+        if 'user' not in session:
+            return render_template('result.html', message="Not authenticated.", back_button=False)
+
+        package_id = request.form.get('package_id', '').strip()
+        if not _valid_package_id(package_id):
+            return render_template('result.html', message="Invalid package ID.", back_button=False)
+
+        cancelled = ckan_zenodo.cancel_package_transfers(package_id, session['user']['username'])
+        return render_template('result.html',
+                               message=f"{cancelled} transfer(s) of this package cancelled.",
+                               back_button=True)
+
     logging.warning(f"Unknown ajax action received: {action!r}")
     return render_template('result.html', message="Unknown action.", back_button=False)
 
@@ -437,7 +561,9 @@ def transfers():
     if 'user' in session:
         username = session['user']['username']
         user_transfers = ckan_zenodo.get_transfers_for_user(username)
-        return render_template("transfers.html", username=session['user']['username'], transfers=user_transfers)
+        package_jobs = ckan_zenodo.get_package_jobs_for_user(username)
+        return render_template("transfers.html", username=session['user']['username'], transfers=user_transfers,
+                               package_jobs=package_jobs)
     else:
         return redirect(url_for('login'))
 
@@ -460,6 +586,9 @@ def api_transfer_status(transfer_id):
         'id': transfer['id'],
         'status': transfer['status'],
         'retry_count': transfer['retry_count'],
+        'error_class': transfer.get('error_class'),
+        'not_before': str(transfer['not_before']) if transfer.get('not_before') else None,
+        **ckan_zenodo.transfer_progress(transfer),
         'updated_at': str(transfer['updated_at']),
     })
 
@@ -468,34 +597,110 @@ def api_transfer_status(transfer_id):
 @csrf.exempt
 def health():
     """
-    Liveness/readiness check. Returns 200 when both DB and RabbitMQ are reachable,
-    503 otherwise. Response body is JSON with per-component status.
+    Readiness check served from the background prober's cached snapshot (no I/O here).
+    Returns 200 when DB and RabbitMQ were reachable at the last probe, 503 otherwise.
+    CKAN/Zenodo outages are reported as 'degraded' but do not fail the check.
     """
-    status = {}
+    snapshot = health_probe.get_snapshot()
+    return jsonify(snapshot), 200 if snapshot['ready'] else 503
 
-    try:
-        conn = db.get_connection()
-        with conn.cursor() as cur:
-            cur.execute('SELECT 1')
-        conn.close()
-        status['db'] = 'ok'
-    except Exception as e:
-        status['db'] = f'error: {e}'
 
-    try:
-        rc = configs.get_rabbitmq_config()
-        rmq_conn = pika.BlockingConnection(
-            pika.ConnectionParameters(host=rc['host'], socket_timeout=2, connection_attempts=1)
-        )
-        rmq_conn.close()
-        status['rabbitmq'] = 'ok'
-    except Exception as e:
-        status['rabbitmq'] = f'error: {e}'
+@app.route('/metrics')
+@csrf.exempt
+def metrics():
+    """Prometheus metrics rendered from the same cached snapshot as /health."""
+    body = health_probe.render_metrics(health_probe.get_snapshot())
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/livez')
+@csrf.exempt
+def livez():
+    """Liveness check: answers as long as the process can serve requests. Does no I/O."""
+    return jsonify({'status': 'alive'})
 
-    all_ok = all(v == 'ok' for v in status.values())
-    status['status'] = 'healthy' if all_ok else 'degraded'
-    return jsonify(status), 200 if all_ok else 503
+
+def _reset_process_state():
+    """Drop per-process resources inherited from the parent so a forked child opens its own."""
+    db.reset_pool()
+    ckan_zenodo.reset_publisher()
+    health_probe.reset()
+
+
+def _serve_prefork(sc, waitress_kwargs):
+    """
+    Bind the listening socket once, then fork sc['processes'] children that each run
+    Waitress on it. The parent only supervises: it restarts children that exit
+    unexpectedly and forwards SIGTERM/SIGINT to all of them on shutdown.
+    """
+    family = socket.AF_INET6 if ':' in sc['host'] else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((sc['host'], sc['port']))
+    sock.listen(sc['backlog'])
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            _reset_process_state()
+            health_probe.get_prober()
+            try:
+                serve(app, sockets=[sock], **waitress_kwargs)
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(sc['processes']):
+        spawn()
+    logging.info(f"Serving on {sc['host']}:{sc['port']} with {sc['processes']} processes "
+                 f"x {waitress_kwargs['threads']} threads")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            logging.warning(f"Server process {pid} exited (status {status}); starting a replacement")
+            spawn()
+    sock.close()
+
+
+def run_server():
+    """
+    Serve the app with Waitress using the [server] settings, pre-forking when processes > 1.
+    The health prober is started before serving, so no request waits for its first probe.
+    """
+    sc = configs.get_server_config()
+    waitress_kwargs = {
+        'threads': sc['threads'],
+        'connection_limit': sc['connection_limit'],
+        'channel_timeout': sc['channel_timeout'],
+    }
+    if sc['processes'] > 1:
+        _serve_prefork(sc, waitress_kwargs)
+    else:
+        health_probe.get_prober()
+        serve(app, host=sc['host'], port=sc['port'], backlog=sc['backlog'], **waitress_kwargs)
 
 
 if __name__ == '__main__':
-    serve(app, host='0.0.0.0', port=8090)
+    run_server()
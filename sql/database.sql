@@ -11,12 +11,99 @@ CREATE TABLE IF NOT EXISTS zenodo_transfers (
     user_email VARCHAR(255) NULL,
     file_path VARCHAR(1024) NOT NULL,
     filename VARCHAR(255) NOT NULL,
+    file_size BIGINT NULL,
+    bytes_sent BIGINT NULL,
+    bytes_per_sec DOUBLE NULL,
+    avg_bytes_per_sec DOUBLE NULL,
+    progress_at TIMESTAMP NULL DEFAULT NULL,
     deposition_id VARCHAR(50) NOT NULL,
     deposition_name VARCHAR(255),
     resource_id VARCHAR(100) NULL,
-    status ENUM('pending', 'in_progress', 'completed', 'failed') DEFAULT 'pending',
+    package_id VARCHAR(100) NULL,
+    source_modified VARCHAR(32) NULL,
+    source_hash VARCHAR(255) NULL,
+    tee_lead_id INT NULL,
+    bundle_manifest MEDIUMTEXT NULL,
+    status ENUM('scheduled', 'pending', 'in_progress', 'completed', 'failed', 'cancelled') DEFAULT 'pending',
+    not_before DATETIME NULL,
     zenodo_response TEXT,
     retry_count INT NOT NULL DEFAULT 0,
+    error_class VARCHAR(32) NULL,
+    worker_id VARCHAR(255) NULL,
+    heartbeat_at TIMESTAMP NULL DEFAULT NULL,
+    task_payload TEXT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_transfers_status_heartbeat (status, heartbeat_at),
+    INDEX idx_transfers_status_not_before (status, not_before),
+    INDEX idx_transfers_user_package (username, package_id),
+    INDEX idx_transfers_deposition_resource (deposition_id, resource_id),
+    INDEX idx_transfers_tee_lead (tee_lead_id)
+);
+
+CREATE TABLE IF NOT EXISTS circuit_breakers (
+    name VARCHAR(64) NOT NULL PRIMARY KEY,
+    state ENUM('closed', 'open', 'half_open') NOT NULL DEFAULT 'closed',
+    reason TEXT NULL,
+    opened_at TIMESTAMP NULL DEFAULT NULL,
+    probe_owner VARCHAR(255) NULL,
+    probe_started_at TIMESTAMP NULL DEFAULT NULL,
+    trips INT NOT NULL DEFAULT 0,
+    calls INT NULL,
+    error_rate FLOAT NULL,
+    latency_ms FLOAT NULL,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
 );
+
+INSERT IGNORE INTO circuit_breakers (name) VALUES ('zenodo');
+
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+    fingerprint CHAR(32) NOT NULL PRIMARY KEY,
+    tokens DOUBLE NOT NULL DEFAULT 0,
+    refilled_at DATETIME(6) NOT NULL DEFAULT '2000-01-01 00:00:00'
+);
+
+CREATE TABLE IF NOT EXISTS upload_leases (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    fingerprint CHAR(32) NOT NULL,
+    owner VARCHAR(255) NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    INDEX idx_upload_leases_fingerprint (fingerprint, expires_at)
+);
+
+CREATE TABLE IF NOT EXISTS transfer_outbox (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    transfer_id INT NULL,
+    payload TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS upload_jobs (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    queue VARCHAR(255) NOT NULL,
+    body TEXT NOT NULL,
+    visible_at DATETIME NOT NULL,
+    claimed_by VARCHAR(255) NULL,
+    deliveries INT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_upload_jobs_queue_visible (queue, visible_at, id),
+    INDEX idx_upload_jobs_claimed_by (claimed_by)
+);
+
+CREATE TABLE IF NOT EXISTS package_jobs (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    username VARCHAR(255) NOT NULL,
+    package_id VARCHAR(100) NOT NULL,
+    deposition_id VARCHAR(50) NOT NULL,
+    mode ENUM('export', 'sync', 'newversion', 'bundle') NOT NULL DEFAULT 'export',
+    version_deposition_id VARCHAR(50) NULL,
+    status ENUM('pending', 'expanding', 'completed', 'failed', 'cancelled') DEFAULT 'pending',
+    total INT NULL,
+    queued INT NOT NULL DEFAULT 0,
+    skipped INT NOT NULL DEFAULT 0,
+    failed INT NOT NULL DEFAULT 0,
+    message TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_package_jobs_user_package (username, package_id)
+);
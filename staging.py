@@ -0,0 +1,205 @@
+"""
+Staging of upload files from network mounts to local scratch.
+
+CKAN resources usually live on NFS-style mounts, and reading them during the
+PUT lets mount latency cap upload throughput. With [staging] scratch_dir set,
+the worker copies the next prefetch_files buffered tasks' files to local scratch
+in copy_threads background threads while the current uploads run, and the
+upload then reads the local copy.
+
+Scratch use is bounded by budget_mb. Copies are evicted least recently used
+first, but a copy that is being copied or uploaded is never evicted; a file
+that does not fit is simply read from the mount. A staged copy is only used
+while the source still has the size and mtime it had when copied. A copy
+holds one of the prefetch_files places until its upload starts, or until the
+worker discards it because the task was dropped or handed back to the queue.
+
+Each worker process stages into its own worker-<pid> directory under
+scratch_dir; directories left behind by processes that no longer exist are
+removed when a Stager starts.
+"""
+import os
+import queue
+import shutil
+import hashlib
+import logging
+import threading
+import contextlib
+import collections
+import configs
+
+
+class _Entry:
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.mtime = None
+        self.ready = threading.Event()
+        self.ok = False
+        self.pins = 0
+        self.used = False
+
+
+class Stager:
+    """Prefetches source files into a bounded, LRU-managed scratch directory."""
+
+    def __init__(self, scratch_dir, budget_bytes, prefetch_files=2, copy_threads=1):
+        self.budget_bytes = budget_bytes
+        self.prefetch_files = prefetch_files
+        self.directory = os.path.join(scratch_dir, f"worker-{os.getpid()}")
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._copies = queue.Queue()
+        _remove_orphaned_dirs(scratch_dir)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+        self._threads = [threading.Thread(target=self._copy_loop, name=f'stager-{n}', daemon=True)
+                         for n in range(max(copy_threads, 1))]
+        for thread in self._threads:
+            thread.start()
+
+    def _used_bytes(self):
+        return sum(entry.size for entry in self._entries.values())
+
+    def _outstanding(self):
+        return sum(1 for entry in self._entries.values() if not entry.used)
+
+    def prefetch(self, source):
+        """Queue a background copy of source unless it is staged already or prefetch_files are waiting."""
+        with self._lock:
+            if source in self._entries or self._outstanding() >= self.prefetch_files:
+                return
+            name = hashlib.sha1(source.encode()).hexdigest()
+            self._entries[source] = _Entry(os.path.join(self.directory, name))
+        self._copies.put(source)
+
+    def _make_room(self, size):
+        # Caller holds the lock. Evicts idle copies, oldest use first.
+        if size > self.budget_bytes:
+            return False
+        for source, entry in list(self._entries.items()):
+            if self._used_bytes() + size <= self.budget_bytes:
+                break
+            if entry.ready.is_set() and entry.pins == 0:
+                self._evict(source)
+        return self._used_bytes() + size <= self.budget_bytes
+
+    def _evict(self, source):
+        entry = self._entries.pop(source)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(entry.path)
+
+    def _copy_loop(self):
+        while True:
+            source = self._copies.get()
+            if source is None:
+                return
+            with self._lock:
+                entry = self._entries.get(source)
+            if entry is not None:
+                self._copy(source, entry)
+
+    def _copy(self, source, entry):
+        try:
+            st = os.stat(source)
+            with self._lock:
+                if not self._make_room(st.st_size):
+                    logging.info(f"Not staging {source}: {st.st_size} bytes do not fit the scratch budget")
+                    return
+                entry.size, entry.mtime = st.st_size, st.st_mtime
+            shutil.copyfile(source, entry.path + '.part')
+            os.replace(entry.path + '.part', entry.path)
+            st = os.stat(source)
+            entry.ok = (st.st_size, st.st_mtime) == (entry.size, entry.mtime)
+        except OSError as e:
+            logging.warning(f"Could not stage {source}: {e}")
+        finally:
+            with self._lock:
+                if not entry.ok and self._entries.get(source) is entry and entry.pins == 0:
+                    self._evict(source)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(entry.path + '.part')
+            entry.ready.set()
+
+    def discard(self, source):
+        """
+        Give up a prefetched copy whose task will not be uploaded here, so it stops
+        holding a prefetch place. An idle copy is deleted; one still being copied is
+        left to the LRU eviction, and one in use is left alone.
+        """
+        with self._lock:
+            entry = self._entries.get(source)
+            if entry is None or entry.pins:
+                return
+            entry.used = True
+            if entry.ready.is_set():
+                self._evict(source)
+
+    @contextlib.contextmanager
+    def staged(self, source):
+        """
+        Yield the path to upload source from: the local copy if one is staged (waiting
+        for a copy in progress to finish), otherwise source itself.
+        """
+        with self._lock:
+            entry = self._entries.get(source)
+            if entry is not None:
+                entry.pins += 1
+                entry.used = True
+                self._entries.move_to_end(source)
+        if entry is None:
+            yield source
+            return
+        try:
+            entry.ready.wait()
+            path = source
+            if entry.ok:
+                try:
+                    st = os.stat(source)
+                    if (st.st_size, st.st_mtime) == (entry.size, entry.mtime):
+                        path = entry.path
+                    else:
+                        logging.info(f"{source} changed since it was staged; reading it from the mount")
+                except OSError:
+                    pass
+            yield path
+        finally:
+            with self._lock:
+                entry.pins -= 1
+                if not entry.ok and entry.pins == 0 and self._entries.get(source) is entry:
+                    self._evict(source)
+
+    def close(self):
+        """Stop the copy threads and delete this process's scratch directory."""
+        for _ in self._threads:
+            self._copies.put(None)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _remove_orphaned_dirs(scratch_dir):
+    """Delete worker-<pid> directories whose process has exited."""
+    if not os.path.isdir(scratch_dir):
+        return
+    for name in os.listdir(scratch_dir):
+        pid = name[len('worker-'):]
+        if not name.startswith('worker-') or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            shutil.rmtree(os.path.join(scratch_dir, name), ignore_errors=True)
+        except PermissionError:
+            pass
+
+
+def get_stager():
+    """Build a Stager from [staging], or return None when scratch_dir is not set."""
+    sc = configs.get_staging_config()
+    if not sc['scratch_dir']:
+        return None
+    return Stager(
+        sc['scratch_dir'],
+        sc['budget_mb'] * 1024 * 1024,
+        prefetch_files=sc['prefetch_files'],
+        copy_threads=sc['copy_threads'],
+    )
@@ -51,6 +51,36 @@ function export_to_zenodo(){
     }
 }
 
+function export_to_depositions() {
+    try {
+        showProgress();
+        $("#output").html('<img src="static/progress.gif" alt="progress">');
+        $.ajax({
+            type: "POST",
+            url: "ajax",
+            data: {
+                action: "export_to_depositions",
+                // Zenodo API key is stored server-side after list_depositions; not re-sent here
+                ckan_resource_id: $('#ckan_resource_id').val(),
+                deposition_ids: ($('#sel_depositions').val() || []).join(',')
+            },
+            success: function (data) {
+                $("#output").html(data);
+                hideProgress();
+            },
+            complete: function () {},
+            error: function () {
+                $("#output").html('<div style="color:red;">An unexpected error occurred. Please reload and try again.</div>');
+                hideProgress();
+            },
+            dataType: 'text'
+        });
+    } catch (e) {
+        hideProgress();
+        alert(e);
+    }
+}
+
 function create_deposit_and_export() {
     try {
         showProgress();
@@ -113,6 +143,122 @@ function export_package_to_zenodo() {
     }
 }
 
+function sync_package_to_zenodo() {
+    try {
+        showProgress();
+        $("#output").html('<img src="static/progress.gif" alt="progress">');
+        $.ajax({
+            type: "POST",
+            url: "ajax",
+            data: {
+                action: "sync_package_to_zenodo",
+                package_id: $('#ckan_package_id').val(),
+                deposition_id: $('#sel_depsition option:selected').val()
+            },
+            success: function (data) {
+                $("#output").html(data);
+                hideProgress();
+            },
+            complete: function () {},
+            error: function () {
+                $("#output").html('<div style="color:red;">An unexpected error occurred. Please reload and try again.</div>');
+                hideProgress();
+            },
+            dataType: 'text'
+        });
+    } catch (e) {
+        hideProgress();
+        alert(e);
+    }
+}
+
+function new_version_to_zenodo() {
+    try {
+        showProgress();
+        $("#output").html('<img src="static/progress.gif" alt="progress">');
+        $.ajax({
+            type: "POST",
+            url: "ajax",
+            data: {
+                action: "new_version_to_zenodo",
+                package_id: $('#ckan_package_id').val(),
+                deposition_id: $('#sel_depsition option:selected').val()
+            },
+            success: function (data) {
+                $("#output").html(data);
+                hideProgress();
+            },
+            complete: function () {},
+            error: function () {
+                $("#output").html('<div style="color:red;">An unexpected error occurred. Please reload and try again.</div>');
+                hideProgress();
+            },
+            dataType: 'text'
+        });
+    } catch (e) {
+        hideProgress();
+        alert(e);
+    }
+}
+
+function bundle_package_to_zenodo() {
+    try {
+        showProgress();
+        $("#output").html('<img src="static/progress.gif" alt="progress">');
+        $.ajax({
+            type: "POST",
+            url: "ajax",
+            data: {
+                action: "bundle_package_to_zenodo",
+                package_id: $('#ckan_package_id').val(),
+                deposition_id: $('#sel_depsition option:selected').val()
+            },
+            success: function (data) {
+                $("#output").html(data);
+                hideProgress();
+            },
+            complete: function () {},
+            error: function () {
+                $("#output").html('<div style="color:red;">An unexpected error occurred. Please reload and try again.</div>');
+                hideProgress();
+            },
+            dataType: 'text'
+        });
+    } catch (e) {
+        hideProgress();
+        alert(e);
+    }
+}
+
+function plan_package_export() {
+    try {
+        showProgress();
+        $("#output").html('<img src="static/progress.gif" alt="progress">');
+        $.ajax({
+            type: "POST",
+            url: "ajax",
+            data: {
+                action: "plan_package_export",
+                package_id: $('#ckan_package_id').val(),
+                deposition_id: $('#sel_depsition option:selected').val()
+            },
+            success: function (data) {
+                $("#output").html(data);
+                hideProgress();
+            },
+            complete: function () {},
+            error: function () {
+                $("#output").html('<div style="color:red;">An unexpected error occurred. Please reload and try again.</div>');
+                hideProgress();
+            },
+            dataType: 'text'
+        });
+    } catch (e) {
+        hideProgress();
+        alert(e);
+    }
+}
+
 function list_depositions(option) {
     try {
         showProgress();
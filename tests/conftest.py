@@ -25,6 +25,7 @@ CKAN_CONFIG = {
     'resources_path': '/mnt/resources',
     'resources_usr_path': '/mnt/homes/{user}',
     'resources_usr_url': 'http://ckan.test/~',
+    'timeout': 30,
 }
 
 ZENODO_CONFIG = {
@@ -32,6 +33,13 @@ ZENODO_CONFIG = {
     'use_sandbox': False,
     'upload_type': 'dataset',
     'access_right': 'restricted',
+    'connect_timeout': 10,
+    'read_timeout': 300,
+    'min_upload_kbps': 0,
+    'stall_seconds': 120,
+    'upload_block_kb': 8192,
+    'tee_buffer_blocks': 4,
+    'upload_drop_cache': True,
 }
 
 RABBITMQ_CONFIG = {
@@ -40,6 +48,12 @@ RABBITMQ_CONFIG = {
     'max_retries': '3',
 }
 
+QUEUE_CONFIG = {
+    'backend': 'rabbitmq',
+    'poll_interval': 1.0,
+    'visibility_timeout': 600,
+}
+
 APP_CONFIG = {
     'secret_key': 'test-secret-key',
     'log_file': '/dev/null',
@@ -65,6 +79,109 @@ SMTP_CONFIG = {
     'from_addr': 'noreply@test.com',
 }
 
+SERVER_CONFIG = {
+    'host': '0.0.0.0',
+    'port': 8090,
+    'threads': 4,
+    'connection_limit': 100,
+    'backlog': 1024,
+    'channel_timeout': 120,
+    'processes': 1,
+}
+
+HEALTH_CONFIG = {
+    'probe_interval': 30,
+    'probe_timeout': 5,
+}
+
+WORKER_CONFIG = {
+    'heartbeat_interval': 30,
+    'heartbeat_timeout': 180,
+    'reap_interval': 60,
+    'reap_batch_size': 100,
+    'progress_interval': 10,
+    'progress_percent': 5,
+    'cancel_check_interval': 5,
+}
+
+# lanes = 0 keeps every task on the plain RABBITMQ_CONFIG['queue']
+SCHEDULER_CONFIG = {
+    'lanes': 0,
+    'upload_slots': 4,
+    'max_uploads_per_user': 2,
+    'prefetch_per_lane': 10,
+    'user_weights': '',
+    'small_file_mb': 0,
+    'reserved_small_slots': 1,
+}
+
+# No scratch_dir: uploads read straight from the resource path
+STAGING_CONFIG = {
+    'scratch_dir': '',
+    'budget_mb': 20480,
+    'prefetch_files': 2,
+    'copy_threads': 1,
+}
+
+# min_file_mb = 0 queues every file at once
+OFFPEAK_CONFIG = {
+    'min_file_mb': 0,
+    'windows': '20:00-06:00',
+    'max_concurrent_large': 2,
+    'release_interval': 60,
+}
+
+# Disabled: exports publish straight to RabbitMQ unless a test enables it
+OUTBOX_CONFIG = {
+    'enabled': False,
+    'batch_size': 100,
+    'relay_interval': 1.0,
+}
+
+# No cache: tests stat (or patch) files afresh every time
+PREFLIGHT_CONFIG = {
+    'threads': 4,
+    'cache_ttl': 0,
+    'max_entries': 100,
+}
+
+PLANNER_CONFIG = {
+    'history_transfers': 200,
+    'largest_files': 3,
+}
+
+BUNDLE_CONFIG = {
+    'max_member_mb': 1,
+}
+
+# Limits of 0 disable the limiter; test_rate_limiter.py builds its own instances
+RATE_LIMIT_CONFIG = {
+    'backend': 'local',
+    'requests_per_minute': 0,
+    'burst': 5,
+    'max_concurrent_uploads': 0,
+    'lease_seconds': 600,
+    'web_max_wait': 5.0,
+}
+
+RETRY_CONFIG = {
+    'policy': 'retry_policy.RetryPolicy',
+    'base_delay': 10,
+    'max_delay': 300,
+    'jitter': 0.5,
+    'max_retry_after': 300,
+}
+
+# The breaker is exercised directly in test_circuit_breaker.py; elsewhere it is off
+CIRCUIT_BREAKER_CONFIG = {
+    'enabled': False,
+    'window_seconds': 300,
+    'min_calls': 5,
+    'failure_rate': 0.5,
+    'open_seconds': 120,
+    'state_cache_seconds': 5,
+}
+
 # ---------------------------------------------------------------------------
 # Patch configs before any test module imports server.py / worker.py
 # ---------------------------------------------------------------------------
@@ -77,6 +194,20 @@ _patches = [
     patch('configs.get_app_config', return_value=APP_CONFIG),
     patch('configs.get_sso_config', return_value=SSO_CONFIG),
     patch('configs.get_smtp_config', return_value=SMTP_CONFIG),
+    patch('configs.get_server_config', return_value=SERVER_CONFIG),
+    patch('configs.get_health_config', return_value=HEALTH_CONFIG),
+    patch('configs.get_worker_config', return_value=WORKER_CONFIG),
+    patch('configs.get_circuit_breaker_config', return_value=CIRCUIT_BREAKER_CONFIG),
+    patch('configs.get_retry_config', return_value=RETRY_CONFIG),
+    patch('configs.get_rate_limit_config', return_value=RATE_LIMIT_CONFIG),
+    patch('configs.get_scheduler_config', return_value=SCHEDULER_CONFIG),
+    patch('configs.get_offpeak_config', return_value=OFFPEAK_CONFIG),
+    patch('configs.get_staging_config', return_value=STAGING_CONFIG),
+    patch('configs.get_outbox_config', return_value=OUTBOX_CONFIG),
+    patch('configs.get_queue_config', return_value=QUEUE_CONFIG),
+    patch('configs.get_preflight_config', return_value=PREFLIGHT_CONFIG),
+    patch('configs.get_planner_config', return_value=PLANNER_CONFIG),
+    patch('configs.get_bundle_config', return_value=BUNDLE_CONFIG),
 ]
 
 
@@ -104,6 +235,20 @@ def mock_configs():
         'rabbitmq': RABBITMQ_CONFIG,
         'app': APP_CONFIG,
         'smtp': SMTP_CONFIG,
+        'server': SERVER_CONFIG,
+        'health': HEALTH_CONFIG,
+        'worker': WORKER_CONFIG,
+        'circuit_breaker': CIRCUIT_BREAKER_CONFIG,
+        'retry': RETRY_CONFIG,
+        'rate_limit': RATE_LIMIT_CONFIG,
+        'scheduler': SCHEDULER_CONFIG,
+        'offpeak': OFFPEAK_CONFIG,
+        'staging': STAGING_CONFIG,
+        'outbox': OUTBOX_CONFIG,
+        'queue': QUEUE_CONFIG,
+        'preflight': PREFLIGHT_CONFIG,
+        'planner': PLANNER_CONFIG,
+        'bundle': BUNDLE_CONFIG,
     }
 
 
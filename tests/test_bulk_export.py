@@ -0,0 +1,189 @@
+"""Unit tests for bulk_export.py — the admin bulk-export CLI."""
+import json
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+import ckan_zenodo
+import bulk_export
+from bulk_export import BulkExport, Manifest
+
+USER = {'username': 'admin', 'email': 'admin@test.com'}
+
+
+def _package(pid, *resource_ids):
+    return {'id': pid, 'name': pid, 'title': f'Title {pid}', 'notes': f'About {pid}',
+            'resources': [{'id': r, 'name': f'{r}.csv', 'url': f'http://ckan.test/{r}'} for r in resource_ids]}
+
+
+def _search(*pages):
+    """search_ckan_packages stand-in serving the given pages of packages."""
+    packages = [p for page in pages for p in page]
+
+    def search(q, fq, rows, start):
+        return {'count': len(packages), 'results': packages[start:start + rows]}
+    return MagicMock(side_effect=search)
+
+
+def _events(path):
+    return [json.loads(line) for line in open(path)]
+
+
+class TestIterPages:
+    def test_fetches_pages_lazily_until_count(self):
+        search = _search([_package('p1'), _package('p2')], [_package('p3')])
+        with patch('ckan_zenodo.search_ckan_packages', search):
+            pages = bulk_export.iter_pages('*:*', 'organization:o', rows=2)
+            start, packages = next(pages)
+            assert search.call_count == 1
+            assert (start, [p['id'] for p in packages]) == (0, ['p1', 'p2'])
+            assert [(s, len(p)) for s, p in pages] == [(2, 1)]
+        assert search.call_count == 2
+
+
+class TestManifest:
+    def test_replays_events_and_ignores_truncated_line(self, tmp_path):
+        path = tmp_path / 'run.jsonl'
+        path.write_text(
+            json.dumps({'event': 'run', 'query': 'organization:o'}) + '\n'
+            + json.dumps({'event': 'deposition', 'package_id': 'p1', 'deposition_id': 9,
+                          'deposition_name': 'Title p1'}) + '\n'
+            + json.dumps({'event': 'resource', 'package_id': 'p1', 'resource_id': 'r1', 'outcome': 'queued'}) + '\n'
+            + json.dumps({'event': 'page', 'next_start': 100}) + '\n'
+            + '{"event": "resource", "packa')
+
+        manifest = Manifest(str(path))
+
+        assert manifest.run == 'organization:o'
+        assert manifest.depositions == {'p1': (9, 'Title p1')}
+        assert manifest.resources == {'r1': 'queued'}
+        assert manifest.next_start == 100
+        manifest.close()
+
+
+class TestBulkExport:
+    def _run(self, tmp_path, search, deposition_id=None, query='organization:o'):
+        manifest = Manifest(str(tmp_path / 'run.jsonl'))
+        export = BulkExport('token', USER, manifest, 'Admin', deposition_id=deposition_id,
+                            batch_size=2, concurrency=2)
+        with patch('ckan_zenodo.search_ckan_packages', search):
+            counts = export.run(query, '*:*', query, rows=2)
+        manifest.close()
+        return counts
+
+    def test_creates_one_deposition_per_package_and_queues_resources(self, tmp_path):
+        search = _search([_package('p1', 'r1', 'r2'), _package('p2', 'r3')])
+        with patch('ckan_zenodo.create_deposition', side_effect=[{'id': 11}, {'id': 12}]) as mock_create, \
+             patch('ckan_zenodo.export_to_zenodo', side_effect=lambda *a, **kw: 100 + int(a[1][1])) as mock_export:
+            counts = self._run(tmp_path, search)
+
+        assert counts['queued'] == 3
+        assert mock_create.call_args_list[0][0] == ('token', 'Title p1', 'About p1', 'Admin')
+        kwargs = {c[0][1]: c[1] for c in mock_export.call_args_list}
+        assert kwargs['r3'] == {'package_id': 'p2', 'user': USER, 'deposition_name': 'Title p2',
+                                'source_modified': None, 'source_hash': None}
+        assert {c[0][1]: c[0][4] for c in mock_export.call_args_list} == {'r1': 11, 'r2': 11, 'r3': 12}
+        events = _events(tmp_path / 'run.jsonl')
+        assert {e['resource_id']: e['transfer_id'] for e in events if e['event'] == 'resource'} == \
+            {'r1': 101, 'r2': 102, 'r3': 103}
+        assert events[-1] == {'event': 'page', 'next_start': 2}
+
+    def test_shared_deposition_is_looked_up_once(self, tmp_path):
+        search = _search([_package('p1', 'r1'), _package('p2', 'r2')])
+        with patch('ckan_zenodo.get_deposition_name', return_value='Shared') as mock_name, \
+             patch('ckan_zenodo.create_deposition') as mock_create, \
+             patch('ckan_zenodo.export_to_zenodo', return_value=1) as mock_export:
+            self._run(tmp_path, search, deposition_id='555')
+
+        mock_name.assert_called_once_with('token', '555')
+        mock_create.assert_not_called()
+        assert all(c[0][4] == '555' for c in mock_export.call_args_list)
+
+    def test_known_outcomes_are_recorded(self, tmp_path):
+        search = _search([_package('p1', 'r1', 'r2')])
+        outcomes = {'r1': ckan_zenodo.DuplicateTransfer('dup'), 'r2': ckan_zenodo.FileTooLarge('big')}
+
+        def export(token, resource_id, *args, **kwargs):
+            raise outcomes[resource_id]
+
+        with patch('ckan_zenodo.create_deposition', return_value={'id': 11}), \
+             patch('ckan_zenodo.export_to_zenodo', side_effect=export):
+            counts = self._run(tmp_path, search)
+
+        assert (counts['skipped'], counts['failed'], counts['errors']) == (1, 1, 0)
+        assert {'event': 'package_done', 'package_id': 'p1'} in _events(tmp_path / 'run.jsonl')
+
+    def test_resume_skips_finished_work_and_retries_errors(self, tmp_path):
+        search = _search([_package('p1', 'r1', 'r2')], [_package('p2', 'r3')])
+        calls = []
+
+        def flaky(token, resource_id, *args, **kwargs):
+            calls.append(resource_id)
+            if resource_id == 'r2' and calls.count('r2') == 1:
+                raise Exception("DB down")
+            return 1
+
+        with patch('ckan_zenodo.create_deposition', side_effect=[{'id': 11}, {'id': 12}]) as mock_create, \
+             patch('ckan_zenodo.export_to_zenodo', side_effect=flaky):
+            first = self._run(tmp_path, search)
+            second = self._run(tmp_path, search)
+
+        assert first['errors'] == 1
+        # The failed page is fetched again, but only r2 is retried and no deposition is created twice
+        assert calls == ['r1', 'r2', 'r3', 'r2']
+        assert mock_create.call_count == 2
+        assert (second['queued'], second['resumed'], second['errors']) == (1, 2, 0)
+        assert _events(tmp_path / 'run.jsonl')[-1] == {'event': 'page', 'next_start': 2}
+
+    def test_manifest_of_another_query_is_refused(self, tmp_path):
+        with patch('ckan_zenodo.export_to_zenodo'):
+            self._run(tmp_path, _search([]))
+            with pytest.raises(ValueError):
+                self._run(tmp_path, _search([]), query='tags:climate')
+
+
+class TestPlan:
+    def test_plans_every_package_with_one_history_lookup(self):
+        search = _search([_package('p1', 'r1'), _package('p2', 'r2', 'r3')], [_package('p3')])
+        per_package = {'resources': 0, 'files': 0, 'bytes': 0, 'largest': [], 'too_large': [],
+                       'missing': [], 'duplicates': []}
+        with patch('ckan_zenodo.search_ckan_packages', search), \
+             patch('planner.historical_throughput', return_value=(100.0, 5)) as mock_history, \
+             patch('planner.plan_resources', return_value=per_package) as mock_plan, \
+             patch('planner.merge_plans', return_value={}) as mock_merge:
+            total = bulk_export.plan('*:*', 'organization:o', rows=2, deposition_id='9')
+
+        mock_history.assert_called_once()
+        assert [len(c[0][0]) for c in mock_plan.call_args_list] == [1, 2, 0]
+        assert all(c[0][1] == '9' and c[1] == {'throughput': (100.0, 5)} for c in mock_plan.call_args_list)
+        assert len(mock_merge.call_args[0][0]) == 3
+        assert total['packages'] == 3
+
+
+class TestMain:
+    def test_plan_needs_no_manifest_or_token(self, monkeypatch, capsys):
+        monkeypatch.delenv('ZENODO_API_KEY', raising=False)
+        with patch('bulk_export.plan', return_value={
+                'packages': 1, 'resources': 1, 'files': 1, 'bytes': 2048, 'projected_seconds': None,
+                'largest': [{'id': 'r1', 'path': '/mnt/r1', 'size': 2048}], 'missing': [], 'too_large': [],
+                'duplicates': [], 'exported_elsewhere': []}):
+            bulk_export.main(['bulk-export', '--organization', 'o', '--plan'])
+
+        out = capsys.readouterr().out
+        assert '1 file(s) to upload, 2.0 KB' in out
+        assert '/mnt/r1' in out
+
+    def test_requires_zenodo_token(self, tmp_path, monkeypatch):
+        monkeypatch.delenv('ZENODO_API_KEY', raising=False)
+        with pytest.raises(SystemExit):
+            bulk_export.main(['bulk-export', '--organization', 'o', '--user', 'admin',
+                              '--manifest', str(tmp_path / 'm.jsonl')])
+
+    def test_organization_becomes_filter_query(self, tmp_path, monkeypatch):
+        monkeypatch.setenv('ZENODO_API_KEY', 'token')
+        with patch.object(BulkExport, 'run', return_value=dict.fromkeys(
+                ['queued', 'skipped', 'failed', 'errors', 'resumed'], 0)) as mock_run:
+            bulk_export.main(['bulk-export', '--organization', 'hiperact', '--user', 'admin',
+                              '--manifest', str(tmp_path / 'm.jsonl'), '--rows', '50'])
+
+        mock_run.assert_called_once_with('organization:hiperact', '*:*', 'organization:hiperact', rows=50)
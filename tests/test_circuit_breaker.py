@@ -0,0 +1,173 @@
+"""Unit tests for circuit_breaker.py — Zenodo failure tracking and shared open/half-open state."""
+import pytest
+import requests
+from unittest.mock import patch, MagicMock
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker, is_zenodo_fault, CLOSED, OPEN, HALF_OPEN
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _http_error(status):
+    response = MagicMock()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"HTTP {status}", response=response)
+
+
+@pytest.fixture
+def shared():
+    """Patch the DB-backed helpers and keep the shared row in a dict."""
+    row = {'state': CLOSED, 'open_for': None}
+
+    def trip(name, reason):
+        row.update(state=OPEN, open_for=0, reason=reason)
+
+    def close(name):
+        row.update(state=CLOSED, open_for=None)
+
+    def claim(name, owner, open_seconds):
+        if row['state'] == OPEN and row['open_for'] >= open_seconds:
+            row['state'] = HALF_OPEN
+            return True
+        return False
+
+    with patch('circuit_breaker.read_state', side_effect=lambda name: dict(row)), \
+         patch('circuit_breaker._trip', side_effect=trip) as mock_trip, \
+         patch('circuit_breaker._close', side_effect=close) as mock_close, \
+         patch('circuit_breaker._claim_probe', side_effect=claim), \
+         patch('circuit_breaker._release_probe') as mock_release, \
+         patch('circuit_breaker._publish_stats'):
+        yield row, mock_trip, mock_close, mock_release
+
+
+def _breaker(clock, **kwargs):
+    defaults = dict(window_seconds=60, min_calls=4, failure_rate=0.5, open_seconds=120,
+                    state_cache_seconds=0, clock=clock)
+    defaults.update(kwargs)
+    return CircuitBreaker(**defaults)
+
+
+class TestIsZenodoFault:
+    def test_server_errors_and_throttling_count(self):
+        assert is_zenodo_fault(_http_error(503))
+        assert is_zenodo_fault(_http_error(429))
+
+    def test_client_errors_do_not_count(self):
+        assert not is_zenodo_fault(_http_error(403))
+        assert not is_zenodo_fault(FileNotFoundError('/missing'))
+
+    def test_network_errors_and_timeouts_count(self):
+        from upload_stream import UploadStalled
+        assert is_zenodo_fault(requests.exceptions.ConnectionError())
+        assert is_zenodo_fault(requests.exceptions.ReadTimeout())
+        assert is_zenodo_fault(UploadStalled('stalled'))
+
+
+class TestCircuitBreaker:
+    def test_opens_when_failure_rate_reached(self, shared):
+        row, mock_trip, _, _ = shared
+        breaker = _breaker(FakeClock())
+        for ok in (True, True, False, False):
+            breaker.record(ok, 1.0)
+
+        mock_trip.assert_called_once()
+        assert breaker.state() == OPEN
+        assert breaker.allow() is False
+
+    def test_stays_closed_below_min_calls(self, shared):
+        _, mock_trip, _, _ = shared
+        breaker = _breaker(FakeClock())
+        for _ in range(3):
+            breaker.record(False, 1.0)
+
+        mock_trip.assert_not_called()
+        assert breaker.allow() is True
+
+    def test_old_failures_leave_the_window(self, shared):
+        _, mock_trip, _, _ = shared
+        clock = FakeClock()
+        breaker = _breaker(clock)
+        for _ in range(3):
+            breaker.record(False, 1.0)
+        clock.now += 61
+        breaker.record(False, 1.0)
+
+        mock_trip.assert_not_called()
+
+    def test_single_probe_after_open_period(self, shared):
+        row = shared[0]
+        row.update(state=OPEN, open_for=121)
+        breaker = _breaker(FakeClock())
+
+        assert breaker.allow() is True
+        assert breaker.allow() is False  # only one probe in flight
+
+    def test_successful_probe_closes_circuit(self, shared):
+        row, _, mock_close, _ = shared
+        row.update(state=OPEN, open_for=121)
+        breaker = _breaker(FakeClock())
+        breaker.allow()
+        breaker.record(True, 2.0)
+
+        mock_close.assert_called_once_with('zenodo')
+        assert breaker.allow() is True
+
+    def test_failed_probe_reopens_circuit(self, shared):
+        row, mock_trip, _, _ = shared
+        row.update(state=OPEN, open_for=121)
+        breaker = _breaker(FakeClock())
+        breaker.allow()
+        breaker.record(False, 2.0)
+
+        assert mock_trip.call_args[0][1] == 'Half-open probe failed'
+        assert breaker.allow() is False
+
+    def test_abandoned_probe_is_released(self, shared):
+        row, _, _, mock_release = shared
+        row.update(state=OPEN, open_for=121)
+        breaker = _breaker(FakeClock())
+        breaker.allow()
+        breaker.abandon_probe()
+
+        mock_release.assert_called_once()
+
+    def test_retry_after_counts_down_open_period(self, shared):
+        row = shared[0]
+        row.update(state=OPEN, open_for=100)
+        assert _breaker(FakeClock()).retry_after() == 20
+
+    def test_fails_open_when_db_unreachable(self):
+        with patch('circuit_breaker.read_state', side_effect=Exception("DB down")):
+            assert _breaker(FakeClock()).allow() is True
+
+    def test_shared_state_is_cached(self, shared):
+        clock = FakeClock()
+        breaker = _breaker(clock, state_cache_seconds=5)
+        with patch('circuit_breaker.read_state', return_value={'state': CLOSED}) as mock_read:
+            breaker.allow()
+            breaker.allow()
+            clock.now += 5
+            breaker.allow()
+
+        assert mock_read.call_count == 2
+
+
+class TestGetBreaker:
+    def test_disabled_returns_none(self, mock_configs):
+        assert circuit_breaker.get_breaker() is None
+
+    def test_enabled_returns_one_breaker_per_process(self, mock_configs):
+        cfg = {**mock_configs['circuit_breaker'], 'enabled': True, 'open_seconds': 30}
+        with patch('configs.get_circuit_breaker_config', return_value=cfg):
+            first = circuit_breaker.get_breaker()
+            second = circuit_breaker.get_breaker()
+
+        assert first is second
+        assert first.open_seconds == 30
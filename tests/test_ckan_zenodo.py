@@ -1,9 +1,12 @@
 """Unit tests for ckan_zenodo.py — all I/O is mocked."""
+import datetime
 import pytest
 import requests as req_lib
 from unittest.mock import patch, MagicMock, call
 
 import ckan_zenodo
+import preflight
+import upload_stream
 from ckan_zenodo import (
     ResourceFileNotFound,
     FileTooLarge,
@@ -18,6 +21,10 @@ from ckan_zenodo import (
     check_duplicate_transfer,
     get_transfer_by_id,
     reset_transfer_for_retry,
+    send_upload_task,
+    create_transfer,
+    create_package_job,
+    reset_publisher,
 )
 
 
@@ -91,7 +98,7 @@ class TestExportToZenodo:
 
         with patch('ckan_zenodo.get_deposition_name', return_value='Deposit'), \
              patch('ckan_zenodo.get_file_path', return_value='/missing/file.csv'), \
-             patch('os.path.exists', return_value=False):
+             patch('preflight.stat', return_value=preflight.MISSING):
 
             with pytest.raises(ResourceFileNotFound):
                 export_to_zenodo('key', 'res-id', 'file.csv', 'http://url', '123')
@@ -107,8 +114,7 @@ class TestExportToZenodo:
 
         with patch('ckan_zenodo.get_deposition_name', return_value='Deposit'), \
              patch('ckan_zenodo.get_file_path', return_value=str(test_file)), \
-             patch('os.path.exists', return_value=True), \
-             patch('os.path.getsize', return_value=2 * 1024 * 1024), \
+             patch('preflight.stat', return_value=preflight.FileStat(True, 2 * 1024 * 1024, 0.0)), \
              patch('configs.get_app_config', return_value=big_app_config):
 
             with pytest.raises(FileTooLarge):
@@ -124,8 +130,7 @@ class TestExportToZenodo:
 
         with patch('ckan_zenodo.get_deposition_name', return_value='Deposit'), \
              patch('ckan_zenodo.get_file_path', return_value=str(test_file)), \
-             patch('os.path.exists', return_value=True), \
-             patch('os.path.getsize', return_value=999 * 1024 * 1024), \
+             patch('preflight.stat', return_value=preflight.FileStat(True, 999 * 1024 * 1024, 0.0)), \
              patch('ckan_zenodo.send_upload_task'):
 
             export_to_zenodo('key', 'res-id', 'file.csv', 'http://url', '123')
@@ -139,7 +144,6 @@ class TestExportToZenodo:
 
         with patch('ckan_zenodo.get_deposition_name', return_value='My Deposit') as mock_dep, \
              patch('ckan_zenodo.get_file_path', return_value=str(test_file)), \
-             patch('os.path.exists', return_value=True), \
              patch('ckan_zenodo.insert_transfer_record', return_value=42) as mock_insert, \
              patch('ckan_zenodo.send_upload_task') as mock_send:
 
@@ -148,11 +152,26 @@ class TestExportToZenodo:
             mock_dep.assert_called_once_with('api-key', '99')
             mock_insert.assert_called_once_with(
                 'testuser', str(test_file), 'data.csv', '99', 'My Deposit',
-                'res-id', 'testuser@test.com'
+                'res-id', 'testuser@test.com', file_size=len("col1,col2\n1,2"), package_id=None,
+                source_modified=None, source_hash=None
             )
             # transfer_id 42 must be passed to send_upload_task
             assert mock_send.call_args[0][6] == 42
 
+    def test_replace_skips_duplicate_check(self, mock_configs, mock_session):
+        with patch('ckan_zenodo.check_duplicate_transfer') as mock_check, \
+             patch('ckan_zenodo.get_file_path', return_value='/mnt/data.csv'), \
+             patch('preflight.stat', return_value=preflight.FileStat(True, 10, 0.0)), \
+             patch('ckan_zenodo.create_transfer', return_value=8) as mock_create:
+
+            assert export_to_zenodo('api-key', 'res-id', 'data.csv', 'http://url', '99', deposition_name='Dep',
+                                    source_modified='2024-05-01T10:00:00', source_hash='md5:abc',
+                                    replace=True) == 8
+
+        mock_check.assert_not_called()
+        assert mock_create.call_args[1]['source_modified'] == '2024-05-01T10:00:00'
+        assert mock_create.call_args[1]['source_hash'] == 'md5:abc'
+
 
 # ---------------------------------------------------------------------------
 # create_deposit_and_export
@@ -178,7 +197,7 @@ class TestCreateDepositAndExport:
     def test_deletes_orphan_when_file_missing(self, mock_configs, mock_session):
         with patch('requests.post', return_value=self._good_create_response(9999)), \
              patch('ckan_zenodo.get_file_path', return_value='/missing/file.csv'), \
-             patch('os.path.exists', return_value=False), \
+             patch('preflight.stat', return_value=preflight.MISSING), \
              patch('requests.delete') as mock_delete:
 
             with pytest.raises(ResourceFileNotFound):
@@ -195,8 +214,7 @@ class TestCreateDepositAndExport:
 
         with patch('requests.post', return_value=self._good_create_response()), \
              patch('ckan_zenodo.get_file_path', return_value=str(test_file)), \
-             patch('os.path.exists', return_value=True), \
-             patch('os.path.getsize', return_value=2 * 1024 * 1024), \
+             patch('preflight.stat', return_value=preflight.FileStat(True, 2 * 1024 * 1024, 0.0)), \
              patch('configs.get_app_config', return_value=big_config):
 
             with pytest.raises(FileTooLarge):
@@ -208,7 +226,6 @@ class TestCreateDepositAndExport:
 
         with patch('requests.post', return_value=self._good_create_response()), \
              patch('ckan_zenodo.get_file_path', return_value=str(test_file)), \
-             patch('os.path.exists', return_value=True), \
              patch('ckan_zenodo.insert_transfer_record', return_value=1), \
              patch('ckan_zenodo.send_upload_task') as mock_send:
 
@@ -225,7 +242,6 @@ class TestCreateDepositAndExport:
         with patch('configs.get_zenodo_config', return_value=custom_zenodo), \
              patch('requests.post', return_value=self._good_create_response()) as mock_post, \
              patch('ckan_zenodo.get_file_path', return_value=str(test_file)), \
-             patch('os.path.exists', return_value=True), \
              patch('ckan_zenodo.insert_transfer_record', return_value=1), \
              patch('ckan_zenodo.send_upload_task'):
 
@@ -241,7 +257,6 @@ class TestCreateDepositAndExport:
 
         with patch('requests.post', return_value=self._good_create_response()) as mock_post, \
              patch('ckan_zenodo.get_file_path', return_value=str(test_file)), \
-             patch('os.path.exists', return_value=True), \
              patch('ckan_zenodo.insert_transfer_record', return_value=1), \
              patch('ckan_zenodo.send_upload_task'):
 
@@ -253,11 +268,54 @@ class TestCreateDepositAndExport:
             assert metadata['access_right'] == 'open'
 
 
+    def test_create_deposition_needs_no_session(self, mock_configs):
+        with patch('requests.post', return_value=self._good_create_response(5)) as mock_post:
+            deposition = ckan_zenodo.create_deposition('key', 'Title', 'Desc', 'Doe, Jane')
+
+        assert deposition == {'id': 5}
+        assert mock_post.call_args[1]['json']['metadata']['creators'] == [
+            {'name': 'Doe, Jane', 'affiliation': 'MyAffiliation'}]
+
+
+# ---------------------------------------------------------------------------
+# search_ckan_packages
+# ---------------------------------------------------------------------------
+
+class TestSearchCkanPackages:
+    def test_pages_oldest_first_including_private(self, mock_configs):
+        with patch('ckan_zenodo.RemoteCKAN') as mock_ckan:
+            mock_ckan.return_value.call_action.return_value = {'count': 0, 'results': []}
+            ckan_zenodo.search_ckan_packages(fq='organization:o', rows=50, start=100)
+
+        action, params = mock_ckan.return_value.call_action.call_args[0]
+        assert action == 'package_search'
+        assert params == {'q': '*:*', 'fq': 'organization:o', 'rows': 50, 'start': 100,
+                          'sort': 'metadata_created asc, id asc', 'include_private': True}
+
+
 # ---------------------------------------------------------------------------
 # get_depositions
 # ---------------------------------------------------------------------------
 
 class TestGetDepositions:
+    def test_caps_the_rate_limit_wait_only_in_a_web_request(self, mock_configs):
+        resp = MagicMock()
+        resp.json.return_value = []
+        with patch('rate_limiter.get_limiter') as get_limiter, patch('requests.get', return_value=resp):
+            get_depositions('key')
+            with patch('ckan_zenodo.has_request_context', return_value=True):
+                get_depositions('key')
+
+        assert [c[1]['max_wait'] for c in get_limiter.return_value.acquire.call_args_list] == [None, 5.0]
+
+    def test_uses_configured_timeouts(self, mock_configs):
+        resp = MagicMock()
+        resp.json.return_value = []
+        with patch('requests.get', return_value=resp) as mock_get:
+            get_depositions('key')
+
+        assert mock_get.call_args[1]['timeout'] == (10, 300)
+
     def test_returns_list_on_success(self, mock_configs):
         mock_resp = MagicMock()
         mock_resp.raise_for_status.return_value = None
@@ -389,3 +447,524 @@ class TestGetTransfersForUser:
         result = get_transfers_for_user('newuser')
 
         assert result == []
+
+
+# ---------------------------------------------------------------------------
+# send_upload_task — cached publisher
+# ---------------------------------------------------------------------------
+
+class TestSendUploadTask:
+    def setup_method(self):
+        reset_publisher()
+
+    def teardown_method(self):
+        reset_publisher()
+
+    def test_reuses_connection_across_publishes(self, mock_configs):
+        with patch('pika.BlockingConnection') as mock_conn_cls:
+            send_upload_task('u', '/f', 'tok', '1', 'Dep', 'f.csv', 1)
+            send_upload_task('u', '/g', 'tok', '1', 'Dep', 'g.csv', 2)
+
+        mock_conn_cls.assert_called_once()
+        channel = mock_conn_cls.return_value.channel.return_value
+        assert channel.basic_publish.call_count == 2
+
+    def test_reconnects_once_when_cached_connection_is_dead(self, mock_configs):
+        import pika
+        dead_channel = MagicMock()
+        dead_channel.basic_publish.side_effect = pika.exceptions.StreamLostError("gone")
+        live_channel = MagicMock()
+
+        conns = [MagicMock(), MagicMock()]
+        conns[0].channel.return_value = dead_channel
+        conns[1].channel.return_value = live_channel
+
+        with patch('pika.BlockingConnection', side_effect=conns):
+            send_upload_task('u', '/f', 'tok', '1', 'Dep', 'f.csv', 1)
+
+        live_channel.basic_publish.assert_called_once()
+        conns[0].close.assert_called_once()
+
+    def test_message_contains_task_fields(self, mock_configs):
+        import json
+        with patch('pika.BlockingConnection') as mock_conn_cls:
+            send_upload_task('alice', '/f.csv', 'tok', '99', 'Dep', 'f.csv', 7, 'a@x.org')
+
+        channel = mock_conn_cls.return_value.channel.return_value
+        body = json.loads(channel.basic_publish.call_args[1]['body'])
+        assert body['transfer_id'] == 7
+        assert body['user_email'] == 'a@x.org'
+        assert channel.basic_publish.call_args[1]['routing_key'] == 'zenodo_upload'
+
+    def test_small_file_is_routed_to_small_queue(self, mock_configs):
+        import json
+        sc = {**mock_configs['scheduler'], 'small_file_mb': 10}
+        with patch('pika.BlockingConnection') as mock_conn_cls, \
+             patch('configs.get_scheduler_config', return_value=sc):
+            send_upload_task('alice', '/f.csv', 'tok', '99', 'Dep', 'f.csv', 7, file_size=2048)
+
+        channel = mock_conn_cls.return_value.channel.return_value
+        assert json.loads(channel.basic_publish.call_args[1]['body'])['file_size'] == 2048
+        assert channel.basic_publish.call_args[1]['routing_key'] == 'zenodo_upload.small'
+
+    def test_large_file_is_scheduled_instead_of_published(self, mock_configs, mock_db_connection):
+        import json
+        import datetime
+        conn, cursor = mock_db_connection
+        oc = {**mock_configs['offpeak'], 'min_file_mb': 100}
+        window = datetime.datetime(2026, 1, 5, 20, 0)
+
+        with patch('pika.BlockingConnection') as mock_conn_cls, \
+             patch('configs.get_offpeak_config', return_value=oc), \
+             patch('offpeak.not_before', return_value=window):
+            send_upload_task('alice', '/f.csv', 'tok', '99', 'Dep', 'f.csv', 7, file_size=200 * 1024 * 1024)
+
+        mock_conn_cls.assert_not_called()
+        sql, params = cursor.execute.call_args[0]
+        assert "status = 'scheduled'" in sql
+        assert params[0] == window
+        assert json.loads(params[1])['transfer_id'] == 7
+        assert params[2] == 7
+
+    def test_outbox_enabled_writes_task_instead_of_publishing(self, mock_configs, mock_db_connection):
+        import json
+        conn, cursor = mock_db_connection
+        oc = {**mock_configs['outbox'], 'enabled': True}
+
+        with patch('pika.BlockingConnection') as mock_conn_cls, \
+             patch('configs.get_outbox_config', return_value=oc):
+            send_upload_task('alice', '/f.csv', 'tok', '99', 'Dep', 'f.csv', 7)
+
+        mock_conn_cls.assert_not_called()
+        sql, params = cursor.execute.call_args[0]
+        assert 'INSERT INTO transfer_outbox' in sql
+        assert params[0] == 7
+        assert json.loads(params[1])['zenodo_token'] == 'tok'
+
+
+class TestCreateTransfer:
+    def test_outbox_writes_row_and_task_in_one_transaction(self, mock_configs, mock_db_connection):
+        import json
+        conn, cursor = mock_db_connection
+        cursor.lastrowid = 42
+        oc = {**mock_configs['outbox'], 'enabled': True}
+
+        with patch('pika.BlockingConnection') as mock_conn_cls, \
+             patch('configs.get_outbox_config', return_value=oc):
+            transfer_id = create_transfer('alice', '/f.csv', 'tok', '99', 'Dep', 'f.csv', 'res-1',
+                                          file_size=10)
+
+        assert transfer_id == 42
+        mock_conn_cls.assert_not_called()
+        insert_sql = cursor.execute.call_args_list[0][0][0]
+        outbox_sql, outbox_params = cursor.execute.call_args_list[1][0]
+        assert 'INSERT INTO zenodo_transfers' in insert_sql
+        assert 'INSERT INTO transfer_outbox' in outbox_sql
+        assert json.loads(outbox_params[1])['transfer_id'] == 42
+        conn.commit.assert_called_once()
+
+    def test_outbox_failure_rolls_back_transfer_row(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.execute.side_effect = [1, Exception("lock wait timeout")]
+        oc = {**mock_configs['outbox'], 'enabled': True}
+
+        with patch('configs.get_outbox_config', return_value=oc):
+            with pytest.raises(Exception, match="lock wait timeout"):
+                create_transfer('alice', '/f.csv', 'tok', '99', 'Dep', 'f.csv')
+
+        conn.rollback.assert_called_once()
+        conn.commit.assert_not_called()
+
+    def test_large_file_is_scheduled_in_the_same_transaction(self, mock_configs, mock_db_connection):
+        import datetime
+        conn, cursor = mock_db_connection
+        cursor.lastrowid = 42
+        oc = {**mock_configs['outbox'], 'enabled': True}
+        off = {**mock_configs['offpeak'], 'min_file_mb': 100}
+
+        with patch('configs.get_outbox_config', return_value=oc), \
+             patch('configs.get_offpeak_config', return_value=off), \
+             patch('offpeak.not_before', return_value=datetime.datetime(2026, 1, 5, 20, 0)):
+            create_transfer('alice', '/f.csv', 'tok', '99', 'Dep', 'f.csv', file_size=200 * 1024 * 1024)
+
+        sqls = [c[0][0] for c in cursor.execute.call_args_list]
+        assert "status = 'scheduled'" in sqls[1]
+        assert not any('transfer_outbox' in sql for sql in sqls)
+        conn.commit.assert_called_once()
+
+    def test_db_queue_enqueues_job_in_the_same_transaction(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.lastrowid = 42
+        qc = {**mock_configs['queue'], 'backend': 'mysql'}
+
+        with patch('configs.get_queue_config', return_value=qc):
+            create_transfer('alice', '/f.csv', 'tok', '99', 'Dep', 'f.csv')
+
+        job_sql, job_params = cursor.execute.call_args_list[1][0]
+        assert 'INSERT INTO upload_jobs' in job_sql
+        assert job_params[0] == 'zenodo_upload'
+        conn.commit.assert_called_once()
+
+    def test_without_outbox_inserts_then_publishes(self, mock_configs):
+        with patch('ckan_zenodo.insert_transfer_record', return_value=3) as mock_insert, \
+             patch('ckan_zenodo.send_upload_task') as mock_send:
+            assert create_transfer('alice', '/f.csv', 'tok', '99', 'Dep', 'f.csv') == 3
+
+        mock_insert.assert_called_once()
+        assert mock_send.call_args[0][6] == 3
+
+
+class TestCreateTeeTransfer:
+    def test_one_row_per_target_and_one_task(self, mock_configs, mock_db_connection):
+        import json
+        conn, cursor = mock_db_connection
+        ids = iter([10, 11, 12])
+        type(cursor).lastrowid = property(lambda self: next(ids))
+        oc = {**mock_configs['outbox'], 'enabled': True}
+
+        with patch('configs.get_outbox_config', return_value=oc), \
+             patch('pika.BlockingConnection') as mock_conn_cls:
+            from ckan_zenodo import create_tee_transfer
+            assert create_tee_transfer('alice', '/f.csv', 'tok', [('1', 'A'), ('2', 'B'), ('3', 'C')],
+                                       'f.csv', 'res-1', file_size=10) == [10, 11, 12]
+
+        mock_conn_cls.assert_not_called()
+        calls = cursor.execute.call_args_list
+        assert sum('INSERT INTO zenodo_transfers' in c[0][0] for c in calls) == 3
+        assert 'tee_lead_id' in calls[3][0][0] and calls[3][0][1] == (10, 11, 12)
+        task = json.loads(calls[4][0][1][1])
+        assert task['transfer_id'] == 10
+        assert [t['deposition_id'] for t in task['targets']] == ['1', '2', '3']
+        conn.commit.assert_called_once()
+
+    def test_large_file_schedules_the_followers_with_the_lead(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        ids = iter([10, 11])
+        type(cursor).lastrowid = property(lambda self: next(ids))
+        night = datetime.datetime(2026, 1, 5, 22, 0)
+
+        with patch('offpeak.is_large', return_value=True), \
+             patch('offpeak.not_before', return_value=night), \
+             patch('ckan_zenodo.publish_task') as mock_publish:
+            from ckan_zenodo import create_tee_transfer
+            create_tee_transfer('alice', '/f.csv', 'tok', [('1', 'A'), ('2', 'B')], 'f.csv', file_size=10)
+
+        mock_publish.assert_not_called()
+        sql, params = cursor.execute.call_args[0]
+        assert "status = 'scheduled'" in sql and 'tee_lead_id = %s' in sql
+        assert params == (night, 10, 11)
+
+    def test_single_target_is_refused(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        from ckan_zenodo import create_tee_transfer
+
+        with pytest.raises(ValueError):
+            create_tee_transfer('alice', '/f.csv', 'tok', [('1', 'A')], 'f.csv', 'res-1', file_size=10)
+
+        cursor.execute.assert_not_called()
+
+
+class TestCreateBundleTransfer:
+    MEMBERS = [{'resource_id': 'r1', 'name': 'a.csv', 'path': '/mnt/a', 'size': 10},
+               {'resource_id': 'r2', 'name': 'b.csv', 'path': '/mnt/b', 'size': 20}]
+
+    def test_one_row_with_manifest_and_a_bundle_task(self, mock_configs, mock_db_connection):
+        import json
+        conn, cursor = mock_db_connection
+        cursor.fetchone.return_value = None
+        cursor.lastrowid = 10
+
+        with patch('ckan_zenodo.publish_task') as mock_publish:
+            from ckan_zenodo import create_bundle_transfer
+            assert create_bundle_transfer('alice', 'tok', '1', 'Dep', 'pkg.zip', self.MEMBERS,
+                                          package_id='pkg') == 10
+
+        calls = cursor.execute.call_args_list
+        insert = next(c for c in calls if 'INSERT INTO zenodo_transfers' in c[0][0])
+        assert insert[0][1][4] == upload_stream.zip_size([('a.csv', 10), ('b.csv', 20)])
+        manifest = next(c for c in calls if 'bundle_manifest = %s' in c[0][0])
+        assert json.loads(manifest[0][1][0]) == self.MEMBERS
+        task = mock_publish.call_args[0][0]
+        assert task['bundle'] is True and task['transfer_id'] == 10
+        conn.commit.assert_called_once()
+
+    def test_live_archive_of_the_same_name_is_a_duplicate(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchone.return_value = (3,)
+
+        with patch('ckan_zenodo.publish_task') as mock_publish:
+            from ckan_zenodo import create_bundle_transfer
+            with pytest.raises(DuplicateTransfer):
+                create_bundle_transfer('alice', 'tok', '1', 'Dep', 'pkg.zip', self.MEMBERS)
+
+        mock_publish.assert_not_called()
+        conn.rollback.assert_called_once()
+
+    def test_archive_over_the_size_limit_raises(self, mock_configs):
+        app = {**mock_configs['app'], 'max_file_size_mb': '1'}
+        members = [{'resource_id': 'r1', 'name': 'a.csv', 'path': '/mnt/a', 'size': 2 * 1024 * 1024}]
+
+        with patch('configs.get_app_config', return_value=app), \
+             patch('db.get_connection') as mock_conn:
+            from ckan_zenodo import create_bundle_transfer
+            with pytest.raises(FileTooLarge):
+                create_bundle_transfer('alice', 'tok', '1', 'Dep', 'pkg.zip', members)
+
+        mock_conn.assert_not_called()
+
+    def test_member_names_are_flat_and_unique(self):
+        from ckan_zenodo import bundle_member_names
+        assert bundle_member_names(['data.csv', 'data.csv', 'a/b.txt', '']) == \
+            ['data.csv', 'data (2).csv', 'a_b.txt', 'resource']
+
+
+class TestExportToDepositions:
+    def test_leaves_out_depositions_already_exported_to(self, mock_configs, mock_session):
+        from ckan_zenodo import export_to_depositions
+
+        def duplicate(resource_id, deposition_id):
+            if deposition_id == '2':
+                raise DuplicateTransfer("dup")
+
+        with patch('ckan_zenodo.check_duplicate_transfer', side_effect=duplicate), \
+             patch('ckan_zenodo.get_file_path', return_value='/mnt/f.csv'), \
+             patch('preflight.stat', return_value=preflight.FileStat(True, 10, 0.0)), \
+             patch('ckan_zenodo.get_deposition_name', side_effect=lambda key, d: f'Dep {d}'), \
+             patch('ckan_zenodo.create_tee_transfer', return_value=[5, 6]) as mock_tee:
+            assert export_to_depositions('key', 'res-1', 'f.csv', 'http://url', ['1', '2', '3', '1']) == [5, 6]
+
+        assert mock_tee.call_args[0][3] == [('1', 'Dep 1'), ('3', 'Dep 3')]
+
+    def test_single_remaining_target_is_an_ordinary_transfer(self, mock_configs, mock_session):
+        from ckan_zenodo import export_to_depositions
+
+        with patch('ckan_zenodo.check_duplicate_transfer'), \
+             patch('ckan_zenodo.get_file_path', return_value='/mnt/f.csv'), \
+             patch('preflight.stat', return_value=preflight.FileStat(True, 10, 0.0)), \
+             patch('ckan_zenodo.get_deposition_name', return_value='Dep'), \
+             patch('ckan_zenodo.create_tee_transfer') as mock_tee, \
+             patch('ckan_zenodo.create_transfer', return_value=7):
+            assert export_to_depositions('key', 'res-1', 'f.csv', 'http://url', ['1']) == [7]
+
+        mock_tee.assert_not_called()
+
+    def test_all_duplicates_raises(self, mock_configs, mock_session):
+        from ckan_zenodo import export_to_depositions
+
+        with patch('ckan_zenodo.check_duplicate_transfer', side_effect=DuplicateTransfer("dup")):
+            with pytest.raises(DuplicateTransfer):
+                export_to_depositions('key', 'res-1', 'f.csv', 'http://url', ['1', '2'])
+
+
+class TestCreatePackageJob:
+    def setup_method(self):
+        reset_publisher()
+
+    def teardown_method(self):
+        reset_publisher()
+
+    def test_records_job_and_publishes_small_message(self, mock_configs, mock_session, mock_db_connection):
+        import json
+        conn, cursor = mock_db_connection
+        cursor.lastrowid = 3
+
+        with patch('pika.BlockingConnection') as mock_conn_cls:
+            assert create_package_job('tok', 'my-dataset', '99') == 3
+
+        assert 'INSERT INTO package_jobs' in cursor.execute.call_args[0][0]
+        channel = mock_conn_cls.return_value.channel.return_value
+        body = json.loads(channel.basic_publish.call_args[1]['body'])
+        assert body == {'type': 'package', 'job_id': 3, 'package_id': 'my-dataset', 'deposition_id': '99',
+                        'mode': 'export', 'username': 'testuser', 'user_email': 'testuser@test.com',
+                        'zenodo_token': 'tok'}
+
+    def test_sync_mode_is_recorded_on_the_job(self, mock_configs, mock_session, mock_db_connection):
+        import json
+        conn, cursor = mock_db_connection
+
+        with patch('pika.BlockingConnection') as mock_conn_cls:
+            create_package_job('tok', 'my-dataset', '99', mode='sync')
+
+        assert cursor.execute.call_args[0][1] == ('testuser', 'my-dataset', '99', 'sync')
+        channel = mock_conn_cls.return_value.channel.return_value
+        assert json.loads(channel.basic_publish.call_args[1]['body'])['mode'] == 'sync'
+
+    def test_outbox_writes_message_in_the_same_transaction(self, mock_configs, mock_session, mock_db_connection):
+        conn, cursor = mock_db_connection
+        oc = {**mock_configs['outbox'], 'enabled': True}
+
+        with patch('pika.BlockingConnection') as mock_conn_cls, \
+             patch('configs.get_outbox_config', return_value=oc):
+            create_package_job('tok', 'my-dataset', '99')
+
+        mock_conn_cls.assert_not_called()
+        assert 'INSERT INTO transfer_outbox' in cursor.execute.call_args[0][0]
+        conn.commit.assert_called_once()
+
+
+# ---------------------------------------------------------------------------
+# Incremental sync
+# ---------------------------------------------------------------------------
+
+class TestGetSyncBaseline:
+    def test_latest_live_transfer_per_resource(self, mock_db_connection):
+        from ckan_zenodo import get_sync_baseline
+        mock_conn, mock_cursor = mock_db_connection
+        mock_cursor.fetchall.return_value = [{'id': 1, 'resource_id': 'r1', 'status': 'completed'},
+                                             {'id': 4, 'resource_id': 'r1', 'status': 'pending'},
+                                             {'id': 2, 'resource_id': 'r2', 'status': 'completed'}]
+
+        baseline = get_sync_baseline('99', ['r1', 'r2', 'r3'])
+
+        assert {rid: row['id'] for rid, row in baseline.items()} == {'r1': 4, 'r2': 2}
+        sql, params = mock_cursor.execute.call_args[0]
+        assert "NOT IN ('failed', 'cancelled')" in sql
+        assert params == ('99', 'r1', 'r2', 'r3')
+
+    def test_no_resources_skips_query(self, mock_db_connection):
+        from ckan_zenodo import get_sync_baseline
+        mock_conn, mock_cursor = mock_db_connection
+
+        assert get_sync_baseline('99', []) == {}
+        mock_cursor.execute.assert_not_called()
+
+
+class TestResourceChanged:
+    EXPORTED_AT = datetime.datetime(2024, 5, 1, 12, 0, 0)
+
+    def _baseline(self, **overrides):
+        baseline = {'file_size': 100, 'source_modified': '2024-05-01T10:00:00', 'source_hash': 'md5:abc',
+                    'updated_at': self.EXPORTED_AT}
+        baseline.update(overrides)
+        return baseline
+
+    def _res(self, **overrides):
+        res = {'id': 'r1', 'last_modified': '2024-05-01T10:00:00', 'hash': 'md5:abc'}
+        res.update(overrides)
+        return res
+
+    def test_unchanged(self):
+        from ckan_zenodo import resource_changed
+        assert resource_changed(self._res(), self._baseline(), preflight.FileStat(True, 100, 0.0)) is None
+
+    def test_missing_file_and_new_size(self):
+        from ckan_zenodo import resource_changed
+        assert resource_changed(self._res(), self._baseline(), preflight.MISSING) == 'file missing'
+        assert resource_changed(self._res(), self._baseline(), preflight.FileStat(True, 101, 0.0)) == 'size changed'
+
+    def test_hash_decides_over_last_modified(self):
+        from ckan_zenodo import resource_changed
+        stat = preflight.FileStat(True, 100, 0.0)
+        assert resource_changed(self._res(hash='md5:def'), self._baseline(), stat) == 'hash changed'
+        assert resource_changed(self._res(last_modified='2024-06-01T00:00:00'), self._baseline(), stat) is None
+        assert resource_changed(self._res(hash='', last_modified='2024-06-01T00:00:00'), self._baseline(),
+                                stat) == 'modified in CKAN'
+
+    def test_unversioned_transfer_compares_file_mtime(self):
+        from ckan_zenodo import resource_changed
+        baseline = self._baseline(source_modified=None, source_hash=None)
+        exported = self.EXPORTED_AT.timestamp()
+        assert resource_changed(self._res(), baseline, preflight.FileStat(True, 100, exported - 60)) is None
+        assert resource_changed(self._res(), baseline, preflight.FileStat(True, 100, exported + 60)) == \
+            'file newer than last export'
+
+
+# ---------------------------------------------------------------------------
+# New versions
+# ---------------------------------------------------------------------------
+
+class TestNewVersion:
+    def test_opens_new_version_and_returns_its_draft(self, mock_configs):
+        from ckan_zenodo import create_new_version
+        created = MagicMock(status_code=201)
+        created.json.return_value = {'links': {'latest_draft': 'https://zenodo.org/api/deposit/depositions/8'}}
+        draft = MagicMock()
+        draft.json.return_value = {'id': 8, 'files': [{'id': 'f1', 'filename': 'a.csv'}]}
+
+        with patch('requests.post', return_value=created) as mock_post, \
+             patch('requests.get', return_value=draft) as mock_get:
+            assert create_new_version('key', '7')['id'] == 8
+
+        assert mock_post.call_args[0][0] == 'https://zenodo.org/api/deposit/depositions/7/actions/newversion'
+        assert mock_get.call_args[0][0] == 'https://zenodo.org/api/deposit/depositions/8'
+
+    def test_refused_new_version_raises(self, mock_configs):
+        from ckan_zenodo import create_new_version
+        with patch('requests.post', return_value=MagicMock(status_code=403)):
+            with pytest.raises(ZenodoAPIError) as exc_info:
+                create_new_version('key', '7')
+        assert exc_info.value.status_code == 403
+
+    def test_local_md5_prefers_ckan_md5_hash(self, tmp_path):
+        from ckan_zenodo import local_md5
+        import hashlib
+        path = tmp_path / 'a.csv'
+        path.write_bytes(b'1,2\n')
+
+        assert local_md5({'hash': 'MD5:' + 'A' * 32}, str(path)) == 'a' * 32
+        # A sha256 (or no hash) in CKAN: the file is read
+        assert local_md5({'hash': 'sha256:' + 'b' * 64}, str(path)) == hashlib.md5(b'1,2\n').hexdigest()
+
+    def test_same_content_checksums_only_files_of_the_same_size(self):
+        from ckan_zenodo import same_content
+        remote = {'filename': 'a.csv', 'filesize': 10, 'checksum': 'c' * 32}
+
+        with patch('ckan_zenodo.file_md5', return_value='c' * 32) as mock_md5:
+            assert same_content(remote, {}, '/mnt/a.csv', preflight.FileStat(True, 11, 0.0)) is False
+            mock_md5.assert_not_called()
+            assert same_content(remote, {}, '/mnt/a.csv', preflight.FileStat(True, 10, 0.0)) is True
+            mock_md5.assert_called_once_with('/mnt/a.csv')
+
+
+# ---------------------------------------------------------------------------
+# Cancellation
+# ---------------------------------------------------------------------------
+
+class TestCancel:
+    def test_cancel_transfer_only_touches_unfinished_own_transfer(self, mock_db_connection):
+        from ckan_zenodo import cancel_transfer
+        mock_conn, mock_cursor = mock_db_connection
+        mock_cursor.execute.return_value = 1
+
+        assert cancel_transfer(7, 'alice') is True
+
+        sql, params = mock_cursor.execute.call_args[0]
+        assert "status = 'cancelled'" in sql
+        assert params == (7, 'alice', 'scheduled', 'pending', 'in_progress')
+        mock_conn.commit.assert_called_once()
+
+    def test_cancelled_scheduled_lead_hands_its_task_to_a_follower(self, mock_db_connection):
+        import json
+        from ckan_zenodo import cancel_transfer
+        mock_conn, mock_cursor = mock_db_connection
+        task = {'transfer_id': 10, 'deposition_id': '1', 'deposition_name': 'A',
+                'targets': [{'transfer_id': tid, 'deposition_id': dep, 'deposition_name': name}
+                            for tid, dep, name in ((10, '1', 'A'), (11, '2', 'B'), (12, '3', 'C'))]}
+        night = datetime.datetime(2026, 1, 5, 22, 0)
+        mock_cursor.fetchall.side_effect = [[(10, night, json.dumps(task))], [(11,), (12,)]]
+        mock_cursor.execute.return_value = 1
+
+        assert cancel_transfer(10, 'alice') is True
+
+        calls = mock_cursor.execute.call_args_list
+        handover = next(c[0][1] for c in calls if c[0][0].startswith('UPDATE zenodo_transfers SET tee_lead_id = NULL'))
+        assert handover[0] == night and handover[2] == 11
+        moved = json.loads(handover[1])
+        assert moved['transfer_id'] == 11 and [t['transfer_id'] for t in moved['targets']] == [11, 12]
+        assert calls[-1][0][1] == (11, 10)
+        mock_conn.commit.assert_called_once()
+
+    def test_cancel_package_returns_count(self, mock_db_connection):
+        from ckan_zenodo import cancel_package_transfers
+        mock_conn, mock_cursor = mock_db_connection
+        mock_cursor.execute.return_value = 40
+
+        assert cancel_package_transfers('pkg', 'alice') == 40
+        assert 'package_id = %s' in mock_cursor.execute.call_args[0][0]
+
+    def test_is_cancelled(self, mock_db_connection):
+        from ckan_zenodo import is_cancelled
+        mock_conn, mock_cursor = mock_db_connection
+        mock_cursor.fetchone.return_value = ('cancelled',)
+
+        assert is_cancelled(7) is True
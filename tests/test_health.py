@@ -0,0 +1,152 @@
+"""Unit tests for health.py — background prober and cached snapshot."""
+from unittest.mock import patch, MagicMock
+
+import health
+from health import HealthProber
+
+
+def _checks(**failures):
+    return {name: MagicMock(side_effect=Exception(failures[name])) if name in failures else MagicMock()
+            for name in ('db', 'rabbitmq', 'ckan', 'zenodo')}
+
+
+class TestHealthProber:
+    def test_snapshot_reports_every_component(self):
+        prober = HealthProber()
+        with patch.dict(HealthProber.checks, _checks()):
+            prober.run_once()
+
+        snap = prober.snapshot()
+        assert snap['status'] == 'healthy'
+        assert snap['ready'] is True
+        for name in ('db', 'rabbitmq', 'ckan', 'zenodo'):
+            assert snap[name] == 'ok'
+            assert snap['checks'][name]['latency_ms'] >= 0
+
+    def test_snapshot_is_cached_between_runs(self):
+        prober = HealthProber()
+        checks = _checks()
+        with patch.dict(HealthProber.checks, checks):
+            prober.run_once()
+            prober.snapshot()
+            prober.snapshot()
+
+        assert checks['db'].call_count == 1
+
+    def test_critical_failure_is_not_ready(self):
+        prober = HealthProber()
+        with patch.dict(HealthProber.checks, _checks(db='refused')):
+            prober.run_once()
+
+        snap = prober.snapshot()
+        assert snap['ready'] is False
+        assert snap['db'] == 'error: refused'
+
+    def test_external_failure_is_degraded_but_ready(self):
+        prober = HealthProber()
+        with patch.dict(HealthProber.checks, _checks(ckan='timeout')):
+            prober.run_once()
+
+        snap = prober.snapshot()
+        assert snap['status'] == 'degraded'
+        assert snap['ready'] is True
+
+    def test_no_probe_yet_is_stale(self):
+        snap = HealthProber().snapshot()
+        assert snap['status'] == 'stale'
+        assert snap['ready'] is False
+
+    def test_old_results_are_stale(self):
+        prober = HealthProber(interval=10)
+        with patch.dict(HealthProber.checks, _checks()):
+            prober.run_once()
+
+        with patch('time.monotonic', return_value=prober._last_run + 31):
+            snap = prober.snapshot()
+
+        assert snap['status'] == 'stale'
+        assert snap['ready'] is False
+
+
+    def test_start_does_not_probe_in_the_caller(self):
+        import threading
+        prober = HealthProber(interval=60)
+        release = threading.Event()
+        checks = _checks()
+        checks['db'].side_effect = lambda timeout: release.wait(5)
+        with patch.dict(HealthProber.checks, checks), \
+             patch('health._read_circuit', return_value={'state': 'closed'}):
+            prober.start()
+            assert prober.snapshot()['status'] == 'stale'
+            release.set()
+            for _ in range(100):
+                if prober._last_run is not None:
+                    break
+                threading.Event().wait(0.05)
+        prober.stop()
+
+        assert prober.snapshot()['status'] == 'healthy'
+
+    def test_db_check_applies_the_timeout(self):
+        with patch('pymysql.connect') as mock_connect:
+            health._check_db(3)
+
+        kwargs = mock_connect.call_args[1]
+        assert (kwargs['connect_timeout'], kwargs['read_timeout'], kwargs['write_timeout']) == (3, 3, 3)
+
+
+class TestCircuitInSnapshot:
+    def _probe(self, circuit):
+        prober = HealthProber()
+        with patch.dict(HealthProber.checks, _checks()), \
+             patch('health._read_circuit', return_value=circuit):
+            prober.run_once()
+        return prober.snapshot()
+
+    def test_open_circuit_is_degraded_but_ready(self):
+        snap = self._probe({'state': 'open', 'trips': 1, 'error_rate': 0.8, 'latency_ms': 950.0})
+        assert snap['zenodo_circuit']['state'] == 'open'
+        assert snap['status'] == 'degraded'
+        assert snap['ready'] is True
+
+    def test_unreadable_circuit_does_not_degrade(self):
+        prober = HealthProber()
+        with patch.dict(HealthProber.checks, _checks()), \
+             patch('health._read_circuit', side_effect=Exception("no table")):
+            prober.run_once()
+
+        snap = prober.snapshot()
+        assert snap['zenodo_circuit']['state'].startswith('unknown')
+        assert snap['status'] == 'healthy'
+
+    def test_metrics_include_components_and_circuit(self):
+        snap = self._probe({'state': 'half_open', 'trips': 3, 'error_rate': 0.6, 'latency_ms': None})
+        text = health.render_metrics(snap)
+
+        assert 'ckan_zenodo_component_up{component="db"} 1' in text
+        assert 'ckan_zenodo_circuit_state{state="half_open"} 1' in text
+        assert 'ckan_zenodo_circuit_state{state="closed"} 0' in text
+        assert 'ckan_zenodo_circuit_trips_total 3' in text
+        assert 'ckan_zenodo_circuit_error_rate 0.6' in text
+        assert 'circuit_latency_ms' not in text
+
+
+class TestGetProber:
+    def teardown_method(self):
+        health.reset()
+
+    def test_started_once_per_process(self):
+        with patch.object(HealthProber, 'start') as mock_start:
+            first = health.get_prober()
+            second = health.get_prober()
+
+        assert first is second
+        mock_start.assert_called_once()
+
+    def test_restarted_after_fork(self):
+        with patch.object(HealthProber, 'start'):
+            first = health.get_prober()
+            with patch('os.getpid', return_value=-1):
+                second = health.get_prober()
+
+        assert first is not second
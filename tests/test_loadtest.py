@@ -0,0 +1,51 @@
+"""Unit tests for loadtest.py — report aggregation and forged session cookies."""
+import pytest
+
+import loadtest
+
+
+class TestParseMix:
+    def test_parses_weights(self):
+        assert loadtest._parse_mix('export=2,transfers=1') == {'export': 2, 'transfers': 1}
+
+    def test_weight_defaults_to_one(self):
+        assert loadtest._parse_mix('transfer_status') == {'transfer_status': 1}
+
+    def test_rejects_unknown_route(self):
+        with pytest.raises(ValueError):
+            loadtest._parse_mix('export=1,bogus=2')
+
+
+class TestSummarise:
+    def test_percentiles_and_throughput_per_route(self):
+        samples = [('export', i / 1000.0, True) for i in range(1, 101)]
+        samples.append(('transfers', 0.5, False))
+
+        result = loadtest.summarise(samples, elapsed=10.0, threads=4, users=2)
+
+        export = result['routes']['export']
+        assert export['requests'] == 100
+        assert export['rps'] == pytest.approx(10.0)
+        assert export['p50_ms'] == pytest.approx(50.0)
+        assert export['p99_ms'] == pytest.approx(99.0)
+        assert export['max_ms'] == pytest.approx(100.0)
+        assert result['routes']['transfers']['errors'] == 1
+        assert result['requests'] == 101
+        assert result['errors'] == 1
+
+    def test_empty_run(self):
+        result = loadtest.summarise([], elapsed=1.0, threads=4, users=1)
+        assert result['requests'] == 0
+        assert result['routes'] == {}
+
+
+class TestSessionCookie:
+    def test_forged_cookie_is_accepted_by_the_app(self, flask_app, monkeypatch):
+        monkeypatch.setattr(flask_app, 'secret_key', flask_app.secret_key)
+        name, value = loadtest._session_cookie('loaduser1')
+        client = flask_app.test_client()
+        client.set_cookie(name, value)
+
+        with client.session_transaction() as sess:
+            assert sess['user']['username'] == 'loaduser1'
+            assert sess['zenodo_apikey'] == 'load-test-key'
@@ -0,0 +1,51 @@
+"""Unit tests for offpeak.py — bandwidth windows for large transfers."""
+import datetime
+from unittest.mock import patch
+
+import offpeak
+from offpeak import parse_windows, in_window, next_window_start
+
+
+def _at(hour, minute=0, day=5):
+    return datetime.datetime(2026, 1, day, hour, minute, 30)
+
+
+class TestWindows:
+    def test_parses_ranges(self):
+        assert parse_windows('20:00-06:00, 12:00-13:30') == [(1200, 360), (720, 810)]
+
+    def test_empty_spec_has_no_windows(self):
+        assert parse_windows('') == []
+
+    def test_window_past_midnight(self):
+        windows = parse_windows('20:00-06:00')
+        assert in_window(_at(23), windows)
+        assert in_window(_at(2), windows)
+        assert not in_window(_at(6), windows)
+        assert not in_window(_at(12), windows)
+
+    def test_no_windows_means_always_open(self):
+        assert in_window(_at(12), [])
+
+
+class TestNextWindowStart:
+    def test_inside_window_is_now(self):
+        assert next_window_start(_at(22), parse_windows('20:00-06:00')) == _at(22).replace(microsecond=0)
+
+    def test_later_today(self):
+        assert next_window_start(_at(9), parse_windows('20:00-06:00')) == datetime.datetime(2026, 1, 5, 20, 0)
+
+    def test_tomorrow(self):
+        windows = parse_windows('01:00-05:00')
+        assert next_window_start(_at(9), windows) == datetime.datetime(2026, 1, 6, 1, 0)
+
+
+class TestIsLarge:
+    def test_disabled_by_default(self):
+        assert not offpeak.is_large(10 ** 12)
+
+    def test_threshold(self, mock_configs):
+        with patch('configs.get_offpeak_config', return_value={**mock_configs['offpeak'], 'min_file_mb': 1}):
+            assert offpeak.is_large(2 * 1024 * 1024)
+            assert not offpeak.is_large(1024 * 1024)
+            assert not offpeak.is_large(None)
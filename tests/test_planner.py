@@ -0,0 +1,118 @@
+"""Unit tests for planner.py — dry-run planning of exports."""
+from unittest.mock import patch
+
+import planner
+
+
+def _res(rid, path):
+    return {'id': rid, 'name': f'{rid}.csv', 'url': path}
+
+
+class TestStatPaths:
+    def test_sizes_and_missing_files(self, tmp_path):
+        present = tmp_path / 'a.csv'
+        present.write_bytes(b'x' * 5)
+
+        sizes = planner.stat_paths([str(present), str(tmp_path / 'missing.csv'), str(present)])
+
+        assert sizes == {str(present): 5, str(tmp_path / 'missing.csv'): None}
+
+
+class TestHistoricalThroughput:
+    def test_median_of_recent_large_uploads(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.return_value = [{'avg_bytes_per_sec': r} for r in (100.0, 300.0, 200.0)]
+
+        assert planner.historical_throughput() == (200.0, 3)
+        sql, params = cursor.execute.call_args[0]
+        assert "status = 'completed'" in sql
+        assert params == (planner.MIN_HISTORY_FILE_SIZE, 200)
+
+    def test_no_history(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.return_value = []
+
+        assert planner.historical_throughput() == (None, 0)
+
+
+class TestPlanResources:
+    def _plan(self, resources, sizes, duplicates=(), throughput=(1000.0, 10), max_mb='0', deposition_id='7'):
+        app = {'max_file_size_mb': max_mb}
+        with patch('ckan_zenodo.get_file_path', side_effect=lambda rid, url: url), \
+             patch('planner.stat_paths', return_value=sizes), \
+             patch('planner.find_duplicates', return_value=set(duplicates)) as mock_dups, \
+             patch('configs.get_app_config', return_value=app):
+            plan = planner.plan_resources(resources, deposition_id, throughput=throughput)
+        return plan, mock_dups
+
+    def test_classifies_files_and_projects_time(self):
+        resources = [_res('r1', '/a'), _res('r2', '/b'), _res('r3', '/c'), _res('r4', '/d'), _res('r5', '/e')]
+        sizes = {'/a': 4000, '/b': None, '/c': 3 * 1024 * 1024, '/d': 50, '/e': 6000}
+
+        plan, mock_dups = self._plan(resources, sizes, duplicates={'r4'}, max_mb='2')
+
+        mock_dups.assert_called_once_with(['r1', 'r2', 'r3', 'r4', 'r5'], '7')
+        assert (plan['files'], plan['bytes']) == (2, 10000)
+        assert [e['id'] for e in plan['largest']] == ['r5', 'r1']
+        assert [e['id'] for e in plan['missing']] == ['r2']
+        assert [e['id'] for e in plan['too_large']] == ['r3']
+        assert [e['id'] for e in plan['duplicates']] == ['r4']
+        # Two files, max_uploads_per_user caps parallel uploads at 2
+        assert plan['parallel_uploads'] == 2
+        assert plan['projected_seconds'] == 5
+
+    def test_new_deposition_lists_earlier_exports_but_still_uploads_them(self):
+        resources = [_res('r1', '/a'), _res('r2', '/b')]
+
+        plan, _ = self._plan(resources, {'/a': 100, '/b': 200}, duplicates={'r2'}, deposition_id=None)
+
+        assert (plan['files'], plan['bytes']) == (2, 300)
+        assert plan['duplicates'] == []
+        assert [e['id'] for e in plan['exported_elsewhere']] == ['r2']
+
+    def test_no_projection_without_history(self):
+        plan, _ = self._plan([_res('r1', '/a')], {'/a': 100}, throughput=(None, 0))
+
+        assert plan['projected_seconds'] is None
+
+    def test_merge_keeps_overall_largest(self):
+        a, _ = self._plan([_res('r1', '/a'), _res('r2', '/b')], {'/a': 10, '/b': 30})
+        b, _ = self._plan([_res('r3', '/c'), _res('r4', '/d')], {'/c': 20, '/d': None})
+
+        total = planner.merge_plans([a, b], throughput=(10.0, 1))
+
+        assert (total['resources'], total['files'], total['bytes']) == (4, 3, 60)
+        assert [e['id'] for e in total['largest']] == ['r2', 'r3', 'r1']
+        assert [e['id'] for e in total['missing']] == ['r4']
+        assert total['projected_seconds'] == 3
+
+
+class TestFindDuplicates:
+    def test_any_deposition_when_none_given(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.return_value = [{'resource_id': 'r1'}]
+
+        assert planner.find_duplicates(['r1', 'r2']) == {'r1'}
+        sql, params = cursor.execute.call_args[0]
+        assert 'deposition_id' not in sql
+        assert params == ['r1', 'r2']
+
+    def test_given_deposition(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.return_value = []
+
+        planner.find_duplicates(['r1'], '7')
+
+        assert cursor.execute.call_args[0][1] == ['r1', '7']
+
+
+class TestFormatting:
+    def test_format_bytes(self):
+        assert planner.format_bytes(512) == '512 B'
+        assert planner.format_bytes(1536) == '1.5 KB'
+        assert planner.format_bytes(5 * 1024 ** 3) == '5.0 GB'
+
+    def test_format_duration(self):
+        assert planner.format_duration(42) == '42s'
+        assert planner.format_duration(5430) == '1h 30m'
+        assert planner.format_duration(None) == 'unknown'
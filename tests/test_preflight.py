@@ -0,0 +1,85 @@
+"""Unit tests for preflight.py — parallel stats with a TTL cache."""
+from unittest.mock import patch
+
+import preflight
+from preflight import Preflight, FileStat
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPreflight:
+    def test_stat_reports_size_mtime_and_missing(self, tmp_path):
+        path = tmp_path / 'a.csv'
+        path.write_bytes(b'x' * 7)
+        pf = Preflight(cache_ttl=0)
+
+        result = pf.stat(str(path))
+
+        assert (result.exists, result.size) == (True, 7)
+        assert result.mtime == path.stat().st_mtime
+        assert pf.stat(str(tmp_path / 'missing.csv')) == preflight.MISSING
+
+    def test_fresh_results_are_cached_until_ttl(self):
+        clock = Clock()
+        pf = Preflight(cache_ttl=60, clock=clock)
+        with patch('preflight._stat', return_value=FileStat(True, 5, 1.0)) as mock_stat:
+            pf.stat('/mnt/a')
+            clock.now = 59
+            pf.stat('/mnt/a')
+            assert mock_stat.call_count == 1
+
+            clock.now = 60
+            pf.stat('/mnt/a')
+            assert mock_stat.call_count == 2
+
+    def test_missing_files_are_not_cached(self):
+        pf = Preflight(cache_ttl=60)
+        with patch('preflight._stat', side_effect=[preflight.MISSING, FileStat(True, 5, 1.0)]):
+            assert not pf.stat('/mnt/a').exists
+            assert pf.stat('/mnt/a').exists
+
+    def test_stat_many_stats_only_uncached_paths_in_parallel(self):
+        pf = Preflight(threads=4, cache_ttl=60)
+        statted = []
+
+        def fake_stat(path):
+            statted.append(path)
+            return FileStat(True, len(path), 1.0)
+
+        with patch('preflight._stat', return_value=FileStat(True, 1, 1.0)):
+            pf.stat('/mnt/a')
+        with patch('preflight._stat', side_effect=fake_stat):
+            results = pf.stat_many(['/mnt/a', '/mnt/bb', '/mnt/ccc', '/mnt/bb'])
+
+        assert sorted(statted) == ['/mnt/bb', '/mnt/ccc']
+        assert {p: r.size for p, r in results.items()} == {'/mnt/a': 1, '/mnt/bb': 7, '/mnt/ccc': 8}
+
+    def test_oldest_entries_are_dropped_beyond_max_entries(self):
+        pf = Preflight(cache_ttl=60, max_entries=2)
+        with patch('preflight._stat', return_value=FileStat(True, 1, 1.0)):
+            for path in ('/a', '/b', '/c'):
+                pf.stat(path)
+
+        assert list(pf._cache) == ['/b', '/c']
+
+    def test_invalidate(self):
+        pf = Preflight(cache_ttl=60)
+        with patch('preflight._stat', return_value=FileStat(True, 1, 1.0)) as mock_stat:
+            pf.stat('/a')
+            pf.invalidate('/a')
+            pf.stat('/a')
+
+        assert mock_stat.call_count == 2
+
+
+class TestExportUsesPreflight:
+    def test_check_file_size_reads_cached_stat(self, mock_configs):
+        import ckan_zenodo
+        with patch('preflight.stat', return_value=FileStat(True, 123, 1.0)):
+            assert ckan_zenodo._check_file_size('/mnt/a') == 123
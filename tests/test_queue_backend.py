@@ -0,0 +1,157 @@
+"""Unit tests for queue_backend.py — the database-backed upload queue."""
+import json
+from unittest.mock import patch, MagicMock
+
+import queue_backend
+from queue_backend import DBChannel
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _job(job_id, deliveries=0):
+    return {'id': job_id, 'body': json.dumps({'transfer_id': job_id}), 'deliveries': deliveries}
+
+
+class TestPublish:
+    def test_inserts_visible_job(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+
+        queue_backend.publish('zenodo_upload.lane03', '{"transfer_id": 1}')
+
+        sql, params = cursor.execute.call_args[0]
+        assert 'INSERT INTO upload_jobs' in sql
+        assert params == ('zenodo_upload.lane03', '{"transfer_id": 1}')
+        conn.commit.assert_called_once()
+
+    def test_ckan_zenodo_publishes_to_table_with_mysql_backend(self, mock_configs):
+        import ckan_zenodo
+        qc = {**mock_configs['queue'], 'backend': 'mysql'}
+
+        with patch('configs.get_queue_config', return_value=qc), \
+             patch('queue_backend.publish') as mock_publish, \
+             patch('pika.BlockingConnection') as mock_conn_cls:
+            ckan_zenodo.publish_task({'username': 'alice', 'transfer_id': 7})
+
+        mock_conn_cls.assert_not_called()
+        assert mock_publish.call_args[0][0] == 'zenodo_upload'
+        assert json.loads(mock_publish.call_args[0][1])['transfer_id'] == 7
+
+
+class TestDBChannel:
+    def test_claims_up_to_prefetch_per_consumer_and_delivers(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.side_effect = [[_job(1), _job(2, deliveries=1)], []]
+        on_message = MagicMock()
+        channel = DBChannel('host:1', prefetch=5)
+        channel.basic_consume('q.lane00', on_message, consumer_tag='c0')
+        channel.basic_consume('q.lane01', on_message, consumer_tag='c1')
+
+        assert channel.claim() == 2
+
+        select_sql, select_params = cursor.execute.call_args_list[0][0]
+        assert 'FOR UPDATE SKIP LOCKED' in select_sql
+        assert select_params == ('q.lane00', 5)
+        update_sql, update_params = cursor.execute.call_args[0]
+        assert 'claimed_by' in update_sql
+        assert update_params == (600, 'host:1', 1, 2)
+        conn.commit.assert_called_once()
+        methods = [c[0][1] for c in on_message.call_args_list]
+        assert [(m.delivery_tag, m.consumer_tag, m.redelivered) for m in methods] == [(1, 'c0', False),
+                                                                                      (2, 'c0', True)]
+
+    def test_full_consumer_is_not_polled(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.return_value = [_job(1)]
+        channel = DBChannel('host:1', prefetch=1)
+        channel.basic_consume('q', MagicMock(), consumer_tag='c0')
+        channel.claim()
+        cursor.execute.reset_mock()
+
+        assert channel.claim() == 0
+
+        cursor.execute.assert_not_called()
+
+    def test_ack_deletes_job_and_frees_prefetch(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.return_value = [_job(1)]
+        channel = DBChannel('host:1', prefetch=1)
+        channel.basic_consume('q', MagicMock(), consumer_tag='c0')
+        channel.claim()
+
+        channel.basic_ack(delivery_tag=1)
+
+        sql, params = cursor.execute.call_args[0]
+        assert sql.startswith('DELETE FROM upload_jobs')
+        assert params == (1, 'host:1')
+        assert channel._unacked == {}
+
+    def test_nack_with_requeue_makes_job_visible(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        channel = DBChannel('host:1')
+
+        channel.basic_nack(delivery_tag=4, requeue=True)
+
+        sql, params = cursor.execute.call_args[0]
+        assert 'visible_at = NOW(), claimed_by = NULL' in sql
+        assert params == (4, 'host:1')
+
+    def test_cancelled_consumer_is_not_polled(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        channel = DBChannel('host:1')
+        channel.basic_consume('q', MagicMock(), consumer_tag='c0')
+        channel.basic_cancel('c0')
+
+        assert channel.claim() == 0
+        assert not any('SELECT' in c[0][0] for c in cursor.execute.call_args_list)
+
+    def test_unacked_jobs_are_extended_before_the_timeout(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        clock = Clock()
+        channel = DBChannel('host:1', visibility_timeout=300, clock=clock)
+        channel._unacked[1] = 'c0'
+        channel._unacked[4] = 'c1'
+
+        clock.now = 50
+        channel._renew()
+        cursor.execute.assert_not_called()
+
+        clock.now = 100
+        channel._renew()
+        sql, params = cursor.execute.call_args[0]
+        assert 'visible_at = NOW() + INTERVAL' in sql
+        assert 'id IN (%s, %s)' in sql
+        assert params == (300, 'host:1', 1, 4)
+
+    def test_process_events_runs_handed_over_calls_and_due_timers(self):
+        clock = Clock()
+        channel = DBChannel('host:1', clock=clock)
+        calls = []
+        channel.connection.add_callback_threadsafe(lambda: calls.append('ack'))
+        channel.connection.call_later(10, lambda: calls.append('resume'))
+
+        channel.process_events()
+        assert calls == ['ack']
+
+        clock.now = 10
+        channel.process_events()
+        assert calls == ['ack', 'resume']
+
+    def test_failed_call_does_not_stop_the_loop(self):
+        channel = DBChannel('host:1')
+        calls = []
+
+        def failing():
+            raise Exception("DB down")
+
+        channel.connection.add_callback_threadsafe(failing)
+        channel.connection.add_callback_threadsafe(lambda: calls.append('next'))
+
+        channel.process_events()
+
+        assert calls == ['next']
@@ -0,0 +1,176 @@
+"""Unit tests for rate_limiter.py — per-token request pacing and upload slots."""
+import pytest
+from unittest.mock import patch, MagicMock
+
+import rate_limiter
+from rate_limiter import RateLimiter, RateLimited, LocalBackend, MySQLBackend, token_fingerprint
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def _limiter(clock, **kwargs):
+    defaults = dict(requests_per_minute=60, burst=2, max_concurrent_uploads=1, poll_seconds=1.0)
+    defaults.update(kwargs)
+    return RateLimiter(LocalBackend(clock=clock), sleep=clock.sleep, **defaults)
+
+
+class TestTokenFingerprint:
+    def test_is_stable_and_hides_token(self):
+        fp = token_fingerprint('secret-token')
+        assert fp == token_fingerprint('secret-token')
+        assert 'secret' not in fp
+        assert len(fp) == 32
+
+
+class TestAcquire:
+    def test_burst_is_free_then_calls_are_spaced_evenly(self):
+        clock = FakeClock()
+        limiter = _limiter(clock)
+
+        waits = [limiter.acquire('tok') for _ in range(5)]
+
+        assert waits[:2] == [0.0, 0.0]
+        # 60/min = one per second once the burst is used
+        assert waits[2:] == pytest.approx([1.0, 1.0, 1.0])
+
+    def test_bucket_refills_while_idle(self):
+        clock = FakeClock()
+        limiter = _limiter(clock)
+        limiter.acquire('tok')
+        limiter.acquire('tok')
+        clock.now += 10
+
+        assert limiter.acquire('tok') == 0.0
+
+    def test_tokens_are_limited_independently(self):
+        clock = FakeClock()
+        limiter = _limiter(clock, burst=1)
+        limiter.acquire('alice')
+
+        assert limiter.acquire('bob') == 0.0
+
+    def test_zero_disables_pacing(self):
+        backend = MagicMock()
+        limiter = RateLimiter(backend, requests_per_minute=0)
+
+        assert limiter.acquire('tok') == 0.0
+        backend.reserve.assert_not_called()
+
+    def test_backend_failure_does_not_block(self):
+        backend = MagicMock()
+        backend.reserve.side_effect = Exception("DB down")
+
+        assert RateLimiter(backend).acquire('tok') == 0.0
+
+    def test_max_wait_raises_without_sleeping_or_taking_a_token(self):
+        clock = FakeClock()
+        limiter = _limiter(clock, burst=1)
+        limiter.acquire('tok')
+
+        with pytest.raises(RateLimited) as exc:
+            limiter.acquire('tok', max_wait=0.5)
+
+        assert exc.value.wait == pytest.approx(1.0)
+        assert clock.now == 1000.0
+        # The refused call left the bucket as it was: the next one waits 1s, not 2s
+        assert limiter.acquire('tok') == pytest.approx(1.0)
+
+    def test_wait_within_max_wait_sleeps(self):
+        clock = FakeClock()
+        limiter = _limiter(clock, burst=1)
+        limiter.acquire('tok')
+
+        assert limiter.acquire('tok', max_wait=5) == pytest.approx(1.0)
+        assert clock.now == pytest.approx(1001.0)
+
+
+class TestUploadSlot:
+    def test_waits_for_a_free_slot(self):
+        clock = FakeClock()
+        limiter = _limiter(clock)
+        fingerprint = token_fingerprint('tok')
+        held = limiter.backend.try_lease(fingerprint, 1, 600, 'other-worker')
+
+        polls = []
+
+        def sleep(seconds):
+            polls.append(seconds)
+            if len(polls) == 3:
+                limiter.backend.release_lease(fingerprint, held)
+
+        limiter._sleep = sleep
+        with limiter.upload_slot('tok'):
+            pass
+
+        assert polls == [1.0, 1.0, 1.0]
+
+    def test_slot_is_released_on_error(self):
+        limiter = _limiter(FakeClock())
+        with pytest.raises(RuntimeError):
+            with limiter.upload_slot('tok'):
+                raise RuntimeError("upload failed")
+
+        with limiter.upload_slot('tok'):
+            pass  # would block forever if the first slot leaked
+
+
+class TestMySQLBackend:
+    def test_reserve_locks_row_and_returns_wait(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        # Bucket empty (0 tokens), 0.5s since the last refill, 1 token/s
+        cursor.fetchone.return_value = (0.0, 500000)
+
+        wait = MySQLBackend().reserve('fp', 1.0, 5)
+
+        assert wait == pytest.approx(0.5)
+        executed = ' '.join(c[0][0] for c in cursor.execute.call_args_list)
+        assert 'FOR UPDATE' in executed
+        assert cursor.execute.call_args[0][1] == (pytest.approx(-0.5), 'fp')
+        conn.commit.assert_called_once()
+
+    def test_reserve_beyond_max_wait_leaves_bucket_alone(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchone.return_value = (0.0, 0)
+
+        wait = MySQLBackend().reserve('fp', 1.0, 5, max_wait=0.5)
+
+        assert wait == pytest.approx(1.0)
+        executed = ' '.join(c[0][0] for c in cursor.execute.call_args_list)
+        assert 'UPDATE rate_limit_buckets' not in executed
+
+    def test_try_lease_refuses_when_full(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchone.side_effect = [(5.0, 0), (2,)]
+
+        assert MySQLBackend().try_lease('fp', 2, 600, 'me') is None
+
+    def test_try_lease_inserts_lease(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchone.side_effect = [(5.0, 0), (1,)]
+        cursor.lastrowid = 77
+
+        assert MySQLBackend().try_lease('fp', 2, 600, 'me') == 77
+
+
+class TestGetLimiter:
+    def setup_method(self):
+        rate_limiter.reset()
+
+    def teardown_method(self):
+        rate_limiter.reset()
+
+    def test_backend_follows_config(self, mock_configs):
+        cfg = {**mock_configs['rate_limit'], 'backend': 'mysql'}
+        with patch('configs.get_rate_limit_config', return_value=cfg):
+            limiter = rate_limiter.get_limiter()
+
+        assert isinstance(limiter.backend, MySQLBackend)
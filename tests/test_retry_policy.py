@@ -0,0 +1,98 @@
+"""Unit tests for retry_policy.py — error classification and retry delays."""
+import datetime
+import requests
+from unittest.mock import patch, MagicMock
+
+import retry_policy
+from retry_policy import RetryPolicy, parse_retry_after, PERMANENT, THROTTLED, TRANSIENT, UNKNOWN
+
+
+def _http_error(status, headers=None):
+    response = MagicMock()
+    response.status_code = status
+    response.headers = headers or {}
+    return requests.exceptions.HTTPError(f"HTTP {status}", response=response)
+
+
+class TestClassify:
+    def test_client_errors_are_permanent(self):
+        policy = RetryPolicy()
+        for status in (400, 401, 403, 404, 410, 413):
+            assert policy.classify(_http_error(status)) == PERMANENT
+
+    def test_missing_file_is_permanent(self):
+        assert RetryPolicy().classify(FileNotFoundError('/gone.csv')) == PERMANENT
+
+    def test_429_is_throttled(self):
+        assert RetryPolicy().classify(_http_error(429)) == THROTTLED
+
+    def test_server_and_network_errors_are_transient(self):
+        from upload_stream import UploadStalled
+        policy = RetryPolicy()
+        assert policy.classify(_http_error(502)) == TRANSIENT
+        assert policy.classify(_http_error(408)) == TRANSIENT
+        assert policy.classify(requests.exceptions.ConnectionError()) == TRANSIENT
+        assert policy.classify(UploadStalled('stalled')) == TRANSIENT
+
+    def test_anything_else_is_unknown(self):
+        assert RetryPolicy().classify(RuntimeError('boom')) == UNKNOWN
+
+
+class TestDecide:
+    def test_permanent_is_never_retried(self):
+        decision = RetryPolicy().decide(_http_error(403), retry_count=0, max_retries=3)
+        assert decision.retry is False
+        assert decision.error_class == PERMANENT
+
+    def test_exhausted_retries_stop(self):
+        decision = RetryPolicy().decide(_http_error(503), retry_count=3, max_retries=3)
+        assert decision.retry is False
+        assert decision.error_class == TRANSIENT
+
+    def test_unknown_uses_plain_backoff(self):
+        policy = RetryPolicy()
+        delays = [policy.decide(RuntimeError(), n, 10).delay for n in (0, 1, 2, 8)]
+        assert delays == [10, 20, 40, 300]
+
+    def test_transient_backoff_is_jittered_within_bounds(self):
+        low = RetryPolicy(rng=lambda: 0.0).decide(_http_error(503), 2, 5).delay
+        high = RetryPolicy(rng=lambda: 1.0).decide(_http_error(503), 2, 5).delay
+        assert low == 20
+        assert high == 40
+
+    def test_throttled_honours_retry_after_with_cap(self):
+        policy = RetryPolicy(max_retry_after=60)
+        assert policy.decide(_http_error(429, {'Retry-After': '30'}), 0, 3).delay == 30
+        assert policy.decide(_http_error(429, {'Retry-After': '900'}), 0, 3).delay == 60
+
+    def test_throttled_without_header_falls_back_to_backoff(self):
+        policy = RetryPolicy(rng=lambda: 1.0)
+        assert policy.decide(_http_error(429), 1, 3).delay == 20
+
+
+class TestParseRetryAfter:
+    def test_seconds(self):
+        assert parse_retry_after('120') == 120
+
+    def test_http_date(self):
+        now = datetime.datetime(2026, 1, 1, 12, 0, 0, tzinfo=datetime.timezone.utc)
+        assert parse_retry_after('Thu, 01 Jan 2026 12:01:30 GMT', now=now) == 90
+
+    def test_garbage_is_ignored(self):
+        assert parse_retry_after('soon') is None
+        assert parse_retry_after(None) is None
+
+
+class TestLoadPolicy:
+    def test_builds_configured_policy(self, mock_configs):
+        cfg = {**mock_configs['retry'], 'base_delay': 5}
+        with patch('configs.get_retry_config', return_value=cfg):
+            policy = retry_policy.load_policy()
+
+        assert isinstance(policy, RetryPolicy)
+        assert policy.base_delay == 5
+
+    def test_unknown_policy_falls_back_to_default(self, mock_configs):
+        cfg = {**mock_configs['retry'], 'policy': 'no_such_module.Policy'}
+        with patch('configs.get_retry_config', return_value=cfg):
+            assert type(retry_policy.load_policy()) is RetryPolicy
@@ -0,0 +1,177 @@
+"""Unit tests for scheduler.py — user lanes and fair-share ordering of upload tasks."""
+import threading
+from unittest.mock import patch
+
+import scheduler
+from scheduler import FairScheduler, parse_weights
+
+
+def _drain(sched, count):
+    """Take count tasks, finishing each one immediately; return the users in order."""
+    order = []
+    for _ in range(count):
+        user, _ = sched.next(timeout=0)
+        order.append(user)
+        sched.done(user)
+    return order
+
+
+class TestFairScheduler:
+    def test_round_robin_between_users(self):
+        sched = FairScheduler(max_uploads_per_user=0)
+        for n in range(6):
+            sched.submit('bulk', n)
+        sched.submit('alice', 'a')
+        sched.submit('bob', 'b')
+
+        order = _drain(sched, 5)
+
+        # alice and bob are served within the first round despite queuing last
+        assert set(order[:3]) == {'bulk', 'alice', 'bob'}
+        assert order[3:] == ['bulk', 'bulk']
+
+    def test_tasks_of_one_user_keep_their_order(self):
+        sched = FairScheduler()
+        for n in range(3):
+            sched.submit('alice', n)
+
+        items = []
+        for _ in range(3):
+            user, item = sched.next(timeout=0)
+            items.append(item)
+            sched.done(user)
+
+        assert items == [0, 1, 2]
+
+    def test_per_user_cap_leaves_slots_for_others(self):
+        sched = FairScheduler(max_uploads_per_user=1)
+        sched.submit('bulk', 1)
+        sched.submit('bulk', 2)
+
+        assert sched.next(timeout=0) == ('bulk', 1)
+        assert sched.next(timeout=0) is None  # bulk already has its one upload running
+
+        sched.submit('alice', 'a')
+        assert sched.next(timeout=0) == ('alice', 'a')
+
+        sched.done('bulk')
+        assert sched.next(timeout=0) == ('bulk', 2)
+
+    def test_weights_share_turns_proportionally(self):
+        sched = FairScheduler(max_uploads_per_user=0, weights={'alice': 3})
+        for n in range(8):
+            sched.submit('alice', n)
+            sched.submit('bob', n)
+
+        order = _drain(sched, 8)
+
+        assert order.count('alice') == 6
+        assert order.count('bob') == 2
+
+    def test_next_blocks_until_submit(self):
+        sched = FairScheduler()
+        result = []
+        t = threading.Thread(target=lambda: result.append(sched.next(timeout=5)))
+        t.start()
+        sched.submit('alice', 'a')
+        t.join()
+
+        assert result == [('alice', 'a')]
+
+    def test_close_releases_waiters(self):
+        sched = FairScheduler()
+        sched.close()
+        assert sched.next(timeout=5) is None
+
+    def test_pending_counts_buffered_tasks(self):
+        sched = FairScheduler()
+        sched.submit('alice', 1)
+        sched.submit('alice', 2)
+        sched.submit('bob', 1)
+
+        assert sched.pending() == {'alice': 2, 'bob': 1}
+
+    def test_peek_interleaves_users_without_taking(self):
+        sched = FairScheduler()
+        sched.submit('bulk', 'b1')
+        sched.submit('bulk', 'b2')
+        sched.submit('alice', 'a1')
+
+        assert sched.peek(3) == ['b1', 'a1', 'b2']
+        assert sched.pending() == {'bulk': 2, 'alice': 1}
+
+    def test_small_only_slot_skips_large_tasks(self):
+        sched = FairScheduler(max_uploads_per_user=0)
+        sched.submit('bulk', 'huge-1')
+        sched.submit('bulk', 'tiny', small=True)
+        sched.submit('bulk', 'huge-2')
+
+        assert sched.next(timeout=0, small_only=True) == ('bulk', 'tiny')
+        assert sched.next(timeout=0, small_only=True) is None
+        assert sched.next(timeout=0) == ('bulk', 'huge-1')
+
+    def test_small_only_slot_is_not_held_back_by_general_uploads(self):
+        sched = FairScheduler(max_uploads_per_user=1)
+        sched.submit('alice', 'huge')
+        sched.submit('alice', 'tiny', small=True)
+
+        assert sched.next(timeout=0) == ('alice', 'huge')
+        assert sched.next(timeout=0) is None
+        assert sched.next(timeout=0, small_only=True) == ('alice', 'tiny')
+
+    def test_small_only_slots_are_capped_per_user_and_shared(self):
+        sched = FairScheduler(max_uploads_per_user=1)
+        for n in range(3):
+            sched.submit('bulk', f'b{n}', small=True)
+        sched.submit('alice', 'a0', small=True)
+
+        assert sched.next(timeout=0, small_only=True) == ('bulk', 'b0')
+        assert sched.next(timeout=0, small_only=True) == ('alice', 'a0')
+        assert sched.next(timeout=0, small_only=True) is None
+        sched.done('bulk', small_only=True)
+        assert sched.next(timeout=0, small_only=True) == ('bulk', 'b1')
+
+
+class TestLanes:
+    def _config(self, mock_configs, lanes):
+        return patch('configs.get_scheduler_config', return_value={**mock_configs['scheduler'], 'lanes': lanes})
+
+    def test_lane_is_stable_per_user(self, mock_configs):
+        with self._config(mock_configs, 16):
+            assert scheduler.lane_queue('alice') == scheduler.lane_queue('alice')
+            assert scheduler.lane_queue('alice').startswith('zenodo_upload.lane')
+
+    def test_all_queues_includes_plain_queue(self, mock_configs):
+        with self._config(mock_configs, 4):
+            queues = scheduler.all_queues()
+
+        assert queues == ['zenodo_upload', 'zenodo_upload.lane00', 'zenodo_upload.lane01',
+                          'zenodo_upload.lane02', 'zenodo_upload.lane03']
+
+    def test_small_files_use_the_users_small_lane(self, mock_configs):
+        sc = {**mock_configs['scheduler'], 'lanes': 4, 'small_file_mb': 10}
+        with patch('configs.get_scheduler_config', return_value=sc):
+            lane = scheduler.lane_queue('alice')[-2:]
+            assert scheduler.lane_queue('alice', 3 * 1024 * 1024) == f'zenodo_upload.small{lane}'
+            assert scheduler.lane_queue('alice', 30 * 1024 * 1024) == f'zenodo_upload.lane{lane}'
+            queues = scheduler.all_queues()
+
+        assert queues[:2] == ['zenodo_upload', 'zenodo_upload.small']
+        assert queues[-4:] == [f'zenodo_upload.small{n:02d}' for n in range(4)]
+
+    def test_small_files_without_lanes_share_the_small_queue(self, mock_configs):
+        sc = {**mock_configs['scheduler'], 'lanes': 0, 'small_file_mb': 10}
+        with patch('configs.get_scheduler_config', return_value=sc):
+            assert scheduler.lane_queue('alice', 3 * 1024 * 1024) == 'zenodo_upload.small'
+
+    def test_zero_lanes_uses_plain_queue(self, mock_configs):
+        assert scheduler.lane_queue('alice') == 'zenodo_upload'
+        assert scheduler.all_queues() == ['zenodo_upload']
+
+
+class TestParseWeights:
+    def test_parses_pairs(self):
+        assert parse_weights('alice=3, bob=2') == {'alice': 3, 'bob': 2}
+
+    def test_empty(self):
+        assert parse_weights('') == {}
@@ -3,6 +3,8 @@ import json
 import pytest
 from unittest.mock import patch, MagicMock
 import ckan_zenodo
+import health
+import rate_limiter
 
 
 # ---------------------------------------------------------------------------
@@ -81,6 +83,13 @@ class TestAjax:
         with client.session_transaction() as sess:
             assert sess.get('zenodo_apikey') == 'validkey123'
 
+    def test_list_depositions_reports_a_busy_token(self, client):
+        with patch('ckan_zenodo.get_depositions', side_effect=rate_limiter.RateLimited("busy", 40)):
+            response = client.post('/ajax', data={'action': 'list_depositions', 'zenodo_apikey': 'validkey123'})
+
+        assert response.status_code == 200
+        assert b'try again in a minute' in response.data
+
     def test_export_to_zenodo_returns_session_expired_without_key(self, client):
         response = client.post('/ajax', data={
             'action': 'export_to_zenodo',
@@ -224,19 +233,13 @@ class TestAjax:
         assert response.status_code == 200
         assert b'Invalid package ID' in response.data
 
-    def test_export_package_queues_all_resources(self, client):
+    def test_export_package_queues_a_package_job(self, client):
         with client.session_transaction() as sess:
             sess['zenodo_apikey'] = 'validkey'
             sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
 
-        mock_package = {
-            'resources': [
-                {'id': '12345678-1234-1234-1234-123456789ab1', 'name': 'f1.csv', 'url': 'http://x/f1'},
-                {'id': '12345678-1234-1234-1234-123456789ab2', 'name': 'f2.csv', 'url': 'http://x/f2'},
-            ]
-        }
-
-        with patch('ckan_zenodo.get_ckan_package', return_value=mock_package), \
+        with patch('ckan_zenodo.create_package_job', return_value=3) as mock_job, \
+             patch('ckan_zenodo.get_ckan_package') as mock_package, \
              patch('ckan_zenodo.export_to_zenodo') as mock_export:
 
             response = client.post('/ajax', data={
@@ -246,31 +249,111 @@ class TestAjax:
             })
 
         assert response.status_code == 200
-        assert mock_export.call_count == 2
-        assert b'2 file(s) queued' in response.data
+        assert b'Package export queued' in response.data
+        mock_job.assert_called_once_with('validkey', 'my-dataset', '99')
+        mock_package.assert_not_called()
+        mock_export.assert_not_called()
 
-    def test_export_package_counts_duplicates_as_skipped(self, client):
+    def test_export_to_depositions_passes_every_target(self, client):
         with client.session_transaction() as sess:
             sess['zenodo_apikey'] = 'validkey'
             sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
+        mock_resource = {'id': '12345678-1234-1234-1234-123456789abc', 'name': 'f.csv', 'url': 'http://x'}
+
+        with patch('ckan_zenodo.get_ckan_resource', return_value=mock_resource), \
+             patch('ckan_zenodo.export_to_depositions', return_value=[1, 2]) as mock_export:
+            response = client.post('/ajax', data={
+                'action': 'export_to_depositions',
+                'ckan_resource_id': '12345678-1234-1234-1234-123456789abc',
+                'deposition_ids': '11,22',
+            })
 
-        mock_package = {
-            'resources': [
-                {'id': '12345678-1234-1234-1234-123456789ab1', 'name': 'f1.csv', 'url': 'http://x/f1'},
-            ]
-        }
+        assert b'Export to 2 deposition(s) queued' in response.data
+        assert mock_export.call_args[0][4] == ['11', '22']
 
-        with patch('ckan_zenodo.get_ckan_package', return_value=mock_package), \
-             patch('ckan_zenodo.export_to_zenodo', side_effect=ckan_zenodo.DuplicateTransfer("dup")):
+    def test_export_to_depositions_rejects_bad_ids(self, client):
+        with client.session_transaction() as sess:
+            sess['zenodo_apikey'] = 'validkey'
+            sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
 
+        with patch('ckan_zenodo.export_to_depositions') as mock_export:
             response = client.post('/ajax', data={
-                'action': 'export_package_to_zenodo',
+                'action': 'export_to_depositions',
+                'ckan_resource_id': '12345678-1234-1234-1234-123456789abc',
+                'deposition_ids': '11,abc',
+            })
+
+        assert b'Invalid deposition ID' in response.data
+        mock_export.assert_not_called()
+
+    def test_sync_package_queues_a_sync_job(self, client):
+        with client.session_transaction() as sess:
+            sess['zenodo_apikey'] = 'validkey'
+            sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
+
+        with patch('ckan_zenodo.create_package_job', return_value=4) as mock_job:
+            response = client.post('/ajax', data={
+                'action': 'sync_package_to_zenodo',
                 'package_id': 'my-dataset',
                 'deposition_id': '99',
             })
 
-        assert response.status_code == 200
-        assert b'skipped' in response.data
+        assert b'Package sync queued' in response.data
+        mock_job.assert_called_once_with('validkey', 'my-dataset', '99', mode='sync')
+
+    def test_new_version_queues_a_new_version_job(self, client):
+        with client.session_transaction() as sess:
+            sess['zenodo_apikey'] = 'validkey'
+            sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
+
+        with patch('ckan_zenodo.create_package_job', return_value=5) as mock_job:
+            response = client.post('/ajax', data={
+                'action': 'new_version_to_zenodo',
+                'package_id': 'my-dataset',
+                'deposition_id': '99',
+            })
+
+        assert b'New version queued' in response.data
+        mock_job.assert_called_once_with('validkey', 'my-dataset', '99', mode='newversion')
+
+    def test_bundle_queues_a_bundle_job(self, client):
+        with client.session_transaction() as sess:
+            sess['zenodo_apikey'] = 'validkey'
+            sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
+
+        with patch('ckan_zenodo.create_package_job', return_value=6) as mock_job:
+            response = client.post('/ajax', data={
+                'action': 'bundle_package_to_zenodo',
+                'package_id': 'my-dataset',
+                'deposition_id': '99',
+            })
+
+        assert b'one ZIP archive' in response.data
+        mock_job.assert_called_once_with('validkey', 'my-dataset', '99', mode='bundle')
+
+    def test_plan_package_export_renders_plan(self, client):
+        with client.session_transaction() as sess:
+            sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
+        plan = {'package': {'id': 'p1', 'name': 'my-dataset', 'title': 'My dataset'},
+                'resources': 3, 'files': 1, 'bytes': 3 * 1024 * 1024,
+                'largest': [{'id': 'r1', 'name': 'big.csv', 'path': '/mnt/r1', 'size': 3 * 1024 * 1024}],
+                'missing': [{'id': 'r2', 'name': 'gone.csv', 'path': '/mnt/r2', 'size': None}],
+                'too_large': [], 'duplicates': [{'id': 'r3', 'name': 'old.csv', 'path': '/mnt/r3', 'size': 10}],
+                'bytes_per_sec': 1024 * 1024, 'history_samples': 40, 'parallel_uploads': 1,
+                'projected_seconds': 3}
+
+        with patch('planner.plan_package', return_value=plan) as mock_plan:
+            response = client.post('/ajax', data={
+                'action': 'plan_package_export',
+                'package_id': 'my-dataset',
+                'deposition_id': '',
+            })
+
+        mock_plan.assert_called_once_with('my-dataset', None)
+        assert b'3.0 MB' in response.data
+        assert b'gone.csv' in response.data
+        assert b'old.csv' in response.data
+        assert b'about 3s' in response.data
 
     def test_retry_transfer_requires_session_key(self, client):
         with client.session_transaction() as sess:
@@ -316,6 +399,43 @@ class TestAjax:
         mock_reset.assert_called_once_with(5)
         mock_send.assert_called_once()
 
+    def test_cancel_transfer_cancels_own_transfer(self, client):
+        with client.session_transaction() as sess:
+            sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
+
+        with patch('ckan_zenodo.cancel_transfer', return_value=True) as mock_cancel:
+            response = client.post('/ajax', data={'action': 'cancel_transfer', 'transfer_id': '5'})
+
+        assert b'Transfer cancelled' in response.data
+        mock_cancel.assert_called_once_with(5, 'alice')
+
+    def test_cancel_transfer_reports_finished_transfer(self, client):
+        with client.session_transaction() as sess:
+            sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
+
+        with patch('ckan_zenodo.cancel_transfer', return_value=False):
+            response = client.post('/ajax', data={'action': 'cancel_transfer', 'transfer_id': '5'})
+
+        assert b'already finished' in response.data
+
+    def test_cancel_package_transfers(self, client):
+        with client.session_transaction() as sess:
+            sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
+
+        with patch('ckan_zenodo.cancel_package_transfers', return_value=12) as mock_cancel:
+            response = client.post('/ajax', data={'action': 'cancel_package_transfers', 'package_id': 'my-pkg'})
+
+        assert b'12 transfer(s)' in response.data
+        mock_cancel.assert_called_once_with('my-pkg', 'alice')
+
+    def test_cancel_package_rejects_invalid_id(self, client):
+        with client.session_transaction() as sess:
+            sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
+
+        response = client.post('/ajax', data={'action': 'cancel_package_transfers', 'package_id': '../x'})
+
+        assert b'Invalid package ID' in response.data
+
 
 # ---------------------------------------------------------------------------
 # /transfers
@@ -331,11 +451,26 @@ class TestTransfers:
         with client.session_transaction() as sess:
             sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
 
-        with patch('ckan_zenodo.get_transfers_for_user', return_value=[]):
+        with patch('ckan_zenodo.get_transfers_for_user', return_value=[]), \
+             patch('ckan_zenodo.get_package_jobs_for_user', return_value=[]):
             response = client.get('/transfers')
 
         assert response.status_code == 200
 
+    def test_renders_package_job_counts(self, client):
+        with client.session_transaction() as sess:
+            sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
+
+        job = {'id': 3, 'package_id': 'my-dataset', 'deposition_id': '99', 'status': 'expanding',
+               'total': 1000, 'queued': 400, 'skipped': 2, 'failed': 1, 'message': None,
+               'created_at': '2026-06-21 14:00:00', 'updated_at': '2026-06-21 14:01:00'}
+        with patch('ckan_zenodo.get_transfers_for_user', return_value=[]), \
+             patch('ckan_zenodo.get_package_jobs_for_user', return_value=[job]):
+            response = client.get('/transfers')
+
+        assert b'my-dataset' in response.data
+        assert b'403 / 1000' in response.data
+
 
 # ---------------------------------------------------------------------------
 # /api/transfer/<id>
@@ -369,20 +504,38 @@ class TestApiTransferStatus:
         assert data['status'] == 'completed'
         assert data['retry_count'] == 1
 
+    def test_returns_upload_progress(self, client):
+        with client.session_transaction() as sess:
+            sess['user'] = {'username': 'alice', 'given_name': 'Alice', 'family_name': 'Smith'}
+
+        mock_transfer = {'id': 7, 'status': 'in_progress', 'retry_count': 0, 'updated_at': '2026-01-01 12:00:00',
+                         'file_size': 1000, 'bytes_sent': 250, 'bytes_per_sec': 50.0, 'progress_age': 3}
+
+        with patch('ckan_zenodo.get_transfer_by_id', return_value=mock_transfer):
+            data = json.loads(client.get('/api/transfer/7').data)
+
+        assert data['percent'] == 25.0
+        assert data['bytes_per_sec'] == 50.0
+        assert data['eta_seconds'] == 15
+        assert data['seconds_since_progress'] == 3
+
 
 # ---------------------------------------------------------------------------
 # /health
 # ---------------------------------------------------------------------------
 
 class TestHealth:
-    def test_returns_200_when_all_ok(self, client):
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_conn.cursor.return_value.__enter__ = lambda s: mock_cursor
-        mock_conn.cursor.return_value.__exit__ = MagicMock(return_value=False)
+    def _snapshot(self, **statuses):
+        components = {'db': 'ok', 'rabbitmq': 'ok', 'ckan': 'ok', 'zenodo': 'ok', **statuses}
+        prober = health.HealthProber()
+        with patch.dict(health.HealthProber.checks,
+                        {name: (MagicMock() if status == 'ok' else MagicMock(side_effect=Exception(status)))
+                         for name, status in components.items()}):
+            prober.run_once()
+        return prober.snapshot()
 
-        with patch('db.get_connection', return_value=mock_conn), \
-             patch('pika.BlockingConnection'):
+    def test_returns_200_when_all_ok(self, client):
+        with patch('health.get_snapshot', return_value=self._snapshot()):
             response = client.get('/health')
 
         assert response.status_code == 200
@@ -390,10 +543,19 @@ class TestHealth:
         assert data['status'] == 'healthy'
         assert data['db'] == 'ok'
         assert data['rabbitmq'] == 'ok'
+        assert 'latency_ms' in data['checks']['db']
+        assert 'checked_at' in data['checks']['rabbitmq']
+
+    def test_metrics_served_from_snapshot(self, client):
+        with patch('health.get_snapshot', return_value=self._snapshot()):
+            response = client.get('/metrics')
+
+        assert response.status_code == 200
+        assert response.content_type.startswith('text/plain')
+        assert b'ckan_zenodo_ready 1' in response.data
 
     def test_returns_503_when_db_down(self, client):
-        with patch('db.get_connection', side_effect=Exception("DB connection failed")), \
-             patch('pika.BlockingConnection'):
+        with patch('health.get_snapshot', return_value=self._snapshot(db='DB connection failed')):
             response = client.get('/health')
 
         assert response.status_code == 503
@@ -402,16 +564,83 @@ class TestHealth:
         assert 'error' in data['db']
 
     def test_returns_503_when_rabbitmq_down(self, client):
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_conn.cursor.return_value.__enter__ = lambda s: mock_cursor
-        mock_conn.cursor.return_value.__exit__ = MagicMock(return_value=False)
-
-        with patch('db.get_connection', return_value=mock_conn), \
-             patch('pika.BlockingConnection', side_effect=Exception("Connection refused")):
+        with patch('health.get_snapshot', return_value=self._snapshot(rabbitmq='Connection refused')):
             response = client.get('/health')
 
         assert response.status_code == 503
         data = json.loads(response.data)
         assert data['status'] == 'degraded'
         assert 'error' in data['rabbitmq']
+
+    def test_zenodo_outage_is_degraded_but_ready(self, client):
+        with patch('health.get_snapshot', return_value=self._snapshot(zenodo='HTTP 502')):
+            response = client.get('/health')
+
+        assert response.status_code == 200
+        assert json.loads(response.data)['status'] == 'degraded'
+
+    def test_health_does_no_io(self, client):
+        with patch('health.get_snapshot', return_value=self._snapshot()), \
+             patch('db.get_connection') as mock_db, \
+             patch('pika.BlockingConnection') as mock_pika:
+            client.get('/health')
+
+        mock_db.assert_not_called()
+        mock_pika.assert_not_called()
+
+    def test_livez_returns_200_without_touching_backends(self, client):
+        with patch('health.get_snapshot') as mock_snapshot:
+            response = client.get('/livez')
+
+        assert response.status_code == 200
+        assert json.loads(response.data)['status'] == 'alive'
+        mock_snapshot.assert_not_called()
+
+
+# ---------------------------------------------------------------------------
+# run_server
+# ---------------------------------------------------------------------------
+
+class TestRunServer:
+    def test_single_process_passes_server_config_to_waitress(self, flask_app, mock_configs):
+        import server
+        sc = {**mock_configs['server'], 'threads': 16, 'connection_limit': 500,
+              'backlog': 2048, 'channel_timeout': 30}
+
+        with patch('configs.get_server_config', return_value=sc), \
+             patch('server.serve') as mock_serve, \
+             patch('server._serve_prefork') as mock_prefork, \
+             patch('health.get_prober') as mock_prober:
+            server.run_server()
+
+        mock_prober.assert_called_once()
+        mock_prefork.assert_not_called()
+        kwargs = mock_serve.call_args[1]
+        assert kwargs['threads'] == 16
+        assert kwargs['connection_limit'] == 500
+        assert kwargs['backlog'] == 2048
+        assert kwargs['channel_timeout'] == 30
+        assert kwargs['port'] == 8090
+
+    def test_multiple_processes_use_prefork(self, flask_app, mock_configs):
+        import server
+        sc = {**mock_configs['server'], 'processes': 4}
+
+        with patch('configs.get_server_config', return_value=sc), \
+             patch('server.serve') as mock_serve, \
+             patch('server._serve_prefork') as mock_prefork:
+            server.run_server()
+
+        mock_serve.assert_not_called()
+        mock_prefork.assert_called_once()
+        assert mock_prefork.call_args[0][1]['threads'] == sc['threads']
+
+    def test_reset_process_state_drops_pool_and_publisher(self, flask_app):
+        import server
+
+        with patch('db.reset_pool') as mock_pool, \
+             patch('ckan_zenodo.reset_publisher') as mock_publisher:
+            server._reset_process_state()
+
+        mock_pool.assert_called_once()
+        mock_publisher.assert_called_once()
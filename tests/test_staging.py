@@ -0,0 +1,124 @@
+"""Unit tests for staging.py — prefetching upload files to local scratch."""
+import os
+from unittest.mock import patch
+
+import pytest
+
+import staging
+from staging import Stager
+
+
+@pytest.fixture
+def stager(tmp_path):
+    s = Stager(str(tmp_path / 'scratch'), budget_bytes=100, prefetch_files=2)
+    yield s
+    s.close()
+
+
+def _source(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(b'x' * size)
+    return str(path)
+
+
+def _stage(stager, source):
+    stager.prefetch(source)
+    stager._entries[source].ready.wait(5)
+
+
+class TestStager:
+    def test_upload_reads_the_staged_copy(self, stager, tmp_path):
+        source = _source(tmp_path, 'a.csv', 10)
+        _stage(stager, source)
+
+        with stager.staged(source) as path:
+            assert path.startswith(stager.directory)
+            with open(path, 'rb') as fp:
+                assert fp.read() == b'x' * 10
+
+    def test_unstaged_file_is_read_from_source(self, stager, tmp_path):
+        source = _source(tmp_path, 'a.csv', 10)
+
+        with stager.staged(source) as path:
+            assert path == source
+
+    def test_file_over_budget_is_not_staged(self, stager, tmp_path):
+        source = _source(tmp_path, 'big.csv', 200)
+        _stage(stager, source)
+
+        with stager.staged(source) as path:
+            assert path == source
+        assert os.listdir(stager.directory) == []
+
+    def test_least_recently_used_copy_is_evicted(self, stager, tmp_path):
+        first = _source(tmp_path, 'a.csv', 60)
+        second = _source(tmp_path, 'b.csv', 60)
+        _stage(stager, first)
+        with stager.staged(first):
+            pass
+
+        _stage(stager, second)
+
+        assert first not in stager._entries
+        with stager.staged(second) as path:
+            assert path != second
+
+    def test_copy_in_use_is_never_evicted(self, stager, tmp_path):
+        first = _source(tmp_path, 'a.csv', 60)
+        second = _source(tmp_path, 'b.csv', 60)
+        _stage(stager, first)
+
+        with stager.staged(first) as path:
+            _stage(stager, second)
+            assert os.path.exists(path)
+            assert second not in stager._entries
+
+    def test_changed_source_is_read_from_source(self, stager, tmp_path):
+        source = _source(tmp_path, 'a.csv', 10)
+        _stage(stager, source)
+        with open(source, 'ab') as fp:
+            fp.write(b'more')
+
+        with stager.staged(source) as path:
+            assert path == source
+
+    def test_prefetch_stops_at_prefetch_files(self, stager, tmp_path):
+        for name in ('a', 'b', 'c'):
+            stager.prefetch(_source(tmp_path, name, 1))
+
+        assert len(stager._entries) == 2
+
+    def test_discarded_copy_frees_its_prefetch_place(self, stager, tmp_path):
+        first = _source(tmp_path, 'a.csv', 10)
+        second = _source(tmp_path, 'b.csv', 10)
+        third = _source(tmp_path, 'c.csv', 10)
+        _stage(stager, first)
+        _stage(stager, second)
+
+        stager.discard(first)
+        stager.prefetch(third)
+
+        assert first not in stager._entries
+        assert third in stager._entries
+
+    def test_discard_leaves_a_copy_in_use(self, stager, tmp_path):
+        source = _source(tmp_path, 'a.csv', 10)
+        _stage(stager, source)
+
+        with stager.staged(source) as path:
+            stager.discard(source)
+            assert os.path.exists(path)
+
+
+class TestScratchDirectories:
+    def test_removes_directories_of_exited_processes(self, tmp_path):
+        orphan = tmp_path / 'worker-999999'
+        orphan.mkdir()
+
+        with patch('os.kill', side_effect=ProcessLookupError):
+            Stager(str(tmp_path), budget_bytes=10).close()
+
+        assert not orphan.exists()
+
+    def test_disabled_without_scratch_dir(self):
+        assert staging.get_stager() is None
@@ -0,0 +1,238 @@
+"""Unit tests for upload_stream.py — streamed request bodies and the stall watchdog."""
+import pytest
+import requests as req_lib
+
+from unittest.mock import patch
+
+from upload_stream import FileBody, TeeBody, ZipBody, ThroughputWatchdog, UploadStalled, ProgressLog, zip_size
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestThroughputWatchdog:
+    def test_no_verdict_before_window_elapses(self):
+        clock = FakeClock()
+        wd = ThroughputWatchdog(min_bytes_per_sec=1024, window=10, clock=clock)
+        clock.now = 9
+        wd.update(0)  # would be 0 B/s, but the window is not complete yet
+
+    def test_raises_when_below_floor_for_a_window(self):
+        clock = FakeClock()
+        wd = ThroughputWatchdog(min_bytes_per_sec=1024, window=10, clock=clock)
+        clock.now = 10
+        with pytest.raises(UploadStalled):
+            wd.update(5 * 1024)  # 512 B/s
+
+    def test_passes_and_starts_new_window_when_fast_enough(self):
+        clock = FakeClock()
+        wd = ThroughputWatchdog(min_bytes_per_sec=1024, window=10, clock=clock)
+        clock.now = 10
+        wd.update(100 * 1024)
+        clock.now = 20
+        with pytest.raises(UploadStalled):
+            wd.update(101 * 1024)  # only 1 KiB in the second window
+
+    def test_stall_is_a_requests_timeout(self):
+        assert issubclass(UploadStalled, req_lib.exceptions.Timeout)
+
+
+class TestFileBody:
+    def test_len_is_file_size(self, tmp_path):
+        f = tmp_path / "data.bin"
+        f.write_bytes(b"x" * 1000)
+        assert len(FileBody(str(f))) == 1000
+
+    def test_iterates_whole_file_in_blocks(self, tmp_path):
+        f = tmp_path / "data.bin"
+        payload = bytes(range(256)) * 10
+        f.write_bytes(payload)
+
+        body = FileBody(str(f), block_size=1000)
+        blocks = list(body)
+
+        assert b"".join(blocks) == payload
+        assert [len(b) for b in blocks] == [1000, 1000, 560]
+        assert body.bytes_sent == len(payload)
+
+    def test_watchdog_sees_running_total(self, tmp_path):
+        f = tmp_path / "data.bin"
+        f.write_bytes(b"x" * 300)
+        seen = []
+
+        class Recorder:
+            def update(self, total):
+                seen.append(total)
+
+        list(FileBody(str(f), block_size=100, watchdog=Recorder()))
+        assert seen == [100, 200, 300]
+
+
+    def test_reports_progress_after_each_block(self, tmp_path):
+        f = tmp_path / "data.bin"
+        f.write_bytes(b"x" * 250)
+        seen = []
+
+        list(FileBody(str(f), block_size=100, progress=lambda sent, size: seen.append((sent, size))))
+        assert seen == [(100, 250), (200, 250), (250, 250)]
+
+    def test_advises_sequential_reads_and_drops_sent_blocks(self, tmp_path):
+        f = tmp_path / "data.bin"
+        f.write_bytes(b"x" * 200)
+
+        with patch('os.posix_fadvise', create=True) as mock_fadvise, \
+             patch('os.POSIX_FADV_SEQUENTIAL', 2, create=True), \
+             patch('os.POSIX_FADV_DONTNEED', 4, create=True):
+            list(FileBody(str(f), block_size=100))
+
+        advice = [c[0][1:] for c in mock_fadvise.call_args_list]
+        assert advice == [(0, 0, 2), (0, 100, 4), (100, 100, 4)]
+
+    def test_no_fadvise_when_drop_cache_is_off(self, tmp_path):
+        f = tmp_path / "data.bin"
+        f.write_bytes(b"x" * 200)
+
+        with patch('os.posix_fadvise', create=True) as mock_fadvise:
+            list(FileBody(str(f), block_size=100, drop_cache=False))
+
+        mock_fadvise.assert_not_called()
+
+
+class TestProgressLog:
+    def test_logs_at_interval_and_at_the_end(self):
+        clock = FakeClock()
+        log = ProgressLog('data.bin', interval=30, clock=clock)
+
+        with patch('logging.info') as mock_info:
+            clock.now = 10
+            log(100, 1000)
+            clock.now = 31
+            log(300, 1000)
+            clock.now = 40
+            log(1000, 1000)
+
+        assert mock_info.call_count == 2
+        assert '100%' in mock_info.call_args[0][0]
+
+
+class TestAbortError:
+    def test_watchdog_error_is_kept_on_the_body(self, tmp_path):
+        f = tmp_path / "data.bin"
+        f.write_bytes(b"x" * 300)
+
+        class Tripwire:
+            def update(self, total):
+                raise UploadStalled("too slow")
+
+        body = FileBody(str(f), block_size=100, watchdog=Tripwire())
+        with pytest.raises(UploadStalled):
+            list(body)
+        assert isinstance(body.abort_error, UploadStalled)
+
+
+class TestTeeBody:
+    def test_every_branch_gets_the_whole_file(self, tmp_path):
+        import threading
+        f = tmp_path / "data.bin"
+        payload = bytes(range(256)) * 40
+        f.write_bytes(payload)
+        tee = TeeBody(str(f), block_size=1000, buffer_blocks=1)
+        branches = [tee.branch(), tee.branch()]
+        received = {}
+
+        def consume(i):
+            received[i] = b"".join(branches[i])
+        threads = [threading.Thread(target=consume, args=(i,)) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=5)
+        tee.join()
+
+        assert received == {0: payload, 1: payload}
+        assert all(len(b) == len(payload) for b in branches)
+
+    def test_closed_branch_does_not_hold_up_the_others(self, tmp_path):
+        f = tmp_path / "data.bin"
+        f.write_bytes(b"x" * 5000)
+        tee = TeeBody(str(f), block_size=1000, buffer_blocks=1)
+        failed, ok = tee.branch(), tee.branch()
+        failed.close()  # e.g. its upload could not start
+
+        assert b"".join(ok) == b"x" * 5000
+        tee.join()
+
+    def test_progress_error_aborts_only_its_branch(self, tmp_path):
+        import threading
+        f = tmp_path / "data.bin"
+        f.write_bytes(b"x" * 5000)
+        tee = TeeBody(str(f), block_size=1000, buffer_blocks=1)
+
+        def cancel(sent, size):
+            if sent >= 2000:
+                raise RuntimeError("cancelled")
+        aborted, ok = tee.branch(progress=cancel), tee.branch()
+        result = {}
+
+        def consume_aborted():
+            try:
+                list(aborted)
+            except RuntimeError as e:
+                result['error'] = e
+        t = threading.Thread(target=consume_aborted)
+        t.start()
+        assert len(b"".join(ok)) == 5000
+        t.join(timeout=5)
+        tee.join()
+
+        assert aborted.abort_error is result['error']
+        assert aborted.bytes_sent == 2000
+
+
+class TestZipBody:
+    def _files(self, tmp_path, *payloads):
+        members = []
+        for i, payload in enumerate(payloads):
+            f = tmp_path / f"f{i}.bin"
+            f.write_bytes(payload)
+            members.append((f"dir/file{i}.bin", str(f)))
+        return members
+
+    def test_streams_a_valid_archive_of_its_exact_length(self, tmp_path):
+        import io
+        import zipfile
+        import zlib
+        payloads = [b"", b"a" * 10, bytes(range(256)) * 50]
+        body = ZipBody(self._files(tmp_path, *payloads), block_size=1000)
+
+        data = b"".join(body)
+
+        assert len(data) == len(body) == body.bytes_sent
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        assert archive.testzip() is None
+        assert [archive.read(f"dir/file{i}.bin") for i in range(3)] == payloads
+        assert body.manifest[2]['crc32'] == f"{zlib.crc32(payloads[2]):08x}"
+        assert body.manifest[2]['offset'] == archive.getinfo('dir/file2.bin').header_offset
+
+    def test_blocks_stay_bounded_whatever_the_file_size(self, tmp_path):
+        body = ZipBody(self._files(tmp_path, b"x" * 10000, b"y"), block_size=1000)
+
+        assert max(len(block) for block in body) < 2 * 1000
+
+    def test_file_changed_since_statted_aborts(self, tmp_path):
+        members = self._files(tmp_path, b"abc")
+        body = ZipBody(members)
+        (tmp_path / "f0.bin").write_bytes(b"abcdef")
+
+        with pytest.raises(ValueError):
+            list(body)
+        assert isinstance(body.abort_error, ValueError)
+
+    def test_size_of_a_member_over_4_gib_includes_zip64_records(self):
+        # Headers, descriptor and central entry with ZIP64 extras, then ZIP64 end records
+        assert zip_size([('a', 2 ** 32)]) == 2 ** 32 + 51 + 24 + 67 + 56 + 20 + 22
@@ -1,11 +1,14 @@
 """Unit tests for worker.py — RabbitMQ callback and Zenodo upload logic."""
 import json
+import datetime
 import pytest
 import requests as req_lib
 from unittest.mock import patch, MagicMock, call
 
-from worker import callback, upload_to_zenodo, update_transfer_status
-from tests.conftest import RABBITMQ_CONFIG
+from worker import (callback, upload_to_zenodo, update_transfer_status, Heartbeat, ProgressRecorder,
+                    reap_stale_transfers, release_scheduled_transfers, relay_outbox, run_package_job,
+                    tee_upload, upload_bundle_to_zenodo)
+from tests.conftest import RABBITMQ_CONFIG, WORKER_CONFIG
 
 
 def _make_task(**overrides):
@@ -55,7 +58,7 @@ class TestCallback:
 
             callback(ch, method, None, body)
 
-            mock_update.assert_any_call(5, 'failed', 'Connection refused', 3)
+            mock_update.assert_any_call(5, 'failed', 'Connection refused', 3, error_class='unknown')
 
     def test_always_acks_on_success(self, mock_configs, mock_db_connection):
         ch, method = _make_channel_and_method(delivery_tag=3)
@@ -131,6 +134,68 @@ class TestUploadToZenodo:
             put_url = mock_put.call_args[0][0]
             assert put_url == 'https://zenodo.org/bucket/xyz/data.csv'
 
+    def test_applies_configured_timeouts(self, mock_configs, tmp_path):
+        test_file = tmp_path / "data.csv"
+        test_file.write_text("data")
+        zc = {**mock_configs['zenodo'], 'connect_timeout': 7, 'read_timeout': 90}
+
+        with patch('configs.get_zenodo_config', return_value=zc), \
+             patch('requests.get', return_value=self._mock_get_response()) as mock_get, \
+             patch('requests.put', return_value=self._mock_put_response()) as mock_put:
+
+            upload_to_zenodo(str(test_file), 'data.csv', 'token', '999')
+
+        assert mock_get.call_args[1]['timeout'] == (7, 90)
+        assert mock_put.call_args[1]['timeout'] == (7, 90)
+
+    def test_streams_sized_body_with_watchdog_when_floor_configured(self, mock_configs, tmp_path):
+        test_file = tmp_path / "data.csv"
+        test_file.write_text("data")
+        zc = {**mock_configs['zenodo'], 'min_upload_kbps': 64, 'stall_seconds': 30}
+
+        with patch('configs.get_zenodo_config', return_value=zc), \
+             patch('requests.get', return_value=self._mock_get_response()), \
+             patch('requests.put', return_value=self._mock_put_response()) as mock_put:
+
+            upload_to_zenodo(str(test_file), 'data.csv', 'token', '999')
+
+        body = mock_put.call_args[1]['data']
+        assert len(body) == 4
+        assert body.watchdog.min_bytes_per_sec == 64 * 1024
+        assert body.watchdog.window == 30
+
+    def test_reraises_stall_hidden_inside_connection_error(self, mock_configs, tmp_path):
+        from upload_stream import UploadStalled
+        test_file = tmp_path / "data.csv"
+        test_file.write_text("data")
+
+        def fake_put(url, data, **kwargs):
+            try:
+                data.abort_error = UploadStalled("too slow")
+                raise data.abort_error
+            except UploadStalled as e:
+                raise req_lib.exceptions.ConnectionError(('Connection aborted.', e))
+
+        with patch('requests.get', return_value=self._mock_get_response()), \
+             patch('requests.put', side_effect=fake_put):
+            with pytest.raises(UploadStalled):
+                upload_to_zenodo(str(test_file), 'data.csv', 'token', '999')
+
+    def test_paces_both_requests_and_holds_upload_slot(self, mock_configs, tmp_path):
+        f = tmp_path / "file.csv"
+        f.write_text("data")
+        limiter = MagicMock()
+
+        with patch('rate_limiter.get_limiter', return_value=limiter), \
+             patch('requests.get', return_value=self._mock_get_response()), \
+             patch('requests.put', return_value=self._mock_put_response()):
+
+            upload_to_zenodo(str(f), 'file.csv', 'zenodo-token', '12345')
+
+        assert limiter.acquire.call_count == 2
+        limiter.acquire.assert_called_with('zenodo-token')
+        limiter.upload_slot.assert_called_once_with('zenodo-token')
+
     def test_raises_on_get_http_error(self, mock_configs, tmp_path):
         test_file = tmp_path / "data.csv"
         test_file.write_text("data")
@@ -160,6 +225,116 @@ class TestUploadToZenodo:
 # update_transfer_status
 # ---------------------------------------------------------------------------
 
+def _tee_task(**overrides):
+    targets = [{'transfer_id': 1, 'deposition_id': '11', 'deposition_name': 'Community'},
+               {'transfer_id': 2, 'deposition_id': '22', 'deposition_name': 'Paper'}]
+    return _make_task(deposition_id='11', deposition_name='Community', targets=targets, **overrides)
+
+
+class TestTeeUpload:
+    def _get(self, url, **kwargs):
+        deposition_id = url.rsplit('/', 1)[1]
+        if deposition_id == '404':
+            raise req_lib.exceptions.HTTPError("404 Not Found")
+        resp = MagicMock()
+        resp.json.return_value = {'links': {'bucket': f'https://zenodo.org/bucket/{deposition_id}'}}
+        return resp
+
+    def test_reads_once_and_uploads_to_every_bucket(self, mock_configs, tmp_path):
+        test_file = tmp_path / "data.csv"
+        test_file.write_bytes(b"x" * 3000)
+        received = {}
+
+        def put(url, data, **kwargs):
+            received[url] = b"".join(data)
+            return MagicMock(text=f'done {url}')
+
+        targets = _tee_task()['targets'] + [{'transfer_id': 3, 'deposition_id': '404', 'deposition_name': 'X'}]
+        with patch('requests.get', side_effect=self._get), \
+             patch('requests.put', side_effect=put), \
+             patch('builtins.open', wraps=open) as mock_open:
+            results = tee_upload(str(test_file), 'data.csv', 'token', targets)
+
+        assert received == {'https://zenodo.org/bucket/11/data.csv': b"x" * 3000,
+                            'https://zenodo.org/bucket/22/data.csv': b"x" * 3000}
+        assert [c[0][0] for c in mock_open.call_args_list].count(str(test_file)) == 1
+        assert results[1] == 'done https://zenodo.org/bucket/11/data.csv'
+        assert isinstance(results[3], req_lib.exceptions.HTTPError)
+
+    def test_callback_completes_succeeded_targets_and_retries_the_rest(self, mock_configs):
+        ch, method = _make_channel_and_method()
+        body = json.dumps(_tee_task(retry_count=0)).encode()
+        error = req_lib.exceptions.ConnectionError("reset")
+
+        with patch('worker._open_targets', side_effect=lambda targets: targets), \
+             patch('worker.update_transfer_status') as mock_update, \
+             patch('worker.tee_upload', return_value={1: 'ok', 2: error}), \
+             patch('time.sleep'):
+            callback(ch, method, None, body)
+
+        mock_update.assert_any_call(1, 'completed', 'ok', 0)
+        assert mock_update.call_args[0][:2] == (2, 'pending')
+        retried = json.loads(ch.basic_publish.call_args[1]['body'])
+        assert [t['transfer_id'] for t in retried['targets']] == [2]
+        assert (retried['transfer_id'], retried['deposition_id']) == (2, '22')
+
+    def test_callback_drops_finished_targets_of_a_redelivered_task(self, mock_configs):
+        ch, method = _make_channel_and_method(delivery_tag=4)
+        body = json.dumps(_tee_task()).encode()
+
+        with patch('worker._open_targets', return_value=[]), \
+             patch('worker.tee_upload') as mock_tee:
+            callback(ch, method, None, body)
+
+        mock_tee.assert_not_called()
+        ch.basic_ack.assert_called_once_with(delivery_tag=4)
+
+
+class TestBundleUpload:
+    def test_streams_the_archive_into_one_put(self, mock_configs, tmp_path):
+        import io
+        import zipfile
+        (tmp_path / "a.csv").write_bytes(b"a" * 100)
+        (tmp_path / "b.csv").write_bytes(b"b" * 200)
+        received = {}
+
+        def put(url, data, **kwargs):
+            received['length'] = len(data)
+            received[url] = b"".join(data)
+            return MagicMock(text='done')
+
+        get = MagicMock()
+        get.json.return_value = {'links': {'bucket': 'https://zenodo.org/bucket/xyz'}}
+        with patch('requests.get', return_value=get), \
+             patch('requests.put', side_effect=put):
+            response, manifest = upload_bundle_to_zenodo(
+                [('a.csv', str(tmp_path / "a.csv")), ('b.csv', str(tmp_path / "b.csv"))], 'pkg.zip', 'token', '9')
+
+        data = received['https://zenodo.org/bucket/xyz/pkg.zip']
+        assert received['length'] == len(data)
+        assert zipfile.ZipFile(io.BytesIO(data)).read('b.csv') == b"b" * 200
+        assert response == 'done'
+        assert [(m['name'], m['size']) for m in manifest] == [('a.csv', 100), ('b.csv', 200)]
+
+    def test_callback_records_the_manifest_and_completes(self, mock_configs):
+        ch, method = _make_channel_and_method()
+        body = json.dumps(_make_task(file_path='', filename='pkg.zip', bundle=True)).encode()
+        members = [{'resource_id': 'r1', 'name': 'a.csv', 'path': '/mnt/a', 'size': 1}]
+        manifest = [{'name': 'a.csv', 'size': 1, 'crc32': 'e8b7be43', 'offset': 0}]
+
+        with patch('worker.update_transfer_status') as mock_update, \
+             patch('worker.load_bundle_members', return_value=members), \
+             patch('worker.upload_bundle_to_zenodo', return_value=('ok', manifest)) as mock_bundle, \
+             patch('worker.record_bundle_manifest') as mock_record, \
+             patch('worker.upload_to_zenodo') as mock_upload:
+            callback(ch, method, None, body)
+
+        mock_upload.assert_not_called()
+        assert mock_bundle.call_args[0][:4] == ([('a.csv', '/mnt/a')], 'pkg.zip', 'zenodo-token', '12345')
+        mock_record.assert_called_once_with(1, members, manifest)
+        mock_update.assert_any_call(1, 'completed', 'ok', 0)
+
+
 class TestUpdateTransferStatus:
     def test_updates_correct_row(self, mock_configs, mock_db_connection):
         mock_conn, mock_cursor = mock_db_connection
@@ -171,6 +346,24 @@ class TestUpdateTransferStatus:
         assert args[1] == ('completed', '{"ok":true}', 7)
         mock_conn.commit.assert_called_once()
 
+    def test_includes_error_class_when_provided(self, mock_configs, mock_db_connection):
+        mock_conn, mock_cursor = mock_db_connection
+
+        update_transfer_status(3, 'failed', '403 Forbidden', retry_count=0, error_class='permanent')
+
+        sql, params = mock_cursor.execute.call_args[0]
+        assert 'error_class=%s' in sql
+        assert params == ('failed', '403 Forbidden', 0, 'permanent', 3)
+
+    def test_completion_clears_error_class_of_earlier_attempts(self, mock_configs, mock_db_connection):
+        mock_conn, mock_cursor = mock_db_connection
+
+        update_transfer_status(7, 'completed', '{"ok":true}')
+
+        sql, params = mock_cursor.execute.call_args[0]
+        assert 'error_class=NULL' in sql
+        assert params == ('completed', '{"ok":true}', 7)
+
     def test_includes_retry_count_when_provided(self, mock_configs, mock_db_connection):
         mock_conn, mock_cursor = mock_db_connection
 
@@ -179,6 +372,15 @@ class TestUpdateTransferStatus:
         args = mock_cursor.execute.call_args[0]
         assert args[1] == ('pending', 'Retry 1/3', 1, 3)
 
+    def test_pending_resets_progress_of_the_stopped_attempt(self, mock_configs, mock_db_connection):
+        mock_conn, mock_cursor = mock_db_connection
+
+        update_transfer_status(3, 'pending', 'Retry 1/3', retry_count=1)
+
+        sql = mock_cursor.execute.call_args[0][0]
+        for column in ('bytes_sent', 'bytes_per_sec', 'avg_bytes_per_sec', 'progress_at'):
+            assert f"{column}=NULL" in sql
+
     def test_closes_connection_after_update(self, mock_configs, mock_db_connection):
         mock_conn, mock_cursor = mock_db_connection
 
@@ -209,6 +411,21 @@ class TestCallbackRetry:
         published = json.loads(ch.basic_publish.call_args[1]['body'])
         assert published['retry_count'] == 1
 
+    def test_retry_of_a_large_file_waits_for_the_off_peak_window(self, mock_configs):
+        ch, method = _make_channel_and_method()
+        body = json.dumps(_make_task(retry_count=0, file_size=500 * 1024 ** 3)).encode()
+
+        with patch('offpeak.is_large', return_value=True), \
+             patch('ckan_zenodo.schedule_task') as mock_schedule, \
+             patch('worker.update_transfer_status'), \
+             patch('worker.upload_to_zenodo', side_effect=Exception("Zenodo down")), \
+             patch('time.sleep'):
+            callback(ch, method, None, body)
+
+        ch.basic_publish.assert_not_called()
+        assert mock_schedule.call_args[0][0]['retry_count'] == 1
+        ch.basic_ack.assert_called_once()
+
     def test_marks_failed_when_max_retries_exhausted(self, mock_configs):
         """When retry_count already equals max_retries, marks transfer as failed."""
         rc = {**RABBITMQ_CONFIG, 'max_retries': '2'}
@@ -257,6 +474,21 @@ class TestCallbackRetry:
             assert mock_sleep.call_args[0][0] == expected_sleep, \
                 f"retry_count={retry_count}: expected sleep {expected_sleep}s"
 
+    def test_stalled_upload_is_retried(self, mock_configs):
+        """A stall frees the slot and goes through the normal retry path."""
+        from upload_stream import UploadStalled
+        ch, method = _make_channel_and_method()
+        body = json.dumps(_make_task(retry_count=0)).encode()
+
+        with patch('worker.update_transfer_status'), \
+             patch('worker.upload_to_zenodo', side_effect=UploadStalled("stalled")), \
+             patch('time.sleep'):
+
+            callback(ch, method, None, body)
+
+        ch.basic_publish.assert_called_once()
+        ch.basic_ack.assert_called_once()
+
     def test_backoff_capped_at_300_seconds(self, mock_configs):
         """Sleep never exceeds 300s regardless of retry count."""
         rc = {**RABBITMQ_CONFIG, 'max_retries': '10'}
@@ -271,3 +503,804 @@ class TestCallbackRetry:
             callback(ch, method, None, body)
 
         assert mock_sleep.call_args[0][0] == 300
+
+
+# ---------------------------------------------------------------------------
+# Heartbeats
+# ---------------------------------------------------------------------------
+
+class TestHeartbeat:
+    def test_claims_on_enter_and_releases_on_exit(self, mock_configs):
+        with patch('worker.worker_id', return_value='host-a:42'), \
+             patch('worker.claim_transfer') as mock_claim, \
+             patch('worker.release_transfer') as mock_release:
+
+            with Heartbeat(7, '{"transfer_id": 7}'):
+                mock_claim.assert_called_once_with(7, 'host-a:42', '{"transfer_id": 7}')
+                mock_release.assert_not_called()
+
+        mock_release.assert_called_once_with(7, 'host-a:42')
+
+    def test_releases_when_upload_raises(self, mock_configs):
+        with patch('worker.claim_transfer'), \
+             patch('worker.release_transfer') as mock_release:
+
+            with pytest.raises(RuntimeError):
+                with Heartbeat(7, '{}'):
+                    raise RuntimeError("upload failed")
+
+        mock_release.assert_called_once()
+
+    def test_heartbeat_db_errors_do_not_fail_upload(self, mock_configs):
+        with patch('worker.claim_transfer', side_effect=Exception("DB down")), \
+             patch('worker.release_transfer', side_effect=Exception("DB down")):
+
+            with Heartbeat(7, '{}'):
+                pass
+
+    def test_callback_claims_transfer_around_upload(self, mock_configs):
+        ch, method = _make_channel_and_method()
+        body = json.dumps(_make_task(transfer_id=9)).encode()
+
+        with patch('worker.update_transfer_status'), \
+             patch('worker.upload_to_zenodo', return_value='ok'), \
+             patch('worker.claim_transfer') as mock_claim, \
+             patch('worker.release_transfer') as mock_release:
+
+            callback(ch, method, None, body)
+
+        transfer_id, _, payload = mock_claim.call_args[0]
+        assert transfer_id == 9
+        assert json.loads(payload)['transfer_id'] == 9
+        mock_release.assert_called_once()
+
+    def test_claim_only_takes_unowned_or_stale_transfers(self, mock_configs, mock_db_connection):
+        from worker import claim_transfer
+        conn, cursor = mock_db_connection
+        cursor.execute.return_value = 0
+
+        assert claim_transfer(9, 'host-b:7', '{}') is False
+
+        sql, params = cursor.execute.call_args[0]
+        assert 'worker_id IS NULL' in sql and 'heartbeat_at < NOW() - INTERVAL %s SECOND' in sql
+        assert "status NOT IN ('completed', 'failed', 'cancelled')" in sql
+        assert params == ('host-b:7', '{}', 9, WORKER_CONFIG['heartbeat_timeout'])
+
+    def test_callback_drops_task_of_a_transfer_owned_elsewhere(self, mock_configs):
+        ch, method = _make_channel_and_method(delivery_tag=8)
+        body = json.dumps(_make_task(transfer_id=9)).encode()
+
+        with patch('worker.update_transfer_status') as mock_update, \
+             patch('worker.upload_to_zenodo') as mock_upload, \
+             patch('worker.claim_transfer', return_value=False), \
+             patch('worker.release_transfer') as mock_release:
+            callback(ch, method, None, body)
+
+        mock_upload.assert_not_called()
+        mock_update.assert_not_called()
+        mock_release.assert_not_called()
+        ch.basic_ack.assert_called_once_with(delivery_tag=8)
+        ch.basic_publish.assert_not_called()
+
+
+# ---------------------------------------------------------------------------
+# Reaper
+# ---------------------------------------------------------------------------
+
+def _stale_row(transfer_id=1, retry_count=0):
+    return {
+        'id': transfer_id,
+        'worker_id': 'dead-host:1',
+        'retry_count': retry_count,
+        'task_payload': json.dumps(_make_task(transfer_id=transfer_id, retry_count=retry_count)),
+    }
+
+
+class TestProgressRecorder:
+    class Clock:
+        now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    def test_writes_first_block_then_throttles(self, mock_configs):
+        clock = self.Clock()
+        recorder = ProgressRecorder(7, 'big.bin', clock=clock)
+
+        with patch('worker.record_progress') as mock_record, \
+             patch('ckan_zenodo.is_cancelled', return_value=False):
+            clock.now = 1
+            recorder(10, 10000)    # first block: written
+            clock.now = 2
+            recorder(20, 10000)    # 1s and 0.1% later: skipped
+            clock.now = 3
+            recorder(600, 10000)   # 5.8% since the last write: written
+            clock.now = 20
+            recorder(700, 10000)   # 17s since the last write: written
+
+        assert [c[0][1] for c in mock_record.call_args_list] == [10, 600, 700]
+        assert mock_record.call_args_list[1][0] == (7, 600, 10000, 295.0)
+
+    def test_last_block_is_always_written(self, mock_configs):
+        clock = self.Clock()
+        recorder = ProgressRecorder(7, 'f.bin', clock=clock)
+
+        with patch('worker.record_progress') as mock_record, \
+             patch('ckan_zenodo.is_cancelled', return_value=False):
+            recorder(10, 1000)
+            recorder(1000, 1000)
+
+        assert mock_record.call_count == 2
+
+    def test_last_block_records_the_average_over_the_upload(self, mock_configs):
+        clock = self.Clock()
+        recorder = ProgressRecorder(7, 'f.bin', clock=clock)
+
+        with patch('worker.record_progress') as mock_record, \
+             patch('ckan_zenodo.is_cancelled', return_value=False):
+            clock.now = 1
+            recorder(900, 1000)
+            clock.now = 10
+            recorder(1000, 1000)   # the last 100 bytes took 9s
+
+        assert [c[1]['average'] for c in mock_record.call_args_list] == [None, 100.0]
+        assert mock_record.call_args[0][3] == pytest.approx(11.1)
+        assert mock_record.call_args[1]['average'] == 100.0
+
+    def test_db_errors_do_not_fail_upload(self, mock_configs):
+        recorder = ProgressRecorder(7, 'f.bin')
+
+        with patch('worker.record_progress', side_effect=Exception("DB down")), \
+             patch('ckan_zenodo.is_cancelled', side_effect=Exception("DB down")):
+            recorder(10, 1000)
+
+    def test_cancellation_aborts_upload(self, mock_configs):
+        import ckan_zenodo
+        clock = self.Clock()
+        recorder = ProgressRecorder(7, 'f.bin', clock=clock)
+
+        with patch('worker.record_progress'), \
+             patch('ckan_zenodo.is_cancelled', side_effect=[False, True]) as mock_check:
+            recorder(10, 1000)
+            clock.now = 2
+            recorder(20, 1000)     # within cancel_check_interval: not checked
+            clock.now = 6
+            with pytest.raises(ckan_zenodo.TransferCancelled):
+                recorder(30, 1000)
+
+        assert mock_check.call_count == 2
+
+
+class TestCancelledTasks:
+    def test_cancelled_task_is_acked_without_upload(self, mock_configs):
+        ch, method = _make_channel_and_method(delivery_tag=9)
+
+        with patch('ckan_zenodo.is_cancelled', return_value=True), \
+             patch('worker.update_transfer_status') as mock_update, \
+             patch('worker.upload_to_zenodo') as mock_upload:
+            callback(ch, method, None, json.dumps(_make_task()).encode())
+
+        mock_upload.assert_not_called()
+        mock_update.assert_not_called()
+        ch.basic_ack.assert_called_once_with(delivery_tag=9)
+
+    def test_upload_aborted_by_cancel_is_not_retried(self, mock_configs):
+        import ckan_zenodo
+        ch, method = _make_channel_and_method()
+
+        with patch('ckan_zenodo.is_cancelled', return_value=False), \
+             patch('worker.update_transfer_status') as mock_update, \
+             patch('worker.upload_to_zenodo', side_effect=ckan_zenodo.TransferCancelled("cancelled")):
+            callback(ch, method, None, json.dumps(_make_task()).encode())
+
+        ch.basic_publish.assert_not_called()
+        assert [c[0][1] for c in mock_update.call_args_list] == ['in_progress']
+        ch.basic_ack.assert_called_once()
+
+    def test_status_update_does_not_overwrite_cancellation(self, mock_configs, mock_db_connection):
+        mock_conn, mock_cursor = mock_db_connection
+
+        update_transfer_status(7, 'failed', 'err')
+
+        assert "status <> 'cancelled'" in mock_cursor.execute.call_args[0][0]
+
+
+class TestReapStaleTransfers:
+    def test_requeues_orphaned_transfer_with_incremented_retry_count(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.return_value = [_stale_row(retry_count=1)]
+
+        with patch('ckan_zenodo.publish_task') as mock_publish:
+            assert reap_stale_transfers() == 1
+
+        assert mock_publish.call_args[0][0]['retry_count'] == 2
+        update_sql, update_args = cursor.execute.call_args[0]
+        assert update_args[0] == 'pending'
+        assert update_args[2] == 2
+        assert 'bytes_sent=NULL' in update_sql and 'progress_at=NULL' in update_sql
+        conn.commit.assert_called_once()
+
+    def test_large_orphaned_transfer_is_rescheduled(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.return_value = [_stale_row(retry_count=1)]
+
+        with patch('offpeak.is_large', return_value=True), \
+             patch('ckan_zenodo.publish_task') as mock_publish, \
+             patch('ckan_zenodo.schedule_task') as mock_schedule:
+            reap_stale_transfers()
+
+        mock_publish.assert_not_called()
+        task, schedule_cursor = mock_schedule.call_args[0]
+        assert task['retry_count'] == 2 and schedule_cursor is cursor
+        conn.commit.assert_called_once()
+
+    def test_marks_failed_when_retries_exhausted(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.return_value = [_stale_row(retry_count=3)]
+
+        with patch('ckan_zenodo.publish_task') as mock_publish, \
+             patch('worker.send_email_notification') as mock_email:
+            reap_stale_transfers()
+
+        mock_publish.assert_not_called()
+        sql, params = cursor.execute.call_args[0]
+        assert params[0] == 'failed'
+        assert 'bytes_sent=NULL' not in sql
+        mock_email.assert_called_once()
+
+    def test_targets_following_a_reaped_lead_get_its_status(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        task = _make_task(transfer_id=1, retry_count=3)
+        task['targets'] = [{'transfer_id': tid, 'deposition_id': dep, 'deposition_name': 'D'}
+                           for tid, dep in ((1, 11), (2, 12), (3, 13))]
+        cursor.fetchall.return_value = [{**_stale_row(retry_count=3), 'task_payload': json.dumps(task)}]
+
+        with patch('worker.send_email_notification'):
+            reap_stale_transfers()
+
+        sql, params = cursor.execute.call_args[0]
+        assert "status = 'in_progress'" in sql
+        assert params[0] == 'failed' and params[3:] == (2, 3)
+
+    def test_selects_by_heartbeat_timeout_and_batch_size(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.return_value = []
+
+        reap_stale_transfers()
+
+        sql, params = cursor.execute.call_args[0]
+        assert 'SKIP LOCKED' in sql
+        assert params == (WORKER_CONFIG['heartbeat_timeout'], WORKER_CONFIG['reap_batch_size'])
+
+    def test_keeps_reaping_while_batches_are_full(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.side_effect = [[_stale_row(1), _stale_row(2)], [_stale_row(3)]]
+
+        with patch('configs.get_worker_config', return_value={**WORKER_CONFIG, 'reap_batch_size': 2}), \
+             patch('ckan_zenodo.publish_task'):
+            assert reap_stale_transfers() == 3
+
+        assert conn.commit.call_count == 2
+
+    def test_rolls_back_batch_when_publish_fails(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.return_value = [_stale_row()]
+
+        with patch('ckan_zenodo.publish_task', side_effect=Exception("broker down")):
+            with pytest.raises(Exception):
+                reap_stale_transfers()
+
+        conn.rollback.assert_called_once()
+        conn.commit.assert_not_called()
+
+    def test_original_task_redelivered_after_a_reap_is_dropped(self, mock_configs, mock_db_connection):
+        # MySQL queue: the reaper re-publishes the task, and the dead owner's unacked
+        # upload_jobs row becomes visible again once its visibility_timeout runs out
+        conn, cursor = mock_db_connection
+        stale = _stale_row(transfer_id=9)
+        cursor.fetchall.return_value = [stale]
+        row = {'status': 'in_progress', 'worker_id': 'dead-host:1'}
+
+        def claim(transfer_id, owner, payload):
+            # claim_transfer()'s WHERE clause, on a stale owner
+            if row['status'] in ('completed', 'failed', 'cancelled'):
+                return False
+            row['worker_id'] = owner
+            return True
+
+        def set_status(transfer_id, status, *args, **kwargs):
+            row['status'] = status
+
+        with patch('ckan_zenodo.publish_task') as mock_publish:
+            reap_stale_transfers()
+        row.update(status=cursor.execute.call_args[0][1][0], worker_id=None)
+        republished = json.dumps(mock_publish.call_args[0][0]).encode()
+
+        with patch('worker.claim_transfer', side_effect=claim), \
+             patch('worker.release_transfer'), \
+             patch('worker._cancelled', return_value=False), \
+             patch('worker.update_transfer_status', side_effect=set_status), \
+             patch('worker.upload_to_zenodo', return_value='ok') as mock_upload:
+            for body in (republished, stale['task_payload'].encode()):
+                ch, method = _make_channel_and_method()
+                callback(ch, method, None, body)
+                ch.basic_ack.assert_called_once()
+
+        mock_upload.assert_called_once()
+        assert row['status'] == 'completed'
+
+
+class TestReleaseScheduledTransfers:
+    _night = datetime.datetime(2026, 1, 5, 22, 0)
+
+    def test_does_nothing_outside_window(self, mock_db_connection):
+        conn, cursor = mock_db_connection
+
+        assert release_scheduled_transfers(self._night.replace(hour=12)) == 0
+
+        cursor.execute.assert_not_called()
+
+    def test_releases_up_to_free_large_slots(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchone.return_value = {'active': 1}
+        cursor.fetchall.return_value = [{'id': 5, 'task_payload': json.dumps(_make_task(transfer_id=5))}]
+
+        with patch('ckan_zenodo.publish_task') as mock_publish:
+            assert release_scheduled_transfers(self._night) == 1
+
+        mock_publish.assert_called_once()
+        select_sql, select_params = cursor.execute.call_args_list[1][0]
+        assert 'LIMIT' in select_sql
+        assert select_params == (self._night, 1)
+        assert "status='pending'" in cursor.execute.call_args[0][0]
+        conn.commit.assert_called_once()
+
+    def test_followers_are_released_with_their_lead_and_not_counted(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchone.return_value = {'active': 0}
+        cursor.fetchall.return_value = [{'id': 5, 'task_payload': json.dumps(_make_task(transfer_id=5))}]
+
+        with patch('ckan_zenodo.publish_task'):
+            release_scheduled_transfers(self._night)
+
+        count_sql, select_sql = (c[0][0] for c in cursor.execute.call_args_list[:2])
+        assert 'tee_lead_id IS NULL' in count_sql and 'tee_lead_id IS NULL' in select_sql
+        sql, params = cursor.execute.call_args[0]
+        assert 'WHERE tee_lead_id=%s' in sql and params == (5,)
+
+    def test_cap_reached_releases_nothing(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchone.return_value = {'active': 2}
+
+        with patch('ckan_zenodo.publish_task') as mock_publish:
+            assert release_scheduled_transfers(self._night) == 0
+
+        mock_publish.assert_not_called()
+
+
+class TestRelayOutbox:
+    def _rows(self, *ids):
+        return [{'id': n, 'payload': json.dumps(_make_task(transfer_id=n))} for n in ids]
+
+    def test_publishes_batch_then_deletes_it(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.return_value = self._rows(1, 2)
+        channel = MagicMock()
+
+        assert relay_outbox(channel) == 2
+
+        assert channel.basic_publish.call_count == 2
+        assert channel.basic_publish.call_args[1]['mandatory'] is True
+        assert channel.basic_publish.call_args[1]['routing_key'] == 'zenodo_upload'
+        delete_sql, delete_params = cursor.execute.call_args[0]
+        assert delete_sql.startswith('DELETE FROM transfer_outbox')
+        assert delete_params == (1, 2)
+        conn.commit.assert_called_once()
+
+    def test_full_batch_is_followed_by_another(self, mock_configs, mock_db_connection):
+        conn, cursor = mock_db_connection
+        cursor.fetchall.side_effect = [self._rows(1, 2), []]
+        oc = {**mock_configs['outbox'], 'batch_size': 2}
+
+        with patch('configs.get_outbox_config', return_value=oc):
+            assert relay_outbox(MagicMock()) == 2
+
+        assert conn.commit.call_count == 2
+
+    def test_refused_publish_keeps_batch_in_outbox(self, mock_configs, mock_db_connection):
+        import pika
+        conn, cursor = mock_db_connection
+        cursor.fetchall.return_value = self._rows(1, 2)
+        channel = MagicMock()
+        channel.basic_publish.side_effect = [None, pika.exceptions.NackError([])]
+
+        with pytest.raises(pika.exceptions.NackError):
+            relay_outbox(channel)
+
+        assert not any('DELETE' in c[0][0] for c in cursor.execute.call_args_list)
+        conn.rollback.assert_called_once()
+        conn.commit.assert_not_called()
+
+
+def _package_task(**overrides):
+    task = {'type': 'package', 'job_id': 3, 'package_id': 'my-dataset', 'deposition_id': '99',
+            'username': 'alice', 'user_email': 'a@x.org', 'zenodo_token': 'tok'}
+    task.update(overrides)
+    return task
+
+
+def _resource(n):
+    return {'id': f'12345678-1234-1234-1234-12345678900{n}', 'name': f'f{n}.csv', 'url': f'http://x/f{n}'}
+
+
+class TestPackageJob:
+    def test_exports_every_resource_and_records_counts(self, mock_configs):
+        import ckan_zenodo
+        package = {'id': 'pkg-uuid', 'resources': [_resource(1), _resource(2), _resource(3)]}
+
+        with patch('ckan_zenodo.get_ckan_package', return_value=package), \
+             patch('ckan_zenodo.get_deposition_name', return_value='Dep') as mock_name, \
+             patch('ckan_zenodo.export_to_zenodo',
+                   side_effect=[None, ckan_zenodo.DuplicateTransfer("dup"),
+                                ckan_zenodo.ResourceFileNotFound("gone")]) as mock_export, \
+             patch('worker.update_package_job', return_value=1) as mock_update:
+            counts = run_package_job(_package_task())
+
+        assert counts == {'queued': 1, 'skipped': 1, 'failed': 1}
+        mock_name.assert_called_once_with('tok', '99')
+        kwargs = mock_export.call_args[1]
+        assert kwargs['package_id'] == 'pkg-uuid'
+        assert kwargs['user'] == {'username': 'alice', 'email': 'a@x.org'}
+        assert kwargs['deposition_name'] == 'Dep'
+        assert mock_update.call_args_list[0] == call(3, 'expanding', total=3, version_deposition_id=None)
+        final = mock_update.call_args
+        assert final[0] == (3, 'completed')
+        assert final[1]['message'] == 'File not found: f3.csv'
+
+    def test_stats_all_files_before_exporting(self, mock_configs):
+        package = {'id': 'pkg-uuid', 'resources': [_resource(1), _resource(2)]}
+        order = []
+
+        with patch('ckan_zenodo.get_ckan_package', return_value=package), \
+             patch('ckan_zenodo.get_deposition_name', return_value='Dep'), \
+             patch('ckan_zenodo.get_file_path', side_effect=lambda rid, url: f'/mnt/{url.rsplit("/", 1)[1]}'), \
+             patch('preflight.stat_many', side_effect=lambda paths: order.append(list(paths))), \
+             patch('ckan_zenodo.export_to_zenodo', side_effect=lambda *a, **kw: order.append(a[1])), \
+             patch('worker.update_package_job', return_value=1):
+            run_package_job(_package_task())
+
+        assert order[0] == ['/mnt/f1', '/mnt/f2']
+        assert len(order) == 3
+
+    def test_cancelled_job_stops_and_cancels_created_transfers(self, mock_configs):
+        package = {'id': 'pkg-uuid', 'resources': [_resource(1), _resource(2), _resource(3)]}
+        clock = iter([0, 20, 20]).__next__
+
+        with patch('ckan_zenodo.get_ckan_package', return_value=package), \
+             patch('ckan_zenodo.get_deposition_name', return_value='Dep'), \
+             patch('ckan_zenodo.export_to_zenodo') as mock_export, \
+             patch('ckan_zenodo.cancel_package_transfers') as mock_cancel, \
+             patch('worker.update_package_job', side_effect=[1, 0]):
+            counts = run_package_job(_package_task(), clock=clock)
+
+        assert counts['queued'] == 1
+        mock_export.assert_called_once()
+        mock_cancel.assert_called_once_with('pkg-uuid', 'alice')
+
+    def test_sync_exports_only_new_and_changed_resources(self, mock_configs):
+        import preflight
+        new, changed, unchanged, running = (dict(_resource(n), hash=f'md5:{n}') for n in range(1, 5))
+        changed['hash'] = 'md5:new'
+        package = {'id': 'pkg-uuid', 'resources': [new, changed, unchanged, running]}
+        baseline = {res['id']: {'status': status, 'file_size': 10, 'source_modified': None,
+                                'source_hash': f"md5:{res['id'][-1]}", 'updated_at': datetime.datetime(2024, 1, 1)}
+                    for res, status in ((changed, 'completed'), (unchanged, 'completed'), (running, 'pending'))}
+
+        with patch('ckan_zenodo.get_ckan_package', return_value=package), \
+             patch('ckan_zenodo.get_deposition_name', return_value='Dep'), \
+             patch('ckan_zenodo.get_file_path', side_effect=lambda rid, url: f'/mnt/{rid}'), \
+             patch('preflight.stat_many', side_effect=lambda paths: {p: preflight.FileStat(True, 10, 0.0)
+                                                                     for p in paths}), \
+             patch('ckan_zenodo.get_sync_baseline', return_value=baseline) as mock_baseline, \
+             patch('ckan_zenodo.export_to_zenodo') as mock_export, \
+             patch('worker.update_package_job', return_value=1):
+            counts = run_package_job(_package_task(mode='sync'))
+
+        assert counts == {'queued': 2, 'skipped': 2, 'failed': 0}
+        assert mock_baseline.call_args[0][0] == '99'
+        exported = {c[0][1]: c[1] for c in mock_export.call_args_list}
+        assert set(exported) == {new['id'], changed['id']}
+        assert exported[new['id']]['replace'] is False
+        assert exported[changed['id']]['replace'] is True
+        assert exported[changed['id']]['source_hash'] == 'md5:new'
+
+    def test_new_version_uploads_only_changed_files_and_deletes_removed(self, mock_configs):
+        import preflight
+        kept, changed, added = _resource(1), _resource(2), _resource(3)
+        package = {'id': 'pkg-uuid', 'resources': [kept, changed, added]}
+        draft = {'id': 8, 'metadata': {'title': 'Dep v2'},
+                 'files': [{'id': 'id1', 'filename': 'f1.csv', 'filesize': 10, 'checksum': 'same'},
+                           {'id': 'id2', 'filename': 'f2.csv', 'filesize': 10, 'checksum': 'old'},
+                           {'id': 'id9', 'filename': 'gone.csv', 'filesize': 5, 'checksum': 'x'}]}
+
+        with patch('ckan_zenodo.get_ckan_package', return_value=package), \
+             patch('ckan_zenodo.create_new_version', return_value=draft) as mock_version, \
+             patch('ckan_zenodo.get_file_path', side_effect=lambda rid, url: f'/mnt/{url.rsplit("/", 1)[1]}'), \
+             patch('preflight.stat_many', side_effect=lambda paths: {p: preflight.FileStat(True, 10, 0.0)
+                                                                     for p in paths}), \
+             patch('ckan_zenodo.file_md5', side_effect=lambda path: 'same' if path == '/mnt/f1' else 'new'), \
+             patch('ckan_zenodo.delete_deposition_file') as mock_delete, \
+             patch('ckan_zenodo.export_to_zenodo') as mock_export, \
+             patch('worker.update_package_job', return_value=1) as mock_update:
+            counts = run_package_job(_package_task(mode='newversion'))
+
+        mock_version.assert_called_once_with('tok', '99')
+        assert mock_update.call_args_list[0] == call(3, 'expanding', total=3, version_deposition_id='8')
+        mock_delete.assert_called_once_with('tok', '8', 'id9')
+        assert counts == {'queued': 2, 'skipped': 1, 'failed': 0}
+        assert [c[0][1] for c in mock_export.call_args_list] == [changed['id'], added['id']]
+        assert all(c[0][4] == '8' and c[1]['deposition_name'] == 'Dep v2' for c in mock_export.call_args_list)
+
+    def test_bundle_zips_small_files_and_exports_large_ones(self, mock_configs):
+        import preflight
+        import ckan_zenodo
+        small, other, large, missing = _resource(1), dict(_resource(2), name='f1.csv'), _resource(3), _resource(4)
+        package = {'id': 'pkg-uuid', 'name': 'my-dataset', 'resources': [small, other, large, missing]}
+        sizes = {'/mnt/f1': 10, '/mnt/f2': 20, '/mnt/f3': 2 * 1024 * 1024}
+
+        with patch('ckan_zenodo.get_ckan_package', return_value=package), \
+             patch('ckan_zenodo.get_deposition_name', return_value='Dep'), \
+             patch('ckan_zenodo.get_file_path', side_effect=lambda rid, url: f'/mnt/{url.rsplit("/", 1)[1]}'), \
+             patch('preflight.stat_many', side_effect=lambda paths: {
+                 p: preflight.FileStat(True, sizes[p], 0.0) if p in sizes else preflight.MISSING for p in paths}), \
+             patch('ckan_zenodo.create_bundle_transfer', return_value=20) as mock_bundle, \
+             patch('ckan_zenodo.export_to_zenodo',
+                   side_effect=[None, ckan_zenodo.ResourceFileNotFound("gone")]) as mock_export, \
+             patch('worker.update_package_job', return_value=1):
+            counts = run_package_job(_package_task(mode='bundle'))
+
+        assert counts == {'queued': 3, 'skipped': 0, 'failed': 1}
+        assert [c[0][1] for c in mock_export.call_args_list] == [large['id'], missing['id']]
+        args, kwargs = mock_bundle.call_args
+        assert args[:5] == ('alice', 'tok', '99', 'Dep', 'my-dataset.zip')
+        assert [(m['resource_id'], m['name'], m['path'], m['size']) for m in args[5]] == \
+            [(small['id'], 'f1.csv', '/mnt/f1', 10), (other['id'], 'f1 (2).csv', '/mnt/f2', 20)]
+        assert kwargs['package_id'] == 'pkg-uuid'
+
+    def test_empty_package_completes_with_message(self, mock_configs):
+        with patch('ckan_zenodo.get_ckan_package', return_value={'resources': []}), \
+             patch('ckan_zenodo.get_deposition_name') as mock_name, \
+             patch('worker.update_package_job', return_value=1) as mock_update:
+            run_package_job(_package_task())
+
+        mock_name.assert_not_called()
+        assert mock_update.call_args[1]['message'] == 'No resources found in this package.'
+
+    def test_callback_fails_job_when_package_cannot_be_read(self, mock_configs):
+        ch, method = _make_channel_and_method(delivery_tag=4)
+
+        with patch('ckan_zenodo.get_ckan_package', side_effect=Exception("CKAN down")), \
+             patch('worker.update_package_job') as mock_update, \
+             patch('worker.upload_to_zenodo') as mock_upload:
+            callback(ch, method, None, json.dumps(_package_task()).encode())
+
+        mock_upload.assert_not_called()
+        assert mock_update.call_args[0] == (3, 'failed')
+        ch.basic_ack.assert_called_once_with(delivery_tag=4)
+
+
+# ---------------------------------------------------------------------------
+# Circuit breaker
+# ---------------------------------------------------------------------------
+
+class TestCallbackCircuitBreaker:
+    def _breaker(self, allow=True, state='closed'):
+        breaker = MagicMock()
+        breaker.allow.return_value = allow
+        breaker.state.return_value = state
+        breaker.retry_after.return_value = 90
+        return breaker
+
+    def test_open_circuit_requeues_without_processing(self, mock_configs):
+        ch, method = _make_channel_and_method(delivery_tag=7)
+        body = json.dumps(_make_task(retry_count=1)).encode()
+
+        with patch('circuit_breaker.get_breaker', return_value=self._breaker(allow=False, state='open')), \
+             patch('worker.update_transfer_status') as mock_update, \
+             patch('worker.upload_to_zenodo') as mock_upload:
+
+            callback(ch, method, None, body)
+
+        mock_upload.assert_not_called()
+        mock_update.assert_not_called()
+        ch.basic_nack.assert_called_once_with(delivery_tag=7, requeue=True)
+        ch.basic_ack.assert_not_called()
+        ch.basic_cancel.assert_called_once_with(method.consumer_tag)
+        assert ch.connection.call_later.call_args[0][0] == 90
+
+    def test_open_circuit_releases_the_staged_copy(self, mock_configs):
+        import worker
+        ch, method = _make_channel_and_method()
+        task = _make_task()
+        stager = MagicMock()
+
+        with patch('circuit_breaker.get_breaker', return_value=self._breaker(allow=False, state='open')), \
+             patch.object(worker, '_stager', stager):
+            callback(ch, method, None, json.dumps(task).encode())
+
+        stager.discard.assert_called_once_with(task['file_path'])
+
+    def test_failure_that_opens_circuit_does_not_use_a_retry(self, mock_configs):
+        ch, method = _make_channel_and_method(delivery_tag=8)
+        body = json.dumps(_make_task(retry_count=1)).encode()
+        breaker = self._breaker(state='open')
+
+        with patch('circuit_breaker.get_breaker', return_value=breaker), \
+             patch('worker.update_transfer_status') as mock_update, \
+             patch('worker.upload_to_zenodo', side_effect=req_lib.exceptions.ConnectionError("reset")), \
+             patch('time.sleep') as mock_sleep:
+
+            callback(ch, method, None, body)
+
+        breaker.record.assert_called_once()
+        assert breaker.record.call_args[0][0] is False
+        mock_sleep.assert_not_called()
+        ch.basic_publish.assert_not_called()
+        ch.basic_nack.assert_called_once_with(delivery_tag=8, requeue=True)
+        ch.basic_ack.assert_not_called()
+        mock_update.assert_called_with(1, 'pending', mock_update.call_args[0][2], 1, error_class='transient')
+
+    def test_client_error_is_not_counted_against_zenodo(self, mock_configs):
+        ch, method = _make_channel_and_method()
+        body = json.dumps(_make_task(retry_count=3)).encode()
+        breaker = self._breaker()
+
+        with patch('circuit_breaker.get_breaker', return_value=breaker), \
+             patch('worker.update_transfer_status'), \
+             patch('worker.upload_to_zenodo', side_effect=FileNotFoundError("/path/to/file.csv")):
+
+            callback(ch, method, None, body)
+
+        breaker.record.assert_not_called()
+        breaker.abandon_probe.assert_called_once()
+        ch.basic_ack.assert_called_once()
+
+    def test_success_is_recorded(self, mock_configs):
+        ch, method = _make_channel_and_method()
+        body = json.dumps(_make_task()).encode()
+        breaker = self._breaker()
+
+        with patch('circuit_breaker.get_breaker', return_value=breaker), \
+             patch('worker.update_transfer_status'), \
+             patch('worker.upload_to_zenodo', return_value='ok'):
+
+            callback(ch, method, None, body)
+
+        assert breaker.record.call_args[0][0] is True
+
+
+# ---------------------------------------------------------------------------
+# Retry policy in the callback
+# ---------------------------------------------------------------------------
+
+def _http_error(status, headers=None):
+    response = MagicMock()
+    response.status_code = status
+    response.headers = headers or {}
+    return req_lib.exceptions.HTTPError(f"HTTP {status}", response=response)
+
+
+class TestCallbackRetryPolicy:
+    def test_permanent_error_fails_without_retry(self, mock_configs):
+        ch, method = _make_channel_and_method()
+        body = json.dumps(_make_task(retry_count=0)).encode()
+
+        with patch('worker.update_transfer_status') as mock_update, \
+             patch('worker.upload_to_zenodo', side_effect=_http_error(403)), \
+             patch('time.sleep') as mock_sleep:
+
+            callback(ch, method, None, body)
+
+        mock_sleep.assert_not_called()
+        ch.basic_publish.assert_not_called()
+        assert mock_update.call_args[0][1] == 'failed'
+        assert mock_update.call_args[1]['error_class'] == 'permanent'
+        ch.basic_ack.assert_called_once()
+
+    def test_throttled_error_waits_for_retry_after(self, mock_configs):
+        ch, method = _make_channel_and_method()
+        body = json.dumps(_make_task(retry_count=0)).encode()
+
+        with patch('worker.update_transfer_status') as mock_update, \
+             patch('worker.upload_to_zenodo', side_effect=_http_error(429, {'Retry-After': '42'})), \
+             patch('time.sleep') as mock_sleep:
+
+            callback(ch, method, None, body)
+
+        mock_sleep.assert_called_once_with(42)
+        ch.basic_publish.assert_called_once()
+        assert mock_update.call_args[1]['error_class'] == 'throttled'
+
+
+# ---------------------------------------------------------------------------
+# Consumer control and upload slots
+# ---------------------------------------------------------------------------
+
+class TestConsumerControl:
+    def test_thread_safe_channel_defers_calls_to_connection_thread(self):
+        from worker import ThreadSafeChannel
+        channel = MagicMock()
+        proxy = ThreadSafeChannel(channel)
+
+        proxy.basic_ack(delivery_tag=3)
+
+        channel.basic_ack.assert_not_called()
+        scheduled = channel.connection.add_callback_threadsafe.call_args[0][0]
+        scheduled()
+        channel.basic_ack.assert_called_once_with(delivery_tag=3)
+
+    def test_deliveries_are_buffered_per_user(self):
+        import worker
+        from scheduler import FairScheduler
+        sched = FairScheduler()
+        method = MagicMock()
+
+        with patch.object(worker, '_scheduler', sched):
+            worker._on_message(MagicMock(), method, None, json.dumps(_make_task(username='alice')).encode())
+
+        assert sched.pending() == {'alice': 1}
+
+    def test_small_file_delivery_is_submitted_as_small(self, mock_configs):
+        import worker
+        from scheduler import FairScheduler
+        sched = FairScheduler()
+        sc = {**mock_configs['scheduler'], 'small_file_mb': 10}
+        body = json.dumps(_make_task(username='alice', file_size=1024)).encode()
+
+        with patch.object(worker, '_scheduler', sched), \
+             patch('configs.get_scheduler_config', return_value=sc):
+            worker._on_message(MagicMock(), MagicMock(), None, body)
+
+        assert sched.next(timeout=0, small_only=True)[0] == 'alice'
+
+    def test_upload_slot_runs_callback_and_frees_user(self):
+        import worker
+        from scheduler import FairScheduler
+        sched = FairScheduler(max_uploads_per_user=1)
+        ch, method = _make_channel_and_method()
+        sched.submit('alice', (method, None, b'{}'))
+        sched.submit('alice', (method, None, b'{}'))
+
+        calls = []
+
+        def fake_callback(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                sched.close()
+
+        with patch.object(worker, '_scheduler', sched), \
+             patch('worker.callback', side_effect=fake_callback):
+            worker.run_upload_slot(ch)
+
+        assert len(calls) == 2
+
+    def test_buffered_files_are_prefetched_to_scratch(self):
+        import worker
+        from scheduler import FairScheduler
+        sched = FairScheduler()
+        stager = MagicMock(prefetch_files=2)
+        body = json.dumps(_make_task(file_path='/mnt/vol/a.csv')).encode()
+
+        with patch.object(worker, '_scheduler', sched), patch.object(worker, '_stager', stager):
+            worker._on_message(MagicMock(), MagicMock(), None, body)
+
+        stager.prefetch.assert_called_once_with('/mnt/vol/a.csv')
+
+    def test_pause_is_not_repeated_for_a_paused_consumer(self):
+        from worker import pause_consuming
+        ch = MagicMock()
+
+        pause_consuming(ch, 'tag-1', 30)
+        pause_consuming(ch, 'tag-1', 30)
+
+        ch.basic_cancel.assert_called_once_with('tag-1')
@@ -0,0 +1,440 @@
+"""
+Streaming request bodies for file uploads to Zenodo.
+
+FileBody is handed to requests as ``data=``: it has a length (so requests sends
+a Content-Length header instead of chunked encoding) and is iterated block by
+block, which lets the upload be observed while it is being sent.
+
+Blocks are read with unbuffered reads of block_size bytes (several MiB for
+large uploads, rather than the small chunks a plain file object yields). Where
+the OS supports posix_fadvise the kernel is told the file is read sequentially,
+so it reads ahead, and each block is dropped from the page cache once sent, so
+a multi-GB upload does not evict everything else cached on the host.
+
+TeeBody reads a file once and serves it to several uploads running at the
+same time (one resource exported to several depositions). Each upload gets a
+TeeBranch, a body like FileBody, fed from its own queue of at most
+buffer_blocks blocks: the reader waits for the slowest branch, so memory stays
+bounded by branches x buffer_blocks x block_size whatever the file size. A
+branch whose upload fails is closed and no longer fed; the others go on.
+
+ZipBody streams a ZIP archive of many local files as a single upload (bundle
+exports of packages with thousands of small files), built on the fly: each
+member is read once, in blocks, and written uncompressed (ZIP_STORED) with its
+CRC-32 in a data descriptor after the data, so nothing is staged: memory
+stays at about two blocks plus the central directory (some 100 bytes per
+member), which can only be written at the end. Because the members' sizes are known beforehand the
+archive's exact length is too (zip_size()), and it is sent with a
+Content-Length like FileBody. ZIP64 records are used only where a size or an
+offset needs them. A member whose size changes before it is read aborts the
+upload, since the archive would no longer match its length.
+
+An exception raised from inside the body iterator reaches the caller wrapped in
+requests.exceptions.ConnectionError, so the body keeps the original error in
+``abort_error`` and callers re-raise that (see worker.upload_to_zenodo).
+"""
+import os
+import time
+import zlib
+import queue
+import struct
+import logging
+import threading
+import requests
+
+
+class UploadStalled(requests.exceptions.Timeout):
+    """Raised when an upload's throughput stays below the configured floor for too long."""
+    pass
+
+
+class ThroughputWatchdog:
+    """
+    Abort an upload that is alive but crawling.
+
+    Throughput is measured over consecutive windows of ``window`` seconds; if the
+    bytes sent during a complete window average less than ``min_bytes_per_sec``,
+    update() raises UploadStalled. A dead connection is caught by the socket
+    timeouts instead — the watchdog is only consulted when a block was sent.
+    """
+
+    def __init__(self, min_bytes_per_sec, window, clock=time.monotonic):
+        self.min_bytes_per_sec = min_bytes_per_sec
+        self.window = window
+        self._clock = clock
+        self._window_start = clock()
+        self._window_bytes = 0
+
+    def update(self, total_bytes):
+        now = self._clock()
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+        rate = (total_bytes - self._window_bytes) / elapsed
+        if rate < self.min_bytes_per_sec:
+            raise UploadStalled(
+                f"Upload stalled: {rate / 1024:.1f} KB/s over the last {elapsed:.0f}s "
+                f"(minimum {self.min_bytes_per_sec / 1024:.0f} KB/s)"
+            )
+        self._window_start = now
+        self._window_bytes = total_bytes
+
+
+class ProgressLog:
+    """FileBody progress callback that logs bytes sent and throughput every interval seconds."""
+
+    def __init__(self, name, interval=30, clock=time.monotonic):
+        self.name = name
+        self.interval = interval
+        self._clock = clock
+        self._started = clock()
+        self._logged = self._started
+
+    def __call__(self, bytes_sent, size):
+        now = self._clock()
+        if now - self._logged < self.interval and bytes_sent < size:
+            return
+        self._logged = now
+        rate = bytes_sent / max(now - self._started, 1e-6)
+        logging.info(f"Uploading {self.name}: {bytes_sent / 2**20:.0f}/{size / 2**20:.0f} MiB "
+                     f"({bytes_sent * 100 // max(size, 1)}%) at {rate / 2**20:.1f} MiB/s")
+
+
+def _fadvise(fd, offset, length, advice):
+    """posix_fadvise where available; the hint is best-effort and never fails the upload."""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+
+class FileBody:
+    """
+    Iterable, sized request body that reads a local file in blocks.
+
+    progress, if given, is called as progress(bytes_sent, size) after every block;
+    like the watchdog, it may raise to abort the upload.
+    """
+
+    def __init__(self, file_path, block_size=64 * 1024, watchdog=None, progress=None, drop_cache=True):
+        self.file_path = file_path
+        self.block_size = block_size
+        self.watchdog = watchdog
+        self.progress = progress
+        self.drop_cache = drop_cache
+        self.size = os.path.getsize(file_path)
+        self.bytes_sent = 0
+        self.abort_error = None
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        with open(self.file_path, 'rb', buffering=0) as fp:
+            if self.drop_cache:
+                _fadvise(fp.fileno(), 0, 0, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+            while True:
+                block = _read_block(fp, self.block_size)
+                if not block:
+                    break
+                yield block
+                # Runs once the previous block has been handed to the socket
+                if self.drop_cache:
+                    _fadvise(fp.fileno(), self.bytes_sent, len(block), getattr(os, 'POSIX_FADV_DONTNEED', 0))
+                self.bytes_sent += len(block)
+                try:
+                    if self.watchdog:
+                        self.watchdog.update(self.bytes_sent)
+                    if self.progress:
+                        self.progress(self.bytes_sent, self.size)
+                except Exception as e:
+                    self.abort_error = e
+                    raise
+
+
+def _read_block(fp, block_size):
+    # An unbuffered read may return less than asked for; top the block up
+    block = fp.read(block_size)
+    while block and len(block) < block_size:
+        more = fp.read(block_size - len(block))
+        if not more:
+            break
+        block += more
+    return block
+
+
+_EOF = object()
+
+
+class _ReadFailed:
+    def __init__(self, error):
+        self.error = error
+
+
+class TeeBranch:
+    """
+    One upload's view of a TeeBody: an iterable, sized request body like FileBody.
+    close() it once its upload has ended, however it ended, so the reader stops
+    waiting for it.
+    """
+
+    def __init__(self, tee, buffer_blocks, watchdog=None, progress=None):
+        self.tee = tee
+        self.size = tee.size
+        self.watchdog = watchdog
+        self.progress = progress
+        self.bytes_sent = 0
+        self.abort_error = None
+        self.closed = threading.Event()
+        self._queue = queue.Queue(maxsize=max(buffer_blocks, 1))
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        self.tee.start()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _EOF:
+                    return
+                if isinstance(item, _ReadFailed):
+                    self.abort_error = item.error
+                    raise item.error
+                yield item
+                self.bytes_sent += len(item)
+                try:
+                    if self.watchdog:
+                        self.watchdog.update(self.bytes_sent)
+                    if self.progress:
+                        self.progress(self.bytes_sent, self.size)
+                except Exception as e:
+                    self.abort_error = e
+                    raise
+        finally:
+            self.close()
+
+    def _put(self, item):
+        # Wait for room, unless the upload has ended meanwhile
+        while not self.closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        self.closed.set()
+        # Free a reader blocked on this queue
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+
+class TeeBody:
+    """
+    Reads a file once, in a thread started by the first branch to be iterated,
+    and hands every block to each open branch.
+    """
+
+    def __init__(self, file_path, block_size=64 * 1024, buffer_blocks=4, drop_cache=True):
+        self.file_path = file_path
+        self.block_size = block_size
+        self.buffer_blocks = buffer_blocks
+        self.drop_cache = drop_cache
+        self.size = os.path.getsize(file_path)
+        self.branches = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def branch(self, watchdog=None, progress=None):
+        """Add a branch; all branches must be added before any is iterated."""
+        branch = TeeBranch(self, self.buffer_blocks, watchdog=watchdog, progress=progress)
+        self.branches.append(branch)
+        return branch
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._read, name='tee-reader', daemon=True)
+                self._thread.start()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def _read(self):
+        try:
+            with open(self.file_path, 'rb', buffering=0) as fp:
+                if self.drop_cache:
+                    _fadvise(fp.fileno(), 0, 0, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+                offset = 0
+                while any(not b.closed.is_set() for b in self.branches):
+                    block = _read_block(fp, self.block_size)
+                    if not block:
+                        break
+                    for branch in self.branches:
+                        branch._put(block)
+                    # Every branch holds its own reference now
+                    if self.drop_cache:
+                        _fadvise(fp.fileno(), offset, len(block), getattr(os, 'POSIX_FADV_DONTNEED', 0))
+                    offset += len(block)
+            item = _EOF
+        except Exception as e:
+            logging.error(f"Reading {self.file_path} for a multi-target upload failed: {e}")
+            item = _ReadFailed(e)
+        for branch in self.branches:
+            branch._put(item)
+
+
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP_FLAGS = 0x0808  # sizes and CRC in a data descriptor; UTF-8 names
+
+
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (0 << 9) | (1 << 5) | 1
+    year = min(t.tm_year, 2107) - 1980
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), (year << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def _local_header(name, size, mtime):
+    zip64 = size >= _ZIP64_LIMIT
+    extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+    sizes = _ZIP64_LIMIT if zip64 else 0
+    dos_time, dos_date = _dos_datetime(mtime)
+    return struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, _ZIP_FLAGS, 0, dos_time, dos_date,
+                       0, sizes, sizes, len(name), len(extra)) + name + extra
+
+
+def _data_descriptor(crc, size):
+    if size >= _ZIP64_LIMIT:
+        return struct.pack('<IIQQ', 0x08074b50, crc, size, size)
+    return struct.pack('<IIII', 0x08074b50, crc, size, size)
+
+
+def _central_entry(name, size, mtime, crc, offset):
+    values = []
+    if size >= _ZIP64_LIMIT:
+        values += [size, size]
+    if offset >= _ZIP64_LIMIT:
+        values.append(offset)
+    extra = struct.pack(f'<HH{len(values)}Q', 1, 8 * len(values), *values) if values else b''
+    version = 45 if values else 20
+    dos_time, dos_date = _dos_datetime(mtime)
+    return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, _ZIP_FLAGS, 0,
+                       dos_time, dos_date, crc, min(size, _ZIP64_LIMIT), min(size, _ZIP64_LIMIT),
+                       len(name), len(extra), 0, 0, 0, 0o100644 << 16, min(offset, _ZIP64_LIMIT)) + name + extra
+
+
+def _end_records(count, directory_offset, directory_size):
+    records = b''
+    if count >= 0xFFFF or directory_offset >= _ZIP64_LIMIT or directory_size >= _ZIP64_LIMIT:
+        end64_offset = directory_offset + directory_size
+        records = struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count,
+                              directory_size, directory_offset)
+        records += struct.pack('<IIQI', 0x07064b50, 0, end64_offset, 1)
+    return records + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                 min(directory_size, _ZIP64_LIMIT), min(directory_offset, _ZIP64_LIMIT), 0)
+
+
+def zip_size(members):
+    """Exact length in bytes of the ZipBody of members, given as (name, size) pairs."""
+    offset = directory_size = count = 0
+    for name, size in members:
+        encoded = name.encode('utf-8')
+        local = len(_local_header(encoded, size, 0)) + size + len(_data_descriptor(0, size))
+        directory_size += len(_central_entry(encoded, size, 0, 0, offset))
+        offset += local
+        count += 1
+    return offset + directory_size + len(_end_records(count, offset, directory_size))
+
+
+class ZipBody:
+    """
+    Iterable, sized request body that streams a ZIP archive of local files.
+
+    members are (name in the archive, file path) pairs; the files are statted
+    here. While the body is iterated, manifest gets one dict per member written
+    (name, size, crc32 and its offset in the archive). progress and watchdog
+    work as for FileBody.
+    """
+
+    def __init__(self, members, block_size=64 * 1024, watchdog=None, progress=None, drop_cache=True):
+        self.block_size = block_size
+        self.watchdog = watchdog
+        self.progress = progress
+        self.drop_cache = drop_cache
+        self.members = []
+        for name, file_path in members:
+            st = os.stat(file_path)
+            self.members.append((name, file_path, st.st_size, st.st_mtime))
+        self.size = zip_size((name, size) for name, _, size, _ in self.members)
+        self.bytes_sent = 0
+        self.abort_error = None
+        self.manifest = []
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        out = bytearray()
+        offset = 0
+        directory = bytearray()
+        try:
+            for name, file_path, size, mtime in self.members:
+                encoded = name.encode('utf-8')
+                out += _local_header(encoded, size, mtime)
+                crc = 0
+                for block in self._read_member(file_path, size):
+                    crc = zlib.crc32(block, crc)
+                    out += block
+                    if len(out) >= self.block_size:
+                        yield bytes(out)
+                        self._sent(len(out))
+                        out.clear()
+                out += _data_descriptor(crc, size)
+                directory += _central_entry(encoded, size, mtime, crc, offset)
+                self.manifest.append({'name': name, 'size': size, 'crc32': f'{crc:08x}', 'offset': offset})
+                offset += len(_local_header(encoded, size, mtime)) + size + len(_data_descriptor(crc, size))
+        except Exception as e:
+            self.abort_error = e
+            raise
+        out += directory
+        out += _end_records(len(self.members), offset, len(directory))
+        # The central directory is the only part held whole: about 100 bytes per member
+        for start in range(0, len(out), self.block_size):
+            block = bytes(out[start:start + self.block_size])
+            yield block
+            self._sent(len(block))
+
+    def _read_member(self, file_path, size):
+        with open(file_path, 'rb', buffering=0) as fp:
+            if os.fstat(fp.fileno()).st_size != size:
+                raise ValueError(f"{file_path} changed size while it was being bundled")
+            if self.drop_cache:
+                _fadvise(fp.fileno(), 0, 0, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+            remaining = size
+            while remaining:
+                block = _read_block(fp, min(self.block_size, remaining))
+                if not block:
+                    raise ValueError(f"{file_path} was truncated while it was being bundled")
+                remaining -= len(block)
+                yield block
+            if self.drop_cache:
+                _fadvise(fp.fileno(), 0, 0, getattr(os, 'POSIX_FADV_DONTNEED', 0))
+
+    def _sent(self, length):
+        self.bytes_sent += length
+        try:
+            if self.watchdog:
+                self.watchdog.update(self.bytes_sent)
+            if self.progress:
+                self.progress(self.bytes_sent, self.size)
+        except Exception as e:
+            self.abort_error = e
+            raise
@@ -1,12 +1,29 @@
+import os
 import time
+import datetime
+import socket
 import logging
+import argparse
+import threading
+import contextlib
 import smtplib
 from email.mime.text import MIMEText
 import pika
 import json
+import pymysql
 import requests
 import configs
 import db
+import ckan_zenodo
+import circuit_breaker
+import retry_policy
+import rate_limiter
+import scheduler
+import offpeak
+import staging
+import queue_backend
+import preflight
+from upload_stream import FileBody, TeeBody, ZipBody, ThroughputWatchdog, ProgressLog
 
 
 # --- Send email notification (no-op when SMTP disabled or no address) ---
@@ -31,26 +48,728 @@ def send_email_notification(to_addr, subject, body):
 
 
 # --- Update transfer status in the database ---
-def update_transfer_status(transfer_id, status, response, retry_count=None):
+# A transfer sent back to 'pending' restarts its upload, as after reset_transfer_for_retry()
+RESET_PROGRESS = "bytes_sent=NULL, bytes_per_sec=NULL, avg_bytes_per_sec=NULL, progress_at=NULL"
+
+
+def update_transfer_status(transfer_id, status, response, retry_count=None, error_class=None):
     """
-    Update the status, response, and optionally retry_count of a transfer record.
+    Update the status, response, and optionally retry_count and error_class of a transfer record.
+    A cancelled transfer keeps its status unless the upload went on to complete.
+    Completing a transfer clears the error_class of any earlier failed attempt;
+    setting it back to 'pending' clears the progress of the attempt that stopped.
     """
+    fields, params = ["status=%s", "zenodo_response=%s"], [status, response]
+    if retry_count is not None:
+        fields.append("retry_count=%s")
+        params.append(retry_count)
+    if error_class is not None:
+        fields.append("error_class=%s")
+        params.append(error_class)
+    elif status == 'completed':
+        fields.append("error_class=NULL")
+    if status == 'pending':
+        fields.append(RESET_PROGRESS)
+    params.append(transfer_id)
+
     connection = db.get_connection()
     try:
         with connection.cursor() as cursor:
-            if retry_count is not None:
-                sql = "UPDATE zenodo_transfers SET status=%s, zenodo_response=%s, retry_count=%s WHERE id=%s"
-                cursor.execute(sql, (status, response, retry_count, transfer_id))
-            else:
-                sql = "UPDATE zenodo_transfers SET status=%s, zenodo_response=%s WHERE id=%s"
-                cursor.execute(sql, (status, response, transfer_id))
+            where = "id=%s" if status == 'completed' else "id=%s AND status <> 'cancelled'"
+            sql = f"UPDATE zenodo_transfers SET {', '.join(fields)} WHERE {where}"
+            cursor.execute(sql, tuple(params))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def update_targets_status(task, *args, **kwargs):
+    """update_transfer_status() for every transfer a task uploads (all targets of a multi-target task)."""
+    for target in task.get('targets') or [task]:
+        update_transfer_status(target['transfer_id'], *args, **kwargs)
+
+
+def worker_id():
+    """Identify this worker process in heartbeats as host:pid."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# --- Worker heartbeats on in-flight transfers ---
+class TransferOwned(Exception):
+    """Raised when a transfer is finished or being uploaded by a worker whose heartbeat is fresh."""
+    pass
+
+
+def claim_transfer(transfer_id, owner, task_payload):
+    """
+    Stamp an in-flight transfer with its owning worker, a fresh heartbeat and the
+    raw task message, which is what the reaper re-publishes if the owner dies.
+    The claim only succeeds if the transfer is not completed, failed or cancelled
+    and no other worker owns it (or its owner's heartbeat is older than
+    heartbeat_timeout). Returns whether it succeeded. A task that loses the claim
+    is a duplicate: e.g. the reaper re-published it, and then the dead owner's
+    unacknowledged message was delivered again as well.
+    """
+    timeout = configs.get_worker_config()['heartbeat_timeout']
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            sql = ("UPDATE zenodo_transfers SET worker_id=%s, heartbeat_at=NOW(), task_payload=%s "
+                   "WHERE id=%s AND status NOT IN ('completed', 'failed', 'cancelled') "
+                   "AND (worker_id IS NULL OR heartbeat_at IS NULL "
+                   "OR heartbeat_at < NOW() - INTERVAL %s SECOND)")
+            rows = cursor.execute(sql, (owner, task_payload, transfer_id, timeout))
+        connection.commit()
+        return bool(rows)
+    finally:
+        connection.close()
+
+
+def touch_heartbeat(transfer_id, owner):
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            sql = ("UPDATE zenodo_transfers SET heartbeat_at=NOW() "
+                   "WHERE id=%s AND worker_id=%s AND status='in_progress'")
+            cursor.execute(sql, (transfer_id, owner))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def release_transfer(transfer_id, owner):
+    """Clear ownership, heartbeat and the stored task (which contains the API token)."""
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            sql = ("UPDATE zenodo_transfers SET worker_id=NULL, heartbeat_at=NULL, task_payload=NULL "
+                   "WHERE id=%s AND worker_id=%s")
+            cursor.execute(sql, (transfer_id, owner))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+class Heartbeat:
+    """
+    Context manager that owns a transfer for the duration of an upload: claims it
+    on entry, refreshes heartbeat_at every heartbeat_interval seconds from a
+    daemon thread, and releases it on exit. If another live worker owns the
+    transfer, or it is already finished, entering raises TransferOwned. Heartbeat errors are only logged —
+    they must never fail the upload itself (a claim that errors counts as won).
+    """
+
+    def __init__(self, transfer_id, task_payload):
+        self.transfer_id = transfer_id
+        self.task_payload = task_payload
+        self.interval = configs.get_worker_config()['heartbeat_interval']
+        self.owner = worker_id()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        try:
+            claimed = claim_transfer(self.transfer_id, self.owner, self.task_payload)
+        except Exception as e:
+            logging.error(f"Could not claim transfer {self.transfer_id}: {e}")
+            claimed = True
+        if not claimed:
+            raise TransferOwned(f"Transfer {self.transfer_id} is being uploaded by another worker")
+        self._thread = threading.Thread(target=self._run, name=f'heartbeat-{self.transfer_id}', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                touch_heartbeat(self.transfer_id, self.owner)
+            except Exception as e:
+                logging.warning(f"Heartbeat failed for transfer {self.transfer_id}: {e}")
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        try:
+            release_transfer(self.transfer_id, self.owner)
+        except Exception as e:
+            logging.error(f"Could not release transfer {self.transfer_id}: {e}")
+        return False
+
+
+# --- Bundle transfers: the files of one ZIP archive upload ---
+def load_bundle_members(transfer_id):
+    """The members listed in a bundle transfer's bundle_manifest."""
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT bundle_manifest FROM zenodo_transfers WHERE id=%s", (transfer_id,))
+            row = cursor.fetchone()
+    finally:
+        connection.close()
+    if not row or not row[0]:
+        raise ValueError(f"Transfer {transfer_id} has no bundle manifest")
+    return json.loads(row[0])
+
+
+def record_bundle_manifest(transfer_id, members, manifest):
+    """Write the uploaded archive's manifest (size, crc32 and offset of each member) into the transfer."""
+    merged = [{**member, **entry} for member, entry in zip(members, manifest)]
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE zenodo_transfers SET bundle_manifest=%s WHERE id=%s",
+                           (json.dumps(merged), transfer_id))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+# --- Upload progress on in-flight transfers ---
+def record_progress(transfer_id, bytes_sent, file_size, bytes_per_sec, average=None):
+    """Write a progress update; average (bytes/s over the whole upload) is given with the last block."""
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            sql = ("UPDATE zenodo_transfers SET bytes_sent=%s, file_size=%s, bytes_per_sec=%s, "
+                   "avg_bytes_per_sec=COALESCE(%s, avg_bytes_per_sec), progress_at=NOW() WHERE id=%s")
+            cursor.execute(sql, (bytes_sent, file_size, bytes_per_sec, average, transfer_id))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def _cancelled(transfer_id):
+    """True if the user cancelled the transfer; a failed check counts as not cancelled."""
+    try:
+        return ckan_zenodo.is_cancelled(transfer_id)
+    except Exception as e:
+        logging.warning(f"Could not check whether transfer {transfer_id} was cancelled: {e}")
+        return False
+
+
+class ProgressRecorder:
+    """
+    FileBody progress callback that writes bytes sent and current throughput to the
+    transfer row — on the first block, then at most every progress_interval seconds
+    or progress_percent of the file, and on the last block. Throughput is measured
+    since the previous write; the last block also records the average over the
+    whole upload (avg_bytes_per_sec, which the planner projects from). Database
+    errors are only logged.
+
+    Every cancel_check_interval seconds it also checks whether the transfer was
+    cancelled and, if so, raises TransferCancelled, which aborts the PUT. Once
+    the last block is sent the upload is left to finish.
+    """
+
+    def __init__(self, transfer_id, filename, clock=time.monotonic):
+        wc = configs.get_worker_config()
+        self.transfer_id = transfer_id
+        self.interval = wc['progress_interval']
+        self.step = wc['progress_percent'] / 100
+        self.cancel_check_interval = wc['cancel_check_interval']
+        self._clock = clock
+        self._log = ProgressLog(filename, clock=clock)
+        self._started = clock()
+        self._written = None
+        self._checked = None
+
+    def __call__(self, bytes_sent, size):
+        now = self._clock()
+        if bytes_sent < size and (self._checked is None or now - self._checked >= self.cancel_check_interval):
+            self._checked = now
+            if _cancelled(self.transfer_id):
+                raise ckan_zenodo.TransferCancelled(f"Transfer {self.transfer_id} was cancelled")
+        self._log(bytes_sent, size)
+        if self._written is not None and bytes_sent < size:
+            written_at, written_bytes = self._written
+            if now - written_at < self.interval and bytes_sent - written_bytes < self.step * size:
+                return
+        since, since_bytes = self._written or (self._started, 0)
+        rate = (bytes_sent - since_bytes) / max(now - since, 1e-6)
+        average = round(bytes_sent / max(now - self._started, 1e-6), 1) if bytes_sent >= size else None
+        self._written = (now, bytes_sent)
+        try:
+            record_progress(self.transfer_id, bytes_sent, size, round(rate, 1), average=average)
+        except Exception as e:
+            logging.warning(f"Could not record progress of transfer {self.transfer_id}: {e}")
+
+
+def _requeue(ch, task):
+    """
+    Send a retried task back: a large file (offpeak.is_large()) waits for the next
+    off-peak window as when it was exported; anything else goes to its lane.
+    """
+    if offpeak.is_large(task.get('file_size')):
+        try:
+            not_before = ckan_zenodo.schedule_task(task)
+            logging.info(f"Retry of transfer {task['transfer_id']} scheduled for {not_before}")
+            return
+        except Exception as e:
+            logging.error(f"Could not schedule the retry of transfer {task['transfer_id']}; queueing it: {e}")
+    ch.basic_publish(
+        exchange='',
+        routing_key=scheduler.lane_queue(task['username'], task.get('file_size')),
+        body=json.dumps(task),
+        properties=pika.BasicProperties(delivery_mode=2),
+    )
+
+
+# --- Re-enqueue transfers whose worker stopped heart-beating ---
+def reap_stale_transfers():
+    """
+    Find 'in_progress' transfers whose heartbeat is older than heartbeat_timeout and
+    re-publish their stored task, reap_batch_size rows per transaction; a large
+    file's task is scheduled for the next off-peak window instead. Each reap
+    counts as an attempt: once max_retries is exceeded the transfer is marked failed.
+    Only the lead of a multi-target task is claimed and heart-beaten, so its other
+    targets still in progress get the same status. Rows are locked with SKIP LOCKED
+    so several reapers can run side by side. Returns the number of transfers handled.
+    """
+    wc = configs.get_worker_config()
+    rc = configs.get_rabbitmq_config()
+    max_retries = int(rc.get('max_retries', 3))
+    total = 0
+
+    while True:
+        connection = db.get_connection()
+        try:
+            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                sql = """SELECT id, worker_id, retry_count, task_payload FROM zenodo_transfers
+                         WHERE status = 'in_progress' AND task_payload IS NOT NULL
+                           AND heartbeat_at < NOW() - INTERVAL %s SECOND
+                         ORDER BY heartbeat_at
+                         LIMIT %s
+                         FOR UPDATE SKIP LOCKED"""
+                cursor.execute(sql, (wc['heartbeat_timeout'], wc['reap_batch_size']))
+                rows = cursor.fetchall()
+
+                for row in rows:
+                    task = json.loads(row['task_payload'])
+                    next_attempt = row['retry_count'] + 1
+                    if next_attempt > max_retries:
+                        status, message = 'failed', (f"Worker {row['worker_id']} stopped responding; "
+                                                     f"all {max_retries + 1} attempts used")
+                    else:
+                        status, message = 'pending', (f"Re-queued: worker {row['worker_id']} "
+                                                      f"stopped responding")
+                        task['retry_count'] = next_attempt
+                    large = status == 'pending' and offpeak.is_large(task.get('file_size'))
+                    if status == 'pending' and not large:
+                        ckan_zenodo.publish_task(task)
+                    progress = f", {RESET_PROGRESS}" if status == 'pending' else ""
+                    cursor.execute(
+                        f"""UPDATE zenodo_transfers
+                            SET status=%s, zenodo_response=%s, retry_count=%s,
+                                worker_id=NULL, heartbeat_at=NULL, task_payload=NULL{progress}
+                            WHERE id=%s""",
+                        (status, message, min(next_attempt, max_retries), row['id']),
+                    )
+                    followers = [target['transfer_id'] for target in task.get('targets', [])
+                                 if target['transfer_id'] != row['id']]
+                    if followers:
+                        cursor.execute(
+                            f"""UPDATE zenodo_transfers SET status=%s, zenodo_response=%s, retry_count=%s{progress}
+                                WHERE id IN ({', '.join(['%s'] * len(followers))}) AND status = 'in_progress'""",
+                            (status, message, min(next_attempt, max_retries), *followers),
+                        )
+                    if large:
+                        not_before = ckan_zenodo.schedule_task(task, cursor)
+                        logging.info(f"Large transfer {row['id']} re-scheduled for {not_before}")
+                    logging.warning(f"Reaped transfer {row['id']} from {row['worker_id']}: {status}")
+                    if status == 'failed':
+                        send_email_notification(
+                            task.get('user_email', ''),
+                            f"Transfer failed: {task['filename']}",
+                            f"Your file '{task['filename']}' failed to upload to Zenodo after all retry "
+                            f"attempts. Error: {message}",
+                        )
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+        total += len(rows)
+        if len(rows) < wc['reap_batch_size']:
+            return total
+
+
+def run_reaper(loop=False):
+    """Run one reap pass, or keep reaping every reap_interval seconds when loop is set."""
+    wc = configs.get_worker_config()
+    while True:
+        try:
+            reaped = reap_stale_transfers()
+            if reaped:
+                logging.info(f"Reaper handled {reaped} orphaned transfer(s)")
+        except Exception as e:
+            logging.error(f"Reaper pass failed: {e}")
+        if not loop:
+            return
+        time.sleep(wc['reap_interval'])
+
+
+# --- Release scheduled large transfers inside off-peak windows ---
+def release_scheduled_transfers(now=None):
+    """
+    While an [offpeak] window is open, publish 'scheduled' transfers whose not_before
+    has passed, oldest first, and set them to 'pending'. The followers of a
+    multi-target task (tee_lead_id) are released with their lead. With
+    max_concurrent_large set, only as many are released as keep the large upload
+    tasks that are pending or in progress under the cap; followers are not counted,
+    as their lead's task uploads them. Returns the number of tasks released.
+    Run a single releaser, as the cap is counted before rows are locked.
+    """
+    oc = configs.get_offpeak_config()
+    now = now or datetime.datetime.now()
+    if not offpeak.in_window(now, offpeak.parse_windows(oc['windows'])):
+        return 0
+
+    connection = db.get_connection()
+    try:
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            limit, params = '', (now,)
+            if oc['max_concurrent_large'] > 0:
+                cursor.execute("""SELECT COUNT(*) AS active FROM zenodo_transfers
+                                  WHERE status IN ('pending', 'in_progress') AND file_size > %s
+                                    AND tee_lead_id IS NULL""",
+                               (offpeak.min_file_bytes(),))
+                free = oc['max_concurrent_large'] - cursor.fetchone()['active']
+                if free <= 0:
+                    return 0
+                limit, params = 'LIMIT %s', (now, free)
+            sql = f"""SELECT id, task_payload FROM zenodo_transfers
+                      WHERE status = 'scheduled' AND not_before <= %s AND tee_lead_id IS NULL
+                      ORDER BY not_before, id {limit}
+                      FOR UPDATE SKIP LOCKED"""
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+            for row in rows:
+                ckan_zenodo.publish_task(json.loads(row['task_payload']))
+                cursor.execute(
+                    """UPDATE zenodo_transfers
+                       SET status='pending', not_before=NULL, task_payload=NULL
+                       WHERE id=%s""",
+                    (row['id'],),
+                )
+                cursor.execute(
+                    """UPDATE zenodo_transfers SET status='pending', not_before=NULL
+                       WHERE tee_lead_id=%s AND status='scheduled'""",
+                    (row['id'],),
+                )
+                logging.info(f"Released scheduled transfer {row['id']} into the upload queue")
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return len(rows)
+
+
+def run_releaser(loop=False):
+    """Run one release pass, or keep releasing every release_interval seconds when loop is set."""
+    oc = configs.get_offpeak_config()
+    while True:
+        try:
+            released = release_scheduled_transfers()
+            if released:
+                logging.info(f"Released {released} scheduled transfer(s)")
+        except Exception as e:
+            logging.error(f"Release pass failed: {e}")
+        if not loop:
+            return
+        time.sleep(oc['release_interval'])
+
+
+# --- Relay upload tasks from the transactional outbox ---
+def open_relay_channel():
+    """Open a RabbitMQ channel with publisher confirms for the outbox relay."""
+    if configs.get_queue_config()['backend'] == 'mysql':
+        return queue_backend.DBChannel(worker_id())
+    rc = configs.get_rabbitmq_config()
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=rc['host']))
+    channel = connection.channel()
+    for queue in scheduler.all_queues():
+        channel.queue_declare(queue=queue, durable=True)
+    channel.confirm_delivery()
+    return channel
+
+
+def relay_outbox(channel):
+    """
+    Publish transfer_outbox rows, oldest first, batch_size rows per transaction:
+    each task goes to its scheduler lane as a persistent, mandatory message, and
+    the batch is deleted only once the broker has confirmed every message in it.
+    If a publish is refused or fails the batch is rolled back and published again
+    on the next pass, so a task may be delivered twice but is never lost. Rows are
+    locked with SKIP LOCKED, so several relays can run side by side.
+    Returns the number of tasks published.
+    """
+    oc = configs.get_outbox_config()
+    total = 0
+
+    while True:
+        connection = db.get_connection()
+        try:
+            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute("""SELECT id, payload FROM transfer_outbox
+                                  ORDER BY id LIMIT %s
+                                  FOR UPDATE SKIP LOCKED""", (oc['batch_size'],))
+                rows = cursor.fetchall()
+                for row in rows:
+                    task = json.loads(row['payload'])
+                    queue = scheduler.lane_queue(task['username'], task.get('file_size'))
+                    channel.basic_publish(exchange='', routing_key=queue, body=row['payload'],
+                                          properties=pika.BasicProperties(delivery_mode=2), mandatory=True)
+                if rows:
+                    placeholders = ', '.join(['%s'] * len(rows))
+                    cursor.execute(f"DELETE FROM transfer_outbox WHERE id IN ({placeholders})",
+                                   tuple(row['id'] for row in rows))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+        total += len(rows)
+        if len(rows) < oc['batch_size']:
+            return total
+
+
+def run_relay(loop=False):
+    """
+    Drain the outbox once, or keep relaying when loop is set: the next pass starts
+    at once while the outbox was full, else after relay_interval seconds.
+    The channel is re-opened after a failed pass.
+    """
+    oc = configs.get_outbox_config()
+    channel = None
+    while True:
+        relayed = 0
+        try:
+            if channel is None or not channel.is_open:
+                channel = open_relay_channel()
+            relayed = relay_outbox(channel)
+            if relayed:
+                logging.info(f"Relayed {relayed} upload task(s) from the outbox")
+        except Exception as e:
+            logging.error(f"Relay pass failed: {e}")
+            if channel is not None:
+                try:
+                    channel.connection.close()
+                except Exception:
+                    pass
+            channel = None
+        if not loop:
+            return
+        if relayed < oc['batch_size']:
+            time.sleep(oc['relay_interval'])
+
+
+# --- Package export jobs ---
+def update_package_job(job_id, status, total=None, counts=None, message=None, version_deposition_id=None):
+    """
+    Record a package job's status and, when given, its resource total, its
+    queued/skipped/failed counts, its message and the draft of the new version
+    it exports to. A cancelled job stays cancelled.
+    """
+    fields, params = ["status=%s"], [status]
+    if total is not None:
+        fields.append("total=%s")
+        params.append(total)
+    if version_deposition_id is not None:
+        fields.append("version_deposition_id=%s")
+        params.append(version_deposition_id)
+    if counts is not None:
+        for name in ('queued', 'skipped', 'failed'):
+            fields.append(f"{name}=%s")
+            params.append(counts[name])
+    if message is not None:
+        fields.append("message=%s")
+        params.append(message)
+    params.append(job_id)
+
+    connection = db.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            sql = f"UPDATE package_jobs SET {', '.join(fields)} WHERE id=%s AND status <> 'cancelled'"
+            rows = cursor.execute(sql, tuple(params))
         connection.commit()
+        return rows
     finally:
         connection.close()
 
 
+def run_package_job(task, clock=time.monotonic):
+    """
+    Expand a package job: fetch the package from CKAN, look up the deposition name
+    once, stat all files in parallel, and export each resource as its own transfer, exactly as a single-resource
+    export would (duplicates are skipped, missing and oversized files counted as
+    failed). A 'sync' job instead skips the resources whose last transfer to the
+    deposition is unchanged (ckan_zenodo.resource_changed()) or still running,
+    and re-exports changed ones over their old file in the bucket. A 'newversion'
+    job first opens a new version of the published deposition, whose draft
+    inherits the files server-side; it deletes the draft's files that no longer
+    belong to the package, skips those whose size and MD5 still match
+    (ckan_zenodo.same_content()) and uploads the rest over them. A 'bundle' job
+    collects the files of at most [bundle] max_member_mb and, after the loop,
+    queues them as one transfer of a ZIP archive named after the package
+    (ckan_zenodo.create_bundle_transfer()); larger files are exported on their own.
+    The job's counts are written every progress_interval seconds and at
+    the end; if the user cancels the package meanwhile, expansion stops and the
+    transfers created so far are cancelled too. Returns the final counts.
+    """
+    wc = configs.get_worker_config()
+    job_id, package_id, deposition_id = task['job_id'], task['package_id'], task['deposition_id']
+    mode = task.get('mode', 'export')
+    token = task['zenodo_token']
+    user = {'username': task['username'], 'email': task.get('user_email', '')}
+
+    package = ckan_zenodo.get_ckan_package(package_id)
+    resources = package.get('resources', [])
+    draft_files, version_id = None, None
+    if mode == 'newversion':
+        draft = ckan_zenodo.create_new_version(token, deposition_id)
+        deposition_id = version_id = str(draft['id'])
+        deposition_name = draft['metadata']['title']
+        draft_files = {f['filename']: f for f in draft.get('files', [])}
+    else:
+        deposition_name = ckan_zenodo.get_deposition_name(token, deposition_id) if resources else None
+    if not update_package_job(job_id, 'expanding', total=len(resources), version_deposition_id=version_id):
+        logging.info(f"Package job {job_id} was cancelled before it started")
+        return None
+
+    # Stat all files in parallel; the checks in export_to_zenodo() then hit the preflight cache
+    paths = {res['id']: ckan_zenodo.get_file_path(res['id'], res['url']) for res in resources}
+    stats = preflight.stat_many(paths.values())
+    baseline = ckan_zenodo.get_sync_baseline(deposition_id, list(paths)) if mode == 'sync' else {}
+
+    bundle, max_member = None, None
+    if mode == 'bundle':
+        bundle = []
+        max_member = configs.get_bundle_config()['max_member_mb'] * 1024 * 1024
+
+    counts, errors = {'queued': 0, 'skipped': 0, 'failed': 0}, []
+    if draft_files:
+        names = {res['name'] for res in resources}
+        for removed in [f for name, f in draft_files.items() if name not in names]:
+            try:
+                ckan_zenodo.delete_deposition_file(token, deposition_id, removed['id'])
+                logging.info(f"New version {deposition_id}: deleted {removed['filename']}")
+            except Exception as e:
+                logging.error(f"Could not delete {removed['filename']} from deposition {deposition_id}: {e}")
+                errors.append(f"Could not delete: {removed['filename']}")
+
+    written_at = clock()
+    for res in resources:
+        last = baseline.get(res['id'])
+        remote = draft_files.get(res['name']) if draft_files else None
+        reason = None
+        if last is not None and last['status'] == 'completed':
+            reason = ckan_zenodo.resource_changed(res, last, stats[paths[res['id']]])
+        try:
+            if last is not None and reason is None:
+                # Unchanged, or its last transfer has not finished yet
+                counts['skipped'] += 1
+            elif remote is not None and ckan_zenodo.same_content(remote, res, paths[res['id']],
+                                                                 stats[paths[res['id']]]):
+                # The new version inherited it unchanged
+                counts['skipped'] += 1
+            elif bundle is not None and stats[paths[res['id']]].exists and \
+                    (max_member <= 0 or stats[paths[res['id']]].size <= max_member):
+                bundle.append({'resource_id': res['id'], 'name': res['name'], 'path': paths[res['id']],
+                               'size': stats[paths[res['id']]].size})
+            else:
+                if reason:
+                    logging.info(f"Sync of package {package_id}: re-exporting {res['name']} ({reason})")
+                ckan_zenodo.export_to_zenodo(token, res['id'], res['name'], res['url'], deposition_id,
+                                             package_id=package.get('id', package_id), user=user,
+                                             deposition_name=deposition_name, replace=last is not None,
+                                             **ckan_zenodo.source_version(res))
+                counts['queued'] += 1
+        except ckan_zenodo.DuplicateTransfer:
+            counts['skipped'] += 1
+        except ckan_zenodo.ResourceFileNotFound:
+            counts['failed'] += 1
+            errors.append(f"File not found: {res['name']}")
+        except ckan_zenodo.FileTooLarge:
+            counts['failed'] += 1
+            errors.append(f"File too large: {res['name']}")
+        except Exception as e:
+            logging.error(f"Error exporting resource {res.get('id')} of package {package_id}: {e}")
+            counts['failed'] += 1
+            errors.append(f"Error: {res['name']}")
+
+        if clock() - written_at >= wc['progress_interval']:
+            written_at = clock()
+            if not update_package_job(job_id, 'expanding', counts=counts):
+                logging.info(f"Package job {job_id} was cancelled; stopping after {sum(counts.values())} "
+                             f"of {len(resources)} resource(s)")
+                ckan_zenodo.cancel_package_transfers(package.get('id', package_id), user['username'])
+                return counts
+
+    if bundle:
+        _queue_bundle(package.get('id', package_id), package.get('name', package_id), bundle,
+                      token, deposition_id, deposition_name, user, counts, errors)
+
+    if not resources:
+        message = "No resources found in this package."
+    else:
+        message = "; ".join(errors)
+    if not update_package_job(job_id, 'completed', counts=counts, message=message):
+        ckan_zenodo.cancel_package_transfers(package.get('id', package_id), user['username'])
+        return counts
+    logging.info(f"Package job {job_id} ({mode}) expanded: {counts['queued']} queued, {counts['skipped']} skipped, "
+                 f"{counts['failed']} failed (package={package_id}, user={user['username']})")
+    return counts
+
+
+def _queue_bundle(package_id, package_name, members, token, deposition_id, deposition_name, user,
+                  counts, errors):
+    """Queue the files collected by a bundle job as one archive transfer, counting them in counts."""
+    for member, name in zip(members, ckan_zenodo.bundle_member_names([m['name'] for m in members])):
+        member['name'] = name
+    filename = f"{package_name}.zip"
+    try:
+        ckan_zenodo.create_bundle_transfer(user['username'], token, deposition_id, deposition_name, filename,
+                                           members, user['email'], package_id=package_id)
+        counts['queued'] += len(members)
+    except ckan_zenodo.DuplicateTransfer:
+        counts['skipped'] += len(members)
+    except ckan_zenodo.FileTooLarge:
+        counts['failed'] += len(members)
+        errors.append(f"Archive too large: {filename}")
+    except Exception as e:
+        logging.error(f"Error queueing the archive {filename} of package {package_id}: {e}")
+        counts['failed'] += len(members)
+        errors.append(f"Error: {filename}")
+
+
+def _package_callback(ch, method, task):
+    """Run a package job message, mark the job failed if it cannot be expanded, and ack it."""
+    try:
+        run_package_job(task)
+    except Exception as e:
+        logging.error(f"Package job {task.get('job_id')} failed: {e}")
+        try:
+            update_package_job(task['job_id'], 'failed', message=f"Could not expand the package: {e}")
+        except Exception as db_err:
+            logging.error(f"Could not mark package job {task.get('job_id')} as failed: {db_err}")
+        send_email_notification(
+            task.get('user_email', ''),
+            f"Package export failed: {task.get('package_id')}",
+            f"The export of package '{task.get('package_id')}' to Zenodo could not be started. Error: {e}",
+        )
+    finally:
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
 # --- Upload a file to Zenodo deposition bucket ---
-def upload_to_zenodo(file_path, filename, zenodo_token, deposition_id):
+def upload_to_zenodo(file_path, filename, zenodo_token, deposition_id, progress=None):
     """
     Upload a local file to the Zenodo deposition storage bucket.
 
@@ -58,37 +777,233 @@ def upload_to_zenodo(file_path, filename, zenodo_token, deposition_id):
         1. Fetch the bucket URL for the deposition.
         2. Upload the file using HTTP PUT request.
 
+    Every request uses the configured connect/read timeouts. When min_upload_kbps
+    is set, a watchdog aborts the PUT with UploadStalled if throughput stays below
+    it for stall_seconds, so a crawling connection cannot hold the worker forever.
+    Both requests are paced by the per-token rate limiter, and the PUT waits for
+    one of the token's concurrent upload slots. The file is streamed in
+    upload_block_kb blocks; progress(bytes_sent, size) is called after each one
+    (by default the progress is logged every 30 seconds).
+
     Returns:
         str: Zenodo API response text after upload.
     """
     zc = configs.get_zenodo_config()
-    zenodo_api_url = zc['api_url']
+    body = FileBody(file_path, block_size=zc['upload_block_kb'] * 1024, watchdog=_watchdog(zc),
+                    progress=progress or ProgressLog(filename), drop_cache=zc['upload_drop_cache'])
+    return _put_to_bucket(body, filename, zenodo_token, deposition_id)
+
+
+# --- Upload many files to a deposition bucket as one ZIP archive ---
+def upload_bundle_to_zenodo(members, filename, zenodo_token, deposition_id, progress=None):
+    """
+    Upload local files to the deposition bucket as a single ZIP archive named
+    filename, built while it is sent (a ZipBody, see upload_stream.py): no
+    archive is written to disk and memory does not grow with the files' size.
+    members are (name in the archive, file path) pairs. Timeouts, the stall
+    watchdog, the rate limiter and progress work as in upload_to_zenodo().
+
+    Returns:
+        tuple: Zenodo's response text and the archive's manifest (name, size,
+        crc32 and offset of each member).
+    """
+    zc = configs.get_zenodo_config()
+    body = ZipBody(members, block_size=zc['upload_block_kb'] * 1024, watchdog=_watchdog(zc),
+                   progress=progress or ProgressLog(filename), drop_cache=zc['upload_drop_cache'])
+    return _put_to_bucket(body, filename, zenodo_token, deposition_id), body.manifest
 
-    headers = {"Content-Type": "application/json"}
+
+def _watchdog(zc):
+    if zc['min_upload_kbps'] > 0:
+        return ThroughputWatchdog(zc['min_upload_kbps'] * 1024, zc['stall_seconds'])
+    return None
+
+
+def _put_to_bucket(body, filename, zenodo_token, deposition_id):
+    """Look up the deposition's bucket and PUT body to it as filename; returns Zenodo's response text."""
+    zc = configs.get_zenodo_config()
     params = {'access_token': zenodo_token}
+    timeout = ckan_zenodo.zenodo_timeout()
+    limiter = rate_limiter.get_limiter()
 
-    r = requests.get(f"{zenodo_api_url}/{deposition_id}", params=params, headers=headers)
+    limiter.acquire(zenodo_token)
+    r = requests.get(f"{zc['api_url']}/{deposition_id}", params=params,
+                     headers={"Content-Type": "application/json"}, timeout=timeout)
     r.raise_for_status()
     bucket_url = r.json()['links']['bucket']
 
-    with open(file_path, "rb") as fp:
-        r = requests.put(f"{bucket_url}/{filename}", data=fp, params=params)
-        r.raise_for_status()
+    with limiter.upload_slot(zenodo_token):
+        limiter.acquire(zenodo_token)
+        try:
+            r = requests.put(f"{bucket_url}/{filename}", data=body, params=params, timeout=timeout)
+        except requests.exceptions.ConnectionError as e:
+            if body.abort_error:
+                raise body.abort_error from e
+            raise
+    r.raise_for_status()
 
     return r.text
 
 
+# --- Upload a file to several deposition buckets, reading it once ---
+def tee_upload(file_path, filename, zenodo_token, targets, progress=None):
+    """
+    Upload a local file to the buckets of several depositions at the same time,
+    reading it only once: each target's PUT runs in its own thread and is fed
+    from a branch of a TeeBody (see upload_stream.py), at most
+    [zenodo] tee_buffer_blocks blocks ahead of the slowest target. Timeouts, the
+    stall watchdog and the rate limiter apply to each request as in
+    upload_to_zenodo(); the whole tee takes one of the token's upload slots.
+    targets are the task's target dicts; progress(target), if given, returns
+    the progress callback of that target's upload.
+
+    Returns:
+        dict: transfer_id -> Zenodo's response text, or the exception that target's upload failed with.
+    """
+    zc = configs.get_zenodo_config()
+    params = {'access_token': zenodo_token}
+    timeout = ckan_zenodo.zenodo_timeout()
+    limiter = rate_limiter.get_limiter()
+
+    results, buckets = {}, {}
+    for target in targets:
+        try:
+            limiter.acquire(zenodo_token)
+            r = requests.get(f"{zc['api_url']}/{target['deposition_id']}", params=params,
+                             headers={"Content-Type": "application/json"}, timeout=timeout)
+            r.raise_for_status()
+            buckets[target['transfer_id']] = r.json()['links']['bucket']
+        except Exception as e:
+            results[target['transfer_id']] = e
+    live = [target for target in targets if target['transfer_id'] in buckets]
+    if not live:
+        return results
+
+    tee = TeeBody(file_path, block_size=zc['upload_block_kb'] * 1024, buffer_blocks=zc['tee_buffer_blocks'],
+                  drop_cache=zc['upload_drop_cache'])
+    branches = {}
+    for target in live:
+        branches[target['transfer_id']] = tee.branch(
+            watchdog=_watchdog(zc),
+            progress=progress(target) if progress else ProgressLog(f"{filename} -> {target['deposition_id']}"))
+
+    def put(transfer_id):
+        branch = branches[transfer_id]
+        try:
+            limiter.acquire(zenodo_token)
+            r = requests.put(f"{buckets[transfer_id]}/{filename}", data=branch, params=params, timeout=timeout)
+            r.raise_for_status()
+            results[transfer_id] = r.text
+        except requests.exceptions.ConnectionError as e:
+            results[transfer_id] = branch.abort_error or e
+        except Exception as e:
+            results[transfer_id] = e
+        finally:
+            branch.close()
+
+    with limiter.upload_slot(zenodo_token):
+        threads = [threading.Thread(target=put, args=(transfer_id,), name=f'tee-{transfer_id}', daemon=True)
+                   for transfer_id in branches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    tee.join()
+    return results
+
+
+def _open_targets(targets):
+    """The targets whose transfer is neither completed nor cancelled; all of them if that cannot be checked."""
+    try:
+        connection = db.get_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"""SELECT id FROM zenodo_transfers
+                                   WHERE id IN ({', '.join(['%s'] * len(targets))})
+                                     AND status IN ('completed', 'cancelled')""",
+                               tuple(target['transfer_id'] for target in targets))
+                done = {row[0] for row in cursor.fetchall()}
+        finally:
+            connection.close()
+    except Exception as e:
+        logging.warning(f"Could not check the targets of transfer {targets[0]['transfer_id']}: {e}")
+        return targets
+    return [target for target in targets if target['transfer_id'] not in done]
+
+
+def _retarget(task, targets):
+    """Make a multi-target task upload only to targets, led by the first of them."""
+    lead = targets[0]
+    task.update(targets=targets, transfer_id=lead['transfer_id'], deposition_id=lead['deposition_id'],
+                deposition_name=lead['deposition_name'])
+
+
+def _tee_attempt(task, upload_path, retry_count):
+    """
+    Run one attempt of a multi-target task. Targets that complete are marked
+    completed; if any failed, the task is narrowed to them and the first error
+    raised, so the retry handling in callback() applies to just those.
+    Returns the deposition IDs uploaded to.
+    """
+    results = tee_upload(upload_path, task['filename'], task['zenodo_token'], task['targets'],
+                         progress=lambda target: ProgressRecorder(target['transfer_id'], task['filename']))
+    completed, failed = [], []
+    for target in task['targets']:
+        result = results[target['transfer_id']]
+        if isinstance(result, ckan_zenodo.TransferCancelled):
+            logging.info(f"Upload of {task['filename']} to deposition {target['deposition_id']} aborted: "
+                         f"transfer {target['transfer_id']} was cancelled")
+        elif isinstance(result, Exception):
+            failed.append((target, result))
+        else:
+            update_transfer_status(target['transfer_id'], 'completed', result, retry_count)
+            completed.append(target['deposition_id'])
+    if failed:
+        _retarget(task, [target for target, _ in failed])
+        raise failed[0][1]
+    if not completed:
+        raise ckan_zenodo.TransferCancelled(f"All transfers of {task['filename']} were cancelled")
+    return completed
+
+
+def _bundle_attempt(task):
+    """Run one attempt of a bundle task: stream its members as one archive and record the manifest."""
+    transfer_id = task['transfer_id']
+    members = load_bundle_members(transfer_id)
+    response, manifest = upload_bundle_to_zenodo([(member['name'], member['path']) for member in members],
+                                                 task['filename'], task['zenodo_token'], task['deposition_id'],
+                                                 progress=ProgressRecorder(transfer_id, task['filename']))
+    record_bundle_manifest(transfer_id, members, manifest)
+    return response
+
+
 # --- RabbitMQ consumer callback ---
 def callback(ch, method, properties, body):
     """
     Process a single upload task from the queue.
 
-    On failure, re-queues with an incremented retry_count and exponential backoff
-    up to max_retries times. After all attempts are exhausted, marks the transfer
-    as 'failed'. Always acknowledges the message so it is removed from the queue.
-    Sends an email notification on completion or final failure if configured.
+    On failure, the retry policy (see retry_policy.py) classifies the error: permanent
+    errors fail the transfer at once; others are re-queued with an incremented
+    retry_count after the policy's delay, up to max_retries times. After all
+    attempts are exhausted, marks the transfer as 'failed'. The classification is
+    stored in the transfer's error_class column. Acknowledges the message so it is removed from the queue, except
+    while the Zenodo circuit breaker is open: then the message is nacked back onto
+    the queue unchanged (no retry used) and this consumer pauses until the open
+    period ends. Tasks of cancelled transfers are acknowledged without uploading,
+    and an upload whose transfer is cancelled meanwhile is aborted. A task whose
+    transfer is finished or claimed by another live worker (Heartbeat) is
+    acknowledged and dropped: it is a duplicate delivery. Sends an email
+    notification on completion or final failure if configured. Package job
+    messages are expanded into transfers by run_package_job() instead. A task
+    with several targets uploads to all of them reading the file once
+    (tee_upload()); cancelled targets are dropped and only failed ones retried.
+    A bundle task uploads the files listed in its transfer's manifest as one
+    ZIP archive (upload_bundle_to_zenodo()).
     """
     task = json.loads(body)
+    if task.get('type') == 'package':
+        _package_callback(ch, method, task)
+        return
     username = task['username']
     file_path = task['file_path']
     filename = task['filename']
@@ -101,79 +1016,327 @@ def callback(ch, method, properties, body):
     rc = configs.get_rabbitmq_config()
     max_retries = int(rc.get('max_retries', 3))
 
+    if task.get('targets'):
+        # A redelivered task may list targets that completed or were cancelled since
+        targets = _open_targets(task['targets'])
+        if not targets:
+            logging.info(f"All transfers of task {transfer_id} completed or were cancelled; dropping it")
+            _discard(file_path)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        _retarget(task, targets)
+        transfer_id, deposition_id = task['transfer_id'], task['deposition_id']
+    elif _cancelled(transfer_id):
+        logging.info(f"Transfer {transfer_id} was cancelled; dropping its task")
+        _discard(file_path)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
+
+    breaker = circuit_breaker.get_breaker()
+    if breaker and not breaker.allow():
+        logging.warning(f"Zenodo circuit is {breaker.state()}; returning transfer {transfer_id} to the queue")
+        _discard(file_path)
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        pause_consuming(ch, method.consumer_tag, breaker.retry_after())
+        return
+
     logging.info(
         f"Processing: {filename} (transfer_id={transfer_id}, "
         f"attempt={retry_count + 1}/{max_retries + 1}, user={username})"
     )
 
+    requeued = False
+    started = time.monotonic()
     try:
-        update_transfer_status(transfer_id, 'in_progress', '', retry_count)
-        response = upload_to_zenodo(file_path, filename, zenodo_token, deposition_id)
-        update_transfer_status(transfer_id, 'completed', response, retry_count)
-        logging.info(f"Upload completed: {filename} -> deposition {deposition_id} (user={username})")
+        with Heartbeat(transfer_id, json.dumps(task)), _staged(file_path) as upload_path:
+            update_targets_status(task, 'in_progress', '', retry_count)
+            started = time.monotonic()
+            if task.get('targets'):
+                deposition_ids = _tee_attempt(task, upload_path, retry_count)
+            else:
+                if task.get('bundle'):
+                    response = _bundle_attempt(task)
+                else:
+                    response = upload_to_zenodo(upload_path, filename, zenodo_token, deposition_id,
+                                                progress=ProgressRecorder(transfer_id, filename))
+                update_transfer_status(transfer_id, 'completed', response, retry_count)
+                deposition_ids = [deposition_id]
+        if breaker:
+            breaker.record(True, time.monotonic() - started)
+        deposition_ids = ', '.join(str(d) for d in deposition_ids)
+        logging.info(f"Upload completed: {filename} -> deposition {deposition_ids} (user={username})")
         send_email_notification(
             user_email,
             f"Transfer completed: {filename}",
-            f"Your file '{filename}' was successfully uploaded to Zenodo deposition {deposition_id}."
+            f"Your file '{filename}' was successfully uploaded to Zenodo deposition {deposition_ids}."
         )
 
+    except ckan_zenodo.TransferCancelled:
+        logging.info(f"Upload of {filename} aborted: transfer {transfer_id} was cancelled (user={username})")
+        if breaker:
+            breaker.abandon_probe()
+
+    except TransferOwned:
+        # A duplicate delivery: re-published by the reaper, and the original redelivered too
+        logging.info(f"Transfer {transfer_id} is finished or being uploaded by another worker; "
+                     f"dropping this copy of its task")
+        _discard(file_path)
+        if breaker:
+            breaker.abandon_probe()
+
     except Exception as e:
         logging.error(f"Upload attempt {retry_count + 1} failed for transfer {transfer_id}: {e}")
+        zenodo_fault = circuit_breaker.is_zenodo_fault(e)
+        if breaker and zenodo_fault:
+            breaker.record(False, time.monotonic() - started)
+        elif breaker:
+            breaker.abandon_probe()
 
-        if retry_count < max_retries:
+        decision = retry_policy.load_policy().decide(e, retry_count, max_retries)
+
+        if breaker and zenodo_fault and breaker.state() != circuit_breaker.CLOSED:
+            # Zenodo is down for everyone: hand the task back untouched instead of spending a retry
+            requeued = True
+            try:
+                update_targets_status(
+                    task, 'pending',
+                    f"Zenodo unavailable, waiting to resume: {e}",
+                    retry_count,
+                    error_class=decision.error_class,
+                )
+            except Exception as db_err:
+                logging.error(f"Could not update status for transfer {transfer_id}: {db_err}")
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            pause_consuming(ch, method.consumer_tag, breaker.retry_after())
+        elif decision.retry:
             next_attempt = retry_count + 1
-            # Exponential backoff: 10s, 20s, 40s … capped at 5 minutes
-            delay = min(2 ** retry_count * 10, 300)
-            logging.info(f"Retrying in {delay}s (attempt {next_attempt}/{max_retries}) ...")
-            time.sleep(delay)
+            logging.info(f"Retrying {decision.error_class} error in {decision.delay:.0f}s "
+                         f"(attempt {next_attempt}/{max_retries}) ...")
+            time.sleep(decision.delay)
 
             task['retry_count'] = next_attempt
-            ch.basic_publish(
-                exchange='',
-                routing_key=rc['queue'],
-                body=json.dumps(task),
-                properties=pika.BasicProperties(delivery_mode=2),
-            )
             try:
-                update_transfer_status(
-                    transfer_id, 'pending',
+                update_targets_status(
+                    task, 'pending',
                     f"Retry {next_attempt}/{max_retries}: {e}",
                     next_attempt,
+                    error_class=decision.error_class,
                 )
             except Exception as db_err:
                 logging.error(f"Could not update retry status for transfer {transfer_id}: {db_err}")
+            _requeue(ch, task)
         else:
-            logging.error(f"All {max_retries + 1} attempts exhausted for transfer {transfer_id}")
+            if decision.error_class == retry_policy.PERMANENT:
+                logging.error(f"Permanent error for transfer {transfer_id}; not retrying")
+                reason = "could not be uploaded to Zenodo"
+            else:
+                logging.error(f"All {max_retries + 1} attempts exhausted for transfer {transfer_id}")
+                reason = "failed to upload to Zenodo after all retry attempts"
             try:
-                update_transfer_status(transfer_id, 'failed', str(e), retry_count)
+                update_targets_status(task, 'failed', str(e), retry_count,
+                                      error_class=decision.error_class)
             except Exception as db_err:
                 logging.error(f"Could not mark transfer {transfer_id} as failed: {db_err}")
             send_email_notification(
                 user_email,
                 f"Transfer failed: {filename}",
-                f"Your file '{filename}' failed to upload to Zenodo after all retry attempts. "
-                f"Error: {e}"
+                f"Your file '{filename}' {reason}. Error: {e}"
             )
 
     finally:
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        if not requeued:
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
+# --- Consumer control ---
+# Set by start_worker(): deliveries are buffered here and served to the upload slots
+_scheduler = None
+_stager = None
+_consumer_queues = {}
+_paused = set()
+_paused_lock = threading.Lock()
+
+
+class ThreadSafeChannel:
+    """
+    Channel stand-in for the upload slot threads. A pika channel may only be used
+    from its connection's thread, so every call is handed over with
+    add_callback_threadsafe and runs on the next turn of the I/O loop.
+    """
+
+    def __init__(self, channel):
+        self._channel = channel
+        self.connection = _ThreadSafeConnection(channel.connection)
+
+    def __getattr__(self, name):
+        target = getattr(self._channel, name)
+
+        def call(*args, **kwargs):
+            self._channel.connection.add_callback_threadsafe(lambda: target(*args, **kwargs))
+        return call
+
+
+class _ThreadSafeConnection:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def call_later(self, delay, fn):
+        self._connection.add_callback_threadsafe(lambda: self._connection.call_later(delay, fn))
+
+
+def _on_message(ch, method, properties, body):
+    """Runs on the connection thread: buffer the delivery for the fair-share scheduler."""
+    try:
+        task = json.loads(body)
+    except ValueError:
+        task = {}
+    _scheduler.submit(task.get('username', ''), (method, properties, body),
+                      small=scheduler.is_small(task.get('file_size')))
+    _prefetch()
+
+
+def _prefetch():
+    """Start copying the files of the next buffered tasks to scratch (no-op without [staging])."""
+    if _stager is None:
+        return
+    for _, _, body in _scheduler.peek(_stager.prefetch_files):
+        try:
+            task = json.loads(body)
+            if not task.get('bundle'):
+                _stager.prefetch(task['file_path'])
+        except (ValueError, KeyError):
+            continue
+
+
+def _staged(file_path):
+    """Context manager yielding the path to upload file_path from (a staged copy, if any)."""
+    return _stager.staged(file_path) if _stager else contextlib.nullcontext(file_path)
+
+
+def _discard(file_path):
+    """Release the staged copy of a task that is dropped or handed back without being uploaded."""
+    if _stager:
+        _stager.discard(file_path)
+
+
+def run_upload_slot(ch, small_only=False):
+    """Upload slot thread: run the tasks the scheduler hands out until it is closed."""
+    while True:
+        picked = _scheduler.next(small_only=small_only)
+        if picked is None:
+            return
+        user, (method, properties, body) = picked
+        _prefetch()
+        try:
+            callback(ch, method, properties, body)
+        except Exception as e:
+            logging.error(f"Unhandled error processing a task for {user}: {e}")
+        finally:
+            _scheduler.done(user, small_only=small_only)
+
+
+def start_consuming(ch, queue=None):
+    queue = queue or configs.get_rabbitmq_config()['queue']
+    consumer_tag = f"{worker_id()}:{queue}"
+    _consumer_queues[consumer_tag] = queue
+    with _paused_lock:
+        _paused.discard(consumer_tag)
+    ch.basic_consume(queue=queue, on_message_callback=_on_message if _scheduler else callback,
+                     consumer_tag=consumer_tag)
+
+
+def pause_consuming(ch, consumer_tag, seconds):
+    """
+    Stop receiving messages from this consumer's queue for the given number of
+    seconds, so a worker does not spin on requeued tasks while the circuit is
+    open. Pausing an already paused consumer does nothing.
+    """
+    with _paused_lock:
+        if consumer_tag in _paused:
+            return
+        _paused.add(consumer_tag)
+    queue = _consumer_queues.get(consumer_tag)
+    logging.warning(f"Pausing consumption of {queue or 'the upload queue'} for {seconds:.0f}s")
+    ch.basic_cancel(consumer_tag)
+    ch.connection.call_later(seconds, lambda: start_consuming(ch, queue))
 
 
 # --- Worker entrypoint ---
 def start_worker():
     """
-    Start a RabbitMQ worker that listens for Zenodo upload tasks.
+    Start a worker that listens for Zenodo upload tasks.
+
+    The worker consumes every scheduler lane plus the plain upload queue, buffers
+    up to prefetch_per_lane deliveries per lane and runs them in upload_slots
+    threads in fair-share order (see scheduler.py). When the small-file lane is
+    enabled, reserved_small_slots of those threads only take small files. With
+    [staging] scratch_dir set, files of buffered tasks are copied to local scratch
+    ahead of their upload (see staging.py). With [queue] backend = mysql the tasks
+    are claimed from the upload_jobs table instead of RabbitMQ (see queue_backend.py).
     """
+    global _scheduler, _stager
     rc = configs.get_rabbitmq_config()
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=rc['host']))
-    channel = connection.channel()
-    channel.queue_declare(queue=rc['queue'], durable=True)
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(queue=rc['queue'], on_message_callback=callback)
+    sc = configs.get_scheduler_config()
+    qc = configs.get_queue_config()
+    if qc['backend'] == 'mysql':
+        channel = queue_backend.DBChannel(worker_id(), poll_interval=qc['poll_interval'],
+                                          visibility_timeout=qc['visibility_timeout'])
+    else:
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=rc['host']))
+        channel = connection.channel()
+    queues = scheduler.all_queues()
+    for queue in queues:
+        channel.queue_declare(queue=queue, durable=True)
+    channel.basic_qos(prefetch_count=sc['prefetch_per_lane'])
+
+    _scheduler = scheduler.FairScheduler(
+        max_uploads_per_user=sc['max_uploads_per_user'],
+        weights=scheduler.parse_weights(sc['user_weights']),
+    )
+    _stager = staging.get_stager()
+    slot_channel = ThreadSafeChannel(channel)
+    small_slots = max(sc['reserved_small_slots'], 0) if sc['small_file_mb'] > 0 else 0
+    general_slots = max(sc['upload_slots'] - small_slots, 1)
+    for n in range(general_slots):
+        threading.Thread(target=run_upload_slot, args=(slot_channel,), name=f'upload-slot-{n}',
+                         daemon=True).start()
+    for n in range(small_slots):
+        threading.Thread(target=run_upload_slot, args=(slot_channel, True), name=f'small-upload-slot-{n}',
+                         daemon=True).start()
+    for queue in queues:
+        start_consuming(channel, queue)
 
-    logging.info('Worker started. Waiting for upload tasks.')
-    channel.start_consuming()
+    logging.info(f"Worker started with {general_slots} upload slot(s) and {small_slots} small-file slot(s) "
+                 f"on {len(queues)} queue(s). Waiting for upload tasks.")
+    try:
+        channel.start_consuming()
+    finally:
+        _scheduler.close()
+        if _stager:
+            _stager.close()
 
 
 if __name__ == '__main__':
-    start_worker()
+    parser = argparse.ArgumentParser(description='Zenodo upload worker')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('consume', help='Consume upload tasks from the queue (default)')
+    reap_parser = subparsers.add_parser('reap', help='Re-enqueue transfers orphaned by dead workers')
+    reap_parser.add_argument('--loop', action='store_true',
+                             help='Keep running, one pass every [worker] reap_interval seconds')
+    release_parser = subparsers.add_parser('release',
+                                           help='Queue scheduled large transfers inside off-peak windows')
+    release_parser.add_argument('--loop', action='store_true',
+                                help='Keep running, one pass every [offpeak] release_interval seconds')
+    relay_parser = subparsers.add_parser('relay', help='Publish upload tasks written to the outbox')
+    relay_parser.add_argument('--loop', action='store_true',
+                              help='Keep running, polling every [outbox] relay_interval seconds when idle')
+    args = parser.parse_args()
+
+    if args.command == 'reap':
+        run_reaper(loop=args.loop)
+    elif args.command == 'release':
+        run_releaser(loop=args.loop)
+    elif args.command == 'relay':
+        run_relay(loop=args.loop)
+    else:
+        start_worker()